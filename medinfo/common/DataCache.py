@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Bounded in memory data cache, to store (database query) results for reuse by long running processes
+(e.g., web server recommender instances) without unbounded memory growth.
+"""
+
+import sys, os
+import time;
+import threading;
+from collections import OrderedDict;
+
+from .Util import log;
+
+# Default memory budget for cache contents (bytes)
+DEFAULT_MAX_BYTES = 1024*1024*1024;
+
+class DataCache:
+    """Drop-in replacement for a plain dict() data cache (supports the usual get / set / in / del operations),
+    but bounded by an (estimated) byte size budget, evicting the least recently used entries as needed.
+
+    Entries can also expire after a time to live (ttl, seconds), set as a default for the cache or per entry,
+    and can be tagged with keys (e.g., the data_cache table keys that AssociationAnalysis clears when the
+    association statistics change) so that all entries depending on that data can be invalidated together.
+
+    Tracks hit, miss, eviction, expiration and invalidation counts to help tune the budget.
+
+    Thread safe, as may be shared by concurrent (web server) request threads.  Every public method holds the same reentrant lock,
+    so compound steps (e.g., a lookup that discards an expired entry or moves it to the most recently used end) are not interleaved.
+    """
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES, ttl=None, defaultTags=None, timer=time.time):
+        self.maxBytes = maxBytes;   # If None, no size limit
+        self.ttl = ttl; # Default time to live for entries in seconds.  If None, no expiration
+        self.defaultTags = frozenset(defaultTags or ());    # Tags to apply to any entries stored without explicit tags
+        self.timer = timer;
+        self.lock = threading.RLock();
+
+        self.entries = OrderedDict();   # key -> (value, nBytes, expireTime, tags) in least to most recently used order
+        self.keysByTag = dict();
+        self.nBytes = 0;
+
+        self.hits = 0;
+        self.misses = 0;
+        self.evictions = 0;
+        self.expirations = 0;
+        self.invalidations = 0;
+
+    def __getstate__(self):
+        state = dict(self.__dict__);
+        del state["lock"];  # Locks cannot be pickled
+        return state;
+
+    def __setstate__(self, state):
+        self.__dict__.update(state);
+        self.lock = threading.RLock();
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries);
+
+    def __contains__(self, key):
+        return self.lookup(key, countStats=False) is not None;
+
+    def __getitem__(self, key):
+        entry = self.lookup(key);
+        if entry is None:
+            raise KeyError(key);
+        return entry[0];
+
+    def get(self, key, default=None):
+        entry = self.lookup(key);
+        if entry is None:
+            return default;
+        return entry[0];
+
+    def __setitem__(self, key, value):
+        self.set(key, value);
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.entries:
+                raise KeyError(key);
+            self.remove(key);
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = default;
+            if key in self.entries:
+                value = self.entries[key][0];
+                self.remove(key);
+            return value;
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys());
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear();
+            self.keysByTag.clear();
+            self.nBytes = 0;
+
+    def lookup(self, key, countStats=True):
+        """Return the (value, nBytes, expireTime, tags) entry for the key, marking it as most recently used.
+        None if not found or expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key);
+            if entry is not None and entry[2] is not None and entry[2] <= self.timer():
+                self.remove(key);
+                self.expirations += 1;
+                entry = None;
+            if entry is None:
+                if countStats: self.misses += 1;
+                return None;
+            self.entries.move_to_end(key);
+            if countStats: self.hits += 1;
+            return entry;
+
+    def set(self, key, value, ttl=None, tags=None, nBytes=None):
+        """Store the value under the key, with an optional time to live (seconds) and tags to support invalidation.
+        If tags not specified, keep the tags of any existing entry for the key (e.g., storing an updated value again),
+        otherwise use the defaultTags.
+        If nBytes not specified, will estimate the memory size of the value.
+        Returns True if stored, or False if the value alone exceeds the cache memory budget.
+        """
+        if nBytes is None:
+            nBytes = estimateSize(value);   # Before taking the lock, as may take a while for large values
+        with self.lock:
+            if key in self.entries:
+                if tags is None:
+                    tags = self.entries[key][3];
+                self.remove(key);
+            if ttl is None:
+                ttl = self.ttl;
+            expireTime = None;
+            if ttl is not None:
+                expireTime = self.timer() + ttl;
+            if tags is None:
+                tags = self.defaultTags;
+            tags = frozenset(tags);
+
+            if self.maxBytes is not None and nBytes > self.maxBytes:
+                log.warning("Cache entry of %d bytes exceeds the cache budget of %d bytes.  Not storing." % (nBytes, self.maxBytes) );
+                self.evictions += 1;
+                return False;
+
+            self.entries[key] = (value, nBytes, expireTime, tags);
+            self.nBytes += nBytes;
+            for tag in tags:
+                self.keysByTag.setdefault(tag, set()).add(key);
+            self.evict();
+            return True;
+
+    def remove(self, key):
+        """Discard the entry for the key.  Raises KeyError if there is none"""
+        with self.lock:
+            (value, nBytes, expireTime, tags) = self.entries.pop(key);
+            self.nBytes -= nBytes;
+            for tag in tags:
+                tagKeys = self.keysByTag.get(tag);
+                if tagKeys is not None:
+                    tagKeys.discard(key);
+                    if not tagKeys:
+                        del self.keysByTag[tag];
+
+    def evict(self):
+        """Discard least recently used entries until within the memory budget"""
+        with self.lock:
+            if self.maxBytes is None:
+                return;
+            while self.nBytes > self.maxBytes and self.entries:
+                key = next(iter(self.entries));
+                self.remove(key);
+                self.evictions += 1;
+
+    def invalidate(self, tag):
+        """Discard all entries stored with the given tag.  Returns the number of entries discarded."""
+        with self.lock:
+            keys = list(self.keysByTag.get(tag, ()));
+            for key in keys:
+                self.remove(key);
+            self.invalidations += len(keys);
+            return len(keys);
+
+    def stats(self):
+        """Dictionary of cache usage statistics"""
+        with self.lock:
+            return \
+                {   "entries": len(self.entries),
+                    "nBytes": self.nBytes,
+                    "maxBytes": self.maxBytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations,
+                };
+
+def estimateSize(value, seenIds=None):
+    """Rough estimate of the memory size in bytes of a value, including the contents of
+    (nested) containers, numpy arrays and simple object attributes.  Objects are only counted once.
+    """
+    if seenIds is None:
+        seenIds = set();
+    if id(value) in seenIds:
+        return 0;
+    seenIds.add(id(value));
+
+    nBytes = sys.getsizeof(value);
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        pass;
+    elif hasattr(value, "nbytes") and hasattr(value, "dtype"):  # numpy array
+        if getattr(value, "base", None) is None:
+            nBytes = max(nBytes, int(value.nbytes));
+    elif isinstance(value, dict):
+        for itemKey, itemValue in value.items():
+            nBytes += estimateSize(itemKey, seenIds) + estimateSize(itemValue, seenIds);
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            nBytes += estimateSize(item, seenIds);
+    elif hasattr(value, "__dict__"):
+        nBytes += estimateSize(value.__dict__, seenIds);
+    return nBytes;
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Order statistics index over a changing collection of sortable keys,
+to find the rank (sorted position) of any key without re-sorting the whole collection after every change.
+"""
+
+import sys, os
+from bisect import bisect_left, insort;
+
+# Target number of keys per bucket.  Buckets are split when they grow to twice this size
+DEFAULT_BUCKET_SIZE = 256;
+
+class RankIndex:
+    """Sorted multiset of keys (any mutually comparable values, e.g., tuples), supporting
+    add, remove and rank (number of keys sorting before a given key) in about O(log n) steps.
+
+    Keys are kept in a list of sorted buckets, each at most twice the bucket size,
+    with a Fenwick (binary indexed) tree over the bucket lengths.
+    So the rank of a key is a prefix sum of the bucket lengths before its bucket, plus its position within its bucket,
+    and adding or removing a key only shifts the elements of one (small) bucket,
+    rather than every key after it, as would inserting into or deleting from one flat sorted array.
+    """
+    def __init__(self, keys=None, bucketSize=DEFAULT_BUCKET_SIZE):
+        self.bucketSize = bucketSize;
+        self.buckets = list();  # Sorted lists of keys, in order
+        self.maxKeys = list();  # Last (largest) key of each bucket, to find which bucket a key belongs in
+        self.tree = list();     # Fenwick tree over the bucket lengths (1-based, tree[0] unused)
+        self.nKeys = 0;
+        if keys:
+            self.rebuild(sorted(keys));
+
+    def __len__(self):
+        return self.nKeys;
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            for key in bucket:
+                yield key;
+
+    def __contains__(self, key):
+        iBucket = bisect_left(self.maxKeys, key);
+        if iBucket >= len(self.buckets):
+            return False;
+        bucket = self.buckets[iBucket];
+        iKey = bisect_left(bucket, key);
+        return iKey < len(bucket) and bucket[iKey] == key;
+
+    def rebuild(self, sortedKeys):
+        """Repartition the (already sorted) keys into evenly filled buckets and rebuild the bucket length tree"""
+        self.buckets = [sortedKeys[i:i+self.bucketSize] for i in range(0, len(sortedKeys), self.bucketSize)];
+        self.maxKeys = [bucket[-1] for bucket in self.buckets];
+        self.nKeys = len(sortedKeys);
+        self.buildTree();
+
+    def buildTree(self):
+        """Rebuild the Fenwick tree from the current bucket lengths in O(number of buckets)"""
+        tree = [0] + [len(bucket) for bucket in self.buckets];
+        for i in range(1, len(tree)):
+            parent = i + (i & -i);
+            if parent < len(tree):
+                tree[parent] += tree[i];
+        self.tree = tree;
+
+    def updateTree(self, iBucket, delta):
+        """Adjust the recorded length of the bucket in the Fenwick tree"""
+        i = iBucket + 1;
+        while i < len(self.tree):
+            self.tree[i] += delta;
+            i += (i & -i);
+
+    def prefixCount(self, iBucket):
+        """Total number of keys in the buckets before the given bucket index"""
+        total = 0;
+        i = iBucket;
+        while i > 0:
+            total += self.tree[i];
+            i -= (i & -i);
+        return total;
+
+    def add(self, key):
+        """Add the key (duplicates allowed)"""
+        if not self.buckets:
+            self.rebuild([key]);
+            return;
+        iBucket = bisect_left(self.maxKeys, key);
+        if iBucket >= len(self.buckets):
+            iBucket = len(self.buckets)-1;  # Larger than everything so far, goes at the end of the last bucket
+        bucket = self.buckets[iBucket];
+        insort(bucket, key);
+        self.maxKeys[iBucket] = bucket[-1];
+        self.nKeys += 1;
+
+        if len(bucket) >= 2*self.bucketSize:
+            # Split the bucket in half, which changes the tree structure, so rebuild it (amortized over bucketSize additions)
+            self.buckets[iBucket:iBucket+1] = [bucket[:self.bucketSize], bucket[self.bucketSize:]];
+            self.maxKeys[iBucket:iBucket+1] = [bucket[self.bucketSize-1], bucket[-1]];
+            self.buildTree();
+        else:
+            self.updateTree(iBucket, +1);
+
+    def remove(self, key):
+        """Remove one occurrence of the key.  Raises ValueError if the key is not present"""
+        iBucket = bisect_left(self.maxKeys, key);
+        if iBucket < len(self.buckets):
+            bucket = self.buckets[iBucket];
+            iKey = bisect_left(bucket, key);
+            if iKey < len(bucket) and bucket[iKey] == key:
+                del bucket[iKey];
+                self.nKeys -= 1;
+                if not bucket:
+                    del self.buckets[iBucket];
+                    del self.maxKeys[iBucket];
+                    self.buildTree();
+                else:
+                    self.maxKeys[iBucket] = bucket[-1];
+                    self.updateTree(iBucket, -1);
+                return;
+        raise ValueError("Key not in index: %s" % (key,));
+
+    def rank(self, key):
+        """Number of keys that sort strictly before the given key (whether or not the key itself is present)"""
+        iBucket = bisect_left(self.maxKeys, key);
+        if iBucket >= len(self.buckets):
+            return self.nKeys;
+        return self.prefixCount(iBucket) + bisect_left(self.buckets[iBucket], key);
+
@@ -2,8 +2,11 @@
 import sys;
 from math import log;
 from math import sqrt, exp, log as ln;
+import numpy as np;
 from scipy.stats import chi2_contingency;
 from scipy.stats import fisher_exact;
+from scipy.stats import chi2 as chi2Distribution;
+from scipy.special import gammaln;
 
 """Count values less than this in the contingency stats table will be considered degenerate and needing normalization.
 Will correct such values by the given adjustment value.
@@ -11,6 +14,11 @@ Will correct such values by the given adjustment value.
 DEGENERATE_VALUE_THRESHOLD = 0.0; # 0.000001;  # Not small enough as Bayes style estimators can yield very small values in scientific notation, which is fine as long as report ratios of small numbers.  Stuck with risk of trying to compare floating point equality to 0 precisely
 DEGENERATE_VALUE_ADJUSTMENT = 0.5;
 
+"""Relative tolerance when comparing hypergeometric probabilities for vectorized two-sided Fisher exact tests,
+so that tables with (numerically) equal probability to the observed one are counted as at least as extreme.
+"""
+FISHER_RELATIVE_TOLERANCE = 1e-7;
+
 class ContingencyStats:
     """Convenience module for setting up contingency (2x2) tables,
     and calculating derived statistics.
@@ -306,6 +314,400 @@ class ContingencyStats:
         """Short-hand for access calc function"""
         return self.calc(key);
 
+class ContingencyStatsArray:
+    """Vectorized version of ContingencyStats.
+    Same 2x2 table setup and statistic IDs, but each of nAB, nA, nB, N can be a numpy array
+    (or scalar to broadcast), so stats can be calculated for a whole set of candidate items at once,
+    instead of constructing one ContingencyStats object (and going through the calc chain) per item.
+
+    Calculations that would raise a (caught) ValueError in the scalar version
+    (e.g., negative table values for chi-square and Fisher's exact tests) yield the same default values per element.
+    Divide by zero cases that would raise an exception in the scalar version will instead yield inf / nan values.
+
+    Calculated stat arrays are cached, so dependent stats (e.g., OR95CILow depending on OR) are not recalculated.
+    """
+    def __init__(self, nAB, nA, nB, N):
+        (nAB, nA, nB, N) = np.broadcast_arrays( *[np.asarray(value, dtype=np.float64) for value in (nAB, nA, nB, N)] );
+
+        # Keep references to original values to avoid potentially losing numerical precision information from calculations
+        self.nAB = nAB;
+        self.nA = nA;
+        self.nB = nB;
+        self.N = N;
+
+        self.ct = [ [None,None], [None,None] ];
+        self.ct[0][0] = nAB.copy();
+        self.ct[0][1] = nA-nAB;
+        self.ct[1][0] = nB-nAB;
+        self.ct[1][1] = N-nA-nB+nAB;
+
+        self.statCache = dict();
+
+    def __len__(self):
+        return self.nAB.size;
+
+    def normalize(self,truncateNegativeValues=False):
+        """Check for irregular table values like negative or zero values and adjust them to avoid calculation failures.
+        Same rules as ContingencyStats.normalize, applied to each table (element) independently.
+        """
+        ct = self.ct;   # Convenience short-hand
+        if truncateNegativeValues:
+            for i in (0,1):
+                for j in (0,1):
+                    ct[i][j] = np.maximum(ct[i][j], 0.0);
+
+        # If any zero values in a table, change or add a small delta value to ALL fields of that table
+        hasDegenerateValues = np.zeros(self.nAB.shape, dtype=bool);
+        for i in (0,1):
+            for j in (0,1):
+                hasDegenerateValues |= (np.abs(ct[i][j]) <= DEGENERATE_VALUE_THRESHOLD);
+        for i in (0,1):
+            for j in (0,1):
+                isDegenerate = (np.abs(ct[i][j]) <= DEGENERATE_VALUE_THRESHOLD);
+                ct[i][j] = np.where(isDegenerate, DEGENERATE_VALUE_ADJUSTMENT, np.where(hasDegenerateValues, ct[i][j]+DEGENERATE_VALUE_ADJUSTMENT, ct[i][j]) );
+
+        self.statCache.clear();   # Any previously calculated values no longer valid
+
+    def calc(self, statId):
+        """Return an array of calculated statistic values by an identifying name"""
+        if statId not in self.statCache:
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                self.statCache[statId] = self.calcArray(statId);
+        return self.statCache[statId];
+
+    def calcArray(self, statId):
+        ct = self.ct;   # Short-hand convenience
+        nAB = self.nAB;
+        nA = self.nA;
+        nB = self.nB;
+        N = self.N;
+
+        if statId in ("total","N"):
+            return N;
+
+        elif statId in ("nA",):
+            return nA;
+
+        elif statId in ("nB",):
+            return nB;
+
+        elif statId in ("nAB","support",):
+            return ct[0][0];
+
+        elif statId in ("P(A)",):
+            return self["nA"] / self["total"];
+
+        elif statId in ("P(!A)",):
+            return 1-self["P(A)"];
+
+        elif statId in ("P(B)","prevalence","preTestProbability","baselineFreq"):
+            return self["nB"] / self["total"];
+
+        elif statId in ("SE(prevalence)",):
+            return np.sqrt( (self["prevalence"]*(1-self["prevalence"]))/self["total"] );
+
+        elif statId in ("prevalence95CILow",):
+            return self["prevalence"] - 1.96*self["SE(prevalence)"]
+
+        elif statId in ("prevalence95CIHigh",):
+            return self["prevalence"] + 1.96*self["SE(prevalence)"]
+
+        elif statId in ("P(!B)",):
+            return 1-self["P(B)"];
+
+        elif statId in ("P(AB)",):
+            return self["nAB"] / self["total"];
+
+        elif statId in ("P(B|A)","positivePredictiveValue","PPV","precision","postTestProbability","confidence","conditionalFreq","truePositiveAccuracy"):
+            denominator = ct[0][0]+ct[0][1];
+            # Where denominator lost to numerical precision, use original values
+            return np.where( denominator == 0.0, nAB / nA, ct[0][0] / denominator );
+
+        elif statId in ("SE(PPV)",):
+            return np.sqrt( (self["PPV"]*(1-self["PPV"]))/(ct[0][0]+ct[0][1]) );
+
+        elif statId in ("PPV95CILow",):
+            return self["PPV"] - 1.96*self["SE(PPV)"]
+
+        elif statId in ("PPV95CIHigh",):
+            return self["PPV"] + 1.96*self["SE(PPV)"]
+
+        elif statId in ("P(!B|A)",):
+            return 1-self["P(B|A)"];
+
+        elif statId in ("P(B|!A)",):
+            return ct[1][0] / (ct[1][0]+ct[1][1]);
+
+        elif statId in ("P(!B|!A)","negativePredictiveValue","NPV","inversePrecision","trueNegativeAccuracy"):
+            return 1-self["P(B|!A)"];
+
+        elif statId in ("P(A|B)","truePositiveRate","TPR","sensitivity","sens","recall"):
+            return ct[0][0] / (ct[0][0]+ct[1][0]);
+
+        elif statId in ("P(!A|B)","falseNegativeRate","FNR","missRate"):
+            return 1-self["P(A|B)"];
+
+        elif statId in ("P(A|!B)","falsePositiveRate","FPR","fallout"):
+            return ct[0][1] / (ct[0][1]+ct[1][1]);
+
+        elif statId in ("P(!A|!B)","trueNegativeRate","TNR","specificity","spec","inverseRecall"):
+            return 1-self["P(A|!B)"];
+
+        elif statId in ("F1","F1-score"):
+            precision = self["precision"];
+            recall = self["recall"];
+            return np.where( precision+recall == 0.0, 0.0, 2*precision*recall / (precision+recall) );
+
+        elif statId in ("positiveLikelihoodRatio","+LR","LR+","LR"):
+            return self["P(A|B)"] / self["P(A|!B)"];
+
+        elif statId in ("negativeLikelihoodRatio","-LR","LR-"):
+            return self["P(!A|B)"] / self["P(!A|!B)"];
+
+        elif statId in ("oddsRatio","OR"):
+            return (ct[0][0]/ct[0][1]) / (ct[1][0]/ct[1][1]);
+
+        elif statId in ("SE(ln(OR))",):
+            return np.sqrt(1/ct[0][0] + 1/ct[0][1] + 1/ct[1][0] + 1/ct[1][1]);
+
+        elif statId in ("oddsRatio95CILow","OR95CILow"):
+            return np.exp( np.log(self["OR"]) - 1.96*self["SE(ln(OR))"] );
+
+        elif statId in ("oddsRatio95CIHigh","OR95CIHigh"):
+            return np.exp( np.log(self["OR"]) + 1.96*self["SE(ln(OR))"] );
+
+        elif statId in ("relativeRisk","RR"):
+            return self["P(B|A)"] / self["P(B|!A)"];
+
+        elif statId in ("SE(ln(RR))",):
+            return np.sqrt(1/ct[0][0] + 1/ct[1][0] + 1/(ct[0][0]+ct[0][1]) + 1/(ct[1][0]+ct[1][1]) );
+
+        elif statId in ("relativeRisk95CILow","RR95CILow"):
+            return np.exp( np.log(self["RR"]) - 1.96*self["SE(ln(RR))"] );
+
+        elif statId in ("relativeRisk95CIHigh","RR95CIHigh"):
+            return np.exp( np.log(self["RR"]) + 1.96*self["SE(ln(RR))"] );
+
+        elif statId in ("interest","freqRatio","TF*IDF","tfidf","lift","P(B|A)/P(B)"):
+            return self["P(B|A)"] / self["P(B)"];
+
+        elif statId in ("YatesChi2",):
+            (chi2, chi2P, isValid) = chi2ContingencyArray(ct, True);
+            return np.where(isValid, chi2, 0.0);
+
+        elif statId in ("P-YatesChi2",):
+            (chi2, chi2P, isValid) = chi2ContingencyArray(ct, True);
+            return np.where(isValid, chi2P, 1.0);
+
+        elif statId in ("P-YatesChi2-NegLog",):
+            (chi2, chi2P, isValid) = chi2ContingencyArray(ct, True);
+            return np.where(isValid, signedNegLog10(chi2P, self["OR"]), 0.0);
+
+        elif statId in ("P-Chi2",):
+            (chi2, chi2P, isValid) = chi2ContingencyArray(ct, False);
+            return np.where(isValid, chi2P, 1.0);
+
+        elif statId in ("P-Chi2-NegLog",):
+            (chi2, chi2P, isValid) = chi2ContingencyArray(ct, False);
+            return np.where(isValid, signedNegLog10(chi2P, self["OR"]), 0.0);
+
+        elif statId in ("P-Fisher",):
+            (oddsRatio, fisherP, isValid) = fisherExactArray(ct);
+            return np.where(isValid, fisherP, 1.0);
+
+        elif statId in ("P-Fisher-Complement",):
+            (oddsRatio, fisherP, isValid) = fisherExactArray(ct);
+            return np.where(isValid, np.where(oddsRatio > 1.0, 1-fisherP, fisherP-1), 0.0);
+
+        elif statId in ("P-Fisher-NegLog",):
+            (oddsRatio, fisherP, isValid) = fisherExactArray(ct);
+            return np.where(isValid, signedNegLog10(fisherP, oddsRatio), 0.0);
+        else:
+            raise UnrecognizedStatException("Unrecognized statistic ID: [%s]" % statId );
+
+    def __getitem__(self, key):
+        """Short-hand for access calc function"""
+        return self.calc(key);
+
+def signedNegLog10(pValues, oddsRatios):
+    """Negative log10 of the P-values, negated again if the odds ratio is not positive (>1),
+    such that sorting in descending order will bring the most significant positive associations
+    to the top and the most significant negative associations to the bottom.
+    Zero P-values are treated as the most extreme float value.
+    """
+    logP = np.full(pValues.shape, -sys.float_info.max);
+    isPositive = (pValues > 0.0);
+    logP[isPositive] = np.log10(pValues[isPositive]);
+    return np.where(oddsRatios > 1.0, -logP, logP);
+
+def chi2ContingencyArray(ct, correction=True):
+    """Vectorized equivalent of scipy.stats.chi2_contingency for an array of 2x2 tables,
+    given ct as a 2x2 nested list of arrays.
+    Returns (chi2, P-value, isValid) arrays, where isValid is False for tables that
+    chi2_contingency would reject with a ValueError (negative values or zero expected frequencies).
+    """
+    observed = np.array([[ct[0][0],ct[0][1]],[ct[1][0],ct[1][1]]], dtype=np.float64);
+    rowSums = observed.sum(axis=1);
+    colSums = observed.sum(axis=0);
+    total = rowSums.sum(axis=0);
+    expected = rowSums[:,np.newaxis] * colSums[np.newaxis,:] / total;
+
+    isValid = ~( (observed < 0).any(axis=(0,1)) | (expected == 0).any(axis=(0,1)) );
+
+    if correction:
+        # Yates continuity correction for the single degree of freedom
+        diff = expected - observed;
+        observed = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff));
+
+    chi2 = ((observed - expected)**2 / expected).sum(axis=(0,1));
+    chi2P = chi2Distribution.sf(chi2, 1);
+    return (chi2, chi2P, isValid);
+
+def fisherExactArray(ct):
+    """Vectorized equivalent of the two-sided scipy.stats.fisher_exact for an array of 2x2 tables,
+    given ct as a 2x2 nested list of arrays.  Table values are truncated to integers, same as fisher_exact.
+
+    Rather than summing over the whole hypergeometric support for every table,
+    uses the unimodal shape of the distribution.  The P-value is the tail (cdf or sf) on the
+    side of the observed value plus the opposite tail beyond the point where the probability mass
+    drops to the observed probability, found by a (vectorized) binary search.
+
+    Returns (oddsRatio, P-value, isValid) arrays, where isValid is False for tables that
+    fisher_exact would reject with a ValueError (negative values).
+    """
+    with np.errstate(invalid="ignore"):
+        c00 = np.trunc(np.asarray(ct[0][0], dtype=np.float64));
+        c01 = np.trunc(np.asarray(ct[0][1], dtype=np.float64));
+        c10 = np.trunc(np.asarray(ct[1][0], dtype=np.float64));
+        c11 = np.trunc(np.asarray(ct[1][1], dtype=np.float64));
+    shape = c00.shape;
+    (c00, c01, c10, c11) = (c00.ravel(), c01.ravel(), c10.ravel(), c11.ravel());
+
+    isValid = ~((c00 < 0) | (c01 < 0) | (c10 < 0) | (c11 < 0));
+    oddsRatio = np.full(c00.shape, np.nan);
+    pValue = np.ones(c00.shape);
+
+    n1 = c00 + c01;
+    n2 = c10 + c11;
+    n = c00 + c10;
+    # If both values in a row or column are zero, P-value is 1 and odds ratio undefined
+    isDefined = isValid & (n1 > 0) & (n2 > 0) & (n > 0) & (c01 + c11 > 0);
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        oddsRatio[isDefined] = np.where( (c10 > 0) & (c01 > 0), c00*c11 / (c10*c01), np.inf )[isDefined];
+
+    iDefined = np.flatnonzero(isDefined);
+    if len(iDefined) > 0:
+        pValue[iDefined] = _fisherExactPValues(c00[iDefined], n1[iDefined], n2[iDefined], n[iDefined]);
+
+    return (oddsRatio.reshape(shape), pValue.reshape(shape), isValid.reshape(shape));
+
+def _fisherExactPValues(x, n1, n2, n):
+    """Two-sided Fisher exact P-values for well-defined tables with upper left cell x,
+    row totals n1, n2 and first column total n.
+    Follows the same steps as scipy.stats.fisher_exact, one array operation per step,
+    but working with log probabilities so that large tables do not underflow.
+    """
+    M = n1 + n2;
+    logGamma = np.log1p(FISHER_RELATIVE_TOLERANCE);
+
+    mode = np.floor((n + 1) * (n1 + 1) / (M + 2));
+    logPExact = hypergeomLogPmf(x, M, n1, n);
+    logPMode = hypergeomLogPmf(mode, M, n1, n);
+
+    pValue = np.ones(x.shape);
+    isMode = (logPMode - logPExact <= logGamma);
+    isLower = ~isMode & (x < mode);
+    isUpper = ~isMode & ~isLower;
+
+    # Observed value below the mode, so add on the corresponding upper tail
+    if isLower.any():
+        i = np.flatnonzero(isLower);
+        (Mi, n1i, ni) = (M[i], n1[i], n[i]);
+        pLower = hypergeomTailSum(x[i], -1, Mi, n1i, ni);
+        logThreshold = logPExact[i] + logGamma;
+        guess = _binarySearchArray(lambda k, j: -hypergeomLogPmf(k, Mi[j], n1i[j], ni[j]), -logThreshold, mode[i], ni);
+        pTail = hypergeomTailSum(guess+1, +1, Mi, n1i, ni);
+        pValue[i] = pLower + pTail;
+
+    # Observed value at or above the mode, so add on the corresponding lower tail
+    if isUpper.any():
+        i = np.flatnonzero(isUpper);
+        (Mi, n1i, ni) = (M[i], n1[i], n[i]);
+        pUpper = hypergeomTailSum(x[i], +1, Mi, n1i, ni);
+        logThreshold = logPExact[i] + logGamma;
+        guess = _binarySearchArray(lambda k, j: hypergeomLogPmf(k, Mi[j], n1i[j], ni[j]), logThreshold, np.zeros(len(i)), mode[i]);
+        pTail = hypergeomTailSum(guess, -1, Mi, n1i, ni);
+        pValue[i] = pUpper + pTail;
+
+    return np.minimum(pValue, 1.0);
+
+def hypergeomLogPmf(k, M, n1, n):
+    """Log of the hypergeometric probability of drawing k marked items in n draws
+    from a population of M items, n1 of which are marked.  -inf for k outside of the support.
+    """
+    with np.errstate(invalid="ignore"):
+        logPmf = _logChoose(n1, k) + _logChoose(M-n1, n-k) - _logChoose(M, n);
+    inSupport = (k >= np.maximum(0, n-(M-n1))) & (k <= np.minimum(n, n1));
+    return np.where(inSupport, logPmf, -np.inf);
+
+def _logChoose(a, b):
+    return gammaln(a+1) - gammaln(b+1) - gammaln(a-b+1);
+
+def hypergeomTailSum(start, step, M, n1, n, blockSize=64):
+    """Total hypergeometric probability from start (inclusive) to the end of the support
+    in the direction of step (+1 or -1).  Start is expected to be on the far side of the mode,
+    so that terms only decrease moving outward and the sum can stop once they no longer contribute.
+    Equivalent to cdf(start) for step -1 or sf(start-1) for step +1.
+    """
+    logFirst = hypergeomLogPmf(start, M, n1, n);
+    total = np.zeros(logFirst.shape);
+    position = np.array(start, dtype=np.float64);
+    offsets = step * np.arange(blockSize);
+
+    active = np.flatnonzero(np.isfinite(logFirst));
+    while len(active) > 0:
+        k = position[active][:,np.newaxis] + offsets[np.newaxis,:];
+        logTerms = hypergeomLogPmf(k, M[active][:,np.newaxis], n1[active][:,np.newaxis], n[active][:,np.newaxis]);
+        terms = np.exp(logTerms - logFirst[active][:,np.newaxis]);  # Relative to first term to avoid underflow
+        total[active] += terms.sum(axis=1);
+        position[active] += step * blockSize;
+        active = active[ terms[:,-1] > total[active] * np.finfo(np.float64).eps ];
+
+    return np.exp(logFirst) * total;
+
+def _binarySearchArray(func, d, lo, hi):
+    """Vectorized binary search over ascending function values, one search per array element.
+    func(k, j) should evaluate the function at points k for the search elements indexed by j.
+    Returns array of k such that func(k) <= d < func(k+1) for each element.
+    """
+    lo = np.array(lo, dtype=np.float64);
+    hi = np.array(hi, dtype=np.float64);
+    result = np.zeros(lo.shape);
+    isFound = np.zeros(lo.shape, dtype=bool);
+
+    active = np.flatnonzero(lo < hi);
+    while len(active) > 0:
+        mid = lo[active] + np.floor((hi[active]-lo[active])/2);
+        midVal = func(mid, active);
+        isBelow = (midVal < d[active]);
+        isAbove = (midVal > d[active]);
+        isEqual = ~isBelow & ~isAbove;
+
+        lo[active[isBelow]] = mid[isBelow]+1;
+        hi[active[isAbove]] = mid[isAbove]-1;
+        result[active[isEqual]] = mid[isEqual];
+        isFound[active[isEqual]] = True;
+
+        active = active[~isEqual];
+        active = active[lo[active] < hi[active]];
+
+    remaining = np.flatnonzero(~isFound);
+    if len(remaining) > 0:
+        atLo = ( func(lo[remaining], remaining) <= d[remaining] );
+        result[remaining] = np.where(atLo, lo[remaining], lo[remaining]-1);
+    return result;
+
 class UnrecognizedStatException(Exception):
     def __init__( self, initStr ):
         Exception.__init__(self, initStr);
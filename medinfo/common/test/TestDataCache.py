@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Test case for respective module in parent package"""
+
+import sys, os
+import threading;
+import unittest
+
+import numpy as np;
+
+from . import Const, Util
+
+from medinfo.common.DataCache import DataCache, estimateSize;
+from medinfo.common.test.Util import MedInfoTestCase
+
+class ManualTimer:
+    """Controllable clock to simulate the passage of time for expiration tests"""
+    def __init__(self):
+        self.currentTime = 0.0;
+    def __call__(self):
+        return self.currentTime;
+
+class TestDataCache(MedInfoTestCase):
+    def setUp(self):
+        MedInfoTestCase.setUp(self);
+        self.timer = ManualTimer();
+
+    def test_dictInterface(self):
+        cache = DataCache(maxBytes=None, timer=self.timer);
+        cache["a"] = [1,2,3];
+        cache["b"] = {"x": 1};
+
+        self.assertTrue("a" in cache);
+        self.assertFalse("c" in cache);
+        self.assertEqual([1,2,3], cache["a"]);
+        self.assertEqual(None, cache.get("c"));
+        self.assertEqual("default", cache.get("c","default"));
+        self.assertRaises(KeyError, cache.__getitem__, "c");
+        self.assertEqual(2, len(cache));
+
+        del cache["a"];
+        self.assertFalse("a" in cache);
+        self.assertEqual({"x": 1}, cache.pop("b"));
+        self.assertEqual(0, len(cache));
+        self.assertEqual(0, cache.nBytes);
+
+        stats = cache.stats();
+        self.assertEqual(1, stats["hits"]);     # "in" checks do not count as hits or misses
+        self.assertEqual(3, stats["misses"]);
+
+    def test_lruEviction(self):
+        # Budget enough for about 3 of the test arrays
+        arraySize = estimateSize(np.zeros(1000));
+        cache = DataCache(maxBytes=arraySize*3 + arraySize//2, timer=self.timer);
+
+        for key in ["a","b","c"]:
+            cache[key] = np.zeros(1000);
+        self.assertEqual(3, len(cache));
+        self.assertEqual(0, cache.evictions);
+
+        # Use "a" so "b" becomes least recently used and will be evicted first
+        cache["a"];
+        cache["d"] = np.zeros(1000);
+        self.assertEqual(["c","a","d"], cache.keys());
+        self.assertEqual(1, cache.evictions);
+        self.assertTrue(cache.nBytes <= cache.maxBytes);
+
+        # Replacing existing entry should not double count
+        cache["d"] = np.zeros(1000);
+        self.assertEqual(3, len(cache));
+        self.assertEqual(1, cache.evictions);
+
+        # Entry too large for the whole budget is rejected, but does not flush everything else
+        self.assertFalse(cache.set("huge", np.zeros(10000)));
+        self.assertFalse("huge" in cache);
+        self.assertEqual(3, len(cache));
+
+    def test_ttlExpiration(self):
+        cache = DataCache(maxBytes=None, ttl=60, timer=self.timer);
+        cache["default"] = "value";
+        cache.set("short", "value", ttl=10);
+        cache.set("long", "value", ttl=1000);
+
+        self.timer.currentTime = 30;
+        self.assertEqual("value", cache.get("default"));
+        self.assertEqual(None, cache.get("short"));
+        self.assertEqual(1, cache.expirations);
+
+        self.timer.currentTime = 100;
+        self.assertFalse("default" in cache);
+        self.assertTrue("long" in cache);
+        self.assertEqual(2, cache.expirations);
+        self.assertEqual(["long"], cache.keys());
+
+    def test_invalidate(self):
+        cache = DataCache(maxBytes=None, defaultTags=["analyzedPatientCount","clinicalItemCountsUpdated"], timer=self.timer);
+        cache["query1"] = [(1,2)];
+        cache["query2"] = [(3,4)];
+        cache.set("itemCounts", [(5,6)], tags=["clinicalItemCountsUpdated"]);
+        cache.set("static", [(7,8)], tags=[]);
+
+        self.assertEqual(3, cache.invalidate("clinicalItemCountsUpdated"));
+        self.assertEqual(["static"], cache.keys());
+        self.assertEqual(0, cache.invalidate("analyzedPatientCount"));   # Already cleared along with the other tag
+        self.assertEqual(3, cache.invalidations);
+        self.assertEqual(estimateSize([(7,8)]), cache.nBytes);
+
+        # Storing a value again keeps the tags of the existing entry, unless new tags are specified
+        cache.set("snapshot", [(9,10)], tags=["modelSnapshot"]);
+        cache["snapshot"] = [(9,10),(11,12)];
+        self.assertEqual(0, cache.invalidate("analyzedPatientCount"));
+        self.assertEqual(1, cache.invalidate("modelSnapshot"));
+
+    def test_threadSafety(self):
+        # Concurrent (web request) threads sharing one cache, with frequent evictions, expirations, and invalidations
+        cache = DataCache(maxBytes=20*estimateSize(np.zeros(100)), ttl=0.0001, defaultTags=["tagA"]);
+        nThreads = 8;
+        nOperations = 5000;
+        errors = list();
+
+        def worker(iThread):
+            try:
+                for iOperation in range(nOperations):
+                    key = (iThread + iOperation) % 50;
+                    if iOperation % 7 == 0:
+                        cache.set(key, np.zeros(100), ttl=None, tags=["tagB"]);
+                    elif iOperation % 5 == 0:
+                        cache[key] = np.zeros(100);
+                    elif iOperation % 11 == 0:
+                        cache.pop(key);
+                    elif iOperation % 13 == 0:
+                        try:
+                            del cache[key];
+                        except KeyError:
+                            pass;   # Expected if not there, just not from a partial removal by another thread
+                    elif iOperation % 97 == 0:
+                        cache.invalidate(["tagA","tagB"][iOperation % 2]);
+                    elif iOperation % 101 == 0:
+                        cache.stats();
+                        cache.keys();
+                    else:
+                        cache.get(key);
+                        key in cache;
+            except Exception as err:
+                errors.append(err);
+
+        switchInterval = sys.getswitchinterval();
+        sys.setswitchinterval(1e-6);    # Switch threads as often as possible to expose any races
+        try:
+            threads = [threading.Thread(target=worker, args=(iThread,)) for iThread in range(nThreads)];
+            for thread in threads:
+                thread.start();
+            for thread in threads:
+                thread.join();
+        finally:
+            sys.setswitchinterval(switchInterval);
+
+        self.assertEqual([], errors);
+
+        # Bookkeeping still consistent with the remaining entries
+        self.assertEqual(sum([entry[1] for entry in cache.entries.values()]), cache.nBytes);
+        self.assertTrue(cache.nBytes <= cache.maxBytes);
+        taggedKeys = set();
+        for tag, keys in cache.keysByTag.items():
+            for key in keys:
+                self.assertTrue(tag in cache.entries[key][3]);
+            taggedKeys.update(keys);
+        self.assertEqual(set(cache.entries.keys()), taggedKeys);
+
+    def test_estimateSize(self):
+        self.assertTrue(estimateSize(np.zeros(10000)) >= 80000);
+        self.assertTrue(estimateSize({1: "x"*1000}) > 1000);
+
+        # Shared objects only counted once
+        shared = "y"*1000;
+        self.assertTrue(estimateSize([shared, shared]) < 2000);
+
+        class Holder:
+            pass;
+        holder = Holder();
+        holder.data = np.zeros(10000);
+        self.assertTrue(estimateSize(holder) >= 80000);
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestDataCache));
+    return suite;
+
+if __name__=="__main__":
+    Util.log.setLevel(Const.LOGGER_LEVEL)
+
+    unittest.TextTestRunner(verbosity=Const.RUNNER_VERBOSITY).run(suite())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Test case for respective module in parent package"""
+
+import sys, os
+import random;
+from bisect import bisect_left;
+import unittest
+
+from . import Const, Util
+
+from medinfo.common.RankIndex import RankIndex;
+from medinfo.common.test.Util import MedInfoTestCase
+
+class TestRankIndex(MedInfoTestCase):
+    def test_rank(self):
+        index = RankIndex([5,1,3,3]);
+        self.assertEqual(4, len(index));
+        self.assertEqual([1,3,3,5], list(index));
+        self.assertEqual(0, index.rank(1));
+        self.assertEqual(1, index.rank(3));    # Duplicates all rank after the same keys
+        self.assertEqual(3, index.rank(4));    # Need not be present
+        self.assertEqual(4, index.rank(9));
+        self.assertTrue(3 in index);
+        self.assertFalse(4 in index);
+
+        index.remove(3);
+        index.add(0);
+        self.assertEqual([0,1,3,5], list(index));
+        self.assertEqual(2, index.rank(3));
+        self.assertRaises(ValueError, index.remove, 4);
+
+        # Composite keys, as for ranking by score then a tie breaker
+        index = RankIndex();
+        index.add((-0.5, 2));
+        index.add((-0.5, 1));
+        index.add((-0.9, 3));
+        self.assertEqual(1, index.rank((-0.5, 1)));
+        self.assertEqual(2, index.rank((-0.5, 2)));
+
+    def test_randomOperations(self):
+        # Small buckets, so that many bucket splits and removals are exercised, checked against a plain sorted list
+        rng = random.Random(42);
+        index = RankIndex(bucketSize=4);
+        expectedKeys = list();
+        for iOperation in range(5000):
+            if expectedKeys and rng.random() < 0.45:
+                key = rng.choice(expectedKeys);
+                expectedKeys.remove(key);
+                index.remove(key);
+            else:
+                key = rng.randint(0,200);
+                expectedKeys.append(key);
+                index.add(key);
+            expectedKeys.sort();
+
+            probeKey = rng.randint(-1,201);
+            self.assertEqual(bisect_left(expectedKeys, probeKey), index.rank(probeKey));
+            self.assertEqual(len(expectedKeys), len(index));
+        self.assertEqual(expectedKeys, list(index));
+        self.assertTrue(max(len(bucket) for bucket in index.buckets) < 2*index.bucketSize);
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestRankIndex));
+    return suite;
+
+if __name__=="__main__":
+    Util.log.setLevel(Const.LOGGER_LEVEL)
+
+    unittest.TextTestRunner(verbosity=Const.RUNNER_VERBOSITY).run(suite())
@@ -9,7 +9,7 @@ from math import sqrt, exp, log as ln;
 
 from . import Const, Util
 
-from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, UnrecognizedStatException;
+from medinfo.common.StatsUtil import AggregateStats, ContingencyStats, ContingencyStatsArray, UnrecognizedStatException;
 from medinfo.common.test.Util import MedInfoTestCase
 
 class TestAggregateStats(MedInfoTestCase):
@@ -263,6 +263,43 @@ class TestContingencyStats(MedInfoTestCase):
             testValue = contStats.calc(statId);
             self.assertAlmostEqual( expectedValue, testValue, 3 );
 
+    def test_contingencyStatsArray(self):
+        # Array version should yield the same values as individual calculations
+        nABs = [self.TEST_NAB,  0,   0,   3,    0.5,    250];
+        nAs =  [self.TEST_NA,   5,   0,   80,   2.0,    3000];
+        nBs =  [self.TEST_NB,   7,   3,   12,   50.0,   400];
+        Ns =   [self.TEST_TOTAL, 100, 100, 3000, 3000.0, 100000];
+
+        contStatsArray = ContingencyStatsArray( nABs, nAs, nBs, Ns );
+        for statId, expectedValue in self.EXPECTED.items():
+            Util.log.debug(statId);
+            self.assertAlmostEqual( expectedValue, contStatsArray[statId][0], 3 );
+
+        for truncateNegativeValues in (False, True):
+            contStatsArray = ContingencyStatsArray( nABs, nAs, nBs, Ns );
+            contStatsArray.normalize(truncateNegativeValues=truncateNegativeValues);
+            for statId in self.EXPECTED.keys():
+                Util.log.debug(statId);
+                testValues = contStatsArray[statId];
+                for i, (nAB, nA, nB, N) in enumerate(zip(nABs, nAs, nBs, Ns)):
+                    contStats = ContingencyStats( nAB, nA, nB, N );
+                    contStats.normalize(truncateNegativeValues=truncateNegativeValues);
+                    self.assertEqualGeneral( contStats[statId], testValues[i], 5 );
+
+        # Negative table values (nB exceeds N) should yield the same defaults as the individual calculations
+        contStatsArray = ContingencyStatsArray( [20, 10], [30, 15], [40, 25], [100, 20] );
+        expected = \
+            {   "P-Fisher": 1.0,
+                "P-Fisher-Complement": 0.0,
+                "P-Fisher-NegLog": 0.0,
+                "P-YatesChi2": 1.0,
+            }
+        for statId, expectedValue in expected.items():
+            Util.log.debug(statId);
+            self.assertAlmostEqual( expectedValue, contStatsArray[statId][1], 3 );
+
+        self.assertRaises( UnrecognizedStatException, contStatsArray.calc, "notAStat" );
+
 class TestUnitTestTools(MedInfoTestCase):
     def test_assertEqualsGeneral(self):
         # Should allow option of verifying equal values by number of significant digits, not just decimal places
@@ -3,20 +3,40 @@ import sys, os
 import json
 import time;
 import math;
-from datetime import datetime;
+import copy;
+import multiprocessing;
+from datetime import datetime, timedelta;
+import numpy as np;
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
+from medinfo.db.Const import KEEP_ALIVE_SECONDS;
 from medinfo.db.Model import SQLQuery, generatePlaceholders;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.Model import RowItemModel;
 from .Env import DATE_FORMAT;
 
-from .DataManager import DataManager;
+from .DataManager import DataManager, isDecayScaledField;
+from .PatientTimelineReader import PatientTimelineReader;
+from .AssociationCountBuffer import AssociationCountBuffer, BUFFER_FILE_SUFFIX, pairKeyArray;
+from .AssociationCountBuffer import isBufferFile, saveBufferFile, loadBufferFile, iterMergedBufferFiles, mergeBufferFiles;
 
 from .Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
 
 from .Util import log;
 
+# When running in parallel, split patients into this many shards per worker process,
+#   so that workers that happen to get patients with less data can pick up more work rather than sit idle
+SHARDS_PER_PROCESS = 4;
+
+# Time units for converting item dates into numerical time lines
+ONE_MICROSECOND = timedelta(microseconds=1);
+MICROSECONDS_PER_SECOND = 1000000;
+
+# When counting associations for a patient's timeline, enumerate about this many item pairs at a time, to bound memory use for long timelines
+PAIR_BLOCK_SIZE = 1000000;
+
+# Database connectors that support the set-based bulk commit queries (INSERT ... ON CONFLICT, UPDATE ... FROM)
+BULK_COMMIT_CONNECTORS = ("psycopg2","sqlite3");
 
 class AnalysisOptions:
     """Simple struct to pass filter parameters on which records to do analysis on"""
@@ -52,6 +72,8 @@ class AssociationAnalysis:
 
     Running batches of 3,000-5,000 patients with ~3,000 possible clinical items yields ~6M associations,
      requiring ~25GB memory for learning then ~45GB memory to reload and commit as a buffer file.
+     (With the original str(tuple) keyed dictionary of dictionaries buffer, ~4.5KB per item pair.
+     The in memory buffer is now a compact AssociationCountBuffer of numeric arrays, ~0.6KB per item pair.)
 
     Suggestion: Break up input patientID list into discrete subsets and run AssociationAnalysis on each with -b
     option to do parallel association counting (on a server with enough RAM to do all in memory),
@@ -64,6 +86,8 @@ class AssociationAnalysis:
     patientsPerCommit = None; # Commit any bufferred analysis results to the database after analyzing this many patients.  If None, will wait until the end before committing, so less DB hits, but will lose  progress if script cancelled midway
     associationsPerCommit = None;   # Commit buffered analysis results if accrue this many association results to avoid risk of running over runtime memory limitations
     itemsPerUpdate = None;  # When updating analyze_dates for patient_items, do so for this many blocks at a time to avoid avoid loading MySQL query time
+    processes = None;   # If more than 1, split patients into shards to analyze in parallel with this many worker processes, then merge the results for a single commit
+    bulkCommit = False; # If True, commit buffered results by streaming into temporary staging tables and applying set-based update queries, rather than one update query per item pair
 
     def __init__(self):
         """Default constructor"""
@@ -72,11 +96,14 @@ class AssociationAnalysis:
         self.patientsPerCommit = None;
         self.associationsPerCommit = None;
         self.itemsPerUpdate = None;
+        self.processes = None;
+        self.bulkCommit = False;
 
     def makeUpdateBuffer(self, existingBuffer=None):
         """Factory method to prepare a blank "updateBuffer" to store association increment data.
         Is really just a dictionary for simple JSON conversion, but instantiate here to control
         expected attributes / keys;
+        Item pair increments are kept in a compact AssociationCountBuffer under the "associationCounts" key.
         If exitingBuffer is not None, assume that is a previous one that we wish to
         clear / blank out.
         """
@@ -86,7 +113,21 @@ class AssociationAnalysis:
         updateBuffer.clear();
         updateBuffer["nAssociations"] = 0;
         updateBuffer["analyzedPatientItemIds"] = set();
-        updateBuffer["incrementDataByItemIdPair"] = dict();
+        updateBuffer["associationCounts"] = AssociationCountBuffer();
+        return updateBuffer;
+
+    def compactUpdateBuffer(self, updateBuffer):
+        """Convert any legacy format update buffer contents (incrementDataByItemIdPair dictionary,
+        e.g., from JSON files or other analysis modules) into the compact associationCounts buffer in place.
+        """
+        if "incrementDataByItemIdPair" in updateBuffer:
+            legacyCounts = AssociationCountBuffer.fromIncrementData(updateBuffer.pop("incrementDataByItemIdPair"));
+            if "associationCounts" in updateBuffer:
+                updateBuffer["associationCounts"].merge(legacyCounts);
+            else:
+                updateBuffer["associationCounts"] = legacyCounts;
+        if "associationCounts" in updateBuffer:
+            updateBuffer["nAssociations"] = len(updateBuffer["associationCounts"]);
         return updateBuffer;
 
     def analyzePatientItems(self, analysisOptions):
@@ -99,6 +140,9 @@ class AssociationAnalysis:
         Will also record analyze_date timestamp on any records analyzed,
         so that analysis will not be repeated if called again on the same records.
         """
+        if self.processes is not None and self.processes > 1:
+            return self.analyzePatientItemsParallel(analysisOptions);
+
         progress = ProgressDots();
         conn = self.connFactory.connection();
 
@@ -109,6 +153,7 @@ class AssociationAnalysis:
             # Keep an in memory buffer of the updates to be done so can stall and submit them
             #   to the database in batch to minimize inefficient DB hits
             updateBuffer = self.makeUpdateBuffer();
+            lastQueryTime = time.time();
             log.info("Main patient item query...")
             for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
                 log.debug("Calculate associations for Patient %d's %d patient items. %d associations in buffer." % (iPatient, len(patientItemList), updateBuffer["nAssociations"]) );
@@ -116,22 +161,127 @@ class AssociationAnalysis:
                 if self.readyForIntervalCommit(iPatient, updateBuffer, analysisOptions):
                     log.info("Commit after %s patients" % (iPatient+1) );
                     self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, iPatient, conn=conn);  # Periodically commit update buffer
-                else:   # If not committing, still send a quick arbitrary query to DB,
-                        # otherwise connection may get recycled because DB thinks timeout with no interaction
-                    DBUtil.execute("select 1+1", conn=conn);
+                    lastQueryTime = time.time();
+                elif time.time() - lastQueryTime > KEEP_ALIVE_SECONDS:
+                    # If not committing for a while, still check in with the DB,
+                    #   otherwise connection may get recycled because DB thinks timeout with no interaction
+                    DBUtil.pingConnection(conn);
+                    lastQueryTime = time.time();
             log.info("Final commit / persist");
             self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);  # Final update buffer commit. Don't use iPatient here, as may collide if interval commit happened to land on last patient
         finally:
             conn.close();
         # progress.PrintStatus();
 
+    def analyzePatientItemsParallel(self, analysisOptions):
+        """Parallel version of analyzePatientItems.
+        Split the patients into shards and count associations for each shard in a pool of worker processes,
+        each with its own update buffer and database connection.  Merge the worker buffers with a
+        (pairwise, parallel) tree reduction, then persist the combined buffer once.
+
+        Association counts only depend on items within each patient, so results should be identical to a serial run.
+        Interval commit options (patientsPerCommit, associationsPerCommit) are not applied here.
+        """
+        conn = self.connFactory.connection();
+        try:
+            linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+
+            patientIds = analysisOptions.patientIds;
+            if not patientIds:
+                patientIds = self.queryPatientIds(analysisOptions, conn=conn);
+            shardOptionsList = self.shardAnalysisOptions(analysisOptions, patientIds, self.processes*SHARDS_PER_PROCESS);
+            log.info("Analyze %d patients in %d shards across %d processes" % (len(patientIds), len(shardOptionsList), self.processes) );
+
+            updateBuffer = self.countPatientShardsParallel(shardOptionsList);
+
+            log.info("Final commit / persist");
+            self.persistUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, analysisOptions, -1, conn=conn);
+        finally:
+            conn.close();
+
+    def countPatientShardsParallel(self, shardOptionsList):
+        """Count associations for each of the shard analysisOptions in a pool of worker processes (see countPatientShard),
+        and return the merged update buffer.
+
+        Workers are only sent plain configuration (this analyzer's class and connection parameters) to construct
+        their own analyzer and load their own clinical item link index once when started (see initShardWorker),
+        rather than pickling this analyzer (with its caches and connection source) for every shard.
+        """
+        connParam = getattr(self.connFactory, "connParam", None);
+        pool = multiprocessing.Pool(self.processes, initializer=initShardWorker, initargs=(self.__class__, connParam));
+        try:
+            shardBuffers = pool.map(analyzePatientShard, shardOptionsList, chunksize=1);
+            log.info("Merge %d shard buffers" % len(shardBuffers) );
+            return self.reduceBuffers(shardBuffers, pool);
+        finally:
+            pool.close();
+            pool.join();
+
+    def countPatientShard(self, analysisOptions, linkedItemIdsByBaseId, conn=None):
+        """Count associations for the patients of the analysisOptions into a new update buffer and return it, without persisting"""
+        updateBuffer = self.makeUpdateBuffer();
+        for patientItemList in self.queryPatientItemsPerPatient(analysisOptions, conn=conn):
+            self.updateItemAssociationsBuffer(patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId);
+        return updateBuffer;
+
+    def queryPatientIds(self, analysisOptions, conn=None):
+        """Query for the distinct patient IDs with items to analyze per the analysisOptions date filters"""
+        query = SQLQuery();
+        query.addSelect("distinct pi.patient_id");
+        query.addFrom("patient_item as pi");
+        query.addFrom("clinical_item as ci");
+        query.addWhere("pi.clinical_item_id = ci.clinical_item_id");
+        query.addWhere("ci.analysis_status <> 0");
+        if analysisOptions.startDate is not None:
+            query.addWhereOp("pi.item_date",">=", analysisOptions.startDate);
+        if analysisOptions.endDate is not None:
+            query.addWhereOp("pi.item_date","<", analysisOptions.endDate);
+        query.addOrderBy("pi.patient_id");
+        resultTable = DBUtil.execute(query, conn=conn);
+        return [row[0] for row in resultTable];
+
+    def shardAnalysisOptions(self, analysisOptions, patientIds, nShards):
+        """Return list of copies of the analysisOptions, each covering a (round-robin) subset of the patientIds"""
+        shardOptionsList = list();
+        for iShard in range(nShards):
+            shardPatientIds = patientIds[iShard::nShards];
+            if shardPatientIds:
+                shardOptions = copy.copy(analysisOptions);
+                shardOptions.patientIds = shardPatientIds;
+                shardOptionsList.append(shardOptions);
+        return shardOptionsList;
+
+    def reduceBuffers(self, updateBuffers, pool=None):
+        """Merge a list of update buffers into one, by merging pairs of buffers at a time
+        (in parallel if a process pool, started with initShardWorker, is provided) until only one remains.
+        """
+        updateBuffers = list(updateBuffers);
+        if not updateBuffers:
+            return self.makeUpdateBuffer();
+
+        while len(updateBuffers) > 1:
+            bufferPairs = [(updateBuffers[i], updateBuffers[i+1]) for i in range(0, len(updateBuffers)-1, 2)];
+            if pool is not None:
+                mergedBuffers = pool.map(mergeBufferPair, bufferPairs, chunksize=1);
+            else:
+                mergedBuffers = [self.mergeBuffers(bufferOne, bufferTwo) for (bufferOne, bufferTwo) in bufferPairs];
+            if len(updateBuffers) % 2 == 1:
+                mergedBuffers.append(updateBuffers[-1]);    # Odd one out carries over to the next round
+            updateBuffers = mergedBuffers;
+
+        updateBuffer = updateBuffers[0];
+        # Merging adds up the association counts of each buffer, which double counts item pairs found in multiple buffers
+        if "associationCounts" in updateBuffer:
+            updateBuffer["nAssociations"] = len(updateBuffer["associationCounts"]);
+        return updateBuffer;
+
     def queryPatientItemsPerPatient(self, analysisOptions, progress=None, conn=None):
         """Query the database for an ordered list of patient clinical items,
         in the order in which they occurred.
         This could be a large amount of data, so option to provide
         list of specific patientIds or date ranges to query for.  In either case,
         results will be returned as an iterator over individual lists
-        for each patient.  Lists will contain RowItemModels, each with data:
+        for each patient.  Lists will contain plain dictionaries, each with data:
             * patient_id
             * encounter_id
             * clinical_item_id
@@ -164,49 +314,23 @@ class AssociationAnalysis:
         query.addOrderBy("pi.item_date");
         query.addOrderBy("pi.clinical_item_id");
 
-        # Query to get an estimate of how long the process will be
-        if progress is not None:
-            progress.total = DBUtil.execute(query.totalQuery(), conn=conn)[0][0];
-
-        cursor = conn.cursor();
+        headers = ["patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date"];
 
-        # Do one massive query, but yield data for one patient at a time.
+        # Do one massive query, but stream the results and yield data for one patient at a time.
         # This should minimize the number of DB queries and the amount of
         #   data that must be kept in memory at any one time.
-        cursor.execute( str(query), tuple(query.params) );
-
-        currentPatientId = None;
-        currentPatientData = list();
+        reader = PatientTimelineReader(query, conn, headers, connFactory=self.connFactory);
 
-        headers = ["patient_item_id","patient_id","encounter_id","clinical_item_id","item_date","analyze_date"];
-
-        row = cursor.fetchone();
-        while row is not None:
-            (patient_item_id, patientId, encounter_id, clinicalItemId, itemDate, analyzeDate) = row;
-            if currentPatientId is None:
-                currentPatientId = patientId;
-
-            if patientId != currentPatientId:
-                # Changed user, yield the existing data for the previous user
-                yield currentPatientData;
-                # Update our data tracking for the current user
-                currentPatientId = patientId;
-                currentPatientData = list();
-
-            rowModel = RowItemModel( row, headers );
-            currentPatientData.append( rowModel );
-
-            row = cursor.fetchone();
-
-        # Yield the final user's data
-        yield currentPatientData;
-
-        # Slight risk here.  Normally DB connection closing should be in finally of a try block,
-        #   but using the "yield" generator construct forbids us from using a try, finally construct.
-        cursor.close();
+        # Cheap estimate of how long the process will be
+        if progress is not None:
+            progress.total = reader.estimateRowCount();
 
-        if not extConn:
-            conn.close();
+        try:
+            for (patientId, patientItemList) in reader:
+                yield patientItemList;
+        finally:
+            if not extConn:
+                conn.close();
 
     def updateItemAssociationsBuffer(self, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None,  progress=None):
         """Given a list of data on patient clinical items,
@@ -218,57 +342,143 @@ class AssociationAnalysis:
         After done, also provide updateBuffer info for subsequent setting the analyze_date
         for all (completed) patient_items from this patient to the current time so that
         subsequent queries will know they have already been accounted for.
+
+        Produces the same counts as checking every (item1, item2) pair in turn in a nested loop,
+        but sorts the timeline once, so the non-negative time pairs for each item1 are a contiguous range found by bisection,
+        then enumerates and aggregates the pairs in numpy array blocks.  Time window buckets are assigned by
+        bisection of the pair time differences against the sorted window sizes, then accumulated into the
+        cumulative count_<seconds> fields, and first occurrence (patient / encounter uniqueness) is tracked
+        with sorted arrays of the pair keys seen so far rather than per pair set lookups.
         """
-        # Keep track of which items to mark as newly analyzed
-        newlyAnalyzedPatientItemIdSet = set();
-
-        # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
-        subsequentItemIds = set();
-        # Keep track of all item pairs encountered to avoid counting patient level duplicates
-        encounterIdPairsByItemIdPair = dict();
-
-        patientId = None;
-        for iItem1, patientItem1 in enumerate(patientItemList):
-            if patientId is None:
-                patientId = patientItem1["patient_id"];
-
-            subsequentItemIds.clear();
-
-            for iItem2, patientItem2 in enumerate(patientItemList):
-                itemIdPair = (patientItem1["clinical_item_id"], patientItem2["clinical_item_id"]);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
-
-                # Verify is not a previously composite linked item pair, in which case no meaningful asssociation stats to calculate
-                #   and that the item dates are in non-negative direction
-                isPairToAnalyze = self.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId );
-                if isPairToAnalyze:
-                    if (patientItem1["analyze_date"] is None or patientItem2["analyze_date"] is None):
-                        # Record the stat update if this pair has not already been analyzed/recorded before
-                        isNewSubsequentItem = patientItem2["clinical_item_id"] not in subsequentItemIds;   # Track repeats
-                        isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
-                        isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
-
-                        self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions );
-
-                        if patientItem1["analyze_date"] is None:
-                            newlyAnalyzedPatientItemIdSet.add(patientItem1["patient_item_id"]);
-                        if patientItem2["analyze_date"] is None:
-                            newlyAnalyzedPatientItemIdSet.add(patientItem2["patient_item_id"]);
-                    subsequentItemIds.add(patientItem2["clinical_item_id"]);
-
-                    if itemIdPair not in encounterIdPairsByItemIdPair:
-                        encounterIdPairsByItemIdPair[itemIdPair] = set();
-                    encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+        if linkedItemIdsByBaseId is None:
+            linkedItemIdsByBaseId = dict();
+        if "analyzedPatientItemIds" not in updateBuffer:
+            updateBuffer["analyzedPatientItemIds"] = set();
+        if "associationCounts" not in updateBuffer:
+            updateBuffer["associationCounts"] = AssociationCountBuffer();
+        associationCounts = updateBuffer["associationCounts"];
+
+        nItems = len(patientItemList);
+        if nItems < 1:
+            return;
+
+        # Determine which time threshold count windows to update
+        if analysisOptions is not None and analysisOptions.deltaSecondsOptions is not None:
+            deltaSecondsOptions = analysisOptions.deltaSecondsOptions;
+        else:
+            deltaSecondsOptions = list(DELTA_NAME_BY_SECONDS.keys());
+        deltaSecondsOptions = np.array(sorted(set(deltaSecondsOptions)), dtype=np.int64);
+
+        # Sort the timeline once (stable, so is unchanged if already ordered by item_date) and convert into parallel numeric arrays
+        patientItemList = sorted(patientItemList, key=lambda patientItem: patientItem["item_date"]);
+        baseDate = patientItemList[0]["item_date"];
+        microseconds = np.array([(patientItem["item_date"]-baseDate) // ONE_MICROSECOND for patientItem in patientItemList], dtype=np.int64);
+        clinicalItemIds = np.array([patientItem["clinical_item_id"] for patientItem in patientItemList], dtype=np.int64);
+        (itemIds, itemIndexes) = np.unique(clinicalItemIds, return_inverse=True);
+        nItemIds = len(itemIds);
+        encounterIndexByEncounterId = dict();
+        encounterIndexes = np.array([encounterIndexByEncounterId.setdefault(patientItem["encounter_id"], len(encounterIndexByEncounterId)) for patientItem in patientItemList], dtype=np.int64);
+        nEncounters = len(encounterIndexByEncounterId);
+        isAnalyzed = np.array([patientItem["analyze_date"] is not None for patientItem in patientItemList], dtype=bool);
+        isNewlyAnalyzed = np.zeros(nItems, dtype=bool);
+
+        # Composite linked item pairs to exclude (either direction), as sorted item index pair codes
+        indexByItemId = dict( (itemId, index) for index, itemId in enumerate(itemIds.tolist()) );
+        excludedCodes = list();
+        for itemId1, index1 in indexByItemId.items():
+            if itemId1 in linkedItemIdsByBaseId:
+                for itemId2 in linkedItemIdsByBaseId[itemId1]:
+                    if itemId2 in indexByItemId:
+                        index2 = indexByItemId[itemId2];
+                        excludedCodes.append(index1*nItemIds + index2);
+                        excludedCodes.append(index2*nItemIds + index1);
+        excludedCodes = np.unique(np.array(excludedCodes, dtype=np.int64));
+
+        # Pair codes (and encounter specific pair codes) seen so far, to identify first occurrences
+        seenPairCodes = np.zeros(0, dtype=np.int64);
+        seenEncounterPairCodes = np.zeros(0, dtype=np.int64);
+
+        # Each item1 pairs with every item2 from the first one at the same time or later (including ties that come earlier in the list)
+        pairStarts = np.searchsorted(microseconds, microseconds, side="left");
+        pairLengths = nItems - pairStarts;
+
+        for (iStart, iEnd, item1, item2) in iterPairBlocks(pairStarts, pairLengths):
+            pairCodes = itemIndexes[item1]*nItemIds + itemIndexes[item2];
+            if len(excludedCodes) > 0:
+                isAcceptable = ~np.isin(pairCodes, excludedCodes);
+                (item1, item2, pairCodes) = (item1[isAcceptable], item2[isAcceptable], pairCodes[isAcceptable]);
+
+            # First occurrences of each item pair for the patient, and within an encounter
+            (isNewPair, seenPairCodes) = markFirstOccurrences(pairCodes, seenPairCodes);
+
+            isNewPairWithinEncounter = np.zeros(len(pairCodes), dtype=bool);
+            sameEncounterIndexes = np.flatnonzero(encounterIndexes[item1] == encounterIndexes[item2]);
+            encounterPairCodes = pairCodes[sameEncounterIndexes]*nEncounters + encounterIndexes[item1[sameEncounterIndexes]];
+            (isNewEncounterPair, seenEncounterPairCodes) = markFirstOccurrences(encounterPairCodes, seenEncounterPairCodes);
+            isNewPairWithinEncounter[sameEncounterIndexes[isNewEncounterPair]] = True;
+
+            # Only record stat updates for pairs that have not already been analyzed/recorded before
+            isToRecord = ~(isAnalyzed[item1] & isAnalyzed[item2]);
+            isNewlyAnalyzed[item1[isToRecord & ~isAnalyzed[item1]]] = True;
+            isNewlyAnalyzed[item2[isToRecord & ~isAnalyzed[item2]]] = True;
+            (item1, item2, pairCodes) = (item1[isToRecord], item2[isToRecord], pairCodes[isToRecord]);
+            isNewPair = isNewPair[isToRecord];
+            isNewPairWithinEncounter = isNewPairWithinEncounter[isToRecord];
+            if len(pairCodes) > 0:
+                secondsDelta = (microseconds[item2] - microseconds[item1]) // MICROSECONDS_PER_SECOND;
+                windowIndexes = np.searchsorted(deltaSecondsOptions, secondsDelta, side="left");  # Smallest time window that includes the pair
+                self.addPairCountsToBuffer(associationCounts, itemIds, nItemIds, deltaSecondsOptions, pairCodes, secondsDelta, windowIndexes, isNewPair, isNewPairWithinEncounter);
 
             # Update progress meter if available
             if progress is not None:
-                progress.Update();
+                progress.Update(iEnd-iStart);
+
+        updateBuffer["nAssociations"] = len(associationCounts);
 
         # Record this analysis date to any unmarked records
-        if "analyzedPatientItemIds" not in updateBuffer:
-            updateBuffer["analyzedPatientItemIds"] = set();
+        newlyAnalyzedPatientItemIdSet = set( patientItemList[iItem]["patient_item_id"] for iItem in np.flatnonzero(isNewlyAnalyzed) );
         updateBuffer["analyzedPatientItemIds"].update(newlyAnalyzedPatientItemIdSet);
 
+    def addPairCountsToBuffer(self, associationCounts, itemIds, nItemIds, deltaSecondsOptions, pairCodes, secondsDelta, windowIndexes, isNewPair, isNewPairWithinEncounter):
+        """Aggregate a block of (item index pair code) observations into count increments per item pair and add them to the buffer.
+        Equivalent to calling updateClinicalItemAssociationBuffer for each observation.
+        """
+        nWindows = len(deltaSecondsOptions);
+        (uniqueCodes, pairIndexes) = np.unique(pairCodes, return_inverse=True);
+        nPairs = len(uniqueCodes);
+        secondsDelta = secondsDelta.astype(np.float64);
+
+        fields = list();
+        columns = list();
+        # Count variant prefixes to use based on classifications of new items
+        for countPrefix, isCounted in (("", None), ("patient_", isNewPair), ("encounter_", isNewPairWithinEncounter)):
+            (prefixIndexes, prefixWindows, prefixDelta) = (pairIndexes, windowIndexes, secondsDelta);
+            if isCounted is not None:
+                (prefixIndexes, prefixWindows, prefixDelta) = (pairIndexes[isCounted], windowIndexes[isCounted], secondsDelta[isCounted]);
+            if len(prefixIndexes) < 1:
+                continue;
+
+            fields.append(countPrefix+"count_any");
+            columns.append(np.bincount(prefixIndexes, minlength=nPairs));
+
+            # Counts per smallest time window, then accumulate into the larger windows that also include them
+            windowCounts = np.bincount(prefixIndexes*(nWindows+1) + prefixWindows, minlength=nPairs*(nWindows+1)).reshape(nPairs, nWindows+1);
+            windowCounts = np.cumsum(windowCounts, axis=1);
+            for iWindow, secondsOption in enumerate(deltaSecondsOptions.tolist()):
+                fields.append(countPrefix+"count_%d" % secondsOption);
+                columns.append(windowCounts[:,iWindow]);
+
+            fields.append(countPrefix+"time_diff_sum");
+            columns.append(np.bincount(prefixIndexes, weights=prefixDelta, minlength=nPairs));
+            fields.append(countPrefix+"time_diff_sum_squares");
+            columns.append(np.bincount(prefixIndexes, weights=prefixDelta**2, minlength=nPairs));
+
+        counts = np.column_stack(columns).astype(np.float64);
+        isUsed = counts.any(axis=0);    # Don't bother adding count fields with nothing to increment
+        fields = [field for field, used in zip(fields, isUsed) if used];
+        pairKeys = pairKeyArray(itemIds[uniqueCodes // nItemIds], itemIds[uniqueCodes % nItemIds]);
+        associationCounts.merge(AssociationCountBuffer.fromArrays(fields, pairKeys, counts[:,isUsed]));
+
     def updateClinicalItemAssociationBuffer(self, patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions=None, itemIdPair=None):
         """Identify and record in the updateBuffer which statistics on associations
         between the two clinical items based on the new piece of observed item pair evidence given.
@@ -304,37 +514,32 @@ class AssociationAnalysis:
         if isNewPairWithinEncounter:
             countPrefixes.append("encounter_");
 
-        if "incrementDataByItemIdPair" not in updateBuffer:
-            updateBuffer["incrementDataByItemIdPair"] = dict();
+        if "associationCounts" not in updateBuffer:
+            updateBuffer["associationCounts"] = AssociationCountBuffer();
             updateBuffer["nAssociations"] = 0;
-        if str(itemIdPair) not in updateBuffer["incrementDataByItemIdPair"]:
-            updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)] = dict();
-            updateBuffer["nAssociations"] += 1;
-        incrementData = updateBuffer["incrementDataByItemIdPair"][str(itemIdPair)];
+        associationCounts = updateBuffer["associationCounts"];
+        row = associationCounts.row(itemIdPair);
+        updateBuffer["nAssociations"] = len(associationCounts);
 
         # Decide on columns to increment pair association with time dependency
+        incrementFields = list();
+        incrementValues = list();
         for countPrefix in countPrefixes:
-            countField = countPrefix+"count_any";
-            if countField not in incrementData:
-                incrementData[countField] = 0;
-            incrementData[countField] += 1;
+            incrementFields.append(countPrefix+"count_any");
+            incrementValues.append(1);
 
             for secondsOption in deltaSecondsOptions:
                 if secondsDelta <= secondsOption:
-                    countField = countPrefix+"count_%d" % secondsOption;
-                    if countField not in incrementData:
-                        incrementData[countField] = 0;
-                    incrementData[countField] += 1;
+                    incrementFields.append(countPrefix+"count_%d" % secondsOption);
+                    incrementValues.append(1);
 
-            sumField = countPrefix+"time_diff_sum";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta;
+            incrementFields.append(countPrefix+"time_diff_sum");
+            incrementValues.append(secondsDelta);
 
-            sumField = countPrefix+"time_diff_sum_squares";
-            if sumField not in incrementData:
-                incrementData[sumField] = 0;
-            incrementData[sumField] += secondsDelta**2;
+            incrementFields.append(countPrefix+"time_diff_sum_squares");
+            incrementValues.append(secondsDelta**2);
+
+        associationCounts.incrementRow(row, incrementFields, incrementValues);
 
     def readyForIntervalCommit(self, iPatient, updateBuffer, analysisOptions):
         isReady = False;
@@ -349,34 +554,22 @@ class AssociationAnalysis:
         else:
             bufferOne["analyzedPatientItemIds"].update(bufferTwo["analyzedPatientItemIds"]);
 
-        if "nAssociations" not in bufferOne:
-            bufferOne["nAssociations"] = 0
-        else:
-             bufferOne["nAssociations"] = bufferOne["nAssociations"] + bufferTwo["nAssociations"]
-
-        if "incrementDataByItemIdPair" not in bufferOne:
-            bufferOne["incrementDataByItemIdPair"] = dict()
-        if "incrementDataByItemIdPair" not in bufferTwo:
-            bufferTwo["incrementDataByItemIdPair"] = dict()
+        self.compactUpdateBuffer(bufferOne);
+        self.compactUpdateBuffer(bufferTwo);
+        if "associationCounts" not in bufferOne:
+            bufferOne["associationCounts"] = AssociationCountBuffer();
 
-        # then fill up any remaining id pairs from buffer two. if you have some in buffer two that are also in buffer one, then add those specific ones together
-        for key, value in bufferTwo["incrementDataByItemIdPair"].items():
-            if key not in bufferOne["incrementDataByItemIdPair"]:
-                bufferOne["incrementDataByItemIdPair"][key] = bufferTwo["incrementDataByItemIdPair"][key]
-            else:
-                for key2, value2 in bufferTwo["incrementDataByItemIdPair"][key].items():
-                    if key2 not in bufferOne["incrementDataByItemIdPair"][key]:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]=bufferTwo["incrementDataByItemIdPair"][key][key2]
-                    else:
-                        bufferOne["incrementDataByItemIdPair"][key][key2]+=bufferTwo["incrementDataByItemIdPair"][key][key2]
+        # Add up the counts for any item pairs in both buffers, and fill in any remaining pairs only in buffer two
+        if "associationCounts" in bufferTwo:
+            bufferOne["associationCounts"].merge(bufferTwo["associationCounts"]);
+        bufferOne["nAssociations"] = len(bufferOne["associationCounts"]);
 
         return bufferOne
 
     def bufferDecay (self, bufferDecay, decayValue):
-        if "incrementDataByItemIdPair" in bufferDecay:
-            for key, value in bufferDecay["incrementDataByItemIdPair"].items():
-                for key2, value2 in bufferDecay["incrementDataByItemIdPair"][key].items():
-                    bufferDecay["incrementDataByItemIdPair"][key][key2] *= decayValue
+        self.compactUpdateBuffer(bufferDecay);
+        if "associationCounts" in bufferDecay:
+            bufferDecay["associationCounts"].decay(decayValue);
         return bufferDecay
 
 
@@ -385,45 +578,105 @@ class AssociationAnalysis:
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
             self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn)
         else:
-            bufferFilename = "%s.%s.json.gz" % (analysisOptions.bufferFile, iPatient);    # Modify filename with which patient done so far, in case saving several sequential results
+            bufferFilename = "%s.%s%s" % (analysisOptions.bufferFile, iPatient, BUFFER_FILE_SUFFIX);    # Modify filename with which patient done so far, in case saving several sequential results
             self.saveBufferToFile(bufferFilename, updateBuffer);
 
     def saveBufferToFile (self, filename, updateBuffer):
-        ofs = stdOpen (filename, "w");
-        updateBuffer["analyzedPatientItemIds"] = list(updateBuffer["analyzedPatientItemIds"]);
-        json.dump(updateBuffer, ofs);
-        ofs.close();
+        """Save the buffer contents to the named file, in the binary (sorted, memory mappable) buffer file format,
+        unless the filename indicates the legacy (gzip) JSON format (*.json or *.json.gz).
+        """
+        if ".json" in os.path.basename(filename):
+            ofs = stdOpen (filename, "w");
+            # JSON file format retains the original incrementDataByItemIdPair (str(tuple) keyed) structure
+            bufferData = dict(updateBuffer);
+            bufferData["analyzedPatientItemIds"] = list(updateBuffer["analyzedPatientItemIds"]);
+            if "associationCounts" in bufferData:
+                bufferData["incrementDataByItemIdPair"] = bufferData.pop("associationCounts").toIncrementData();
+            json.dump(bufferData, ofs);
+            ofs.close();
+        else:
+            self.compactUpdateBuffer(updateBuffer);
+            associationCounts = updateBuffer.get("associationCounts", AssociationCountBuffer());
+            saveBufferFile(filename, associationCounts, updateBuffer.get("analyzedPatientItemIds",()) );
 
         # Wipe out buffer to reflect incremental changes done, so any new ones should be recorded fresh
         updateBuffer = self.makeUpdateBuffer(updateBuffer);
 
     def loadUpdateBufferFromFile(self, filename):
+        """Load a buffer from the named file.  If there is no such file, then treat the filename as a prefix
+        for a series of enumerated files and merge them all into one mass buffer.
+        Binary format buffer files are merged in a single streaming pass (see iterMergedBufferFiles),
+        while any legacy JSON files are loaded and merged one at a time.
+        """
         updateBuffer = None;
-        try:
-            #print >> sys.stderr, filename
+        if os.path.isfile(filename):
             log.info("Loading: %s" % filename);
-            ifs = stdOpen(filename, "r")
-            updateBuffer = json.load(ifs)
-            updateBuffer["analyzedPatientItemIds"] = set(updateBuffer["analyzedPatientItemIds"])
-            ifs.close()
-        except IOError as exc:
+            if isBufferFile(filename):
+                updateBuffer = self.loadBufferFiles([filename]);
+            else:
+                ifs = stdOpen(filename, "r")
+                updateBuffer = json.load(ifs)
+                updateBuffer["analyzedPatientItemIds"] = set(updateBuffer["analyzedPatientItemIds"])
+                ifs.close()
+                self.compactUpdateBuffer(updateBuffer);
+        else:
             # Apparently could not find the named filename. See if instead it's a prefix
             #    for a series of enumerated files and then merge them into one mass buffer
-            dirname = os.path.dirname(filename);
-            if dirname == "": dirname = ".";    # Implicitly the current working directory
-            basename = os.path.basename(filename);
-            for nextFilename in os.listdir(dirname):
-                if nextFilename.startswith(basename):
-                    nextFilepath = os.path.join(dirname, nextFilename);
+            binaryFilenames = list();
+            for nextFilepath in self.bufferFilenamesByPrefix(filename):
+                if isBufferFile(nextFilepath):
+                    binaryFilenames.append(nextFilepath);
+                else:
                     nextUpdateBuffer = self.loadUpdateBufferFromFile(nextFilepath);
                     if updateBuffer is None:    # First update buffer, use it as base
                         updateBuffer = nextUpdateBuffer;
                     else:    # Have existing update buffer. Just update it's contents with the next one
                         updateBuffer = self.mergeBuffers(updateBuffer, nextUpdateBuffer);
                         del nextUpdateBuffer;	# Make sure memory gets reclaimed
+            if binaryFilenames:
+                log.info("Loading: %d buffer files with prefix %s" % (len(binaryFilenames), filename) );
+                binaryBuffer = self.loadBufferFiles(binaryFilenames);
+                if updateBuffer is None:
+                    updateBuffer = binaryBuffer;
+                else:
+                    updateBuffer = self.mergeBuffers(updateBuffer, binaryBuffer);
 
         return updateBuffer;
 
+    def bufferFilenamesByPrefix(self, filenamePrefix):
+        """List of (existing) file paths that start with the given filename prefix"""
+        dirname = os.path.dirname(filenamePrefix);
+        if dirname == "": dirname = ".";    # Implicitly the current working directory
+        basename = os.path.basename(filenamePrefix);
+        filenames = list();
+        for nextFilename in sorted(os.listdir(dirname)):
+            nextFilepath = os.path.join(dirname, nextFilename);
+            if nextFilename.startswith(basename) and os.path.isfile(nextFilepath):
+                filenames.append(nextFilepath);
+        return filenames;
+
+    def loadBufferFiles(self, filenames):
+        """Load and merge the given binary buffer files into a new update buffer,
+        streaming through the memory mapped file contents in pair key order, so only the merged result is held in memory.
+        """
+        updateBuffer = self.makeUpdateBuffer();
+        associationCounts = updateBuffer["associationCounts"];
+        for filename in filenames:
+            (fields, pairKeys, counts, analyzedPatientItemIds) = loadBufferFile(filename);
+            updateBuffer["analyzedPatientItemIds"].update(analyzedPatientItemIds.tolist());
+        for (fields, pairKeys, counts) in iterMergedBufferFiles(filenames):
+            associationCounts.merge(AssociationCountBuffer.fromArrays(fields, pairKeys, counts));
+        updateBuffer["nAssociations"] = len(associationCounts);
+        return updateBuffer;
+
+    def mergeBufferFiles(self, filenamePrefix, outputFilename):
+        """Merge all of the binary buffer files with the given filename prefix into one output buffer file,
+        streaming through them without loading them all into memory.
+        """
+        filenames = [filename for filename in self.bufferFilenamesByPrefix(filenamePrefix) if isBufferFile(filename)];
+        log.info("Merging %d buffer files with prefix %s into %s" % (len(filenames), filenamePrefix, outputFilename) );
+        mergeBufferFiles(filenames, outputFilename);
+
     def commitUpdateBufferFromFile(self, filename):
         conn = self.connFactory.connection();
         updateBuffer = self.loadUpdateBufferFromFile(filename);
@@ -440,9 +693,26 @@ class AssociationAnalysis:
         if not extConn:
             conn = self.connFactory.connection();
         try:
-            if "incrementDataByItemIdPair" in updateBuffer:
+            self.compactUpdateBuffer(updateBuffer);
+            if "associationCounts" in updateBuffer:
+                # If stored counts are lazily decayed, pre-scale the increments to match (see DecayingWindows)
+                decayScale = self.dataManager.loadAssociationDecayScale(conn=conn);
+                if decayScale != 1.0:
+                    associationCounts = updateBuffer["associationCounts"];
+                    associationCounts.decay(1.0/decayScale, [field for field in associationCounts.fields if isDecayScaledField(field)]);
+            if self.bulkCommit and DBUtil.Env.DATABASE_CONNECTOR_NAME not in BULK_COMMIT_CONNECTORS:
+                log.warning("Bulk commit not supported for %s database connections. Using per item pair update queries." % DBUtil.Env.DATABASE_CONNECTOR_NAME );
+                self.bulkCommit = False;
+
+            if self.bulkCommit:
+                if "associationCounts" in updateBuffer:
+                    self.bulkIncrementItemAssociations(updateBuffer["associationCounts"], linkedItemIdsByBaseId, conn);
+                if "analyzedPatientItemIds" in updateBuffer:
+                    self.bulkRecordAnalyzedItems(updateBuffer["analyzedPatientItemIds"], conn);
+            elif "associationCounts" in updateBuffer:
+                associationCounts = updateBuffer["associationCounts"];
                 # Ensure baseline records exist to facilitate subsequent incremental update queries
-                itemIdPairs = list(updateBuffer["incrementDataByItemIdPair"].keys());
+                itemIdPairs = list(associationCounts.itemIdPairs());
                 self.prepareItemAssociations(itemIdPairs, linkedItemIdsByBaseId, conn);
 
                 # Construct incremental update queries based on each item pair's incremental counts/sums
@@ -452,7 +722,9 @@ class AssociationAnalysis:
                 incrementProg.total = nItemPairs;
                 cursor = conn.cursor();
                 try:
-                    for (itemIdPair, incrementData) in updateBuffer["incrementDataByItemIdPair"].items():
+                    for (itemIdPair, incrementData) in associationCounts.items():
+                        if not incrementData:
+                            continue;   # Nothing to increment (e.g., all counts decayed to zero)
                         query = ["UPDATE clinical_item_association SET"];
                         for col, increment in incrementData.items():
                             query.append("%(col)s=%(col)s+%(increment)s" % {"col":col,"increment":increment});
@@ -460,14 +732,13 @@ class AssociationAnalysis:
                         query.pop();    # Drop extra comma at end of list
                         query.append("WHERE clinical_item_id=%(p)s AND subsequent_item_id=%(p)s" % {"p":DBUtil.SQL_PLACEHOLDER} );
                         query = str.join(" ", query);
-                        itemIdPair = eval(itemIdPair)
                         cursor.execute(query, itemIdPair);
                         incrementProg.update();
                     # incrementProg.printStatus();
                 finally:
                     cursor.close();
 
-            if "analyzedPatientItemIds" in updateBuffer:
+            if not self.bulkCommit and "analyzedPatientItemIds" in updateBuffer:
                 # Record analysis date for the given patient items
                 patientItemIdSet = updateBuffer["analyzedPatientItemIds"];
                 nItems = len(patientItemIdSet);
@@ -518,16 +789,96 @@ class AssociationAnalysis:
             if not extConn:
                 conn.close();
 
+    def bulkIncrementItemAssociations(self, associationCounts, linkedItemIdsByBaseId, conn):
+        """Set-based alternative to prepareItemAssociations and the per item pair increment update queries.
+        Stream the buffered increments into a temporary staging table (COPY for PostgreSQL, executemany batches otherwise),
+        then insert all of the baseline (zero) records and apply all of the increments with one query each.
+        """
+        if len(associationCounts) < 1:
+            return;
+        fields = associationCounts.fields;
+        timer = time.time();
+
+        # Baseline records for all combinations of the items involved, excluding (composite) linked item pairs
+        clinicalItemIdSet = set();
+        for (itemId1, itemId2) in associationCounts.itemIdPairs():
+            clinicalItemIdSet.add(itemId1);
+            clinicalItemIdSet.add(itemId2);
+        linkedItemIdPairs = list();
+        for itemId1 in clinicalItemIdSet:
+            if itemId1 in linkedItemIdsByBaseId:
+                for itemId2 in linkedItemIdsByBaseId[itemId1]:
+                    if itemId2 in clinicalItemIdSet:
+                        linkedItemIdPairs.append( (itemId1, itemId2) );
+
+        DBUtil.execute("create temporary table temp_association_item (clinical_item_id BIGINT)", conn=conn);
+        DBUtil.execute("create temporary table temp_association_link (clinical_item_id BIGINT, linked_item_id BIGINT)", conn=conn);
+        DBUtil.execute("create temporary table temp_association_increment (clinical_item_id BIGINT, subsequent_item_id BIGINT, %s)" % str.join(", ", ["%s DOUBLE PRECISION" % field for field in fields]), conn=conn);
+        try:
+            DBUtil.bulkInsertRows("temp_association_item", ["clinical_item_id"], [(itemId,) for itemId in clinicalItemIdSet], conn=conn);
+            DBUtil.bulkInsertRows("temp_association_link", ["clinical_item_id","linked_item_id"], linkedItemIdPairs, conn=conn);
+            nItemPairs = DBUtil.bulkInsertRows("temp_association_increment", ["clinical_item_id","subsequent_item_id"]+fields, associationCounts.iterRows(), conn=conn);
+
+            log.debug("Ensure %d baseline records ready" % (len(clinicalItemIdSet)**2) );
+            DBUtil.execute \
+            (   """insert into clinical_item_association (clinical_item_id, subsequent_item_id)
+                select item1.clinical_item_id, item2.clinical_item_id
+                from temp_association_item as item1 cross join temp_association_item as item2
+                where not exists
+                (   select 1 from temp_association_link as link
+                    where (link.clinical_item_id = item1.clinical_item_id and link.linked_item_id = item2.clinical_item_id)
+                    or (link.clinical_item_id = item2.clinical_item_id and link.linked_item_id = item1.clinical_item_id)
+                )
+                on conflict (clinical_item_id, subsequent_item_id) do nothing
+                """,
+                conn=conn
+            );
+
+            log.debug("Primary increment updates for %d item pairs" % nItemPairs );
+            DBUtil.execute \
+            (   """update clinical_item_association
+                set %s
+                from temp_association_increment as increment
+                where clinical_item_association.clinical_item_id = increment.clinical_item_id
+                and clinical_item_association.subsequent_item_id = increment.subsequent_item_id
+                """ % str.join(", ", ["%(col)s = clinical_item_association.%(col)s + increment.%(col)s" % {"col": field} for field in fields]),
+                conn=conn
+            );
+        finally:
+            DBUtil.execute("drop table temp_association_increment", conn=conn);
+            DBUtil.execute("drop table temp_association_link", conn=conn);
+            DBUtil.execute("drop table temp_association_item", conn=conn);
+        log.debug("%.3f seconds for bulk increment of %d item pairs" % (time.time()-timer, nItemPairs) );
+
+    def bulkRecordAnalyzedItems(self, patientItemIdSet, conn):
+        """Set-based alternative to marking patient_item analyze_dates with (chunks of) growing IN clause lists.
+        Stream the patient item IDs into a temporary staging table and update them with a single query.
+        """
+        nItems = len(patientItemIdSet);
+        log.debug("Record %d analyzed items" % nItems );
+        if nItems < 1:
+            return;
+        DBUtil.execute("create temporary table temp_analyzed_item (patient_item_id BIGINT)", conn=conn);
+        try:
+            DBUtil.bulkInsertRows("temp_analyzed_item", ["patient_item_id"], [(itemId,) for itemId in patientItemIdSet], conn=conn);
+            DBUtil.execute \
+            (   """update patient_item
+                set analyze_date = %(p)s
+                where patient_item_id in (select patient_item_id from temp_analyzed_item)
+                and analyze_date is null
+                """ % {"p": DBUtil.SQL_PLACEHOLDER},
+                (datetime.now(),),
+                conn=conn
+            );
+        finally:
+            DBUtil.execute("drop table temp_analyzed_item", conn=conn);
+
     def prepareItemAssociations(self, itemIdPairs, linkedItemIdsByBaseId, conn):
         """Make sure all pair-wise item association records are ready / initialized
         so that subsequent queries don't have to pause to check for their existence.
         Should help greatly to reduce number of queries and execution time.
         """
         clinicalItemIdSet = set();
-        #Do the below to convert the list of strings into a list of pairs, which is needed for the rest of this function
-        for index, pair in enumerate(itemIdPairs):
-            itemIdPairs[index]=eval(pair)
-
         for (itemId1, itemId2) in itemIdPairs:
             clinicalItemIdSet.add(itemId1);
             clinicalItemIdSet.add(itemId2);
@@ -576,6 +927,9 @@ class AssociationAnalysis:
         return isAcceptable;
 
     def acceptableClinicalItemIdPair(self, itemId1, itemId2, linkedItemIdsByBaseId):
+        if hasattr(linkedItemIdsByBaseId, "isLinkedPair"):
+            # Precomputed ClinicalItemLinkIndex
+            return not linkedItemIdsByBaseId.isLinkedPair(itemId1, itemId2);
         isAcceptable = True;
         isAcceptable = isAcceptable and (itemId1 not in linkedItemIdsByBaseId or itemId2 not in linkedItemIdsByBaseId[itemId1]);
         isAcceptable = isAcceptable and (itemId2 not in linkedItemIdsByBaseId or itemId1 not in linkedItemIdsByBaseId[itemId2]);
@@ -592,7 +946,10 @@ class AssociationAnalysis:
         parser.add_option("-p", "--patientsPerCommit", dest="patientsPerCommit", help="If provided, will commit incremental analysis results to the database after every p patients.  If not set, will just wait until full analysis to commit all (will keep more in memory, and will lose progress if script aborted during mid-execution).  Beware that large values are more efficient, but requires more runtime memory which can exceed memory limits.")
         parser.add_option("-a", "--associationsPerCommit", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit. 1M seems to just fit within 7.5GB memory (assuming 64-bit Python). Running batches of 3000 patients with ~3000 possible clinical items yields ~5M associations requiring ~25GB memory for learning then ~45GB memory to reload and commit a buffer file.")
         parser.add_option("-u", "--itemsPerUpdate", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query. (e.g., 10,000)")
+        parser.add_option("-n", "--processes", dest="processes", help="If provided, split the patients into shards to analyze in parallel with this many worker processes, then merge the results to commit once. Interval commit options (-p, -a) are ignored in this case.")
+        parser.add_option("-k", "--bulkCommit", dest="bulkCommit", action="store_true", help="If set, commit analysis results to the database by streaming them into temporary staging tables (COPY for PostgreSQL) and applying set-based update queries, instead of one update query per item pair. Requires database support for INSERT ... ON CONFLICT and UPDATE ... FROM (PostgreSQL 9.5+, SQLite 3.33+).")
         parser.add_option("-b", "--bufferFile", dest="bufferFile", help="If provided, send buffer to output file rather than commiting to database. If patientIds arguments and idFile parameter are blank, then instead read in bufferFile from this filename (prefix) and commit to database.")
+        parser.add_option("-m", "--mergeBufferFile", dest="mergeBufferFile", help="If provided with a bufferFile (prefix) and no patientIds, merge all of the binary buffer files with that prefix into this single output buffer file rather than commiting to database.")
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -613,11 +970,16 @@ class AssociationAnalysis:
 
         if options.itemsPerUpdate is not None:
             self.itemsPerUpdate = int(options.itemsPerUpdate);
+        if options.bulkCommit:
+            self.bulkCommit = True;
 
         if analysisOptions.bufferFile is not None and not analysisOptions.patientIds:
             # Have a previously generated result buffer file and not trying to train on any patientID subset.
             # Just commit buffer file directly to database
-            self.commitUpdateBufferFromFile(analysisOptions.bufferFile);
+            if options.mergeBufferFile is not None:
+                self.mergeBufferFiles(analysisOptions.bufferFile, options.mergeBufferFile);
+            else:
+                self.commitUpdateBufferFromFile(analysisOptions.bufferFile);
         else:
             # Usual association analysis from scratch with option to commit direct to database or save to buffer file
             analysisOptions.startDate = None;
@@ -640,12 +1002,81 @@ class AssociationAnalysis:
                 self.patientsPerCommit = int(options.patientsPerCommit);
             if options.associationsPerCommit is not None:
                 self.associationsPerCommit = int(options.associationsPerCommit);
+            if options.processes is not None:
+                self.processes = int(options.processes);
 
             self.analyzePatientItems(analysisOptions);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
 
+def iterPairBlocks(pairStarts, pairLengths, blockSize=PAIR_BLOCK_SIZE):
+    """Each row i pairs with the contiguous range of column positions pairStarts[i] to pairStarts[i]+pairLengths[i].
+    Enumerate those pairs in the same order as a nested loop would, as (iStart, iEnd, rows, columns) arrays
+    for blocks of rows iStart to iEnd, so that the number of pairs enumerated at once is bounded by about blockSize.
+    """
+    nRows = len(pairStarts);
+    cumulativeLengths = np.cumsum(pairLengths);
+    iStart = 0;
+    while iStart < nRows:
+        priorLength = 0;
+        if iStart > 0:
+            priorLength = cumulativeLengths[iStart-1];
+        iEnd = max(iStart+1, int(np.searchsorted(cumulativeLengths, priorLength+blockSize, side="right")));
+        iEnd = min(iEnd, nRows);
+
+        lengths = pairLengths[iStart:iEnd];
+        blockOffsets = np.cumsum(lengths) - lengths;
+        rows = np.repeat(np.arange(iStart, iEnd), lengths);
+        columns = np.arange(lengths.sum()) + np.repeat(pairStarts[iStart:iEnd] - blockOffsets, lengths);
+        yield (iStart, iEnd, rows, columns);
+        iStart = iEnd;
+
+def markFirstOccurrences(codes, seenCodes):
+    """Flag the first occurrence of each value in the codes array that is not already in the (sorted) seenCodes array.
+    Returns the boolean flag array and the updated seenCodes array.
+    """
+    isFirst = np.zeros(len(codes), dtype=bool);
+    (uniqueCodes, firstIndexes) = np.unique(codes, return_index=True);
+    isUnseen = ~np.isin(uniqueCodes, seenCodes, assume_unique=True);
+    isFirst[firstIndexes[isUnseen]] = True;
+    return (isFirst, np.union1d(seenCodes, uniqueCodes));
+
+# Analyzer and clinical item link index of a worker process, set up once by initShardWorker for the shards the worker is sent
+shardWorkerAnalyzer = None;
+shardWorkerLinkedItemIdsByBaseId = None;
+
+def initShardWorker(analyzerClass, connParam):
+    """Worker process initializer for AssociationAnalysis.countPatientShardsParallel.
+    Construct an analyzer (of the same class as the parent's) with its own connection source,
+    and load the clinical item link index once for all of the shards the worker will be sent.
+    """
+    global shardWorkerAnalyzer, shardWorkerLinkedItemIdsByBaseId;
+    shardWorkerAnalyzer = analyzerClass();
+    shardWorkerAnalyzer.connFactory = DBUtil.ConnectionFactory(connParam);
+    shardWorkerAnalyzer.dataManager.connFactory = shardWorkerAnalyzer.connFactory;
+    conn = shardWorkerAnalyzer.connFactory.connection();
+    try:
+        shardWorkerLinkedItemIdsByBaseId = shardWorkerAnalyzer.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
+    finally:
+        conn.close();
+
+def analyzePatientShard(analysisOptions):
+    """Worker process function for AssociationAnalysis.analyzePatientItemsParallel.
+    Count associations for one shard of patients into a new update buffer and return it.
+    Module level function so it can be sent to a multiprocessing pool.
+    """
+    conn = shardWorkerAnalyzer.connFactory.connection();
+    try:
+        return shardWorkerAnalyzer.countPatientShard(analysisOptions, shardWorkerLinkedItemIdsByBaseId, conn=conn);
+    finally:
+        conn.close();
+
+def mergeBufferPair(bufferPair):
+    """Worker process function to merge two update buffers, for AssociationAnalysis.reduceBuffers"""
+    (bufferOne, bufferTwo) = bufferPair;
+    return shardWorkerAnalyzer.mergeBuffers(bufferOne, bufferTwo);
+
 if __name__ == "__main__":
     instance = AssociationAnalysis();
     instance.main(sys.argv);
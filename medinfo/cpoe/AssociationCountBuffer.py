@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Compact in memory buffer of clinical_item_association count increments,
+for AssociationAnalysis to accumulate item pair statistics before committing them to the database.
+"""
+
+import sys, os
+import json;
+import numpy as np;
+
+# Number of item pair rows to preallocate for a new buffer.  Will double in size whenever more are needed.
+INITIAL_CAPACITY = 1024;
+
+# Mask for the lower 32 bits of a pair key
+LOWER_32_BITS = 0xFFFFFFFF;
+
+# Binary buffer file format.  Fixed size header block (magic string, then JSON description padded with spaces),
+#   then records of (pairKey, counts...) sorted by pair key, then the analyzed patient_item IDs.
+BUFFER_FILE_SUFFIX = ".counts.bin";
+BUFFER_FILE_MAGIC = b"ASSOCBUF";
+BUFFER_FILE_HEADER_SIZE = 4096;
+
+# Number of records to write or merge at a time when streaming buffer files
+FILE_CHUNK_SIZE = 100000;
+
+def pairKey(itemId1, itemId2):
+    """Combine a pair of (32 bit, possibly negative) clinical item IDs into a single 64 bit integer key"""
+    return (int(itemId1) << 32) | (int(itemId2) & LOWER_32_BITS);
+
+def pairKeyArray(itemIds1, itemIds2):
+    """Vectorized version of pairKey for parallel arrays of clinical item IDs"""
+    itemIds1 = np.asarray(itemIds1, dtype=np.int64);
+    itemIds2 = np.asarray(itemIds2, dtype=np.int64);
+    return (itemIds1 << 32) | (itemIds2 & LOWER_32_BITS);
+
+def itemIdPairFromKey(key):
+    """Reverse of pairKey.  Return the (itemId1, itemId2) tuple"""
+    key = int(key);
+    itemId1 = key >> 32;
+    itemId2 = ((key & LOWER_32_BITS) ^ 0x80000000) - 0x80000000; # Sign extend lower 32 bits
+    return (itemId1, itemId2);
+
+def parseItemIdPair(itemIdPairStr):
+    """Parse the str(tuple) item pair keys of legacy update buffers, e.g., "(-11, -6)", back into a tuple of ints"""
+    return tuple( int(itemIdStr) for itemIdStr in itemIdPairStr.strip("()").split(",") );
+
+class AssociationCountBuffer:
+    """Compact alternative to the original updateBuffer["incrementDataByItemIdPair"] dictionary,
+    which kept a str(tuple) key and a dictionary of up to ~50 count / time sum fields per item pair.
+
+    Here each item pair is mapped by a single integer key to a row of a preallocated
+    numeric counts matrix, with one column per count field (e.g., patient_count_3600).
+    Columns are added as new count fields are first used.
+    """
+    def __init__(self, fields=None, capacity=INITIAL_CAPACITY):
+        self.fields = list();   # Count field name per column
+        self.columnByField = dict();
+        self.rowByPairKey = dict();
+        self.pairKeys = np.zeros(capacity, dtype=np.int64);   # Pair key per row
+        self.counts = np.zeros((capacity, 0), dtype=np.float64);
+        self.nRows = 0;
+        if fields is not None:
+            for field in fields:
+                self.column(field);
+
+    def __len__(self):
+        """Number of item pairs in the buffer"""
+        return self.nRows;
+
+    def __contains__(self, itemIdPair):
+        return pairKey(*itemIdPair) in self.rowByPairKey;
+
+    def column(self, field):
+        """Return the column index for the named count field, adding a new column if not yet seen"""
+        if field not in self.columnByField:
+            self.columnByField[field] = len(self.fields);
+            self.fields.append(field);
+            self.counts = np.hstack( (self.counts, np.zeros((len(self.counts),1))) );
+        return self.columnByField[field];
+
+    def row(self, itemIdPair):
+        """Return the row index for the item pair, adding a new (zero) row if not yet seen"""
+        key = pairKey(*itemIdPair);
+        row = self.rowByPairKey.get(key);
+        if row is None:
+            row = self.addRows(np.array([key], dtype=np.int64))[0];
+        return row;
+
+    def addRows(self, keys):
+        """Append rows for the given (new) pair keys.  Return the array of new row indexes."""
+        nNew = len(keys);
+        self.reserve(self.nRows + nNew);
+        rows = np.arange(self.nRows, self.nRows+nNew);
+        self.pairKeys[rows] = keys;
+        for key, row in zip(keys.tolist(), rows.tolist()):
+            self.rowByPairKey[key] = row;
+        self.nRows += nNew;
+        return rows;
+
+    def reserve(self, capacity):
+        """Ensure preallocated space for at least the given number of rows, doubling capacity as needed"""
+        if capacity > len(self.pairKeys):
+            newCapacity = max(capacity, 2*len(self.pairKeys), INITIAL_CAPACITY);
+            pairKeys = np.zeros(newCapacity, dtype=np.int64);
+            pairKeys[:self.nRows] = self.pairKeys[:self.nRows];
+            counts = np.zeros((newCapacity, len(self.fields)), dtype=np.float64);
+            counts[:self.nRows] = self.counts[:self.nRows];
+            self.pairKeys = pairKeys;
+            self.counts = counts;
+
+    def increment(self, itemIdPair, field, value=1):
+        """Add the value to the count field for the item pair"""
+        row = self.row(itemIdPair);
+        column = self.column(field);
+        self.counts[row,column] += value;
+
+    def incrementRow(self, row, fields, values):
+        """Add the values to the respective count fields of a row index (as previously returned by row())"""
+        columns = [self.column(field) for field in fields];
+        self.counts[row,columns] += values;
+
+    def incrementData(self, itemIdPair):
+        """Dictionary of the non-zero count fields for the item pair, as in the legacy buffer format"""
+        return self.rowIncrementData(self.rowByPairKey[pairKey(*itemIdPair)]);
+
+    def rowIncrementData(self, row):
+        counts = self.counts[row];
+        incrementData = dict();
+        for column in np.flatnonzero(counts):
+            incrementData[self.fields[column]] = counts[column].item();
+        return incrementData;
+
+    def itemIdPairs(self):
+        """Iterator over all item pair tuples in the buffer, in row order"""
+        for key in self.pairKeys[:self.nRows].tolist():
+            yield itemIdPairFromKey(key);
+
+    def items(self):
+        """Iterator over (itemIdPair, incrementData) for all rows, equivalent to the legacy buffer dictionary items()"""
+        for row, itemIdPair in enumerate(self.itemIdPairs()):
+            yield (itemIdPair, self.rowIncrementData(row));
+
+    def iterRows(self, chunkSize=INITIAL_CAPACITY):
+        """Iterator over flat row lists of [itemId1, itemId2, count1, count2, ...] with counts in the order of self.fields,
+        e.g., to stream into a database table.  Converts the counts matrix a chunk at a time to limit memory use.
+        """
+        for start in range(0, self.nRows, chunkSize):
+            end = min(start+chunkSize, self.nRows);
+            pairKeys = self.pairKeys[start:end].tolist();
+            countRows = self.counts[start:end].tolist();
+            for key, countRow in zip(pairKeys, countRows):
+                yield list(itemIdPairFromKey(key)) + countRow;
+
+    def merge(self, other):
+        """Add all counts from the other buffer into this one.  Return self."""
+        if len(other) < 1:
+            return self;
+        columns = np.array([self.column(field) for field in other.fields], dtype=np.int64);
+
+        otherKeys = other.pairKeys[:other.nRows];
+        rows = np.fromiter( (self.rowByPairKey.get(key,-1) for key in otherKeys.tolist()), dtype=np.int64, count=len(otherKeys) );
+        isNew = (rows < 0);
+        if isNew.any():
+            rows[isNew] = self.addRows(otherKeys[isNew]);
+
+        # Rows are unique per pair key, so direct fancy index increment is safe
+        self.counts[rows[:,np.newaxis], columns[np.newaxis,:]] += other.counts[:other.nRows];
+        return self;
+
+    def decay(self, decayValue, fields=None):
+        """Scale all counts by the decay value (e.g., to diminish the weight of older data).
+        If fields specified, only scale those count fields.
+        """
+        if fields is None:
+            self.counts[:self.nRows] *= decayValue;
+        else:
+            for field in fields:
+                if field in self.columnByField:
+                    self.counts[:self.nRows, self.columnByField[field]] *= decayValue;
+        return self;
+
+    def trim(self):
+        """Release any preallocated space beyond the current rows"""
+        self.pairKeys = self.pairKeys[:self.nRows].copy();
+        self.counts = self.counts[:self.nRows].copy();
+
+    def __getstate__(self):
+        """Don't bother serializing (e.g., pickling to send between processes) the unused preallocated space"""
+        state = dict(self.__dict__);
+        state["pairKeys"] = self.pairKeys[:self.nRows];
+        state["counts"] = self.counts[:self.nRows];
+        return state;
+
+    def save(self, filename):
+        """Serialize the buffer contents to a (numpy .npz) file"""
+        with open(filename,"wb") as outFile:
+            np.savez_compressed(outFile, fields=np.array(self.fields, dtype=str), pairKeys=self.pairKeys[:self.nRows], counts=self.counts[:self.nRows]);
+
+    def load(filename):
+        """Return a new buffer loaded from a file previously generated by save()"""
+        with np.load(filename) as data:
+            return AssociationCountBuffer.fromArrays(data["fields"].tolist(), data["pairKeys"], data["counts"]);
+    load = staticmethod(load);
+
+    def fromArrays(fields, pairKeys, counts):
+        """Return a new buffer from parallel arrays of (unique) pair keys and count rows"""
+        countBuffer = AssociationCountBuffer(fields, capacity=len(pairKeys));
+        countBuffer.addRows(np.asarray(pairKeys, dtype=np.int64));
+        countBuffer.counts[:len(pairKeys)] = counts;
+        return countBuffer;
+    fromArrays = staticmethod(fromArrays);
+
+    def fromIncrementData(incrementDataByItemIdPair):
+        """Return a new buffer converted from a legacy incrementDataByItemIdPair dictionary (str(tuple) keys)"""
+        countBuffer = AssociationCountBuffer(capacity=len(incrementDataByItemIdPair));
+        for itemIdPair, incrementData in incrementDataByItemIdPair.items():
+            if isinstance(itemIdPair, str):
+                itemIdPair = parseItemIdPair(itemIdPair);
+            row = countBuffer.row(itemIdPair);
+            countBuffer.incrementRow(row, list(incrementData.keys()), list(incrementData.values()));
+        return countBuffer;
+    fromIncrementData = staticmethod(fromIncrementData);
+
+    def toIncrementData(self):
+        """Convert to a legacy incrementDataByItemIdPair dictionary (str(tuple) keys), e.g., for JSON serialization"""
+        incrementDataByItemIdPair = dict();
+        for itemIdPair, incrementData in self.items():
+            incrementDataByItemIdPair[str(itemIdPair)] = incrementData;
+        return incrementDataByItemIdPair;
+
+
+def recordDtype(nFields):
+    """Numpy record type for binary buffer file rows of a pair key and the given number of count fields"""
+    return np.dtype([("pairKey","<i8"), ("counts","<f8",(nFields,))]);
+
+class BufferFileWriter:
+    """Incrementally write a binary buffer file.  Records must be written in increasing (unique) pair key order
+    across all calls to writeRows, so that many files can later be merged in a single streaming pass.
+    """
+    def __init__(self, filename, fields):
+        self.filename = filename;
+        self.fields = list(fields);
+        self.dtype = recordDtype(len(self.fields));
+        self.nRows = 0;
+        self.lastKey = None;
+        self.outFile = open(filename, "wb");
+        self.outFile.write(b"\0" * BUFFER_FILE_HEADER_SIZE);    # Placeholder until the row counts are known on close
+
+    def writeRows(self, pairKeys, counts):
+        if len(pairKeys) < 1:
+            return;
+        if self.lastKey is not None and pairKeys[0] <= self.lastKey:
+            raise ValueError("Buffer file rows must be written in increasing pair key order");
+        records = np.empty(len(pairKeys), dtype=self.dtype);
+        records["pairKey"] = pairKeys;
+        records["counts"] = counts;
+        self.outFile.write(records.tobytes());
+        self.nRows += len(pairKeys);
+        self.lastKey = pairKeys[-1];
+
+    def close(self, analyzedPatientItemIds=()):
+        itemIds = np.array(sorted(analyzedPatientItemIds), dtype="<i8");
+        self.outFile.write(itemIds.tobytes());
+
+        header = {"fields": self.fields, "nRows": self.nRows, "nItemIds": len(itemIds)};
+        header = BUFFER_FILE_MAGIC + json.dumps(header).encode("ascii");
+        if len(header) >= BUFFER_FILE_HEADER_SIZE:
+            raise ValueError("Too many count fields to describe in buffer file header: %d" % len(self.fields) );
+        self.outFile.seek(0);
+        self.outFile.write(header.ljust(BUFFER_FILE_HEADER_SIZE-1)+b"\n");
+        self.outFile.close();
+
+def isBufferFile(filename):
+    """Whether the named file is in the binary buffer file format (as opposed to, e.g., legacy gzip JSON)"""
+    with open(filename, "rb") as inFile:
+        return inFile.read(len(BUFFER_FILE_MAGIC)) == BUFFER_FILE_MAGIC;
+
+def saveBufferFile(filename, countBuffer, analyzedPatientItemIds=(), chunkSize=FILE_CHUNK_SIZE):
+    """Write the contents of the buffer to a binary buffer file, sorted by pair key, a chunk at a time"""
+    order = np.argsort(countBuffer.pairKeys[:countBuffer.nRows], kind="stable");
+    writer = BufferFileWriter(filename, countBuffer.fields);
+    for start in range(0, len(order), chunkSize):
+        rows = order[start:start+chunkSize];
+        writer.writeRows(countBuffer.pairKeys[rows], countBuffer.counts[rows]);
+    writer.close(analyzedPatientItemIds);
+
+def loadBufferFile(filename):
+    """Memory map the contents of a binary buffer file, without reading it all into memory.
+    Returns (fields, pairKeys, counts, analyzedPatientItemIds) where the latter three are read-only array views.
+    """
+    with open(filename, "rb") as inFile:
+        header = inFile.read(BUFFER_FILE_HEADER_SIZE);
+    if not header.startswith(BUFFER_FILE_MAGIC):
+        raise ValueError("Not a binary association buffer file: %s" % filename);
+    header = json.loads(header[len(BUFFER_FILE_MAGIC):].decode("ascii"));
+    fields = header["fields"];
+    dtype = recordDtype(len(fields));
+
+    records = np.zeros(0, dtype=dtype);
+    if header["nRows"] > 0:
+        records = np.memmap(filename, dtype=dtype, mode="r", offset=BUFFER_FILE_HEADER_SIZE, shape=(header["nRows"],));
+    itemIds = np.zeros(0, dtype="<i8");
+    if header["nItemIds"] > 0:
+        itemIds = np.memmap(filename, dtype="<i8", mode="r", offset=BUFFER_FILE_HEADER_SIZE+header["nRows"]*dtype.itemsize, shape=(header["nItemIds"],));
+    return (fields, records["pairKey"], records["counts"], itemIds);
+
+def iterMergedBufferFiles(filenames, chunkSize=FILE_CHUNK_SIZE):
+    """Streaming k-way merge of binary buffer files (each sorted by pair key).
+    Generates (fields, pairKeys, counts) chunks in increasing pair key order, with the counts
+    for any pairs found in multiple files added together, and count columns aligned to the
+    union of all of the files' fields.  Only about one chunk per file is in memory at a time.
+    """
+    bufferFiles = [loadBufferFile(filename) for filename in filenames];
+    fields = list();
+    for (fileFields, pairKeys, counts, itemIds) in bufferFiles:
+        for field in fileFields:
+            if field not in fields:
+                fields.append(field);
+    columnsList = [np.array([fields.index(field) for field in fileFields], dtype=np.int64) for (fileFields, pairKeys, counts, itemIds) in bufferFiles];
+    positions = [0] * len(bufferFiles);
+
+    while True:
+        active = [iFile for iFile, (fileFields, pairKeys, counts, itemIds) in enumerate(bufferFiles) if positions[iFile] < len(pairKeys)];
+        if not active:
+            break;
+
+        # Every file's next chunk covers at least up to the smallest of their last keys,
+        #   so all rows up to that key can be finalized now.
+        threshold = min( bufferFiles[iFile][1][min(positions[iFile]+chunkSize, len(bufferFiles[iFile][1]))-1] for iFile in active );
+        keyChunks = list();
+        countChunks = list();
+        for iFile in active:
+            (fileFields, pairKeys, counts, itemIds) = bufferFiles[iFile];
+            start = positions[iFile];
+            end = start + int(np.searchsorted(pairKeys[start:start+chunkSize], threshold, side="right"));
+            countChunk = np.zeros((end-start, len(fields)));
+            countChunk[:,columnsList[iFile]] = counts[start:end];
+            keyChunks.append(np.array(pairKeys[start:end]));
+            countChunks.append(countChunk);
+            positions[iFile] = end;
+
+        pairKeys = np.concatenate(keyChunks);
+        counts = np.concatenate(countChunks);
+        order = np.argsort(pairKeys, kind="stable");
+        pairKeys = pairKeys[order];
+        (uniqueKeys, starts) = np.unique(pairKeys, return_index=True);
+        yield (fields, uniqueKeys, np.add.reduceat(counts[order], starts, axis=0));
+
+def mergeBufferFiles(filenames, outputFilename, chunkSize=FILE_CHUNK_SIZE):
+    """Merge many binary buffer files into a single new one, streaming without loading them all into memory"""
+    analyzedPatientItemIds = set();
+    fields = list();
+    for filename in filenames:
+        (fileFields, pairKeys, counts, itemIds) = loadBufferFile(filename);
+        analyzedPatientItemIds.update(itemIds.tolist());
+        for field in fileFields:
+            if field not in fields:
+                fields.append(field);
+
+    writer = BufferFileWriter(outputFilename, fields);
+    for (fields, pairKeys, counts) in iterMergedBufferFiles(filenames, chunkSize):
+        writer.writeRows(pairKeys, counts);
+    writer.close(analyzedPatientItemIds);
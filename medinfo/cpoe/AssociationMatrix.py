@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+In memory sparse matrix representation of the clinical_item_association table,
+to support rapid (vectorized) recommender queries without having to keep
+per-row Python dictionaries for every association pair.
+"""
+
+import sys, os
+import time;
+import json;
+import struct;
+import numpy as np;
+from scipy.sparse import csr_matrix;
+
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from .DataManager import isDecayScaledField;
+
+from .Util import log;
+
+# Number of rows to pull from the database cursor at a time when loading large association tables
+FETCH_SIZE = 100000;
+
+# Structural filter for which association records are worth loading at all
+ASSOCIATION_FILTER = "count_any > 0";
+
+# Leading bytes to identify a binary snapshot file written by AssociationMatrix.save
+SNAPSHOT_MAGIC = b"CDSSAMTX";
+
+# Snapshot file format version.  Increment whenever the layout or stored arrays change, so old snapshots are rejected rather than misread
+SNAPSHOT_VERSION = 1;
+
+# Byte alignment of each array stored in a snapshot file, so memory mapped arrays are aligned for efficient numeric access
+SNAPSHOT_ALIGNMENT = 64;
+
+# Delimiter for the count column / prefix names in snapshot array names
+NAME_DELIM = "|";
+
+# Structural arrays of the matrix to store in a snapshot (besides the count columns, base counts and categories)
+STRUCTURE_ARRAYS = ("itemIds","pairKeys","sourceIndex","targetIndex","rowPtr","colOrder","colPtr");
+
+class AssociationMatrix:
+    """Sparse (compressed sparse row) storage of clinical_item_association counts.
+    Row = clinical_item_id (query / source item), Column = subsequent_item_id (target item).
+    Clinical item IDs (which may be negative for test data) are mapped to
+    contiguous matrix indexes by the sorted itemIds array.
+
+    All count columns share a single sparsity structure, defined by the association
+    records that satisfy ASSOCIATION_FILTER, so explicitly stored zero counts are retained.
+    That way, every loaded count column is just one numeric array aligned to the same pair positions.
+
+    A compressed sparse column ordering (colOrder, colPtr) is also kept to support
+    inverted queries (lookup by subsequent_item_id to "recommend" preceding items).
+
+    If targetFilter is set, the matrix is only a slice of the association table,
+    with just the associations whose targetFilter column (e.g., subsequent_item_id) is one of the given item IDs.
+    """
+    def __init__(self, sourceIds, targetIds):
+        """Initialize the sparsity structure from parallel arrays of (clinical_item_id, subsequent_item_id) pairs"""
+        sourceIds = np.asarray(sourceIds, dtype=np.int64);
+        targetIds = np.asarray(targetIds, dtype=np.int64);
+
+        self.itemIds = np.unique(np.concatenate((sourceIds, targetIds)));
+        nItems = len(self.itemIds);
+
+        sourceIndex = np.searchsorted(self.itemIds, sourceIds);
+        targetIndex = np.searchsorted(self.itemIds, targetIds);
+
+        # Sort pairs into row-major order so each source item's associations are contiguous
+        pairKeys = self.pairKey(sourceIndex, targetIndex);
+        rowOrder = np.argsort(pairKeys, kind="stable");
+        self.pairKeys = pairKeys[rowOrder];
+        self.sourceIndex = sourceIndex[rowOrder].astype(np.int32);
+        self.targetIndex = targetIndex[rowOrder].astype(np.int32);
+        self.rowPtr = np.searchsorted(self.sourceIndex, np.arange(nItems+1)).astype(np.int64);
+
+        # Column-major ordering as a permutation of the pair positions
+        self.colOrder = np.lexsort((self.sourceIndex, self.targetIndex));
+        self.colPtr = np.searchsorted(self.targetIndex[self.colOrder], np.arange(nItems+1)).astype(np.int64);
+
+        self.countsByField = dict();   # Count column name -> float array aligned to pair positions
+        self.baseCountsByPrefix = dict(); # Count prefix -> float array aligned to item indexes (NaN if no base count available)
+        self.categoryIds = None;    # Category ID per item index, if loaded
+        self.decayScale = 1.0;  # Lazy decay scale factor applied to count columns loaded from the database
+        self.targetFilter = None;   # (column name, item IDs) if only a slice of the association records were loaded
+
+    def pairKey(sourceIndex, targetIndex):
+        """Combine source and target matrix indexes into a single sortable 64 bit key"""
+        return (np.asarray(sourceIndex, dtype=np.int64) << 32) | np.asarray(targetIndex, dtype=np.int64);
+    pairKey = staticmethod(pairKey);
+
+    def __len__(self):
+        """Number of stored association pairs"""
+        return len(self.pairKeys);
+
+    def nItems(self):
+        return len(self.itemIds);
+
+    def itemIndex(self, itemIds):
+        """Return array of matrix indexes for the given clinical item IDs.  -1 for any item not in the matrix."""
+        itemIds = np.asarray(list(itemIds), dtype=np.int64);
+        if len(self.itemIds) < 1:
+            return np.full(len(itemIds), -1, dtype=np.int64);
+        index = np.searchsorted(self.itemIds, itemIds);
+        index = np.minimum(index, len(self.itemIds)-1);
+        index[self.itemIds[index] != itemIds] = -1;
+        return index;
+
+    def itemIdMask(self, itemIds):
+        """Boolean array over matrix indexes, True for any of the given clinical item IDs"""
+        mask = np.zeros(len(self.itemIds), dtype=bool);
+        index = self.itemIndex(itemIds);
+        mask[index[index >= 0]] = True;
+        return mask;
+
+    def hasField(self, field):
+        return field in self.countsByField;
+
+    def setField(self, field, sourceIds, targetIds, values):
+        """Store a count column given parallel arrays of item ID pairs and values.
+        Pairs not part of the sparsity structure are ignored, and structural pairs
+        not represented in the input are left as zero.
+        """
+        counts = np.zeros(len(self.pairKeys), dtype=np.float64);
+        self.countsByField[field] = counts;
+        if len(self.pairKeys) < 1:
+            return counts;
+
+        sourceIndex = self.itemIndex(sourceIds);
+        targetIndex = self.itemIndex(targetIds);
+        values = np.asarray(values, dtype=np.float64);
+
+        isKnown = (sourceIndex >= 0) & (targetIndex >= 0);
+        keys = self.pairKey(sourceIndex[isKnown], targetIndex[isKnown]);
+        positions = np.searchsorted(self.pairKeys, keys);
+        positions = np.minimum(positions, len(self.pairKeys)-1);
+        isStored = (self.pairKeys[positions] == keys);
+        counts[positions[isStored]] = values[isKnown][isStored];
+        return counts;
+
+    def setBaseCounts(self, countPrefix, itemIds, baseCounts):
+        """Store baseline clinical_item counts (e.g., item_count, patient_count) aligned to item indexes"""
+        vector = np.full(len(self.itemIds), np.nan);
+        index = self.itemIndex(itemIds);
+        baseCounts = np.asarray(baseCounts, dtype=np.float64);
+        vector[index[index >= 0]] = baseCounts[index >= 0];
+        self.baseCountsByPrefix[countPrefix] = vector;
+        return vector;
+
+    def setCategoryIds(self, itemIds, categoryIds):
+        """Store clinical_item_category_id per item index.  Items without a category recorded get None-like sentinel."""
+        self.categoryIds = np.full(len(self.itemIds), np.iinfo(np.int64).min, dtype=np.int64);
+        index = self.itemIndex(itemIds);
+        categoryIds = np.asarray(categoryIds, dtype=np.int64);
+        self.categoryIds[index[index >= 0]] = categoryIds[index >= 0];
+
+    def hasCategoryMask(self):
+        return self.categoryIds != np.iinfo(np.int64).min;
+
+    def rowEntries(self, queryIndexes, invert=False):
+        """Return the pair positions (into the count arrays) for all stored associations
+        from the given query item indexes, in order of the query indexes given.
+        If invert, then look up by target (subsequent) item rather than source item.
+        """
+        ptr = self.rowPtr;
+        if invert:
+            ptr = self.colPtr;
+        queryIndexes = np.asarray(queryIndexes, dtype=np.int64);
+        starts = ptr[queryIndexes];
+        ends = ptr[queryIndexes+1];
+        lengths = ends - starts;
+        total = int(lengths.sum());
+        if total < 1:
+            return np.zeros(0, dtype=np.int64);
+        # Vectorized concatenation of the ranges [start,end) for each query item
+        offsets = np.repeat(starts - np.concatenate(([0],np.cumsum(lengths)[:-1])), lengths);
+        positions = np.arange(total, dtype=np.int64) + offsets;
+        if invert:
+            positions = self.colOrder[positions];
+        return positions;
+
+    def csr(self, field=None, invert=False, values=None):
+        """Return a scipy.sparse CSR matrix view of the named count column (or the structural pattern of ones if no field).
+        Explicitly stored zero counts are retained.  If invert, returns the transposed matrix (rows = subsequent items).
+        Alternatively, specify values as an array aligned to the pair positions to use as the matrix data.
+        """
+        nItems = len(self.itemIds);
+        if values is not None:
+            data = np.asarray(values, dtype=np.float64);
+        elif field is None:
+            data = np.ones(len(self.pairKeys));
+        else:
+            data = self.countsByField[field];
+        if not invert:
+            return csr_matrix((data, self.targetIndex, self.rowPtr), shape=(nItems,nItems));
+        else:
+            return csr_matrix((data[self.colOrder], self.sourceIndex[self.colOrder], self.colPtr), shape=(nItems,nItems));
+
+    def snapshotArrays(self):
+        """Dictionary of all of the arrays that make up the matrix, by snapshot array name"""
+        arraysByName = dict();
+        for name in STRUCTURE_ARRAYS:
+            arraysByName[name] = getattr(self, name);
+        for field, counts in self.countsByField.items():
+            arraysByName[NAME_DELIM.join(("counts", field))] = counts;
+        for countPrefix, baseCounts in self.baseCountsByPrefix.items():
+            arraysByName[NAME_DELIM.join(("baseCounts", countPrefix))] = baseCounts;
+        if self.categoryIds is not None:
+            arraysByName["categoryIds"] = self.categoryIds;
+        return arraysByName;
+
+    def save(self, filename, header=None):
+        """Write the matrix (including any loaded count columns, base counts and categories)
+        into a single binary snapshot file that load can memory map.
+        header is an optional dictionary of other (JSON serializable) values to store with the snapshot.
+        Writes to a temporary file that is then renamed, so concurrent readers never see a partially written snapshot.
+        """
+        arraysByName = dict( (name, np.ascontiguousarray(array)) for name, array in self.snapshotArrays().items() );
+        layout = dict();
+        offset = 0;
+        for name, array in arraysByName.items():
+            layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset};
+            offset = alignOffset(offset + array.nbytes);
+        targetFilter = None;
+        if self.targetFilter is not None:
+            targetFilter = [self.targetFilter[0], [int(itemId) for itemId in self.targetFilter[1]]];
+        snapshotHeader = {"version": SNAPSHOT_VERSION, "decayScale": self.decayScale, "targetFilter": targetFilter, "arrays": layout, "header": header};
+        headerBytes = json.dumps(snapshotHeader).encode("utf-8");
+        dataStart = alignOffset(len(SNAPSHOT_MAGIC) + 8 + len(headerBytes));
+
+        tempFilename = "%s.%d.tmp" % (filename, os.getpid());
+        try:
+            with open(tempFilename, "wb") as outputFile:
+                outputFile.write(SNAPSHOT_MAGIC);
+                outputFile.write(struct.pack("<q", len(headerBytes)));
+                outputFile.write(headerBytes);
+                for name, array in arraysByName.items():
+                    outputFile.seek(dataStart + layout[name]["offset"]);
+                    array.tofile(outputFile);
+                outputFile.truncate(dataStart + offset);
+            os.replace(tempFilename, filename);
+        finally:
+            if os.path.exists(tempFilename):
+                os.remove(tempFilename);
+
+    def load(filename):
+        """Load a snapshot file written by save.  The arrays are read-only memory maps of the file,
+        so processes loading the same snapshot share its data through the OS page cache,
+        and only the pages actually used are read from disk.
+        Raises ValueError if the file is not a snapshot of the current SNAPSHOT_VERSION.
+        Returns (matrix, header) 2-ple, with the other values stored along with the snapshot.
+        """
+        with open(filename, "rb") as inputFile:
+            if inputFile.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("Not an association matrix snapshot file: %s" % filename);
+            (headerLength,) = struct.unpack("<q", inputFile.read(8));
+            snapshotHeader = json.loads(inputFile.read(headerLength).decode("utf-8"));
+        if snapshotHeader["version"] != SNAPSHOT_VERSION:
+            raise ValueError("Snapshot file %s is version %s, but expected version %s" % (filename, snapshotHeader["version"], SNAPSHOT_VERSION) );
+        dataStart = alignOffset(len(SNAPSHOT_MAGIC) + 8 + headerLength);
+
+        buffer = np.memmap(filename, dtype=np.uint8, mode="r");
+        matrix = AssociationMatrix([], []);
+        for name, arrayLayout in snapshotHeader["arrays"].items():
+            dtype = np.dtype(arrayLayout["dtype"]);
+            shape = tuple(arrayLayout["shape"]);
+            start = dataStart + arrayLayout["offset"];
+            array = buffer[start:start+dtype.itemsize*int(np.prod(shape))].view(dtype).reshape(shape);
+            if NAME_DELIM in name:
+                (arrayType, key) = name.split(NAME_DELIM, 1);
+                if arrayType == "counts":
+                    matrix.countsByField[key] = array;
+                else:
+                    matrix.baseCountsByPrefix[key] = array;
+            else:
+                setattr(matrix, name, array);
+        matrix.decayScale = snapshotHeader["decayScale"];
+        if snapshotHeader["targetFilter"] is not None:
+            matrix.targetFilter = tuple(snapshotHeader["targetFilter"]);
+        return (matrix, snapshotHeader["header"]);
+    load = staticmethod(load);
+
+    def loadFromDatabase(fields=None, conn=None, connFactory=None, decayScale=1.0, targetFilter=None):
+        """Load the association structure (records satisfying ASSOCIATION_FILTER)
+        and any specified count columns from the database.
+        decayScale is any lazy decay scale factor (see DataManager.loadAssociationDecayScale)
+        to apply to the stored counts, including any count columns loaded later.
+        targetFilter is an optional (column name, item IDs) 2-ple to only load
+        the association records with one of the item IDs in that column
+        (e.g., ("subsequent_item_id", outcomeItemIds) for the columns of just a few target items).
+        Returns a new AssociationMatrix.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            if connFactory is None:
+                connFactory = DBUtil.ConnectionFactory();
+            conn = connFactory.connection();
+        try:
+            if fields is None:
+                fields = list();
+            fields = [field for field in fields];
+            (sourceIds, targetIds, valueColumns) = fetchAssociationColumns(fields, conn, decayScale, targetFilter);
+            matrix = AssociationMatrix(sourceIds, targetIds);
+            matrix.decayScale = decayScale;
+            matrix.targetFilter = targetFilter;
+            for field, values in zip(fields, valueColumns):
+                matrix.setField(field, sourceIds, targetIds, values);
+            return matrix;
+        finally:
+            if not extConn:
+                conn.close();
+    loadFromDatabase = staticmethod(loadFromDatabase);
+
+    def loadFields(self, fields, conn):
+        """Ensure the named count columns are loaded, querying the database for any that are missing"""
+        missingFields = [field for field in fields if field not in self.countsByField];
+        if missingFields:
+            (sourceIds, targetIds, valueColumns) = fetchAssociationColumns(missingFields, conn, self.decayScale, self.targetFilter);
+            for field, values in zip(missingFields, valueColumns):
+                self.setField(field, sourceIds, targetIds, values);
+        return len(missingFields);
+
+def alignOffset(offset):
+    """Round the byte offset up to the next multiple of SNAPSHOT_ALIGNMENT"""
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT;
+
+def fetchAssociationColumns(fields, conn, decayScale=1.0, targetFilter=None):
+    """Query the clinical_item_association table for item pairs and the named count columns,
+    fetching in chunks directly into numeric arrays rather than building per-row Python objects.
+    Decaying count columns are multiplied by the decayScale to get their current values.
+    If targetFilter (column name, item IDs) is provided, only query for the records with those item IDs in that column.
+    Returns (sourceIds, targetIds, valueColumns) where valueColumns is a list of arrays parallel to fields.
+    """
+    query = SQLQuery();
+    query.addSelect("clinical_item_id");
+    query.addSelect("subsequent_item_id");
+    for field in fields:
+        query.addSelect("coalesce(%s,0)" % field);  # Guard against null counts so can convert directly to numeric arrays
+    query.addFrom("clinical_item_association");
+    query.addWhere(ASSOCIATION_FILTER);
+    if targetFilter is not None:
+        (targetCol, targetItemIds) = targetFilter;
+        query.addWhereIn(targetCol, list(targetItemIds));
+
+    timer = time.time();
+    cursor = conn.cursor();
+    try:
+        cursor.execute(str(query), tuple(query.getParams()));
+        chunks = list();
+        rows = cursor.fetchmany(FETCH_SIZE);
+        while rows:
+            chunks.append(np.array(rows, dtype=np.float64).reshape(len(rows), 2+len(fields)));
+            rows = cursor.fetchmany(FETCH_SIZE);
+    finally:
+        cursor.close();
+
+    if chunks:
+        data = np.concatenate(chunks);
+    else:
+        data = np.zeros((0, 2+len(fields)));
+    log.debug("Loaded %d association records in %.3f sec" % (len(data), time.time()-timer) );
+
+    sourceIds = data[:,0].astype(np.int64);
+    targetIds = data[:,1].astype(np.int64);
+    valueColumns = [data[:,2+iField] for iField in range(len(fields))];
+    if decayScale != 1.0:
+        valueColumns = [(values*decayScale if isDecayScaledField(field) else values) for field, values in zip(fields, valueColumns)];
+    return (sourceIds, targetIds, valueColumns);
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Index of the clinical_item_link relationships between composite (or virtual) clinical items and their component items,
+flattened so that multi-level inherited links are reported as directly belonging to any parent items.
+Allows association analysis to rapidly check whether a pair of items is linked and so has no meaningful association stats.
+"""
+
+import sys, os
+import json;
+import numpy as np;
+
+class ClinicalItemLinkIndex(dict):
+    """Drop-in replacement for the plain linkedItemIdsByBaseId dictionary (base clinical_item_id -> set of linked item IDs),
+    but built once as the transitive closure of the link graph, rather than by repeated passes until nothing changes.
+
+    Links are processed in topological order (strongly connected components via Tarjan's algorithm),
+    so each item's closure is just the union of its direct links' closures.  Cyclic links cannot be resolved
+    into a meaningful composite hierarchy, so raise a ValueError rather than risking an infinite loop.
+
+    signature records summary values of the clinical_item_link table the index was built from,
+    so a cached / persisted copy can be checked against the current table contents.
+    """
+    def __init__(self, linkPairs=(), signature=None):
+        dict.__init__(self);
+        self.signature = signature;
+        self.update(closureFromLinks(linkPairs));
+
+    def isLinked(self, baseItemId, linkedItemId):
+        """Whether the linkedItemId is a (direct or inherited) component of the baseItemId"""
+        linkedItemIds = self.get(baseItemId);
+        return linkedItemIds is not None and linkedItemId in linkedItemIds;
+
+    def isLinkedPair(self, itemId1, itemId2):
+        """Whether the items are linked in either direction"""
+        return self.isLinked(itemId1, itemId2) or self.isLinked(itemId2, itemId1);
+
+    def linkPairs(self):
+        """Iterate through all of the (base, linked) item ID pairs of the closure"""
+        for baseItemId, linkedItemIds in self.items():
+            for linkedItemId in linkedItemIds:
+                yield (baseItemId, linkedItemId);
+
+    def save(self, filename):
+        """Store the closure link pairs into a numpy archive file"""
+        pairs = np.array(list(self.linkPairs()), dtype=np.int64).reshape(-1,2);
+        header = {"signature": self.signature};
+        with open(filename, "wb") as outputFile:
+            np.savez(outputFile, header=np.array(json.dumps(header)), baseItemIds=pairs[:,0], linkedItemIds=pairs[:,1]);
+
+    def load(filename):
+        """Load a previously saved index file.  Link pairs are already closed, so no need to recalculate."""
+        with np.load(filename) as data:
+            header = json.loads(str(data["header"]));
+            index = ClinicalItemLinkIndex(signature=header["signature"]);
+            for baseItemId, linkedItemId in zip(data["baseItemIds"].tolist(), data["linkedItemIds"].tolist()):
+                if baseItemId not in index:
+                    index[baseItemId] = set();
+                index[baseItemId].add(linkedItemId);
+        return index;
+    load = staticmethod(load);
+
+def closureFromLinks(linkPairs):
+    """Given (clinical_item_id, linked_item_id) pairs, return a dictionary of each base item ID
+    to the set of all of its directly linked and inherited linked item IDs.
+    Raises ValueError if the links contain any cycles.
+    """
+    childIdsByBaseId = dict();
+    for (baseItemId, linkedItemId) in linkPairs:
+        if baseItemId not in childIdsByBaseId:
+            childIdsByBaseId[baseItemId] = set();
+        childIdsByBaseId[baseItemId].add(linkedItemId);
+
+    closureByBaseId = dict();
+    for component in stronglyConnectedComponents(childIdsByBaseId):
+        # Components are produced in reverse topological order, so any linked items are already resolved
+        itemId = component[0];
+        if len(component) > 1 or itemId in childIdsByBaseId.get(itemId, ()):
+            raise ValueError("Cyclic clinical_item_link relationships between items: %s" % sorted(component) );
+        if itemId in childIdsByBaseId:
+            closure = set();
+            for childId in childIdsByBaseId[itemId]:
+                closure.add(childId);
+                closure.update(closureByBaseId.get(childId, ()));
+            closureByBaseId[itemId] = closure;
+    return closureByBaseId;
+
+def stronglyConnectedComponents(childIdsByNodeId):
+    """Tarjan's algorithm (iterative to avoid recursion limits on deep hierarchies) over the graph
+    of node ID -> set of child node IDs.  Yields lists of node IDs for each strongly connected component,
+    in reverse topological order (i.e., any children's components before their parents').
+    """
+    indexByNodeId = dict();
+    lowLinkByNodeId = dict();
+    stack = list();
+    onStack = set();
+
+    for rootId in childIdsByNodeId:
+        if rootId in indexByNodeId:
+            continue;
+        indexByNodeId[rootId] = lowLinkByNodeId[rootId] = len(indexByNodeId);
+        stack.append(rootId);
+        onStack.add(rootId);
+        workStack = [(rootId, iter(childIdsByNodeId.get(rootId, ())))];
+        while workStack:
+            (nodeId, childIter) = workStack[-1];
+            childId = next(childIter, None);
+            if childId is not None:
+                if childId not in indexByNodeId:
+                    indexByNodeId[childId] = lowLinkByNodeId[childId] = len(indexByNodeId);
+                    stack.append(childId);
+                    onStack.add(childId);
+                    workStack.append( (childId, iter(childIdsByNodeId.get(childId, ()))) );
+                elif childId in onStack:
+                    lowLinkByNodeId[nodeId] = min(lowLinkByNodeId[nodeId], indexByNodeId[childId]);
+            else:
+                workStack.pop();
+                if workStack:
+                    parentId = workStack[-1][0];
+                    lowLinkByNodeId[parentId] = min(lowLinkByNodeId[parentId], lowLinkByNodeId[nodeId]);
+                if lowLinkByNodeId[nodeId] == indexByNodeId[nodeId]:
+                    component = list();
+                    memberId = None;
+                    while memberId != nodeId:
+                        memberId = stack.pop();
+                        onStack.discard(memberId);
+                        component.append(memberId);
+                    yield component;
@@ -6,13 +6,45 @@ Support module to manage data and statistics
 import sys, os
 import time;
 from optparse import OptionParser
-import math;
 from datetime import datetime;
-from medinfo.common.Util import stdOpen, ProgressDots;
+from medinfo.common.DataCache import DataCache;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel, generatePlaceholders;
-from medinfo.db.Model import modelListFromTable, modelDictFromList;
+from .ClinicalItemLinkIndex import ClinicalItemLinkIndex;
 from .Util import log;
+from .Const import COUNT_PREFIX_OPTIONS, DELTA_NAME_BY_SECONDS;
+
+# data_cache table keys that are cleared whenever the association model changes.
+#   In memory dataCache entries are tagged with these, so they are invalidated at the same time.
+MODEL_CACHE_KEYS = ("analyzedPatientCount","clinicalItemCountsUpdated");
+
+# In memory dataCache key (and tag) for the flattened clinical_item_link index, invalidated whenever links are added
+LINK_INDEX_CACHE_KEY = "clinicalItemLinkIndex";
+
+# data_cache table key for the global (lazy) decay scale factor that stored clinical_item_association counts
+#   should be multiplied by to get their current (decayed) values.  If not present, scale is 1.0
+DECAY_SCALE_CACHE_KEY = "associationDecayScale";
+
+# Key to store the in memory association matrix under in the dataCache
+ASSOCIATION_MATRIX_CACHE_KEY = "AssociationMatrix";
+
+# In memory dataCache tag for an association matrix imported from a model snapshot file.
+#   The snapshot was already checked against the database when imported, so it is not discarded along with
+#   query results whenever the model cache keys are invalidated (e.g., analyzedPatientCount not yet recorded)
+MODEL_SNAPSHOT_CACHE_TAG = "modelSnapshot";
+
+# clinical_item_association count columns to include in model snapshots by default (every time window for every count prefix)
+SNAPSHOT_COUNT_FIELDS = [countPrefix+"count_"+str(seconds) for countPrefix in COUNT_PREFIX_OPTIONS for seconds in sorted(DELTA_NAME_BY_SECONDS)] + \
+                        [countPrefix+"count_any" for countPrefix in COUNT_PREFIX_OPTIONS];
+
+# clinical_item base count columns to include in model snapshots, by count prefix (as ItemAssociationRecommender.loadBaseCounts names them)
+SNAPSHOT_BASE_COUNT_PREFIXES = ("item_","patient_","encounter_");
+
+def isDecayScaledField(field):
+    """Whether the clinical_item_association column is one of the count columns that decay
+    (e.g., count_0, patient_count_any), as opposed to time difference sums or keys.
+    """
+    return "count_" in field;
 
 class DataManager:
     connFactory = None;
@@ -21,8 +53,9 @@ class DataManager:
     def __init__(self):
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.maxClinicalItemId = None;  # Can set to a value to limit what items will be processed.  Particularly for setting to 0, so will only work on negative values, generally only test cases, while leaving "real" data alone
-        self.dataCache = dict();  # If set, use as in memory data cache.  Set to None to avoid usage if having memory leak problems with persistent processes
+        self.dataCache = DataCache(defaultTags=MODEL_CACHE_KEYS);  # If set, use as in memory data cache (LRU bounded by memory budget).  Set to None to avoid usage altogether
         self.queryCount = 0;
+        self.context = None;    # If set to a RecommenderContext, record cache lookups and rows fetched for instrumentation
 
     def resetAssociationModel(self, conn=None):
         extConn = True;
@@ -61,6 +94,7 @@ class DataManager:
 
             # Flag that any cached association metrics will be out of date
             self.clearCacheData("analyzedPatientCount",conn=conn);
+            self.clearCacheData(DECAY_SCALE_CACHE_KEY,conn=conn);
 
             # Reset clinical_item denormalized counts
             self.updateClinicalItemCounts(conn=conn);
@@ -91,29 +125,29 @@ class DataManager:
                     # Item count caches already updated, no need to recalculate them
                     return;
 
-            # First reset all counts to zero
-            query = "update clinical_item set item_count = 0, patient_count = 0, encounter_count = 0 ";
-            params = [];
+            # Look along "diagonal" of matrix for primary summary stats, with counts reset to zero for items without any.
+            #   Single set-based update, only touching rows whose counts actually change.
+            #   Apply any lazy decay scale, so the denormalized counts reflect current (decayed) values.
+            sourceQuery = \
+                """select ci.clinical_item_id,
+                    coalesce(cia.count_0,0)*%(p)s as item_count,
+                    coalesce(cia.patient_count_0,0)*%(p)s as patient_count,
+                    coalesce(cia.encounter_count_0,0)*%(p)s as encounter_count
+                from clinical_item as ci left outer join clinical_item_association as cia
+                    on ci.clinical_item_id = cia.clinical_item_id and cia.clinical_item_id = cia.subsequent_item_id
+                where
+                    (coalesce(ci.item_count,-1) <> coalesce(cia.count_0,0)*%(p)s or
+                    coalesce(ci.patient_count,-1) <> coalesce(cia.patient_count_0,0)*%(p)s or
+                    coalesce(ci.encounter_count,-1) <> coalesce(cia.encounter_count_0,0)*%(p)s)
+                """ % {"p": DBUtil.SQL_PLACEHOLDER};
+            decayScale = self.loadAssociationDecayScale(conn=conn);
+            params = [decayScale]*6;
             if self.maxClinicalItemId is not None:  # Restrict to (test) data
-                query += "where clinical_item_id < %s" % DBUtil.SQL_PLACEHOLDER;
+                sourceQuery += "and ci.clinical_item_id < %s" % DBUtil.SQL_PLACEHOLDER;
                 params.append(self.maxClinicalItemId);
-            DBUtil.execute(query, params, conn=conn);
-
-            sqlQuery = SQLQuery();
-            sqlQuery.addSelect("clinical_item_id");
-            sqlQuery.addSelect("count_0 as item_count");
-            sqlQuery.addSelect("patient_count_0 as patient_count");
-            sqlQuery.addSelect("encounter_count_0 as encounter_count");
-            sqlQuery.addFrom("clinical_item_association as ci");
-            sqlQuery.addWhere("clinical_item_id = subsequent_item_id"); # Look along "diagonal" of matrix for primary summary stats
-            if self.maxClinicalItemId is not None:  # Restrict to (test) data
-                sqlQuery.addWhereOp("clinical_item_id","<", self.maxClinicalItemId );
 
-            resultTable = DBUtil.execute( sqlQuery, includeColumnNames=True, conn=conn );
-            resultModels = modelListFromTable( resultTable );
-
-            for result in resultModels:
-                DBUtil.updateRow("clinical_item", result, result["clinical_item_id"], conn=conn);
+            query = DBUtil.buildUpdateFromQuery("clinical_item", ["item_count","patient_count","encounter_count"], sourceQuery, ["clinical_item_id"]);
+            DBUtil.execute(query, params, conn=conn);
 
             # Make a note that this cache data has been updated
             self.setCacheData("clinicalItemCountsUpdated", "True", conn=conn);
@@ -169,15 +203,18 @@ class DataManager:
             conn = self.connFactory.connection();
             extConn = False;
         try:
+            clinicalItemIds = tuple(clinicalItemIds);
+            if not clinicalItemIds:
+                return; # Nothing to do
             placeholders = generatePlaceholders(len(clinicalItemIds))
 
             # Change analysis status
-            DBUtil.execute("update clinical_item set analysis_status = 0 where clinical_item_id in (%s)" % placeholders, tuple(clinicalItemIds), conn=conn );
+            DBUtil.execute("update clinical_item set analysis_status = 0 where clinical_item_id in (%s)" % placeholders, clinicalItemIds, conn=conn );
             # Retroactively remove any prior analysis records
-            DBUtil.execute("delete from clinical_item_association where clinical_item_id in (%s)" % placeholders, tuple(clinicalItemIds), conn=conn );
-            DBUtil.execute("delete from clinical_item_association where subsequent_item_id in (%s)" % placeholders, tuple(clinicalItemIds), conn=conn );
-            # Retroactively clear any prior analyze_date recordings since effectively undoing that work that may be redone later
-            DBUtil.execute("update patient_item set analyze_date = null where clinical_item_id in (%s)" % placeholders, tuple(clinicalItemIds), conn=conn );
+            DBUtil.execute("delete from clinical_item_association where clinical_item_id in (%s) or subsequent_item_id in (%s)" % (placeholders, placeholders), clinicalItemIds+clinicalItemIds, conn=conn );
+            # Retroactively clear any prior analyze_date recordings since effectively undoing that work that may be redone later.
+            #   Skip records never analyzed, to avoid rewriting (potentially millions of) rows that would not change
+            DBUtil.execute("update patient_item set analyze_date = null where clinical_item_id in (%s) and analyze_date is not null" % placeholders, clinicalItemIds, conn=conn );
         finally:
             if not extConn:
                 conn.close();
@@ -295,37 +332,31 @@ class DataManager:
                 DBUtil.execute(insertQuery, insertParams, conn=conn);
 
             # Extract back link information, which will also flatten out any potential inherited links
+            self.invalidateDataCache(LINK_INDEX_CACHE_KEY);
             linkedItemIdsByBaseId = self.loadLinkedItemIdsByBaseId(conn=conn);
             linkedItemIds = linkedItemIdsByBaseId[compositeId];
 
-            # Create patienItem records for the composite clinical item to overlap existing component ones
-            # First query for the existing component records
-            query = SQLQuery();
-            query.addSelect("*");
-            query.addFrom("patient_item");
-            query.addWhereIn("clinical_item_id", linkedItemIds);
-            results = DBUtil.execute(query, includeColumnNames=True, conn=conn);
-            patientItems = modelListFromTable(results);
-
-            # Patch component records to instead become composite item records then insert back into database
-            progress = ProgressDots(total=len(patientItems));
-            for patientItem in patientItems:
-                del patientItem["patient_item_id"];
-                patientItem["clinical_item_id"] = compositeId;
-                patientItem["analyze_date"] = None;
-
-                insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-                insertParams= list(patientItem.values());
-
-                try:
-                    # Optimistic insert of a new unique item
-                    DBUtil.execute( insertQuery, insertParams, conn=conn );
-                except conn.IntegrityError as err:
-                    # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-                    log.info(err);
-                progress.Update();
-
-            # progress.PrintStatus();
+            # Create patienItem records for the composite clinical item to overlap existing component ones.
+            # Copy the existing component records in a single insert-select statement, patched to instead become composite item records.
+            #   Duplicates (e.g., multiple components for the same patient and time) are skipped rather than erroring out.
+            colNames = DBUtil.execute("select * from patient_item where 1=0", includeColumnNames=True, conn=conn)[0];
+            colNames.remove("patient_item_id");
+            selectCols = list();
+            for colName in colNames:
+                if colName == "clinical_item_id":
+                    selectCols.append("%s" % DBUtil.SQL_PLACEHOLDER);
+                elif colName == "analyze_date":
+                    selectCols.append("null");
+                else:
+                    selectCols.append(colName);
+            placeholders = generatePlaceholders(len(linkedItemIds));
+            selectQuery = "select %s from patient_item where clinical_item_id in (%s)" % (str.join(",", selectCols), placeholders);
+            params = [compositeId];
+            params.extend(linkedItemIds);
+
+            insertQuery = DBUtil.buildInsertSelectQuery("patient_item", colNames, selectQuery, ignoreDuplicates=True);
+            nInserted = DBUtil.execute(insertQuery, params, conn=conn);
+            log.debug("Inserted %s patient_item records for composite item %s" % (nInserted, compositeId) );
         finally:
             if not extConn:
                 conn.close();
@@ -395,28 +426,14 @@ class DataManager:
 
             DBUtil.updateRow("clinical_item", {"name": compositeName, "description": compositeDescription}, baseClinicalItemId, conn=conn);
 
-            if reassignMergedItems:
-                # Reassign other items to the base item, but save backup data first
-                query = SQLQuery();
-                query.addSelect("patient_item_id");
-                query.addSelect("clinical_item_id");
-                query.addFrom("patient_item");
-                query.addWhereIn("clinical_item_id", deactivateIds);
-                results = DBUtil.execute(query, conn=conn);
-
-                insertQuery = DBUtil.buildInsertQuery("backup_link_patient_item", ["patient_item_id","clinical_item_id"] );
-                for (patientItemId, clinicalItemId) in results:
-                    insertParams = (patientItemId, clinicalItemId);
-                    try:
-                        # Optimistic insert of a new unique item
-                        DBUtil.execute( insertQuery, insertParams, conn=conn );
-                    except conn.IntegrityError as err:
-                        # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-                        log.info(err);
-                        pass;
+            if reassignMergedItems and deactivateIds:
+                # Reassign other items to the base item, but save backup data first (skipping any links already backed up)
+                placeholders = generatePlaceholders(len(deactivateIds));
+                selectQuery = "select patient_item_id, clinical_item_id from patient_item where clinical_item_id in (%s)" % placeholders;
+                insertQuery = DBUtil.buildInsertSelectQuery("backup_link_patient_item", ["patient_item_id","clinical_item_id"], selectQuery, ignoreDuplicates=True);
+                DBUtil.execute(insertQuery, tuple(deactivateIds), conn=conn);
 
                 # Now to actual reassignment of patient items to the unifying base clinical item
-                placeholders = generatePlaceholders(len(deactivateIds));
                 query = "update patient_item set clinical_item_id = %s where clinical_item_id in (%s)" % (DBUtil.SQL_PLACEHOLDER,placeholders);
                 params = [baseClinicalItemId];
                 params.extend(deactivateIds);
@@ -463,58 +480,148 @@ class DataManager:
             limit 1000
         """
         # Basically does same thing as merging composite items, just skip the reassignment step
-        self.mergeRelated(baseClinicalItemId, clinicalItemIds, reassignMergedItems=False);
+        self.mergeRelated(baseClinicalItemId, clinicalItemIds, reassignMergedItems=False, conn=conn);
 
-    def loadLinkedItemIdsByBaseId(self, maxItemId=None, conn=None):
-        """Effectively load the clinical_item_link table into a dictionary object
+    def loadLinkedItemIdsByBaseId(self, maxItemId=None, acceptCache=True, conn=None):
+        """Effectively load the clinical_item_link table into a dictionary object (ClinicalItemLinkIndex)
         to facilitate rapid lookup of linked clinical items.
         Includes flattening of link hierarchies such that multi-level inherited links will be reported as directly
-        belonging to any parent items.
+        belonging to any parent items.  Raises ValueError if the links are cyclic.
+
+        If acceptCache is True, reuse any index previously built into the in memory dataCache,
+        as long as summary values of the clinical_item_link table show it has not changed since.
+        Beware the returned index may then be shared with other callers, so should not be modified.
         """
         extConn = conn is not None;
         if not extConn:
             conn = self.connFactory.connection();
 
-        linkedItemIdsByBaseId = None;
+        linkIndex = None;
         try:
-            linkedItemIdsByBaseId = dict();
-            query = "select clinical_item_id, linked_item_id from clinical_item_link";
+            whereClause = "";
             params = list();
             if maxItemId is not None:
-                query += " where clinical_item_id < %s" % DBUtil.SQL_PLACEHOLDER;
+                whereClause = " where clinical_item_id < %s" % DBUtil.SQL_PLACEHOLDER;
                 params.append(maxItemId);
+
+            # Cheap summary of the link table contents, to tell if any cached index is still up to date
+            signatureQuery = "select count(*), max(clinical_item_link_id), sum(clinical_item_id), sum(linked_item_id) from clinical_item_link" + whereClause;
+            signature = [ (int(value) if value is not None else None) for value in DBUtil.execute( signatureQuery, params, conn=conn)[0] ];
+
+            cacheKey = (LINK_INDEX_CACHE_KEY, maxItemId);
+            if acceptCache and self.dataCache is not None:
+                linkIndex = self.dataCache.get(cacheKey);
+                if linkIndex is not None and linkIndex.signature == signature:
+                    return linkIndex;
+
+            query = "select clinical_item_id, linked_item_id from clinical_item_link" + whereClause;
             clinicalItemLinkTable = DBUtil.execute( query, params, conn=conn);
-            for (clinicalItemId, linkedItemId) in clinicalItemLinkTable:
-                if clinicalItemId not in linkedItemIdsByBaseId:
-                    linkedItemIdsByBaseId[clinicalItemId] = set();
-                linkedItemIdsByBaseId[clinicalItemId].add(linkedItemId);
-
-            # Additional passes to capture inherited relationships (beware this could be infinite loop if cyclic inheritance pattern)
-            lookForNewLinks = True;
-            inheritanceDepth = 0;
-            while lookForNewLinks:
-                lookForNewLinks = False;
-                inheritanceDepth += 1;
-
-                for (clinicalItemId, linkedItemIdSet) in linkedItemIdsByBaseId.items():
-                    linkedItemIdSetCopy = set(linkedItemIdSet); # Make copy as could be modifying set as iterate through it
-                    for linkedItemId in linkedItemIdSetCopy:
-                        if linkedItemId in linkedItemIdsByBaseId:
-                            subLinkedItemIds = linkedItemIdsByBaseId[linkedItemId];
-                            preSize = len(linkedItemIdSet);
-                            linkedItemIdSet.update(subLinkedItemIds);
-                            postSize = len(linkedItemIdSet);
-                            if postSize > preSize:
-                                # New inherited links were recorded, so will need to do at least one more pass to keep look for further inheritance depth
-                                lookForNewLinks = True;
-
-                if inheritanceDepth > 8 and (math.log(inheritanceDepth,2) % 1) < 0.001:
-                    # Very high inheritance depth, caution that may be infinite loop that should be aborted
-                    log.warning("Clinical Item Link Inheritance Resolution down to depth %s.  Potential for infinite loop." % inheritanceDepth );
+            linkIndex = ClinicalItemLinkIndex(clinicalItemLinkTable, signature);
+
+            if hasattr(self.dataCache, "invalidate"):
+                self.dataCache.set(cacheKey, linkIndex, tags=[LINK_INDEX_CACHE_KEY]);
+            elif self.dataCache is not None:
+                self.dataCache[cacheKey] = linkIndex;
+        finally:
+            if not extConn:
+                conn.close();
+        return linkIndex;
+
+    def loadAssociationDecayScale(self, conn=None):
+        """Global scale factor that stored clinical_item_association counts should be multiplied by
+        to get their current values, if using lazy decay (see DecayingWindows).  1.0 if never set.
+        """
+        dataStr = self.getCacheData(DECAY_SCALE_CACHE_KEY, conn=conn);
+        if dataStr is None:
+            return 1.0;
+        return float(dataStr);
+
+    def setAssociationDecayScale(self, decayScale, conn=None):
+        """Record a new global decay scale factor for clinical_item_association counts.
+        Any cached association metrics or denormalized counts are then out of date.
+        """
+        self.setCacheData(DECAY_SCALE_CACHE_KEY, repr(float(decayScale)), conn=conn);
+        self.clearCacheData("analyzedPatientCount", conn=conn);
+        self.clearCacheData("clinicalItemCountsUpdated", conn=conn);
+
+    def exportModelSnapshot(self, filename, countFields=None, conn=None):
+        """Store a versioned snapshot of the association model into a binary file (see AssociationMatrix.save),
+        that recommender processes can then memory map (see importModelSnapshot)
+        rather than each loading the whole clinical_item_association table and related counts from the database.
+        Includes the association count columns (default SNAPSHOT_COUNT_FIELDS), clinical_item base counts,
+        category map, decay scale and analyzed patient count.
+        Returns the AssociationMatrix that was stored.
+        """
+        from .AssociationMatrix import AssociationMatrix;   # Deferred, since the matrix module itself depends on this module
+
+        if countFields is None:
+            countFields = SNAPSHOT_COUNT_FIELDS;
+
+        extConn = conn is not None;
+        if not extConn:
+            conn = self.connFactory.connection();
+        try:
+            # Ensure the denormalized base counts are current before copying them
+            self.updateClinicalItemCounts(acceptCache=True, conn=conn);
+
+            decayScale = self.loadAssociationDecayScale(conn=conn);
+            matrix = AssociationMatrix.loadFromDatabase(countFields, conn=conn, decayScale=decayScale);
+
+            baseCountCols = [countPrefix+"count" for countPrefix in SNAPSHOT_BASE_COUNT_PREFIXES];
+            itemTable = DBUtil.execute("select clinical_item_id, clinical_item_category_id, analysis_status, %s from clinical_item" % str.join(",", baseCountCols), conn=conn);
+            matrix.setCategoryIds([row[0] for row in itemTable], [row[1] for row in itemTable]);
+
+            # Same base counts the recommender would load, only for the items fit for analysis
+            analyzedItemTable = [row for row in itemTable if row[2] is not None and row[2] != 0];
+            for iCol, countPrefix in enumerate(SNAPSHOT_BASE_COUNT_PREFIXES):
+                baseCounts = [(row[3+iCol] if row[3+iCol] is not None else float("nan")) for row in analyzedItemTable];
+                matrix.setBaseCounts(countPrefix, [row[0] for row in analyzedItemTable], baseCounts);
+
+            analyzedPatientCount = self.getCacheData("analyzedPatientCount", conn=conn);
+            if analyzedPatientCount is not None:
+                analyzedPatientCount = float(analyzedPatientCount);
+
+            header = {"createTime": str(datetime.now()), "decayScale": decayScale, "analyzedPatientCount": analyzedPatientCount};
+            matrix.save(filename, header);
+            log.info("Stored model snapshot with %d associations and %d count columns into %s" % (len(matrix), len(countFields), filename) );
+            return matrix;
         finally:
             if not extConn:
                 conn.close();
-        return linkedItemIdsByBaseId;
+
+    def importModelSnapshot(self, filename, checkCurrent=True, conn=None):
+        """Load a model snapshot file (see exportModelSnapshot) into the dataCache as the association matrix
+        for recommenders using this DataManager, so they can answer queries without first loading the association table.
+        The snapshot arrays are memory mapped read-only, so multiple processes share a single copy through the OS page cache.
+
+        If checkCurrent, first compare the snapshot's decay scale and analyzed patient count against the database data_cache values.
+        If they differ, the model must have been updated since the snapshot was taken, so ignore it.
+        Returns the loaded AssociationMatrix, or None if the snapshot was out of date.
+        """
+        from .AssociationMatrix import AssociationMatrix;   # Deferred, since the matrix module itself depends on this module
+
+        (matrix, header) = AssociationMatrix.load(filename);
+        if checkCurrent:
+            extConn = conn is not None;
+            if not extConn:
+                conn = self.connFactory.connection();
+            try:
+                decayScale = self.loadAssociationDecayScale(conn=conn);
+                analyzedPatientCount = self.getCacheData("analyzedPatientCount", conn=conn);
+                if analyzedPatientCount is not None:
+                    analyzedPatientCount = float(analyzedPatientCount);
+            finally:
+                if not extConn:
+                    conn.close();
+            if decayScale != header["decayScale"] or analyzedPatientCount != header["analyzedPatientCount"]:
+                log.warning("Model snapshot %s (created %s) is out of date with the database, so not using it" % (filename, header["createTime"]) );
+                return None;
+
+        if hasattr(self.dataCache, "invalidate"):
+            self.dataCache.set(ASSOCIATION_MATRIX_CACHE_KEY, matrix, tags=[MODEL_SNAPSHOT_CACHE_TAG]);
+        elif self.dataCache is not None:
+            self.dataCache[ASSOCIATION_MATRIX_CACHE_KEY] = matrix;
+        return matrix;
 
     def getCacheData(self,key,conn=None):
         """Utility function to retrieve cached data item from data_cache table.  Returns None if not found"""
@@ -538,8 +645,12 @@ class DataManager:
         if not extConn:
             conn = self.connFactory.connection();
 
-        # Clear any prior setting to make way for the new one
-        self.clearCacheData(key,conn=conn);
+        # Clear any prior setting to make way for the new one.  Only discard any in memory copy of this same key,
+        #   as recording a (re)calculated value does not mean the data that other entries are tagged with has changed
+        deleteQuery = "delete from data_cache where data_key = %s" % DBUtil.SQL_PLACEHOLDER;
+        DBUtil.execute( deleteQuery, (key,), conn=conn );
+        if self.dataCache is not None:
+            self.dataCache.pop(key, None);
 
         insertQuery = DBUtil.buildInsertQuery("data_cache", ("data_key","data_value","last_update") );
         insertParams= ( key, str(value), datetime.now() );
@@ -549,7 +660,9 @@ class DataManager:
             conn.close();
 
     def clearCacheData(self,key,conn=None):
-        """Utility function to set cached data item in data_cache table"""
+        """Utility function to clear cached data item from data_cache table.
+        Signals the underlying data has changed, so also invalidates in memory dataCache entries tagged with the key.
+        """
         extConn = conn is not None;
         if not extConn:
             conn = self.connFactory.connection();
@@ -557,14 +670,25 @@ class DataManager:
         cacheQuery = "delete from data_cache where data_key = %s" % DBUtil.SQL_PLACEHOLDER;
         DBUtil.execute( cacheQuery, (key,), conn=conn );
 
+        self.invalidateDataCache(key);
+
         if not extConn:
             conn.close();
 
+    def invalidateDataCache(self, key):
+        """Discard any in memory dataCache entries that depend on the data_cache table key,
+        since the underlying data must have changed.
+        A plain dict dataCache has no dependency information, so is left as is.
+        """
+        if hasattr(self.dataCache, "invalidate"):
+            self.dataCache.invalidate(key);
+
     def executeCacheOption(self, query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, conn=None, connFactory=None, autoCommit=True):
         """Wrap DBUtil.execute.  If instance's dataCache is present, will check and store any results in there
         to help reduce time for repeat queries.
 
-        Beware, bad idea to store lots of varied, huge results in this cache, otherwise memory leak explosion.
+        Beware, if dataCache is a plain dict, bad idea to store lots of varied, huge results in this cache, otherwise memory leak explosion.
+        A DataCache will instead evict the least recently used results when it reaches its memory budget.
         """
         if connFactory is None:
             connFactory = self.connFactory;
@@ -574,11 +698,17 @@ class DataManager:
             dataCache = dict(); # Create a temporary holder
 
         queryStr = DBUtil.parameterizeQueryString(query);
-        if queryStr not in dataCache:
-            dataCache[queryStr] = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
+        results = dataCache.get(queryStr);
+        if self.context is not None:
+            self.context.addCacheLookup("queryResults", results is not None);
+        if results is None:
+            results = DBUtil.execute( query, parameters, includeColumnNames, incTypeCodes, formatter, conn, connFactory, autoCommit );
             self.queryCount += 1;
+            if self.context is not None:
+                self.context.addCount("rowsFetched", len(results));
+            dataCache[queryStr] = results;
 
-        dataCopy = list(dataCache[queryStr]);
+        dataCopy = list(results);
 
         return dataCopy;
 
@@ -595,6 +725,7 @@ class DataManager:
         parser.add_option("-m", "--mergeRelated", dest="mergeRelated", metavar="<clinicalItemIds>",  help="The specified clinical items will be merged / composited into the first clinical item provided.  Patient_item instances will be reassigned to the merged clinical_item (while backup links will be saved to backup_link_patient_item), clinical_item_association counts for the merged item will be updated to reflect the accumulation of all merged items, then the remaining now redundant items will be deactivated.")
         parser.add_option("-u", "--unifyRedundant",    dest="unifyRedundant", metavar="<clinicalItemIds>",    help="The specified clinical items will be collapsed into the first clinical item provide, assuming the clinical_item pairs have perfect 1-to-1 association, indicating redundancy (though this sometimes occurs legitimately as well).  Deactivate the duplicate items (remove from analysis as above) except for 1, and relabel that 1 to indicate its unification from the others")
         parser.add_option("-C", "--updateClinicalItemCounts",    dest="updateClinicalItemCounts",     action="store_true",    help="If set, will update the denormalized clinical_item.item_count columns with the current DB data")
+        parser.add_option("-s", "--exportModelSnapshot",    dest="exportModelSnapshot", metavar="<filename>",    help="Store a snapshot of the current association model (association counts, clinical item base counts, categories, analyzed patient count) into the specified file, that recommender processes can memory map for fast startup")
         parser.add_option("-r", "--resetAssociationModel",    dest="resetAssociationModel",     action="store_true",    help="If set, will clear out any existing data/parameters generated from association model (e.g., clinical_item_association, analyze_date, cache values)")
 
         (options, args) = parser.parse_args(argv[1:])
@@ -663,6 +794,8 @@ class DataManager:
             self.updateClinicalItemCounts();
         elif options.resetAssociationModel:
             self.resetAssociationModel();
+        elif options.exportModelSnapshot is not None:
+            self.exportModelSnapshot(options.exportModelSnapshot);
 
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
@@ -41,10 +41,15 @@ from medinfo.cpoe.Env import DATE_FORMAT
 from medinfo.db import DBUtil
 from medinfo.cpoe.test import TestAssociationAnalysis
 from medinfo.cpoe import AssociationAnalysis
+from medinfo.cpoe.DataManager import DataManager
 from medinfo.cpoe.test.Const import RUNNER_VERBOSITY
 from medinfo.cpoe.Const import DELTA_NAME_BY_SECONDS, SECONDS_PER_DAY;
 from .Util import log;
 
+# In lazy decay mode, once the accumulated decay scale factor drops below this value,
+#	apply it to the stored counts and reset it to 1.0, so pre-scaled increments do not grow without bound
+DECAY_RENORMALIZE_SCALE = 1e-6;
+
 class DecayAnalysisOptions:
 	"""Simple struct to pass filter parameters on which records to do analysis on"""
 	def __init__(self):
@@ -58,6 +63,7 @@ class DecayAnalysisOptions:
 		self.itemsPerUpdate = None
 		self.outputFile = None
 		self.skipLargerCountWindows = True;	# If set, then won't try to update association count fields longer than the given delta time, since will never be a different number than the next largest interval count and just consumes extra memory
+		self.lazyDecay = False;	# If set, decay by just updating a global scale factor, rather than rewriting every stored count each delta. Readers (via DataManager / AssociationMatrix) apply the scale to the stored counts
 
 
 class DecayingWindows:
@@ -68,19 +74,18 @@ class DecayingWindows:
 		self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
 		self.decayCount = 0
 
-	def standardDecay (self, decayAnalysisOptions):
+	def standardDecay (self, decayAnalysisOptions, decay=None):
+		"""Multiply every clinical_item_association count by the decay value (default from the decayAnalysisOptions)"""
+		if decay is None:
+			decay = decayAnalysisOptions.decay
 		conn = self.connFactory.connection()
-		prefixes = ['', 'patient_', 'encounter_']
-		times = ['0', '3600', '7200', '21600', '43200', '86400', '172800', '345600', '604800', '1209600', '2592000', '7776000', '15552000', '31536000', '63072000', '126144000', 'any']
 		try:
 			log.debug("Connected to datbase");
 			curs = conn.cursor()
 
 			fields = list()
-			for prefix in prefixes:
-				for time in times:
-					fieldName = prefix + "count_" + str(time)
-					fields.append(fieldName + '=' + fieldName + "*" + str(decayAnalysisOptions.decay))
+			for fieldName in decayCountFields():
+				fields.append(fieldName + '=' + fieldName + "*" + repr(float(decay)))
 
 			"""log.debug("starting to drop indices");
 			sqlQuery = "ALTER TABLE clinical_item_association drop CONSTRAINT clinical_item_association_pkey;"
@@ -125,6 +130,21 @@ class DecayingWindows:
 			curs.close()
 			conn.close()
 
+	def lazyDecay (self, decayAnalysisOptions):
+		"""Closed form alternative to standardDecay.  Rather than rewriting every clinical_item_association row,
+		just multiply the global decay scale factor that readers apply to the stored counts
+		(and that new increments are divided by when committed by AssociationAnalysis).
+		Only rewrites the stored counts (renormalizes) on the rare occasions the scale drops below DECAY_RENORMALIZE_SCALE.
+		"""
+		dataManager = DataManager()
+		dataManager.connFactory = self.connFactory
+		decayScale = dataManager.loadAssociationDecayScale() * decayAnalysisOptions.decay
+		if decayScale < DECAY_RENORMALIZE_SCALE:
+			log.debug("renormalize decay scale %s" % decayScale);
+			self.standardDecay(decayAnalysisOptions, decayScale)
+			decayScale = 1.0
+		dataManager.setAssociationDecayScale(decayScale)
+
 	def decayAnalyzePatientItems(self, decayAnalysisOptions):
 		log.debug("delta = %s" % decayAnalysisOptions.delta);
 
@@ -135,6 +155,7 @@ class DecayingWindows:
 		currentBuffer = None;	# In memory buffer if using temp files. Otherwise, use the database as the data cache
 		if decayAnalysisOptions.outputFile is not None:
 			currentBuffer = dict();
+		bufferScale = 1.0;	# In lazy decay mode, scale factor to apply to the in memory buffer counts
 
 		#####
 		# Step one delta (e.g., month) at a time until end date
@@ -156,7 +177,16 @@ class DecayingWindows:
 
 			# Decay any existing stats before learn new ones to increment
 			if currentBuffer is None:
-				self.standardDecay(decayAnalysisOptions)
+				if decayAnalysisOptions.lazyDecay:
+					self.lazyDecay(decayAnalysisOptions)
+				else:
+					self.standardDecay(decayAnalysisOptions)
+			elif decayAnalysisOptions.lazyDecay:
+				bufferScale *= decayAnalysisOptions.decay
+				if bufferScale < DECAY_RENORMALIZE_SCALE:
+					log.debug("buffer renormalize");
+					currentBuffer = instance.bufferDecay(currentBuffer, bufferScale)
+					bufferScale = 1.0
 			else:
 				log.debug("buffer decay");
 				currentBuffer = instance.bufferDecay(currentBuffer, decayAnalysisOptions.decay)
@@ -197,6 +227,8 @@ class DecayingWindows:
 			# if you have been doing everything in memory, then load the latest buffer from Analysis Options and merge it with your current buffer
 			if currentBuffer is not None:
 				bufferOneDelta = instance.loadUpdateBufferFromFile(decayAnalysisOptions.outputFile)
+				if bufferScale != 1.0:
+					bufferOneDelta = instance.bufferDecay(bufferOneDelta, 1.0/bufferScale)	# Pre-scale new counts to match the lazily decayed buffer
 				currentBuffer = instance.mergeBuffers(currentBuffer, bufferOneDelta)
 				log.debug("finished merge");
 
@@ -208,6 +240,9 @@ class DecayingWindows:
 		
 		# Commit to database if have been doing everything in memory. (If not, then have already been commiting to database incrementally)
 		if currentBuffer is not None:
+			if bufferScale != 1.0:
+				currentBuffer = instance.bufferDecay(currentBuffer, bufferScale)	# Apply lazy decay scale once before commit
+
 			finalCommitBufferFileName = "finalCommitBuffer.txt"
 
 			if os.path.exists(decayAnalysisOptions.outputFile):
@@ -236,6 +271,7 @@ class DecayingWindows:
 		parser.add_option("-a", "--associationsPerCommit", type="int", dest="associationsPerCommit", help="If provided, will commit incremental analysis results to the database when accrue this many association items.  Can help to avoid allowing accrual of too much buffered items whose runtime memory will exceed the 32bit 2GB program limit.")
 		parser.add_option("-u", "--itemsPerUpdate", type="int", dest="itemsPerUpdate", help="If provided, when updating patient_item analyze_dates, will only update this many items at a time to avoid overloading MySQL query.")
 		parser.add_option("-o", "--outputFile", dest="outputFile", help="If provided, send buffer to output file rather than commiting to database")
+		parser.add_option("-l", "--lazyDecay", dest="lazyDecay", action="store_true", help="If set, decay by updating a single global scale factor (applied when counts are read), rather than rewriting every stored association count after each delta")
 		(options, args) = parser.parse_args(argv[1:])
 
 		decayAnalysisOptions = DecayAnalysisOptions()
@@ -257,6 +293,8 @@ class DecayingWindows:
 
 		if options.outputFile is not None:
 			decayAnalysisOptions.outputFile = options.outputFile
+		if options.lazyDecay:
+			decayAnalysisOptions.lazyDecay = True
 
 		#set patientIds based on either a file input or args
 		decayAnalysisOptions.patientIds = list()
@@ -279,6 +317,13 @@ class DecayingWindows:
 		self.decayAnalyzePatientItems(decayAnalysisOptions)
 
 
+def decayCountFields():
+	"""Names of all of the clinical_item_association count columns that decay"""
+	prefixes = ['', 'patient_', 'encounter_']
+	times = ['0', '3600', '7200', '21600', '43200', '86400', '172800', '345600', '604800', '1209600', '2592000', '7776000', '15552000', '31536000', '63072000', '126144000', 'any']
+	return [prefix + "count_" + str(itemTime) for prefix in prefixes for itemTime in times]
+
+
 if __name__== "__main__":
 
 	instance = DecayingWindows()
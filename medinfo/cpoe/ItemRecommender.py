@@ -8,22 +8,28 @@ items / orders.
 """
 import sys, os
 import time;
+import copy;
 from operator import itemgetter
 from optparse import OptionParser;
 import json;
 import urllib.parse;
 import math;
+import numpy as np;
+from scipy.sparse import csr_matrix;
 from datetime import datetime, timedelta;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
-from medinfo.common.StatsUtil import ContingencyStats, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
+from medinfo.common.RankIndex import RankIndex;
+from medinfo.common.StatsUtil import ContingencyStats, ContingencyStatsArray, UnrecognizedStatException, DEGENERATE_VALUE_ADJUSTMENT;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.Model import RowItemFieldComparator;
 from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.db.ResultsFormatter import TextResultsFormatter;
 
-from .DataManager import DataManager;
+from .DataManager import DataManager, ASSOCIATION_MATRIX_CACHE_KEY, isDecayScaledField;
+from .AssociationMatrix import AssociationMatrix;
+from .RecommenderMetrics import RecommenderContext, RecommenderMetrics, NULL_STAGE;
 
 from .Util import log;
 from .Const import AGGREGATOR_OPTIONS;
@@ -38,6 +44,17 @@ DEFAULT_DERIVED_STATS = ["baselineFreq","conditionalFreq","freqRatio"];
 # Test value for total patient count when simulating calculations for unit test
 SIMULATED_PATIENT_COUNT = 3000.0;
 
+# Sort fields whose weighted / unweighted aggregate across query items is a weighted average of the component scores,
+#   so an aggregate result can never score better than its best component.  Allows early stopping with a TopKNeighborIndex
+AVERAGED_SCORE_FIELDS = ("PPV","conditionalFreq","P(B|A)","lift","freqRatio","interest","P(B|A)/P(B)");
+
+# Relative margin by which the top scores must beat the best possible score of any unseen item before stopping early,
+#   to guard against floating point differences between the indexed and recalculated scores
+NEIGHBOR_BOUND_TOLERANCE = 1e-9;
+
+# Number of queries to score together in each sparse matrix product of recommendBatch, to bound the intermediate memory use
+RECOMMEND_BATCH_SIZE = 1000;
+
 class RecommenderQuery:
     """Simple struct to pass query parameters
     """
@@ -167,6 +184,8 @@ class BaseItemRecommender:
     def __init__(self):
         self.connFactory = DBUtil.ConnectionFactory();  # Default connection source
         self.dataManager = DataManager();
+        self.metrics = None;    # If set to a RecommenderMetrics, accumulate instrumentation of each recommendWithContext call
+        self.context = None;    # RecommenderContext for the call in progress, only while collecting instrumentation
 
     def __call__(self, query):
         """Primary function.  Given a query object representing
@@ -180,6 +199,85 @@ class BaseItemRecommender:
         """
         raise NotImplementedError("Abstract base class method.  Sub-class should override.");
 
+    def recommendBatch(self, queries, conn=None):
+        """Batch version of the primary function.  Given a list of query objects
+        (e.g., one per patient or time point being evaluated), return a list of the
+        respective recommendation result lists, in the same order.
+        Default implementation just runs each query in turn over a shared connection,
+        but sub-classes can override to share work across the queries.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            return [self(query, conn=conn) for query in queries];
+        finally:
+            if not extConn:
+                conn.close();
+
+    def recommendWithContext(self, query, formatResults=False, conn=None):
+        """Same results as the primary function, but also collect instrumentation (RecommenderContext)
+        of the time spent in each pipeline stage, database queries and rows fetched, cache lookups,
+        and candidate set sizes.  If formatResults, also run formatRecommenderResults within the instrumented call.
+        If the metrics attribute is set, the context is accumulated there as well.
+        Returns (results, context) 2-ple.
+        """
+        context = RecommenderContext();
+        (self.context, self.dataManager.context) = (context, context);
+        queryCount = self.dataManager.queryCount;
+        try:
+            if conn is None:
+                results = self(query);  # Not every recommender accepts a connection argument
+            else:
+                results = self(query, conn=conn);
+            if formatResults and results:
+                with self.stage("formatResults"):
+                    self.formatRecommenderResults(results, conn=conn);
+        finally:
+            (self.context, self.dataManager.context) = (None, None);
+
+        context.addCount("dbQueries", self.dataManager.queryCount - queryCount);
+        context.addCount("resultItems", len(results));
+        context.finish();
+        if self.metrics is not None:
+            self.metrics.record(context);
+        return (results, context);
+
+    def stage(self, name):
+        """Timer (context manager) for the named stage of the recommendation pipeline.
+        Does nothing unless collecting instrumentation (see recommendWithContext).
+        """
+        if self.context is None:
+            return NULL_STAGE;
+        return self.context.stage(name);
+
+    def recordCount(self, name, value=1):
+        """Add to the named instrumentation count (e.g., rowsFetched, candidateItems), if collecting instrumentation"""
+        if self.context is not None:
+            self.context.addCount(name, value);
+
+    def recordCacheLookup(self, cacheName, hit):
+        """Note whether a lookup in the named cache was a hit, if collecting instrumentation"""
+        if self.context is not None:
+            self.context.addCacheLookup(cacheName, hit);
+
+    def session(self, query, conn=None):
+        """Start an incremental recommendation session for the query, where query items can be added one at a time
+        and the rank of target items looked up after each, without re-running the whole query.
+        Returns None if this recommender does not support incremental sessions, in which case callers
+        should just run complete queries instead.
+        """
+        return None;
+
+    def targetScorer(self, query, conn=None):
+        """Prepare a scorer for just the query's targetItemIds (e.g., outcomes to predict), to score them
+        for many sets of query items at once without producing whole recommendation lists.
+        Returns None if this recommender (or the query options) do not support that,
+        in which case callers should just run complete queries instead.
+        """
+        return None;
+
     def defaultExcludedClinicalItemCategoryIds(self, conn=None):
         """Return the default list of clinical item categories that
         should be excluded from a recommendation list.
@@ -320,6 +418,35 @@ class BaseItemRecommender:
 
     populateDerivedStats = staticmethod(populateDerivedStats);
 
+    def populateDerivedStatsList(resultModels, statIds):
+        """Batch version of populateDerivedStats for a list of result models,
+        calculating each stat for all of the models at once with a ContingencyStatsArray.
+        """
+        if len(resultModels) < 1:
+            return;
+        for resultModel in resultModels:
+            if "nAB" not in resultModel:    # Baseline query, so just populate with full correlations
+                resultModel["nAB"] = resultModel["nB"];
+                resultModel["nA"] = resultModel["N"];
+
+        contStats = ContingencyStatsArray \
+            (   [resultModel["nAB"] for resultModel in resultModels],
+                [resultModel["nA"] for resultModel in resultModels],
+                [resultModel["nB"] for resultModel in resultModels],
+                [resultModel["N"] for resultModel in resultModels],
+            );
+        contStats.normalize(truncateNegativeValues=False);
+
+        for statId in statIds:
+            statValues = None;  # Only calculate if some model actually needs it
+            for i, resultModel in enumerate(resultModels):
+                if statId not in resultModel:   # Skip stats that have already been populated
+                    if statValues is None:
+                        statValues = contStats[statId];
+                    resultModel[statId] = float(statValues[i]);
+
+    populateDerivedStatsList = staticmethod(populateDerivedStatsList);
+
     def populateAggregateStats(aggregateResult, query, statIds=None):
         """Calculate and populate the aggregate result item with stats based
         on its component items (expected in item keyed by "componentResults"
@@ -408,12 +535,30 @@ class BaseItemRecommender:
             nA' = Product((nAi-nAiB)/(N-nB)) * (N-nB) + nAB'
         """
         if statIds is None:
-            statIds = {query.sortField}
-            for (fieldOp, value) in query.fieldFilters.items():
-                if value is not None:
-                    field = fieldOp[:-1];
-                    statIds.add(field);
+            statIds = BaseItemRecommender.queryStatIds(query);
 
+        BaseItemRecommender.populateAggregateCounts(aggregateResult, query);
+
+        # Populate derived statistics that may be used as scoring measures
+        BaseItemRecommender.populateDerivedStats(aggregateResult, statIds);
+        aggregateResult["score"] = aggregateResult[query.sortField];
+
+    populateAggregateStats = staticmethod(populateAggregateStats);
+
+    def queryStatIds(query):
+        """Set of stats needed to sort and filter results by the query options"""
+        statIds = {query.sortField}
+        for (fieldOp, value) in query.fieldFilters.items():
+            if value is not None:
+                field = fieldOp[:-1];
+                statIds.add(field);
+        return statIds;
+    queryStatIds = staticmethod(queryStatIds);
+
+    def populateAggregateCounts(aggregateResult, query):
+        """Aggregation step of populateAggregateStats.  Populate the aggregate result nAB, nA, nB, N counts
+        based on its component items, per the query.aggregationMethod, without yet calculating derived stats.
+        """
         if "componentResultsById" in aggregateResult:
             componentResultsById = aggregateResult["componentResultsById"];
 
@@ -450,7 +595,8 @@ class BaseItemRecommender:
                 for componentId, component in componentResultsById.items():
                     nAB_ = max(component["nAB"],DEGENERATE_VALUE_ADJUSTMENT);   # Small adjustment to avoid zero value that will wipe out all information in product
                     nA_ = max(component["nA"],DEGENERATE_VALUE_ADJUSTMENT); # Similar check should not be necessary
-                    aggregateResult["product(nAB/nB)"] *= nAB_ / component["nB"];
+                    nB_ = component["nB"] if component["nB"] > 0 else DEGENERATE_VALUE_ADJUSTMENT; # Target items may have associations but no baseline count of their own. Leave any other (e.g., decayed fractional) counts as is
+                    aggregateResult["product(nAB/nB)"] *= nAB_ / nB_;
                     aggregateResult["product(nA/N)"] *= nA_ / component["N"];
 
                 aggregateResult["nAB"] = aggregateResult["product(nAB/nB)"] * aggregateResult["nB"]
@@ -482,17 +628,14 @@ class BaseItemRecommender:
                 for componentId, component in componentResultsById.items():
                     nAB_ = max(component["nAB"],DEGENERATE_VALUE_ADJUSTMENT);   # Small adjustment to avoid zero value that will wipe out all information in product
                     nA_ = component["nA"];
-                    aggregateResult["Product(nAB/nB)"] *= nAB_ / component["nB"];
+                    nB_ = component["nB"] if component["nB"] > 0 else DEGENERATE_VALUE_ADJUSTMENT; # Target items may have associations but no baseline count of their own. Leave any other (e.g., decayed fractional) counts as is
+                    aggregateResult["Product(nAB/nB)"] *= nAB_ / nB_;
                     aggregateResult["Product((nA-nAB)/(N-nB))"] *= (nA_-nAB_) / (component["N"]-component["nB"]);
 
                 aggregateResult["nAB"] = aggregateResult["Product(nAB/nB)"] * aggregateResult["nB"];
                 aggregateResult["nA"] = aggregateResult["Product((nA-nAB)/(N-nB))"] * (aggregateResult["N"]-aggregateResult["nB"]) + aggregateResult["nAB"];
 
-        # Populate derived statistics that may be used as scoring measures
-        BaseItemRecommender.populateDerivedStats(aggregateResult, statIds);
-        aggregateResult["score"] = aggregateResult[query.sortField];
-
-    populateAggregateStats = staticmethod(populateAggregateStats);
+    populateAggregateCounts = staticmethod(populateAggregateCounts);
 
 
     def filterAggregateResultsByQuery( self, aggregateResultsByItemId, query ):
@@ -500,14 +643,25 @@ class BaseItemRecommender:
         and ordered list of aggregateResults based on the query sort and filter options.
         Should require calculation of summary statistics for each aggregate result based on component results.
         """
+        # Calculate and populate the aggregate result items with stats based on their component items
+        #   to enable subsequent sorting and filtering.  Derived stats calculated for all items at once.
+        with self.stage("aggregateStats"):
+            aggregateResults = list(aggregateResultsByItemId.values());
+            for aggregateResult in aggregateResults:
+                self.populateAggregateCounts(aggregateResult, query);
+            self.populateDerivedStatsList(aggregateResults, self.queryStatIds(query));
+
+        with self.stage("filterSort"):
+            return self.filterSortAggregateResults(aggregateResults, query);
+
+    def filterSortAggregateResults( self, aggregateResults, query ):
+        """Apply the query value filters to the (stat populated) aggregateResults,
+        and return the top results in order of the query sort field.
+        """
         # Now collect and sort the aggregated results to return only the top relevant results
         aggregateResultsWithScore = list();
-        for aggregateResult in aggregateResultsByItemId.values():
-            itemId = aggregateResult["clinical_item_id"];
-
-            # Calculate and populate the aggregate result item with stats based on its component items
-            #   to enable subsequent sorting and filtering
-            self.populateAggregateStats(aggregateResult, query);
+        for aggregateResult in aggregateResults:
+            aggregateResult["score"] = aggregateResult[query.sortField];
 
             # Look for value filters
             excludeResult = False;
@@ -564,11 +718,7 @@ class ItemAssociationRecommender(BaseItemRecommender):
 
         try:
             # Determine sorting / scoring field based on time limit parameters
-            countField = "count_any";
-            if query.timeDeltaMax is not None:
-                timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
-                countField = "count_%d" % timeDeltaSeconds;
-            countField = query.countPrefix+countField;
+            countField = self.countFieldByQuery(query);
 
             sqlQuery = SQLQuery();
             sqlQuery.addSelect("cia."+query.sourceCol()+"");
@@ -596,21 +746,26 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 sqlQuery.limit = query.limit;
 
                 #print >> sys.stderr, "DEFAULT Query:", sqlQuery, sqlQuery.params
-                resultTable = self.dataManager.executeCacheOption( sqlQuery, includeColumnNames=True, conn=conn );
-                resultModels = modelListFromTable( resultTable );
-                resultModels = self.filterResultItems(resultModels, query);
+                with self.stage("loadAssociations"):
+                    resultTable = self.dataManager.executeCacheOption( sqlQuery, includeColumnNames=True, conn=conn );
+                    resultModels = modelListFromTable( resultTable );
+                    resultModels = self.filterResultItems(resultModels, query);
+                self.recordCount("candidateItems", len(resultModels));
 
                 # Direct DB query results will basically work, just add a score column
                 #   Use total number of patient records as a denominator as theoretical number of distinct times an order could be made
                 #   Technically not perfectly accurate, since a single patient can have the same order entered in multiple times.
-                totalPatients = self.totalPatientCount(query, conn);
+                with self.stage("populateResultCounts"):
+                    totalPatients = self.totalPatientCount(query, conn);
 
-                for result in resultModels:
-                    nB = result["nB"] = result[query.countPrefix+"count_0"];
-                    N = result["N"] = totalPatients;
+                    for result in resultModels:
+                        nB = result["nB"] = result[query.countPrefix+"count_0"];
+                        N = result["N"] = totalPatients;
 
-                    self.populateDerivedStats(result, [query.sortField]);
-                    result["score"] = result[query.sortField];
+                with self.stage("aggregateStats"):
+                    self.populateDerivedStatsList(resultModels, [query.sortField]);
+                    for result in resultModels:
+                        result["score"] = result[query.sortField];
                 return resultModels;
 
             nQueryItems = len(query.queryItemIds);
@@ -618,13 +773,6 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 # Special case of an empty query set, just look for the most commonly used items in general
                 return self( query, default=True, conn=conn );
             else:
-                # Determine sorting / scoring field based on time limit parameters
-                countField = "count_any";
-                if query.timeDeltaMax is not None:
-                    timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
-                    countField = "count_%d" % timeDeltaSeconds;
-                countField = query.countPrefix+countField;
-
                 #if query.limit is not None:
                     # Don't need to return whole data table?  Maybe just get enough to fulfill query quantity?
                     # But need to expand by query item count however, since aggregating across multiple queries
@@ -634,7 +782,9 @@ class ItemAssociationRecommender(BaseItemRecommender):
                 #   # Above will not work however, since single query is pulling data for all query items,
                 #   # and really should be applying cut-off limit to each "sub-query"
                 #print >> sys.stderr, "AssocQuery:", sqlQuery, sqlQuery.params;
-                resultModels = self.loadResultModels( query, sqlQuery, conn=conn );
+                with self.stage("loadAssociations"):
+                    resultModels = self.loadResultModels( query, sqlQuery, conn=conn );
+                self.recordCount("componentResults", len(resultModels));
 
                 if len(resultModels) < 1:
                     # Not able to find any recommendations based on this query data.  Just return default recommendations then.
@@ -646,6 +796,18 @@ class ItemAssociationRecommender(BaseItemRecommender):
             if not extConn:
                 conn.close();
 
+    def countFieldByQuery(query):
+        """Determine which clinical_item_association count column to score by, based on the
+        query time limit (timeDeltaMax) and counting method (countPrefix) parameters.
+        """
+        countField = "count_any";
+        if query.timeDeltaMax is not None:
+            timeDeltaSeconds = (query.timeDeltaMax.days*SECONDS_PER_DAY + query.timeDeltaMax.seconds);
+            countField = "count_%d" % timeDeltaSeconds;
+        countField = query.countPrefix+countField;
+        return countField;
+    countFieldByQuery = staticmethod(countFieldByQuery);
+
     def loadResultModels( self, query, sqlQuery, conn ):
         """Query for the results from the SQL query, but if the dataCache is set on this instance,
         see if this can be retrieved/stored from there as well, to minimize repetitive database hits.
@@ -657,29 +819,43 @@ class ItemAssociationRecommender(BaseItemRecommender):
         # Populate a cache if it has not already been so
         dataCache = self.dataManager.dataCache;
         if dataCache is None: dataCache = dict();
-        if simpleSQLQuery not in dataCache:
-            dataCache[simpleSQLQuery] = dict();
+        resultsBySourceId = dataCache.get(simpleSQLQuery);
+        self.recordCacheLookup("associations", resultsBySourceId is not None);
+        if resultsBySourceId is None:
+            resultsBySourceId = dict();
 
             #print >> sys.stderr, sqlQuery;
 
             newResultsTable = DBUtil.execute( sqlQuery, includeColumnNames=True, conn=conn );
             newResultModels = modelListFromTable(newResultsTable);
             self.dataManager.queryCount += 1;
+            self.recordCount("rowsFetched", len(newResultModels));
+
+            # Apply any lazy decay scale to the stored counts, consistent with the (already scaled) baseline item counts
+            decayScale = self.dataManager.loadAssociationDecayScale(conn=conn);
+            if decayScale != 1.0:
+                decayFields = [field for field in newResultsTable[0] if isDecayScaledField(field)];
+                for result in newResultModels:
+                    for field in decayFields:
+                        if result[field] is not None:
+                            result[field] *= decayScale;
 
             for result in newResultModels:
                 #print >> sys.stderr, "CACHE IT:", (result);
                 sourceItemId = result[query.sourceCol()];
-                if sourceItemId not in dataCache[simpleSQLQuery]:
-                    dataCache[simpleSQLQuery][sourceItemId] = list();
+                if sourceItemId not in resultsBySourceId:
+                    resultsBySourceId[sourceItemId] = list();
                 resultCopy = dict(result);
-                dataCache[simpleSQLQuery][sourceItemId].append(resultCopy);
+                resultsBySourceId[sourceItemId].append(resultCopy);
+
+            dataCache[simpleSQLQuery] = resultsBySourceId;  # Bounded cache may evict this later, so keep working off the local reference
 
         # Pull out the relevant results of interest
         resultModels = list();
         # See if can find what we want from the previously cached results
         for queryItemId in query.queryItemIds:
-            if queryItemId in dataCache[simpleSQLQuery]:
-                for result in dataCache[simpleSQLQuery][queryItemId]:
+            if queryItemId in resultsBySourceId:
+                for result in resultsBySourceId[queryItemId]:
                     resultCopy = dict(result);
                     resultModels.append( resultCopy );
                     #print >> sys.stderr, "PULL IT", resultCopy;
@@ -719,10 +895,13 @@ class ItemAssociationRecommender(BaseItemRecommender):
             return self( query, default=True, conn=conn );
 
         # Ensure core association count statistics are available for each result
-        self.populateResultCounts( resultModels, query, countField, conn=conn );
+        with self.stage("populateResultCounts"):
+            self.populateResultCounts( resultModels, query, countField, conn=conn );
 
         # Organize all possible results by target item ID, with component results as sub items
-        aggregateResultsByItemId = self.collateAggregateResuls( resultModels, query );
+        with self.stage("collate"):
+            aggregateResultsByItemId = self.collateAggregateResuls( resultModels, query );
+        self.recordCount("candidateItems", len(aggregateResultsByItemId));
 
         # Now filter down the total list based on the query sort and filter options
         filteredAggregateResults = self.filterAggregateResultsByQuery( aggregateResultsByItemId, query );
@@ -822,6 +1001,74 @@ class ItemAssociationRecommender(BaseItemRecommender):
         return resultModels;
 
 
+    def targetScorer(self, query, conn=None):
+        """Scorer for the query's targetItemIds (see TargetItemScorer).
+        Only applies if every target could be in the recommendation results (no limit below the number of targets or value field filters),
+        so that the targets' scores do not depend on which other items would be recommended.
+        """
+        if not query.targetItemIds:
+            return None;
+        if query.limit is not None and query.limit < len(query.targetItemIds):
+            return None;
+        if [value for value in query.fieldFilters.values() if value is not None]:
+            return None;
+        return TargetItemScorer(self, query, conn=conn);
+
+    def loadTargetAssociationMatrix(self, query, countField, conn):
+        """Retrieve (from the dataCache if available) an AssociationMatrix with only the
+        association records leading to the query's targetItemIds, rather than the whole association table.
+        """
+        dataCache = self.dataManager.dataCache;
+        if dataCache is None: dataCache = dict();   # No caching, so will just be a temporary matrix for this query
+
+        targetItemIds = sorted(query.targetItemIds);
+        cacheKey = "%s.%s:%s" % (ASSOCIATION_MATRIX_CACHE_KEY, query.targetCol(), str.join(",", [str(itemId) for itemId in targetItemIds]) );
+        matrix = dataCache.get(cacheKey);
+        self.recordCacheLookup("associationMatrix", matrix is not None);
+        if matrix is None:
+            decayScale = self.dataManager.loadAssociationDecayScale(conn=conn);
+            matrix = AssociationMatrix.loadFromDatabase([query.countPrefix+"count_0", countField], conn=conn, decayScale=decayScale, targetFilter=(query.targetCol(), targetItemIds));
+            self.dataManager.queryCount += 1;
+            self.recordCount("rowsFetched", len(matrix));
+
+            # Category lookup to support application level category exclusion filters
+            categoryTable = DBUtil.execute("select clinical_item_id, clinical_item_category_id from clinical_item", conn=conn);
+            self.dataManager.queryCount += 1;
+            matrix.setCategoryIds([row[0] for row in categoryTable], [row[1] for row in categoryTable]);
+
+            dataCache[cacheKey] = matrix;
+
+        if matrix.loadFields([query.countPrefix+"count_0", countField], conn) > 0:
+            self.dataManager.queryCount += 1;
+            dataCache[cacheKey] = matrix;   # Store again so a bounded cache accounts for the added columns
+
+        return matrix;
+
+    def loadBaseCounts(self, matrix, query, conn):
+        """Return array of baseline item counts (nA, nB) aligned to the matrix item indexes,
+        loading them from the clinical_item table if not already stored with the matrix.
+        """
+        # Ensure the summary count cache is up-to-date before using it to query
+        self.dataManager.updateClinicalItemCounts(acceptCache=query.acceptCache, conn=conn);
+
+        countPrefix = query.countPrefix;
+        if countPrefix == "":
+            countPrefix = "item_";
+
+        if countPrefix not in matrix.baseCountsByPrefix:
+            baseCountQuery = SQLQuery();
+            baseCountQuery.addSelect("ci.clinical_item_id");
+            baseCountQuery.addSelect(countPrefix+"count");
+            baseCountQuery.addFrom("clinical_item as ci");
+            baseCountQuery.addWhere("analysis_status <> 0");    # Will need all records fit for analysis to scale any suggested item
+            baseCountResultTable = self.dataManager.executeCacheOption( baseCountQuery, conn=conn );
+
+            itemIds = [row[0] for row in baseCountResultTable];
+            baseCounts = [row[1] if row[1] is not None else np.nan for row in baseCountResultTable];
+            matrix.setBaseCounts(countPrefix, itemIds, baseCounts);
+
+        return matrix.baseCountsByPrefix[countPrefix];
+
     def totalPatientCount(self, query, conn):
         """DB Query for total patient count to use to scale data.
         Option to filter essentially to only test data
@@ -845,6 +1092,10 @@ class ItemAssociationRecommender(BaseItemRecommender):
             totalPatients = float(dataStr);
             return totalPatients;
 
+        # Cache value cleared, possibly by another process updating the association model,
+        #   so in memory results based on the prior model are no longer valid either
+        self.dataManager.invalidateDataCache("analyzedPatientCount");
+
         # No result returned from cache, so do raw query
         totalPatientQuery = SQLQuery();
         totalPatientQuery.addSelect("count(distinct patient_id)")
@@ -869,6 +1120,9 @@ class ItemAssociationRecommender(BaseItemRecommender):
                     "   <outputFile>    Tab-delimited table of recommender results..\n"+\
                     "                       Leave blank or specify \"-\" to send to stdout.\n"
         parser = OptionParser(usage=usageStr)
+        parser.add_option("-M", "--metricsFile", dest="metricsFile", help="If set, write instrumentation metrics of the recommender call (stage timings, database queries and rows, cache hit ratios, candidate set sizes) to this file.  Specify \"-\" for stderr");
+        parser.add_option("-F", "--metricsFormat", dest="metricsFormat", default="json", help="Format of the metrics output: json or prometheus (text exposition format).  Default json");
+        parser.add_option("-s", "--modelSnapshot", dest="modelSnapshot", metavar="<filename>", help="If set, start from the association model snapshot file (see DataManager -s) rather than loading the association model from the database, answering the query with the in memory SparseItemAssociationRecommender.  Ignored (with a warning) if the snapshot is out of date with the database");
 
         (options, args) = parser.parse_args(argv[1:])
 
@@ -892,14 +1146,33 @@ class ItemAssociationRecommender(BaseItemRecommender):
             query.parseParams(paramDict);
             displayFields = query.getDisplayFields();
 
-            # Core recommender query
-            recommendedData = self( query );
+            recommender = self;
+            if options.modelSnapshot is not None:
+                if not isinstance(recommender, SparseItemAssociationRecommender):
+                    recommender = SparseItemAssociationRecommender();
+                recommender.dataManager.importModelSnapshot(options.modelSnapshot);
+
+            # Core recommender query, with denormalized links to clinical item descriptions
+            metrics = RecommenderMetrics();
+            recommender.metrics = metrics;
+            (recommendedData, context) = recommender.recommendWithContext( query, formatResults=True );
+            recommender.metrics = None;
             if recommendedData:
-                # Denormalize results with links to clinical item descriptions
-                self.formatRecommenderResults(recommendedData);
                 # Ensure derived fields are populated if selected for display
-                for resultModel in recommendedData:
-                    self.populateDerivedStats(resultModel, displayFields);
+                recommender.populateDerivedStatsList(recommendedData, displayFields);
+
+            if options.metricsFile is not None:
+                metricsFile = sys.stderr;
+                if options.metricsFile != "-":
+                    metricsFile = stdOpen(options.metricsFile,"w");
+                try:
+                    if options.metricsFormat == "prometheus":
+                        metricsFile.write(metrics.toPrometheusText());
+                    else:
+                        print(metrics.toJSON(), file=metricsFile);
+                finally:
+                    if metricsFile not in (sys.stdout, sys.stderr):
+                        metricsFile.close();
 
             colNames = ["rank","clinical_item_id","name","description","category_description"];
             colNames.extend(displayFields);
@@ -915,6 +1188,893 @@ class ItemAssociationRecommender(BaseItemRecommender):
         timer = time.time() - timer;
         log.info("%.3f seconds to complete",timer);
 
+class SparseItemAssociationRecommender(ItemAssociationRecommender):
+    """Same recommendations as ItemAssociationRecommender, but rather than pulling association
+    records into per-row dictionaries on every query, loads the clinical_item_association counts
+    once into an in memory AssociationMatrix (cached in the DataManager.dataCache) and then
+    answers queries with vectorized array operations over the relevant matrix rows.
+
+    Filtering, aggregation across query items, and (top-k) sorting are all done on numeric arrays.
+    Only the final result items to return are built into RowItemModels, with their
+    component results, so callers see the same result structure as the parent class.
+
+    If a precomputed neighborIndex (TopKNeighborIndex) is set, eligible queries are answered
+    by only looking at the top ranked associations of each query item (see neighborIndexRecommend).
+
+    recommendBatch answers many queries (e.g., for every patient in an evaluation set) in one call,
+    sharing the matrix and baseline count lookups, and scoring the queries together with sparse matrix products.
+
+    session supports adding query items one at a time (see IncrementalRecommenderSession).
+    """
+    def __init__(self):
+        ItemAssociationRecommender.__init__(self);
+        self.neighborIndex = None;  # If set to a TopKNeighborIndex, use for fast path top-k queries
+
+    def __call__(self, query, default=False, conn=None):
+        if default or len(query.queryItemIds) < 1:
+            # Most common items overall (cold start) case is just a small direct query anyway
+            return ItemAssociationRecommender.__call__(self, query, default=True, conn=conn);
+
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            countField = self.countFieldByQuery(query);
+            with self.stage("loadAssociations"):
+                matrix = self.loadAssociationMatrix(query, countField, conn=conn);
+
+            if self.isNeighborIndexQuery(query, countField):
+                with self.stage("neighborIndex"):
+                    results = self.neighborIndexRecommend(matrix, query, countField, conn=conn);
+                if results is not None:
+                    return results;
+                # Otherwise could not be resolved within the indexed top associations, so fall back to the full calculation
+
+            with self.stage("populateResultCounts"):
+                components = self.loadComponentArrays(matrix, query, countField, conn=conn);
+
+            if components is None:
+                # Not able to find any recommendations based on this query data.  Just return default recommendations then.
+                return self( query, default=True, conn=conn );
+            self.recordCount("componentResults", len(components["nAB"]));
+
+            with self.stage("aggregateStats"):
+                aggregates = self.aggregateComponentArrays(components, query);
+            self.recordCount("candidateItems", len(aggregates["targetIndex"]));
+
+            with self.stage("filterSort"):
+                return self.filterAggregateArraysByQuery(matrix, components, aggregates, query, countField);
+        finally:
+            if not extConn:
+                conn.close();
+
+    def recommendBatch(self, queries, conn=None):
+        """Same results as calling the recommender on each query separately, but queries using the same
+        association counts share a single load of the matrix, baseline counts and total patient count.
+
+        For top-k queries aggregated by (un)weighted average, the approximate aggregate scores for
+        a whole block of queries are calculated at once by sparse matrix products (see batchCandidateIndexes).
+        Only the candidate target items that could make each query's top results then get the exact
+        per query calculation, so ranking and scores are identical to the single query path.
+        Other queries (e.g., Bayesian aggregation, field filters, no limit) get the full per query calculation,
+        still with the shared data.
+        """
+        extConn = True;
+        if conn is None:
+            conn = self.connFactory.connection();
+            extConn = False;
+        try:
+            resultsList = [None]*len(queries);
+
+            # Group queries by the association data they need
+            queryIndexesByGroup = dict();
+            for iQuery, query in enumerate(queries):
+                if len(query.queryItemIds) < 1:
+                    resultsList[iQuery] = self(query, default=True, conn=conn);
+                else:
+                    groupKey = (self.countFieldByQuery(query), query.countPrefix, query.invertQuery, query.aggregationMethod, query.acceptCache, query.maxRecommendedId is None);
+                    queryIndexesByGroup.setdefault(groupKey, list()).append(iQuery);
+
+            for groupKey, groupIndexes in queryIndexesByGroup.items():
+                countField = groupKey[0];
+                firstQuery = queries[groupIndexes[0]];
+                matrix = self.loadAssociationMatrix(firstQuery, countField, conn=conn);
+                baseCounts = self.loadBaseCounts(matrix, firstQuery, conn);
+                totalPatients = self.totalPatientCount(firstQuery, conn);
+
+                for iStart in range(0, len(groupIndexes), RECOMMEND_BATCH_SIZE):
+                    batchIndexes = groupIndexes[iStart:iStart+RECOMMEND_BATCH_SIZE];
+                    batchQueries = [queries[iQuery] for iQuery in batchIndexes];
+                    candidatesList = self.batchCandidateIndexes(matrix, batchQueries, countField, baseCounts, totalPatients);
+
+                    for iQuery, query, candidateIndex in zip(batchIndexes, batchQueries, candidatesList):
+                        if candidateIndex is None:
+                            components = self.loadComponentArrays(matrix, query, countField, conn, baseCounts, totalPatients);
+                        else:
+                            queryIndexes = self.queryItemIndexes(matrix, query);
+                            components = self.candidateComponentArrays(matrix, queryIndexes, candidateIndex, query, countField, conn, baseCounts, totalPatients);
+
+                        if components is None:
+                            resultsList[iQuery] = self(query, default=True, conn=conn);
+                        else:
+                            aggregates = self.aggregateComponentArrays(components, query);
+                            resultsList[iQuery] = self.filterAggregateArraysByQuery(matrix, components, aggregates, query, countField);
+            return resultsList;
+        finally:
+            if not extConn:
+                conn.close();
+
+    def session(self, query, conn=None):
+        return IncrementalRecommenderSession(self, query, conn=conn);
+
+    def batchCandidateIndexes(self, matrix, queries, countField, baseCounts, totalPatients):
+        """For a list of queries that share the same count column and aggregation method,
+        find the target item indexes that could make each query's top (limit) results.
+
+        Builds a sparse (query x item) weight matrix Q (1/nA per query item for weighted aggregation, 1 for unweighted),
+        so that with the association matrix S (ones per stored pair) and count matrix C:
+            sum(weight) = Q*S,  sum(nA*weight) = (Q.nA)*S,  sum(nAB*weight) = Q*C
+        gives the aggregate counts and scores for every (query, target) pair in a few sparse products.
+        The candidates are the targets scoring within a rounding tolerance of each query's limit-th best score.
+
+        Returns a list parallel to the queries, with an array of candidate target item indexes,
+        or None for queries that should just get the full calculation
+        (no limit, value field filters, non-average aggregation methods, or ambiguous NaN / infinite scores).
+        """
+        candidatesList = [None]*len(queries);
+        if len(matrix) < 1 or queries[0].aggregationMethod not in ("weighted","unweighted"):
+            return candidatesList;
+        invert = queries[0].invertQuery;
+
+        batchQueryIndexes = list(); # Which of the queries are being scored in the sparse products
+        rows = list();
+        cols = list();
+        for iQuery, query in enumerate(queries):
+            if query.limit is None or query.limit < 1:
+                continue;
+            if [value for value in query.fieldFilters.values() if value is not None]:
+                continue;
+            queryIndexes = matrix.itemIndex(query.queryItemIds);
+            queryIndexes = queryIndexes[queryIndexes >= 0];
+            queryIndexes = queryIndexes[~np.isnan(baseCounts[queryIndexes])];   # Components without baseline counts are dropped anyway
+            if (baseCounts[queryIndexes] <= 0).any():
+                continue;   # Degenerate weights, leave to the full calculation
+            rows.append(np.full(len(queryIndexes), len(batchQueryIndexes), dtype=np.int64));
+            cols.append(queryIndexes);
+            batchQueryIndexes.append(iQuery);
+        if not batchQueryIndexes:
+            return candidatesList;
+
+        rows = np.concatenate(rows);
+        cols = np.concatenate(cols);
+        nA = baseCounts[cols];
+        weight = np.ones(len(cols));
+        if queries[0].aggregationMethod == "weighted":
+            weight = 1.0 / nA;
+        shape = (len(batchQueryIndexes), len(matrix.itemIds));
+        weightMatrix = csr_matrix((weight, (rows, cols)), shape=shape);
+        countWeightMatrix = csr_matrix((nA*weight, (rows, cols)), shape=shape);
+
+        # Counts shifted by one, so that zero counts are not dropped from the product structure
+        structure = matrix.csr(invert=invert);
+        shiftedCounts = matrix.csr(invert=invert, values=matrix.countsByField[countField]+1.0);
+        # Same operand structures, so the (unsorted) product entries come out in the same order
+        sumWeight = (weightMatrix @ structure).tocsr();
+        sumCountWeight = (countWeightMatrix @ structure).tocsr();
+        sumShiftedWeight = (weightMatrix @ shiftedCounts).tocsr();
+        if not (np.array_equal(sumWeight.indptr, sumShiftedWeight.indptr) and np.array_equal(sumWeight.indices, sumShiftedWeight.indices) and
+                np.array_equal(sumWeight.indptr, sumCountWeight.indptr) and np.array_equal(sumWeight.indices, sumCountWeight.indices)):
+            return candidatesList;  # Some sums cancelled out to zero, so cannot line up the results
+
+        targetIndex = sumWeight.indices;
+        nB = baseCounts[targetIndex];
+        contStats = ContingencyStatsArray((sumShiftedWeight.data - sumWeight.data) / sumWeight.data, sumCountWeight.data / sumWeight.data, nB, float(totalPatients));
+        contStats.normalize(truncateNegativeValues=False);
+
+        for iBatch, iQuery in enumerate(batchQueryIndexes):
+            query = queries[iQuery];
+            (start, end) = (sumWeight.indptr[iBatch], sumWeight.indptr[iBatch+1]);
+            rowTargets = targetIndex[start:end];
+            rowScores = contStats[query.sortField][start:end];
+            keep = ~np.isnan(nB[start:end]) & self.targetFilterMask(matrix, rowTargets, query);
+            (rowTargets, rowScores) = (rowTargets[keep], rowScores[keep]);
+            if not np.isfinite(rowScores).all():
+                continue;   # Unclear how these would rank, so leave to the full calculation
+            if not query.sortReverse:
+                rowScores = -rowScores;
+
+            if len(rowScores) > query.limit:
+                limitScore = np.partition(rowScores, len(rowScores)-query.limit)[len(rowScores)-query.limit];
+                isCandidate = (rowScores >= limitScore - NEIGHBOR_BOUND_TOLERANCE*max(1.0, abs(limitScore)));
+                rowTargets = rowTargets[isCandidate];
+            candidatesList[iQuery] = rowTargets;
+
+        return candidatesList;
+
+    def loadAssociationMatrix(self, query, countField, conn):
+        """Retrieve the association matrix from the dataCache, or load it from the database if not yet available.
+        Ensure the count columns needed for the query are loaded.
+        """
+        dataCache = self.dataManager.dataCache;
+        if dataCache is None: dataCache = dict();   # No caching, so will just be a temporary matrix for this query
+
+        matrix = dataCache.get(ASSOCIATION_MATRIX_CACHE_KEY);
+        self.recordCacheLookup("associationMatrix", matrix is not None);
+        if matrix is None:
+            decayScale = self.dataManager.loadAssociationDecayScale(conn=conn);
+            matrix = AssociationMatrix.loadFromDatabase([query.countPrefix+"count_0", countField], conn=conn, decayScale=decayScale);
+            self.dataManager.queryCount += 2;
+            self.recordCount("rowsFetched", len(matrix));
+
+            # Category lookup to support application level category exclusion filters
+            categoryTable = DBUtil.execute("select clinical_item_id, clinical_item_category_id from clinical_item", conn=conn);
+            self.dataManager.queryCount += 1;
+            itemIds = [row[0] for row in categoryTable];
+            categoryIds = [row[1] for row in categoryTable];
+            matrix.setCategoryIds(itemIds, categoryIds);
+
+            dataCache[ASSOCIATION_MATRIX_CACHE_KEY] = matrix;
+
+        if matrix.loadFields([query.countPrefix+"count_0", countField], conn) > 0:
+            self.dataManager.queryCount += 1;
+            dataCache[ASSOCIATION_MATRIX_CACHE_KEY] = matrix;   # Store again so a bounded cache accounts for the added columns
+
+        return matrix;
+
+    def isNeighborIndexQuery(self, query, countField):
+        """Whether the query can be answered with the neighborIndex fast path.
+        Requires a descending top-k query by an indexed sortField, without field filters
+        or specific target items (that could exclude all of the indexed top associations).
+        For multiple query items, the aggregate score must also be bounded by the component scores.
+        """
+        index = self.neighborIndex;
+        if index is None or query.limit is None or query.limit < 1 or query.limit > index.k:
+            return False;
+        if query.invertQuery or not query.sortReverse or query.targetItemIds:
+            return False;
+        for (fieldOp, value) in query.fieldFilters.items():
+            if value is not None:
+                return False;
+        if query.aggregationMethod not in ("weighted","unweighted"):
+            return False;
+        if len(query.queryItemIds) > 1 and query.sortField not in AVERAGED_SCORE_FIELDS:
+            return False;
+        return index.hasList(countField, query.sortField);
+
+    def neighborIndexRecommend(self, matrix, query, countField, conn):
+        """Threshold algorithm style fast path.  Walk down the indexed top-k target lists of each query item
+        in parallel, calculating the exact aggregate score for each target item seen so far
+        (by random access into the matrix for all of its component associations).
+        Once the limit-th best aggregate score beats the best score that any unseen target could still achieve
+        (the best of the next list entries, since the aggregate is a weighted average of component scores),
+        then the top results are final.  Each pass doubles the list depth considered, up to the indexed k.
+
+        Returns the same aggregate results as the full calculation, or None if the top results
+        could not be resolved within the indexed lists (or the index is out of date).
+        """
+        index = self.neighborIndex;
+        limit = query.limit;
+
+        if len(matrix) < 1 or index.totalPatients(countField) != self.totalPatientCount(query, conn):
+            return None;    # Index built against different association data
+
+        queryIndexes = self.queryItemIndexes(matrix, query);
+        neighborLists = [index.neighbors(countField, query.sortField, itemId) for itemId in matrix.itemIds[queryIndexes]];
+
+        depth = limit;
+        while True:
+            seenIds = [np.zeros(0, dtype=np.int64)];
+            bound = -np.inf;    # Best score that any target not yet seen could achieve
+            for (targetIds, scores, isComplete) in neighborLists:
+                seenIds.append(targetIds[:depth]);
+                if depth < len(scores):
+                    bound = max(bound, scores[depth]);
+                elif not isComplete:
+                    bound = max(bound, scores[-1]);
+            candidateIndex = matrix.itemIndex(np.unique(np.concatenate(seenIds)));
+            candidateIndex = candidateIndex[candidateIndex >= 0];
+            candidateIndex = candidateIndex[self.targetFilterMask(matrix, candidateIndex, query)];
+
+            components = self.candidateComponentArrays(matrix, queryIndexes, candidateIndex, query, countField, conn);
+            if components is not None:
+                aggregates = self.aggregateComponentArrays(components, query);
+                self.populateDerivedStatArrays(aggregates, self.queryStatIds(query));
+                scores = aggregates[query.sortField];
+                if np.isnan(scores).any():
+                    return None;    # Unclear how these would rank, so leave to the full calculation
+                if bound == -np.inf:
+                    # All lists exhausted, so have seen every possible target
+                    return self.filterAggregateArraysByQuery(matrix, components, aggregates, query, countField);
+                if len(scores) >= limit:
+                    limitScore = np.partition(scores, len(scores)-limit)[len(scores)-limit];
+                    if limitScore > bound and limitScore - bound > NEIGHBOR_BOUND_TOLERANCE*max(1.0, abs(bound)):
+                        return self.filterAggregateArraysByQuery(matrix, components, aggregates, query, countField);
+            elif bound == -np.inf:
+                return None;    # Nothing to recommend from the index, leave default recommendations to the full calculation
+
+            if depth >= index.k:
+                return None;
+            depth = min(2*depth, index.k);
+
+    def candidateComponentArrays(self, matrix, queryIndexes, candidateIndex, query, countField, conn, baseCounts=None, totalPatients=None):
+        """Component association arrays between the query items and only the given candidate target item indexes,
+        looked up directly in the matrix.  Same ordering as the components from loadComponentArrays
+        (by query item, then target item index), so equal scores are ranked the same way.
+        Returns None if no such associations are found.
+        """
+        candidateIndex = np.sort(candidateIndex);
+        (ptr, rowTargetIndexes) = (matrix.rowPtr, matrix.targetIndex);
+        if query.invertQuery:
+            (ptr, rowTargetIndexes) = (matrix.colPtr, matrix.sourceIndex[matrix.colOrder]);
+        positions = [np.zeros(0, dtype=np.int64)];
+        for queryIndex in queryIndexes:
+            # Rows are sorted by target item index, so can search within just the query item's row
+            (start, end) = (ptr[queryIndex], ptr[queryIndex+1]);
+            rowTargetIndex = rowTargetIndexes[start:end];
+            rowPositions = np.minimum(np.searchsorted(rowTargetIndex, candidateIndex), max(end-start-1, 0));
+            if end > start:
+                positions.append(start + rowPositions[rowTargetIndex[rowPositions] == candidateIndex]);
+        positions = np.concatenate(positions);
+        if len(positions) < 1:
+            return None;
+
+        if query.invertQuery:
+            positions = matrix.colOrder[positions];
+            (sourceIndex, targetIndex) = (matrix.targetIndex[positions], matrix.sourceIndex[positions]);
+        else:
+            (sourceIndex, targetIndex) = (matrix.sourceIndex[positions], matrix.targetIndex[positions]);
+        return self.buildComponentArrays(matrix, positions, sourceIndex, targetIndex, query, countField, conn, baseCounts, totalPatients);
+
+    def queryItemIndexes(matrix, query):
+        """Matrix indexes of the query items (those found in the matrix), in ascending order.
+        Components are collected by query item in this order, so the ordering of tied results
+        does not depend on the iteration order of the query item set.
+        """
+        queryIndexes = matrix.itemIndex(query.queryItemIds);
+        return np.sort(queryIndexes[queryIndexes >= 0]);
+    queryItemIndexes = staticmethod(queryItemIndexes);
+
+    def loadComponentArrays(self, matrix, query, countField, conn, baseCounts=None, totalPatients=None):
+        """Equivalent of loadResultModels + filterResultItems + populateResultCounts,
+        but returning a dictionary of parallel arrays (one element per component association)
+        rather than a list of result models.
+        Optionally provide the baseCounts and totalPatients if already loaded.
+        Returns None if no component associations are found.
+        """
+        queryIndexes = self.queryItemIndexes(matrix, query);
+        positions = matrix.rowEntries(queryIndexes, invert=query.invertQuery);
+
+        if query.invertQuery:
+            (sourceIndex, targetIndex) = (matrix.targetIndex[positions], matrix.sourceIndex[positions]);
+        else:
+            (sourceIndex, targetIndex) = (matrix.sourceIndex[positions], matrix.targetIndex[positions]);
+
+        keep = self.targetFilterMask(matrix, targetIndex, query);
+        if not keep.any():
+            return None;
+
+        return self.buildComponentArrays(matrix, positions[keep], sourceIndex[keep], targetIndex[keep], query, countField, conn, baseCounts, totalPatients);
+
+    def targetFilterMask(matrix, targetIndex, query):
+        """Boolean array, True for the target item indexes that pass the query item filters.
+        Same filters as would otherwise be applied in the SQL query and filterResultItems.
+        """
+        targetIds = matrix.itemIds[targetIndex];
+        keep = np.ones(len(targetIndex), dtype=bool);
+        if query.maxRecommendedId is not None:
+            keep &= (targetIds <= query.maxRecommendedId);
+        if query.excludeCategoryIds:
+            targetCategoryIds = matrix.categoryIds[targetIndex];
+            keep &= matrix.hasCategoryMask()[targetIndex];
+            keep &= ~np.isin(targetCategoryIds, list(query.excludeCategoryIds));
+        if query.targetItemIds:
+            keep &= np.isin(targetIds, list(query.targetItemIds));
+        else:
+            keep &= ~np.isin(targetIds, list(query.queryItemIds));
+        if query.excludeItemIds:
+            keep &= ~np.isin(targetIds, list(query.excludeItemIds));
+        return keep;
+    targetFilterMask = staticmethod(targetFilterMask);
+
+    def buildComponentArrays(self, matrix, positions, sourceIndex, targetIndex, query, countField, conn, baseCounts=None, totalPatients=None):
+        """Populate the component association arrays (nAB, nA, nB, N) for the given (already filtered) pair positions.
+        Returns None if none of the components have baseline counts available.
+        """
+        if baseCounts is None:
+            baseCounts = self.loadBaseCounts(matrix, query, conn);
+        if totalPatients is None:
+            totalPatients = self.totalPatientCount(query, conn);
+
+        components = dict();
+        components["position"] = positions;
+        components["sourceIndex"] = sourceIndex;
+        components["targetIndex"] = targetIndex;
+        components["nAB"] = matrix.countsByField[countField][components["position"]];
+        components["nA"] = baseCounts[components["sourceIndex"]];
+        components["nB"] = baseCounts[components["targetIndex"]];
+        components["N"] = np.full(len(components["position"]), float(totalPatients));
+
+        # Items without baseline counts available cannot be scaled
+        hasBaseCounts = ~(np.isnan(components["nA"]) | np.isnan(components["nB"]));
+        if not hasBaseCounts.all():
+            for key in list(components.keys()):
+                components[key] = components[key][hasBaseCounts];
+            if not hasBaseCounts.any():
+                return None;
+
+        return components;
+
+    def aggregateComponentArrays(components, query):
+        """Array equivalent of collateAggregateResuls + the aggregation in populateAggregateStats.
+        Groups the components by target item (in order of first appearance) and calculates the
+        aggregate nAB, nA, nB, N counts (and intermediate sums / products) for each.
+        Returns dictionary of arrays, one element per target item.
+        Stores the group label for each component back into components["label"].
+        """
+        (uniqueTargets, firstIndex, inverse) = np.unique(components["targetIndex"], return_index=True, return_inverse=True);
+        appearanceOrder = np.argsort(firstIndex, kind="stable");
+        labelByUnique = np.empty(len(appearanceOrder), dtype=np.int64);
+        labelByUnique[appearanceOrder] = np.arange(len(appearanceOrder));
+        labels = components["label"] = labelByUnique[inverse.ravel()];
+        nTargets = len(appearanceOrder);
+
+        nAB = components["nAB"];
+        nA = components["nA"];
+        nB = components["nB"];
+        N = components["N"];
+
+        aggregates = dict();
+        aggregates["targetIndex"] = uniqueTargets[appearanceOrder];
+        # Baseline counts are identical across components of the same target
+        aggregates["nB"] = nB[firstIndex[appearanceOrder]];
+        aggregates["N"] = N[firstIndex[appearanceOrder]];
+
+        if query.aggregationMethod in ("weighted","unweighted"):
+            weight = np.ones(len(labels));
+            if query.aggregationMethod == "weighted":
+                weight = 1.0 / nA;
+            components["weight"] = weight;
+
+            aggregates["sum(nAB*weight)"] = np.bincount(labels, weights=nAB*weight, minlength=nTargets);
+            aggregates["sum(nA*weight)"] = np.bincount(labels, weights=nA*weight, minlength=nTargets);
+            aggregates["sum(weight)"] = np.bincount(labels, weights=weight, minlength=nTargets);
+
+            aggregates["nAB"] = aggregates["sum(nAB*weight)"] / aggregates["sum(weight)"];
+            aggregates["nA"] = aggregates["sum(nA*weight)"] / aggregates["sum(weight)"];
+
+        elif query.aggregationMethod in ("NaiveBayes"):
+            aggregates["product(nAB/nB)"] = np.ones(nTargets);
+            aggregates["product(nA/N)"] = np.ones(nTargets);
+            np.multiply.at(aggregates["product(nAB/nB)"], labels, np.maximum(nAB,DEGENERATE_VALUE_ADJUSTMENT) / np.where(nB > 0, nB, DEGENERATE_VALUE_ADJUSTMENT));
+            np.multiply.at(aggregates["product(nA/N)"], labels, np.maximum(nA,DEGENERATE_VALUE_ADJUSTMENT) / N);
+
+            aggregates["nAB"] = aggregates["product(nAB/nB)"] * aggregates["nB"];
+            aggregates["nA"] = aggregates["product(nA/N)"] * aggregates["N"];
+
+        elif query.aggregationMethod in ("SerialBayes"):
+            nAB_ = np.maximum(nAB,DEGENERATE_VALUE_ADJUSTMENT);
+            aggregates["Product(nAB/nB)"] = np.ones(nTargets);
+            aggregates["Product((nA-nAB)/(N-nB))"] = np.ones(nTargets);
+            np.multiply.at(aggregates["Product(nAB/nB)"], labels, nAB_ / np.where(nB > 0, nB, DEGENERATE_VALUE_ADJUSTMENT));
+            np.multiply.at(aggregates["Product((nA-nAB)/(N-nB))"], labels, (nA-nAB_) / (N-nB));
+
+            aggregates["nAB"] = aggregates["Product(nAB/nB)"] * aggregates["nB"];
+            aggregates["nA"] = aggregates["Product((nA-nAB)/(N-nB))"] * (aggregates["N"]-aggregates["nB"]) + aggregates["nAB"];
+
+        else:
+            # Baseline, just populate with full correlations, same as populateDerivedStats
+            aggregates["nAB"] = aggregates["nB"];
+            aggregates["nA"] = aggregates["N"];
+
+        return aggregates;
+    aggregateComponentArrays = staticmethod(aggregateComponentArrays);
+
+    def populateDerivedStatArrays(aggregates, statIds):
+        """Array equivalent of populateDerivedStats.  Add an array for each of the statIds
+        to the aggregates, skipping any that are already populated.
+        """
+        contStats = ContingencyStatsArray( aggregates["nAB"], aggregates["nA"], aggregates["nB"], aggregates["N"] );
+        contStats.normalize(truncateNegativeValues=False);
+        for statId in statIds:
+            if statId not in aggregates:
+                aggregates[statId] = contStats[statId];
+    populateDerivedStatArrays = staticmethod(populateDerivedStatArrays);
+
+    def filterAggregateArraysByQuery(self, matrix, components, aggregates, query, countField):
+        """Array equivalent of filterAggregateResultsByQuery.
+        Calculate the score and filter stats for each aggregate target item,
+        apply the field filters, and select only the top results (without having to fully sort all candidates).
+        Returns list of RowItemModel aggregate results, in the same format as the parent class.
+        """
+        self.populateDerivedStatArrays(aggregates, self.queryStatIds(query));
+        scores = aggregates[query.sortField];
+
+        # Look for value filters
+        keep = np.ones(len(scores), dtype=bool);
+        for (fieldOp, value) in query.fieldFilters.items():
+            if value is not None:
+                field = fieldOp[:-1];
+                op = fieldOp[-1];
+                if op == "<":
+                    keep &= ~(aggregates[field] < value);
+                elif op == ">":
+                    keep &= ~(aggregates[field] > value);
+        candidates = np.flatnonzero(keep);
+        candidateScores = scores[candidates];
+
+        limit = query.limit;
+        if limit is not None and limit < 1:
+            return list();
+        if limit is not None and limit < len(candidates):
+            # Only need to sort the top candidates, though retain any ties at the cut-off threshold
+            #   so that the final (stable) ordering is the same as if had sorted everything
+            if query.sortReverse:
+                threshold = np.partition(candidateScores, len(candidateScores)-limit)[len(candidateScores)-limit];
+                isTop = (candidateScores >= threshold);
+            else:
+                threshold = np.partition(candidateScores, limit-1)[limit-1];
+                isTop = (candidateScores <= threshold);
+            candidates = candidates[isTop];
+            candidateScores = candidateScores[isTop];
+
+        sortOrder = np.argsort(candidateScores, kind="stable");
+        if query.sortReverse:
+            sortOrder = sortOrder[::-1];    # Descending order of score to get top results
+        selected = candidates[sortOrder][:limit];
+
+        return self.buildAggregateResults(matrix, components, aggregates, selected, query, countField);
+
+    def buildAggregateResults(self, matrix, components, aggregates, selected, query, countField):
+        """Build the aggregate RowItemModels (with componentResultsById) for only the selected aggregate labels, in the order given"""
+        aggregateResults = list();
+        aggregateResultsByLabel = dict();
+        for label in selected:
+            aggregateResult = RowItemModel();
+            aggregateResult["clinical_item_id"] = int(matrix.itemIds[aggregates["targetIndex"][label]]);
+            aggregateResult["componentResultsById"] = dict();
+            for field, values in aggregates.items():
+                if field != "targetIndex":
+                    aggregateResult[field] = float(values[label]);
+            aggregateResult["score"] = aggregateResult[query.sortField];
+            aggregateResults.append(aggregateResult);
+            aggregateResultsByLabel[label] = aggregateResult;
+
+        componentFields = ["nAB","nA","nB","N"];
+        if "weight" in components:
+            componentFields.append("weight");
+        count0Values = matrix.countsByField[query.countPrefix+"count_0"];
+        for iComponent in np.flatnonzero(np.isin(components["label"], selected)):
+            sourceItemId = int(matrix.itemIds[components["sourceIndex"][iComponent]]);
+            targetItemId = int(matrix.itemIds[components["targetIndex"][iComponent]]);
+            position = components["position"][iComponent];
+
+            component = dict();
+            component[query.sourceCol()] = sourceItemId;
+            component[query.targetCol()] = targetItemId;
+            component[query.countPrefix+"count_0"] = float(count0Values[position]);
+            component[countField] = float(matrix.countsByField[countField][position]);
+            for field in componentFields:
+                component[field] = float(components[field][iComponent]);
+
+            aggregateResultsByLabel[components["label"][iComponent]]["componentResultsById"][sourceItemId] = component;
+
+        return aggregateResults;
+
+class IncrementalRecommenderSession:
+    """Running recommendation state for a query whose query items are added one at a time
+    (e.g., reviewing how well each successive item in a patient's record would have been predicted by the items before it).
+
+    Rather than re-running the query for every growing set of query items, adding an item folds just that item's
+    association row into running per target aggregates (sum(nAB*weight), product(nAB/nB), etc.),
+    and only the targets in that row are rescored.  The sort keys of all ranked targets are kept in a RankIndex,
+    so rescoring a target and finding the rank of any target each take about O(log n) steps,
+    rather than re-sorting the recommendation list.
+
+    Ranks are the same as the positions in the SparseItemAssociationRecommender results for the same query items,
+    including the order of tied scores, which the batch path breaks by the order the targets are first found in the
+    components (by query item index, then target item index), reversed for descending sort order.
+    """
+    def __init__(self, recommender, query, conn=None):
+        self.recommender = recommender;
+        self.conn = conn;
+        self.query = copy.copy(query);
+        self.query.queryItemIds = set();    # Accumulated by addItem
+        self.query.limit = None;
+
+        self.countField = recommender.countFieldByQuery(self.query);
+        self.matrix = recommender.loadAssociationMatrix(self.query, self.countField, conn=conn);
+        self.baseCounts = recommender.loadBaseCounts(self.matrix, self.query, conn);
+        self.totalPatients = recommender.totalPatientCount(self.query, conn);
+        self.statIds = recommender.queryStatIds(self.query);
+
+        nItems = len(self.matrix.itemIds);
+        # Static target filters (excluded items, categories, etc.), before any query items are added
+        self.isEligible = recommender.targetFilterMask(self.matrix, np.arange(nItems, dtype=np.int64), self.query);
+        self.nComponents = np.zeros(nItems, dtype=np.int64);
+        self.firstQueryIndex = np.full(nItems, nItems, dtype=np.int64);   # Lowest query item index associated with each target, for the tied score order
+
+        # Running aggregates per target item index, initialized to the empty sums / products
+        self.runningArrays = dict();
+        if self.query.aggregationMethod in ("weighted","unweighted"):
+            for name in ("sum(nAB*weight)","sum(nA*weight)","sum(weight)"):
+                self.runningArrays[name] = np.zeros(nItems);
+        elif self.query.aggregationMethod in ("NaiveBayes"):
+            for name in ("product(nAB/nB)","product(nA/N)"):
+                self.runningArrays[name] = np.ones(nItems);
+        elif self.query.aggregationMethod in ("SerialBayes"):
+            for name in ("Product(nAB/nB)","Product((nA-nAB)/(N-nB))"):
+                self.runningArrays[name] = np.ones(nItems);
+
+        self.scores = np.full(nItems, np.nan);
+        self.rankKeyByIndex = dict();   # Sort key of each ranked target index, in recommendation list order
+        self.rankIndex = RankIndex();
+
+        self.defaultData = None;    # Lazily loaded default recommendations for when there are no associations to work from
+        self.defaultRankById = None;
+
+    def addItem(self, itemId):
+        """Add the item to the query items, updating the aggregates and scores of its associated targets"""
+        if itemId in self.query.queryItemIds:
+            return;
+        self.query.queryItemIds.add(itemId);
+
+        matrix = self.matrix;
+        queryIndex = matrix.itemIndex([itemId])[0];
+        if queryIndex < 0:
+            return;
+        changedIndex = [np.array([queryIndex], dtype=np.int64)];
+        if not self.query.targetItemIds:
+            self.isEligible[queryIndex] = False;   # Query items are not recommended back
+
+        nA = self.baseCounts[queryIndex];
+        if not np.isnan(nA):
+            positions = matrix.rowEntries([queryIndex], invert=self.query.invertQuery);
+            if self.query.invertQuery:
+                targetIndex = matrix.sourceIndex[positions];
+            else:
+                targetIndex = matrix.targetIndex[positions];
+
+            # Items without baseline counts available cannot be scaled
+            nB = self.baseCounts[targetIndex];
+            hasBaseCounts = ~np.isnan(nB);
+            (positions, targetIndex, nB) = (positions[hasBaseCounts], targetIndex[hasBaseCounts], nB[hasBaseCounts]);
+            nAB = matrix.countsByField[self.countField][positions];
+            N = self.totalPatients;
+
+            # Each target appears only once per row, so can update with plain fancy indexing
+            self.nComponents[targetIndex] += 1;
+            self.firstQueryIndex[targetIndex] = np.minimum(self.firstQueryIndex[targetIndex], queryIndex);
+            running = self.runningArrays;
+            if self.query.aggregationMethod in ("weighted","unweighted"):
+                weight = 1.0;
+                if self.query.aggregationMethod == "weighted":
+                    weight = 1.0 / nA;
+                running["sum(nAB*weight)"][targetIndex] += nAB*weight;
+                running["sum(nA*weight)"][targetIndex] += nA*weight;
+                running["sum(weight)"][targetIndex] += weight;
+            elif self.query.aggregationMethod in ("NaiveBayes"):
+                running["product(nAB/nB)"][targetIndex] *= np.maximum(nAB,DEGENERATE_VALUE_ADJUSTMENT) / np.where(nB > 0, nB, DEGENERATE_VALUE_ADJUSTMENT);
+                running["product(nA/N)"][targetIndex] *= max(nA,DEGENERATE_VALUE_ADJUSTMENT) / N;
+            elif self.query.aggregationMethod in ("SerialBayes"):
+                nAB_ = np.maximum(nAB,DEGENERATE_VALUE_ADJUSTMENT);
+                running["Product(nAB/nB)"][targetIndex] *= nAB_ / np.where(nB > 0, nB, DEGENERATE_VALUE_ADJUSTMENT);
+                running["Product((nA-nAB)/(N-nB))"][targetIndex] *= (nA-nAB_) / (N-nB);
+            changedIndex.append(targetIndex);
+
+        self.rescore(np.unique(np.concatenate(changedIndex)));
+
+    def rescore(self, targetIndex):
+        """Recalculate the scores of the given (unique) target item indexes and update their sort keys in the rank index"""
+        # Take out the prior sort keys
+        for index in targetIndex.tolist():
+            rankKey = self.rankKeyByIndex.pop(index, None);
+            if rankKey is not None:
+                self.rankIndex.remove(rankKey);
+
+        # Only targets with some component associations that pass the item filters are ranked at all
+        targetIndex = targetIndex[self.isEligible[targetIndex] & (self.nComponents[targetIndex] > 0)];
+        if len(targetIndex) < 1:
+            return;
+
+        aggregates = self.aggregateArrays(targetIndex);
+        self.recommender.populateDerivedStatArrays(aggregates, self.statIds);
+        isRanked = np.ones(len(targetIndex), dtype=bool);
+        for (fieldOp, value) in self.query.fieldFilters.items():
+            if value is not None:
+                field = fieldOp[:-1];
+                op = fieldOp[-1];
+                if op == "<":
+                    isRanked &= ~(aggregates[field] < value);
+                elif op == ">":
+                    isRanked &= ~(aggregates[field] > value);
+
+        scores = aggregates[self.query.sortField];
+        self.scores[targetIndex] = scores;
+
+        # Same order as the (stable) sorting of the results:  Ascending score, then component order, with NaN scores at the end.
+        #   Reversed for descending order, so NaN scores first and ties in reverse component order
+        isNaN = np.isnan(scores);
+        sortKeys = np.where(isNaN, 0.0, scores);
+        sign = -1 if self.query.sortReverse else +1;
+        for (index, isNaNScore, sortKey, firstQueryIndex) in zip(targetIndex[isRanked].tolist(), isNaN[isRanked].tolist(), sortKeys[isRanked].tolist(), self.firstQueryIndex[targetIndex[isRanked]].tolist()):
+            rankKey = (sign*isNaNScore, sign*sortKey, sign*firstQueryIndex, sign*index);
+            self.rankKeyByIndex[index] = rankKey;
+            self.rankIndex.add(rankKey);
+
+    def aggregateArrays(self, targetIndex):
+        """Aggregate nAB, nA, nB, N counts for the target item indexes from the running aggregates.
+        Same calculation as SparseItemAssociationRecommender.aggregateComponentArrays.
+        """
+        running = self.runningArrays;
+        aggregates = dict();
+        aggregates["nB"] = self.baseCounts[targetIndex];
+        aggregates["N"] = np.full(len(targetIndex), float(self.totalPatients));
+        if self.query.aggregationMethod in ("weighted","unweighted"):
+            sumWeight = running["sum(weight)"][targetIndex];
+            aggregates["nAB"] = running["sum(nAB*weight)"][targetIndex] / sumWeight;
+            aggregates["nA"] = running["sum(nA*weight)"][targetIndex] / sumWeight;
+        elif self.query.aggregationMethod in ("NaiveBayes"):
+            aggregates["nAB"] = running["product(nAB/nB)"][targetIndex] * aggregates["nB"];
+            aggregates["nA"] = running["product(nA/N)"][targetIndex] * aggregates["N"];
+        elif self.query.aggregationMethod in ("SerialBayes"):
+            aggregates["nAB"] = running["Product(nAB/nB)"][targetIndex] * aggregates["nB"];
+            aggregates["nA"] = running["Product((nA-nAB)/(N-nB))"][targetIndex] * (aggregates["N"]-aggregates["nB"]) + aggregates["nAB"];
+        else:
+            # Baseline, just populate with full correlations, same as populateDerivedStats
+            aggregates["nAB"] = aggregates["nB"];
+            aggregates["nA"] = aggregates["N"];
+        return aggregates;
+
+    def rank(self, itemId):
+        """Return (rank, score) of the target item among the current recommendations (ranks start at 1).
+        If the item would not be in the recommendation list at all, returns
+        (number of recommendations, None), same as scanning to the end of the list without finding it.
+        """
+        if not self.rankKeyByIndex and not (self.isEligible & (self.nComponents > 0)).any():
+            # No associations to work from, so a full query would return the default recommendations
+            return self.defaultRank(itemId);
+
+        index = self.matrix.itemIndex([itemId])[0];
+        if index < 0 or index not in self.rankKeyByIndex:
+            return (len(self.rankIndex), None);
+        return (self.rankIndex.rank(self.rankKeyByIndex[index])+1, float(self.scores[index]));
+
+    def defaultRank(self, itemId):
+        """(rank, score) of the target item among the default recommendations.
+        These do not depend on the query items, other than that query items are not recommended back,
+        so are only loaded once per session.
+        """
+        if self.defaultData is None:
+            defaultQuery = copy.copy(self.query);
+            defaultQuery.queryItemIds = set();
+            self.defaultData = self.recommender(defaultQuery, default=True, conn=self.conn);
+            self.defaultRankById = dict();
+            for iRec, recommendationModel in enumerate(self.defaultData):
+                self.defaultRankById[recommendationModel["clinical_item_id"]] = iRec;
+
+        # Skip past any query items (without associations) that the full query would have filtered out
+        skippedRanks = list();
+        if not self.query.targetItemIds:
+            skippedRanks = [self.defaultRankById[queryItemId] for queryItemId in self.query.queryItemIds if queryItemId in self.defaultRankById];
+        iRec = self.defaultRankById.get(itemId);
+        if iRec is None or iRec in skippedRanks:
+            return (len(self.defaultData) - len(skippedRanks), None);
+        nSkipped = len([skippedRank for skippedRank in skippedRanks if skippedRank < iRec]);
+        return (iRec - nSkipped + 1, self.defaultData[iRec]["score"]);
+
+class TargetItemScorer:
+    """Scores only the targetItemIds of a query (e.g., death or readmission outcomes to predict),
+    for many different sets of query items (e.g., one per patient of an evaluation cohort).
+
+    Rather than the whole association table, keeps a column slice of the association matrix,
+    with only the associations leading to the target items (filtered in the database query).
+    A batch of query item sets is scored in one pass: the component associations of every query set are concatenated,
+    labeled by (query set, target item), and aggregated together with the same array calculations
+    as SparseItemAssociationRecommender, into a (query sets x target items) score matrix.
+
+    Scores are the same as the recommender would report for the targets in its recommendation results.
+    Query sets without any component associations get the recommender's default (baseline frequency) scores.
+    """
+    def __init__(self, recommender, query, conn=None):
+        self.recommender = recommender;
+        self.conn = conn;
+        self.query = copy.copy(query);
+        self.query.queryItemIds = set();    # Each scored set will provide its own
+
+        self.targetItemIds = np.array(sorted(query.targetItemIds), dtype=np.int64);
+        self.countField = recommender.countFieldByQuery(self.query);
+        self.matrix = recommender.loadTargetAssociationMatrix(self.query, self.countField, conn=conn);
+        self.baseCounts = recommender.loadBaseCounts(self.matrix, self.query, conn);
+        self.totalPatients = recommender.totalPatientCount(self.query, conn);
+        self.defaultScores = None;  # Lazily loaded (scores, isScored) for query sets without any associations
+
+        # Score matrix column for each matrix item index (-1 if not a target)
+        self.columnByIndex = np.full(len(self.matrix.itemIds), -1, dtype=np.int64);
+        targetIndex = self.matrix.itemIndex(self.targetItemIds);
+        self.columnByIndex[targetIndex[targetIndex >= 0]] = np.flatnonzero(targetIndex >= 0);
+
+    def scoreBatch(self, queryItemIdsList):
+        """Return (scores, isScored) arrays of shape (len(queryItemIdsList) x number of targets),
+        with the score (query.sortField) for each target item (in sorted targetItemIds order) given each set of query item IDs,
+        and whether the target would be in the recommendation results at all.
+        """
+        matrix = self.matrix;
+        query = self.query;
+        nItems = len(matrix.itemIds);
+        scores = np.full((len(queryItemIdsList), len(self.targetItemIds)), np.nan);
+        isScored = np.zeros(scores.shape, dtype=bool);
+
+        # Component associations of every query set, labeled by query set row
+        positions = [np.zeros(0, dtype=np.int64)];
+        queryRows = [np.zeros(0, dtype=np.int64)];
+        for iQuery, queryItemIds in enumerate(queryItemIdsList):
+            queryIndexes = matrix.itemIndex(queryItemIds);
+            queryIndexes = queryIndexes[queryIndexes >= 0];
+            rowPositions = matrix.rowEntries(queryIndexes, invert=query.invertQuery);
+            positions.append(rowPositions);
+            queryRows.append(np.full(len(rowPositions), iQuery, dtype=np.int64));
+        positions = np.concatenate(positions);
+        queryRows = np.concatenate(queryRows);
+        if query.invertQuery:
+            (sourceIndex, targetIndex) = (matrix.targetIndex[positions].astype(np.int64), matrix.sourceIndex[positions].astype(np.int64));
+        else:
+            (sourceIndex, targetIndex) = (matrix.sourceIndex[positions].astype(np.int64), matrix.targetIndex[positions].astype(np.int64));
+
+        # Same filters as the recommender, including dropping components without baseline counts to scale by
+        keep = SparseItemAssociationRecommender.targetFilterMask(matrix, targetIndex, query);
+        keep &= ~(np.isnan(self.baseCounts[sourceIndex]) | np.isnan(self.baseCounts[targetIndex]));
+        (positions, queryRows, sourceIndex, targetIndex) = (positions[keep], queryRows[keep], sourceIndex[keep], targetIndex[keep]);
+
+        if len(positions) > 0:
+            components = dict();
+            components["targetIndex"] = queryRows*nItems + targetIndex;    # Aggregate by (query set, target) label
+            components["nAB"] = matrix.countsByField[self.countField][positions];
+            components["nA"] = self.baseCounts[sourceIndex];
+            components["nB"] = self.baseCounts[targetIndex];
+            components["N"] = np.full(len(positions), float(self.totalPatients));
+
+            aggregates = SparseItemAssociationRecommender.aggregateComponentArrays(components, query);
+            SparseItemAssociationRecommender.populateDerivedStatArrays(aggregates, [query.sortField]);
+            labels = aggregates["targetIndex"];
+            (rows, columns) = (labels // nItems, self.columnByIndex[labels % nItems]);
+            scores[rows, columns] = aggregates[query.sortField];
+            isScored[rows, columns] = True;
+
+        # Query sets without any associations get the default recommendations instead
+        hasComponents = np.zeros(len(queryItemIdsList), dtype=bool);
+        hasComponents[queryRows] = True;
+        if not hasComponents.all():
+            (defaultScores, defaultIsScored) = self.loadDefaultScores();
+            scores[~hasComponents] = defaultScores;
+            isScored[~hasComponents] = defaultIsScored;
+
+        return (scores, isScored);
+
+    def score(self, queryItemIds, default=None):
+        """Return dictionary of score by target item ID for the set of query item IDs,
+        with the default value for any targets that would not be in the recommendation results.
+        """
+        (scores, isScored) = self.scoreBatch([queryItemIds]);
+        scoreByItemId = dict();
+        for itemId, score, scored in zip(self.targetItemIds.tolist(), scores[0].tolist(), isScored[0].tolist()):
+            scoreByItemId[itemId] = score if scored else default;
+        return scoreByItemId;
+
+    def loadDefaultScores(self):
+        """(scores, isScored) arrays for the targets from the recommender's default recommendations"""
+        if self.defaultScores is None:
+            scores = np.full(len(self.targetItemIds), np.nan);
+            isScored = np.zeros(len(self.targetItemIds), dtype=bool);
+            columnByItemId = dict( (itemId, iColumn) for iColumn, itemId in enumerate(self.targetItemIds.tolist()) );
+            for recommendationModel in self.recommender(self.query, default=True, conn=self.conn):
+                if recommendationModel["clinical_item_id"] in columnByItemId:
+                    iColumn = columnByItemId[recommendationModel["clinical_item_id"]];
+                    scores[iColumn] = recommendationModel[self.query.sortField];
+                    isScored[iColumn] = True;
+            self.defaultScores = (scores, isScored);
+        return self.defaultScores;
+
 class BaselineFrequencyRecommender(ItemAssociationRecommender):
     """Concrete implementation class for item (e.g., order) recommendation.
     Simple default recommender that just recomds items
@@ -923,6 +2083,9 @@ class BaselineFrequencyRecommender(ItemAssociationRecommender):
     def __call__(self, query, conn=None):
         return ItemAssociationRecommender.__call__(self,query,default=True,conn=conn);
 
+    def targetScorer(self, query, conn=None):
+        return None;
+
 class RandomItemRecommender(BaseItemRecommender):
     """Absolute baseline for comparison.
     Recommender that just randomly scores and recommends items regardless of input.
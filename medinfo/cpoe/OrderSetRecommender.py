@@ -6,11 +6,12 @@ then this module will return with a ranked and scored list of associated items /
 """
 import sys, os
 import time;
-from operator import itemgetter
 from optparse import OptionParser;
 import json;
 import urllib.parse;
 import math;
+import numpy as np;
+from scipy.sparse import csr_matrix;
 from datetime import datetime, timedelta;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
@@ -22,9 +23,17 @@ from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.db.ResultsFormatter import TextResultsFormatter;
 from medinfo.cpoe.ItemRecommender import BaseItemRecommender;
 from medinfo.cpoe.Const import COLLECTION_TYPE_ORDER_SET;
-from .Util import log;
 from .Const import AD_HOC_SECTION;
 
+# Score name that each sort field option is an alias for in the recommender results
+SCORE_NAME_BY_SORT_FIELD = \
+    {   "totalItemWeight": "tf", "tf": "tf", "PPV": "tf", "P(item|query)": "tf", "P(B|A)": "tf",
+        "tfidf": "tfidf", "lift": "tfidf", "interest": "tfidf", "P(item|query)/P(item)": "tfidf", "P(B|A)/P(B)": "tfidf",
+    };
+
+# Placeholder category ID for items without a category recorded
+NULL_CATEGORY_ID = np.iinfo(np.int64).min;
+
 class OrderSetRecommender(BaseItemRecommender):
     """Implementation class for item (e.g., order) recommendation based on existing order sets.
     Given query clinical items (orders), look for existing order sets that include them.
@@ -46,6 +55,9 @@ class OrderSetRecommender(BaseItemRecommender):
     Estimate P(item) = |OrderSets containing item| / |Items in Any Order Set|
         Can derive this by summing over all order sets for P(item|OrderSet_j)*P(OrderSet_j);
     Use above to generate TF*IDF, lift estimates with P(item|query) / P(item)
+
+    For speed, the order set contents are also stored as sparse (item x order set) matrices when the lookups are loaded,
+    so each query reduces to a couple of sparse matrix-vector products over all candidate items at once.
     """
     def __init__(self):
         """Initialize module with prior generated model and word document counts from TopicModel module.
@@ -61,6 +73,15 @@ class OrderSetRecommender(BaseItemRecommender):
         self.itemIdsByOrderSetId = None;
         self.orderSetIdsByItemId = None;
 
+        # Array versions of the lookups, aligned to the sorted itemIds (items in any order set) and orderSetIds
+        self.itemIds = None;
+        self.orderSetIds = None;
+        self.itemCategoryIds = None;
+        self.isCandidateItem = None;
+        self.membershipMatrix = None;   # (item x order set) ones if the item is in the order set
+        self.itemWeightMatrix = None;   # (item x order set) P(item|OrderSet)
+        self.numOrderSetsWithItem = None;
+
     def initItemLookups(self, query):
         """Load lookup info and save into local member variables for reuse later
         so don't have to do wasteful repeat DB lookups for serial queries
@@ -98,6 +119,42 @@ class OrderSetRecommender(BaseItemRecommender):
             if self.isItemRecommendable(itemId, emptyQuerySet, query, self.categoryIdByItemId):
                 self.candidateItemIds.add(itemId);
 
+        self.initWeightMatrices();
+
+    def initWeightMatrices(self):
+        """Build the sparse (item x order set) matrices and per item arrays from the order set lookups"""
+        self.itemIds = np.array(sorted(self.orderSetIdsByItemId.keys()), dtype=np.int64);
+        self.orderSetIds = list(self.itemIdsByOrderSetId.keys());
+        itemIndexById = dict(zip(self.itemIds.tolist(), range(len(self.itemIds))));
+
+        rows = list();
+        cols = list();
+        weights = list();
+        for iOrderSet, orderSetId in enumerate(self.orderSetIds):
+            orderSetItemIds = self.itemIdsByOrderSetId[orderSetId];
+            for itemId in orderSetItemIds:
+                rows.append(itemIndexById[itemId]);
+                cols.append(iOrderSet);
+                weights.append(1.0 / len(orderSetItemIds));
+        shape = (len(self.itemIds), len(self.orderSetIds));
+        self.membershipMatrix = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape);
+        self.itemWeightMatrix = csr_matrix((weights, (rows, cols)), shape=shape);
+
+        self.numOrderSetsWithItem = np.asarray(self.membershipMatrix.sum(axis=1)).ravel();
+
+        categoryIds = [self.categoryIdByItemId.get(itemId) for itemId in self.itemIds.tolist()];
+        self.itemCategoryIds = np.array([NULL_CATEGORY_ID if categoryId is None else categoryId for categoryId in categoryIds], dtype=np.int64);
+        self.isCandidateItem = np.isin(self.itemIds, list(self.candidateItemIds));
+
+    def recommendableMask(self, queryItemIds, query):
+        """Array equivalent of isItemRecommendable, over the candidate itemIds"""
+        mask = self.isCandidateItem & ~np.isin(self.itemIds, list(queryItemIds));
+        if query.excludeItemIds:
+            mask &= ~np.isin(self.itemIds, list(query.excludeItemIds));
+        if query.excludeCategoryIds:
+            mask &= ~np.isin(self.itemCategoryIds, list(query.excludeCategoryIds));
+        return mask;
+
     def __call__(self, query):
         # Given query items, lookup existing order sets to find and score related items
 
@@ -114,27 +171,22 @@ class OrderSetRecommender(BaseItemRecommender):
                 queryItemCountById[itemId] = 1;
 
         # Primary execution.  Apply query to generate scored relationship to each order set.
-        weightByOrderSetId = self.estimateOrderSetWeights(queryItemCountById, self.itemIdsByOrderSetId, self.orderSetIdsByItemId);
-
-        # Composite scores for (recommendable) items by taking weighted average across the top items for each topic
-        recScoreByItemId = dict();
-        for itemId in self.candidateItemIds:
-            if self.isItemRecommendable(itemId, queryItemCountById, query, self.categoryIdByItemId):
-                recScoreByItemId[itemId] = 0.0;
-        for orderSetId, orderSetWeight in weightByOrderSetId.items():
-            for itemId in list(recScoreByItemId.keys()):
-                itemWeight = self.itemOrderSetWeight(itemId, orderSetId, self.itemIdsByOrderSetId);
-                recScoreByItemId[itemId] += orderSetWeight*itemWeight;
+        orderSetWeights = self.estimateOrderSetWeightArray(queryItemCountById);
+        weightByOrderSetId = dict(zip(self.orderSetIds, orderSetWeights.tolist()));
+
+        # Composite scores for (recommendable) items by taking weighted average across the order sets
+        totalItemWeights = self.itemWeightMatrix.dot(orderSetWeights);
+        tfidfs = totalItemWeights * len(self.itemIds) / self.numOrderSetsWithItem;    # Scale TF*IDF score based on baseline order set counts to prioritize disproportionately common items
+        candidates = np.flatnonzero(self.recommendableMask(queryItemCountById, query));
+        # Only the top (query.limit) results, in descending score order, with ties broken by descending item ID
+        selected = topScoreIndexes(candidates, {"tf": totalItemWeights, "tfidf": tfidfs}, self.itemIds, query);
 
         # Build 2-pls with lists to sort by score
         recommendedData = list();
-        numItemsInAnyOrderSet = len(self.orderSetIdsByItemId);
-        for itemId, totalItemWeight in recScoreByItemId.items():
-            tfidf = 0.0;
-
-            if itemId in self.orderSetIdsByItemId:
-                numOrderSetsWithItem = len(self.orderSetIdsByItemId[itemId]);
-                tfidf = totalItemWeight * numItemsInAnyOrderSet / numOrderSetsWithItem;    # Scale TF*IDF score based on baseline order set counts to prioritize disproportionately common items
+        for itemIndex in selected:
+            itemId = int(self.itemIds[itemIndex]);
+            totalItemWeight = float(totalItemWeights[itemIndex]);
+            tfidf = float(tfidfs[itemIndex]);
             itemModel = \
                 {   "totalItemWeight": totalItemWeight, "tf": totalItemWeight, "PPV": totalItemWeight, "P(item|query)": totalItemWeight, "P(B|A)": totalItemWeight,
                     "tfidf": tfidf, "lift": tfidf, "interest": tfidf, "P(item|query)/P(item)": tfidf, "P(B|A)/P(B)": tfidf,
@@ -143,9 +195,22 @@ class OrderSetRecommender(BaseItemRecommender):
                 };
             itemModel["score"] = itemModel[query.sortField];
             recommendedData.append(itemModel);
-        recommendedData.sort(key=itemgetter("score", "clinical_item_id"), reverse=True)
         return recommendedData;
 
+    def estimateOrderSetWeightArray(self, queryItemIds):
+        """Array equivalent of estimateOrderSetWeights, aligned to the orderSetIds"""
+        queryVector = np.isin(self.itemIds, list(queryItemIds)).astype(np.float64);
+        numQueryItemsInAnyOrderSet = queryVector.sum();
+        if numQueryItemsInAnyOrderSet < 1:  # Blank query or otherwise searching for things we have no data.
+            # Treat as if effectively querying for all possible query items equally
+            queryVector[:] = 1.0;
+            numQueryItemsInAnyOrderSet = queryVector.sum();
+        return self.membershipMatrix.T.dot(queryVector) / numQueryItemsInAnyOrderSet;
+
+    def recommendBatch(self, queries, conn=None):
+        """Lookups are loaded once in memory, so just run each query in turn (no database connection needed)"""
+        return [self(query) for query in queries];
+
     def estimateOrderSetWeights(self, queryItemIds, itemIdsByOrderSetId, orderSetIdsByItemId):
         """
         Estimate each P(OrderSet|queryItems) = |Intersect(OrderSet,queryItems)| / |queryItems in Any OrderSets|
@@ -220,8 +285,7 @@ class OrderSetRecommender(BaseItemRecommender):
                 # Denormalize results with links to clinical item descriptions
                 self.formatRecommenderResults(recommendedData);
                 # Ensure derived fields are populated if selected for display
-                for resultModel in recommendedData:
-                    self.populateDerivedStats(resultModel, displayFields);
+                self.populateDerivedStatsList(recommendedData, displayFields);
 
             colNames = ["rank","clinical_item_id","name","description","category_description"];
             colNames.extend(displayFields);
@@ -238,6 +302,24 @@ class OrderSetRecommender(BaseItemRecommender):
         log.info("%.3f seconds to complete",timer);
     """
 
+def topScoreIndexes(candidates, scoresByName, itemIds, query):
+    """Given candidate item indexes and score arrays (e.g., "tf", "tfidf") over all items,
+    return the candidate indexes in descending order of the query.sortField score (ties broken by descending item ID).
+    If a query limit is set, only the top results are returned (only those need to be fully sorted).
+    query.sortField can be any of the aliases of the named scores (e.g., "PPV" for "tf", "lift" for "tfidf").
+    """
+    scores = scoresByName[SCORE_NAME_BY_SORT_FIELD[query.sortField]][candidates];
+    limit = query.limit;
+    if limit is not None and limit < len(candidates):
+        if limit < 1:
+            return candidates[:0];
+        # Retain any ties at the cut-off threshold, so the final ordering is the same as if had sorted everything
+        threshold = np.partition(scores, len(scores)-limit)[len(scores)-limit];
+        isTop = (scores >= threshold);
+        (candidates, scores) = (candidates[isTop], scores[isTop]);
+    sortOrder = np.lexsort((itemIds[candidates], scores))[::-1];
+    return candidates[sortOrder][:limit];
+
 if __name__ == "__main__":
     instance = OrderSetRecommender();
     instance.main(sys.argv);
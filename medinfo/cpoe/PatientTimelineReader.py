@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Streaming reader for large patient item (timeline) queries, sorted by patient,
+yielding the rows for one patient at a time without holding the whole result set in memory.
+"""
+
+import sys, os
+import json;
+import threading;
+import queue;
+import numpy as np;
+
+from medinfo.db import DBUtil;
+
+# Number of rows to pull from the database cursor at a time
+FETCH_SIZE = 10000;
+
+# Maximum number of fetched row chunks for the background prefetch thread to queue up ahead of the consumer
+PREFETCH_CHUNKS = 4;
+
+# Row formats that the reader can yield per patient
+#   tuple:   List of the raw row tuples
+#   dict:    List of plain dictionaries keyed by the column headers (cheaper than building RowItemModels)
+#   records: numpy record array with fields named by the column headers
+ROW_FORMATS = ("tuple","dict","records");
+
+class PatientTimelineReader:
+    """Iterate through the results of a (patient_id, item_date) ordered SQLQuery,
+    yielding (patientId, rows) 2-ples with all of the rows for each patient in turn.
+
+    For PostgreSQL, uses a named (server side) cursor, so the database streams results in
+    fetchSize batches rather than sending the entire result set to the client up front.
+    The cursor is declared WITH HOLD, so it survives any commits the caller makes on the same connection
+    while iterating (e.g., interval commits during association analysis).
+
+    If prefetch is set, a background thread fetches the next row batches while the caller
+    processes the current patient, so database I/O overlaps with computation.
+    The thread streams the query through its own dedicated connection (from the connFactory),
+    so it never shares the caller's connection with the caller's other queries and commits.
+    Beware that the dedicated connection does not see any changes the caller has not yet committed.
+    (Not available for SQLite, for which the reader always fetches through the caller's connection in the calling thread.)
+    """
+    def __init__(self, query, conn, headers, groupColumn="patient_id", rowFormat="dict", fetchSize=FETCH_SIZE, prefetch=True, connFactory=None):
+        """headers are the column names of the query results, which must include the groupColumn"""
+        if rowFormat not in ROW_FORMATS:
+            raise ValueError("Unrecognized row format: %s" % rowFormat);
+        self.query = query;
+        self.conn = conn;
+        self.headers = list(headers);
+        self.groupIndex = self.headers.index(groupColumn);
+        self.rowFormat = rowFormat;
+        self.fetchSize = fetchSize;
+        self.prefetch = prefetch and DBUtil.Env.DATABASE_CONNECTOR_NAME != "sqlite3";
+        self.connFactory = connFactory;
+        if self.connFactory is None:
+            self.connFactory = DBUtil.ConnectionFactory();  # Default connection source for the prefetch thread
+
+    def estimateRowCount(self):
+        """Cheap estimate of the number of result rows, to use for progress tracking.
+        For PostgreSQL, just ask for the query planner's row estimate rather than running a full count query.
+        """
+        if DBUtil.Env.DATABASE_CONNECTOR_NAME == "psycopg2":
+            explainResult = DBUtil.execute("explain (format json) "+str(self.query), tuple(self.query.getParams()), conn=self.conn, autoCommit=False);
+            plan = explainResult[0][0];
+            if isinstance(plan, str):
+                plan = json.loads(plan);
+            return int(plan[0]["Plan"]["Plan Rows"]);
+        return DBUtil.execute(self.query.totalQuery(), conn=self.conn)[0][0];
+
+    def __iter__(self):
+        currentGroupId = None;
+        currentRows = list();
+        for chunk in self.iterChunks():
+            for row in chunk:
+                groupId = row[self.groupIndex];
+                if groupId != currentGroupId and currentRows:
+                    yield (currentGroupId, self.formatRows(currentRows));
+                    currentRows = list();
+                currentGroupId = groupId;
+                currentRows.append(row);
+        if currentRows:
+            yield (currentGroupId, self.formatRows(currentRows));
+
+    def formatRows(self, rows):
+        if self.rowFormat == "dict":
+            headers = self.headers;
+            return [dict(zip(headers, row)) for row in rows];
+        elif self.rowFormat == "records":
+            return np.rec.fromrecords(rows, names=self.headers);
+        return rows;
+
+    def iterChunks(self):
+        """Iterate over batches (lists) of result rows"""
+        if self.prefetch:
+            return self.iterPrefetchedChunks();
+        return self.iterFetchedChunks();
+
+    def iterFetchedChunks(self):
+        """Fetch through the caller's connection, holding the cursor open across any commits the caller makes while iterating"""
+        return DBUtil.iterExecute(self.query, chunkFormat="rows", iterSize=self.fetchSize, withHold=True, conn=self.conn);
+
+    def iterPrefetchedChunks(self):
+        """Fetch through a dedicated connection in a background thread, passing the chunks back through a bounded queue.
+        iterExecute opens the connection in the thread and closes it when the thread is done.
+        """
+        chunkQueue = queue.Queue(PREFETCH_CHUNKS);
+        stopEvent = threading.Event();
+
+        def put(item):
+            """Queue up the item unless the consumer stops first.  Returns whether the item was queued."""
+            while not stopEvent.is_set():
+                try:
+                    chunkQueue.put(item, timeout=0.1);
+                    return True;
+                except queue.Full:
+                    pass;
+            return False;
+
+        def produce():
+            chunks = DBUtil.iterExecute(self.query, chunkFormat="rows", iterSize=self.fetchSize, connFactory=self.connFactory);
+            try:
+                for chunk in chunks:
+                    if not put(chunk):
+                        return;
+                put(None);   # End of data marker
+            except Exception as err:
+                put(err);
+            finally:
+                chunks.close();
+
+        thread = threading.Thread(target=produce, name="PatientTimelineReader");
+        thread.daemon = True;
+        thread.start();
+        try:
+            chunk = chunkQueue.get();
+            while chunk is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk;
+                yield chunk;
+                chunk = chunkQueue.get();
+        finally:
+            # Consumer done or abandoned iteration, so let the producer finish closing its cursor and connection
+            stopEvent.set();
+            thread.join();
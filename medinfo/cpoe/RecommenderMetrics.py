@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Instrumentation for the recommendation pipeline, to track per stage latency,
+database / cache usage, and the sizes of the intermediate candidate sets,
+for individual recommender calls and accumulated across many calls (e.g., for a production process).
+"""
+
+import sys, os
+import time;
+import json;
+from collections import deque;
+import numpy as np;
+
+# Number of most recent per call values to keep for each metric to estimate quantiles (e.g., p99 latency) from
+SAMPLE_SIZE = 1000;
+
+# Quantiles to report for each metric
+QUANTILES = (0.5, 0.9, 0.99);
+
+# Name prefix for the Prometheus style text exposition metrics
+METRIC_PREFIX = "cdss_recommender";
+
+# Name of the pseudo-stage recording the total time of each recommender call
+TOTAL_STAGE = "total";
+
+class NullStage:
+    """No-op stand-in for a RecommenderContext stage timer, when not collecting metrics"""
+    def __enter__(self):
+        return self;
+    def __exit__(self, *args):
+        return False;
+
+NULL_STAGE = NullStage();
+
+class StageTimer:
+    """Context manager adding the elapsed time of its block to a context stage"""
+    def __init__(self, context, name):
+        self.context = context;
+        self.name = name;
+    def __enter__(self):
+        self.startTime = time.time();
+        return self;
+    def __exit__(self, *args):
+        self.context.addStageTime(self.name, time.time() - self.startTime);
+        return False;
+
+class RecommenderContext:
+    """Instrumentation for a single recommender call.
+        stageTimes: Stage name (e.g., loadAssociations, aggregateStats) -> seconds spent (accumulated if a stage repeats)
+        counts:     Count name (e.g., rowsFetched, candidateItems, dbQueries) -> value
+        cacheLookups: Cache name -> [hits, misses]
+    """
+    def __init__(self):
+        self.startTime = time.time();
+        self.stageTimes = dict();
+        self.counts = dict();
+        self.cacheLookups = dict();
+
+    def stage(self, name):
+        """Context manager to time a block of the pipeline as the named stage"""
+        return StageTimer(self, name);
+
+    def addStageTime(self, name, seconds):
+        self.stageTimes[name] = self.stageTimes.get(name, 0.0) + seconds;
+
+    def addCount(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value;
+
+    def addCacheLookup(self, cacheName, hit):
+        if cacheName not in self.cacheLookups:
+            self.cacheLookups[cacheName] = [0,0];
+        self.cacheLookups[cacheName][0 if hit else 1] += 1;
+
+    def cacheHitRatio(self, cacheName=None):
+        """Fraction of cache lookups (for the named cache or all caches) that were hits.  None if no lookups"""
+        lookups = list(self.cacheLookups.values());
+        if cacheName is not None:
+            lookups = [self.cacheLookups.get(cacheName, [0,0])];
+        hits = sum([lookup[0] for lookup in lookups]);
+        total = hits + sum([lookup[1] for lookup in lookups]);
+        if total < 1:
+            return None;
+        return float(hits) / total;
+
+    def finish(self):
+        """Record the total elapsed time since the context was created"""
+        self.stageTimes[TOTAL_STAGE] = time.time() - self.startTime;
+
+    def toDict(self):
+        cacheLookups = dict();
+        for cacheName, (hits, misses) in self.cacheLookups.items():
+            cacheLookups[cacheName] = {"hits": hits, "misses": misses, "hitRatio": self.cacheHitRatio(cacheName)};
+        return {"stageTimes": dict(self.stageTimes), "counts": dict(self.counts), "cacheLookups": cacheLookups};
+
+class MetricSummary:
+    """Running count and sum of a per call metric, with a window of the most recent values to estimate quantiles from"""
+    def __init__(self, sampleSize=SAMPLE_SIZE):
+        self.count = 0;
+        self.total = 0.0;
+        self.samples = deque(maxlen=sampleSize);
+
+    def add(self, value):
+        self.count += 1;
+        self.total += value;
+        self.samples.append(value);
+
+    def quantile(self, q):
+        if not self.samples:
+            return None;
+        return float(np.percentile(list(self.samples), q*100));
+
+    def toDict(self):
+        summary = {"count": self.count, "sum": self.total};
+        for q in QUANTILES:
+            summary["p%g" % (q*100)] = self.quantile(q);
+        return summary;
+
+class RecommenderMetrics:
+    """Accumulate RecommenderContexts across many recommender calls,
+    for summaries of the stage latencies, counts and cache hit ratios,
+    as JSON or Prometheus style text exposition format.
+    """
+    def __init__(self, sampleSize=SAMPLE_SIZE):
+        self.sampleSize = sampleSize;
+        self.nCalls = 0;
+        self.stageSummaries = dict();   # Stage name -> MetricSummary of seconds per call
+        self.countSummaries = dict();   # Count name -> MetricSummary of values per call
+        self.cacheLookups = dict();     # Cache name -> [hits, misses]
+
+    def record(self, context):
+        self.nCalls += 1;
+        for (summariesByName, valuesByName) in [(self.stageSummaries, context.stageTimes), (self.countSummaries, context.counts)]:
+            for name, value in valuesByName.items():
+                if name not in summariesByName:
+                    summariesByName[name] = MetricSummary(self.sampleSize);
+                summariesByName[name].add(value);
+        for cacheName, (hits, misses) in context.cacheLookups.items():
+            if cacheName not in self.cacheLookups:
+                self.cacheLookups[cacheName] = [0,0];
+            self.cacheLookups[cacheName][0] += hits;
+            self.cacheLookups[cacheName][1] += misses;
+
+    def toDict(self):
+        cacheLookups = dict();
+        for cacheName, (hits, misses) in self.cacheLookups.items():
+            hitRatio = None;
+            if hits+misses > 0:
+                hitRatio = float(hits) / (hits+misses);
+            cacheLookups[cacheName] = {"hits": hits, "misses": misses, "hitRatio": hitRatio};
+        return \
+            {   "calls": self.nCalls,
+                "stageSeconds": dict( (name, summary.toDict()) for name, summary in self.stageSummaries.items() ),
+                "counts": dict( (name, summary.toDict()) for name, summary in self.countSummaries.items() ),
+                "cacheLookups": cacheLookups,
+            };
+
+    def toJSON(self):
+        return json.dumps(self.toDict(), indent=2, sort_keys=True);
+
+    def toPrometheusText(self, prefix=METRIC_PREFIX):
+        """Prometheus style text exposition format of the accumulated metrics"""
+        lines = list();
+        lines.append("# TYPE %s_calls_total counter" % prefix);
+        lines.append("%s_calls_total %d" % (prefix, self.nCalls));
+        for (metricName, labelName, summariesByName) in [("stage_seconds","stage",self.stageSummaries), ("count","name",self.countSummaries)]:
+            lines.append("# TYPE %s_%s summary" % (prefix, metricName));
+            for name in sorted(summariesByName):
+                summary = summariesByName[name];
+                for q in QUANTILES:
+                    lines.append('%s_%s{%s="%s",quantile="%g"} %r' % (prefix, metricName, labelName, name, q, summary.quantile(q)));
+                lines.append('%s_%s_sum{%s="%s"} %r' % (prefix, metricName, labelName, name, summary.total));
+                lines.append('%s_%s_count{%s="%s"} %d' % (prefix, metricName, labelName, name, summary.count));
+        lines.append("# TYPE %s_cache_lookups_total counter" % prefix);
+        for cacheName in sorted(self.cacheLookups):
+            (hits, misses) = self.cacheLookups[cacheName];
+            lines.append('%s_cache_lookups_total{cache="%s",result="hit"} %d' % (prefix, cacheName, hits));
+            lines.append('%s_cache_lookups_total{cache="%s",result="miss"} %d' % (prefix, cacheName, misses));
+        return str.join("\n", lines) + "\n";
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Offline precomputed index of the top-k associated (target / subsequent) items for each source clinical item,
+per association count column (time window and count prefix) and sort field.
+Allows the SparseItemAssociationRecommender to answer typical top 10-50 queries
+by only looking at the top of each query item's list, rather than scoring every association.
+"""
+
+import sys, os
+import time;
+from optparse import OptionParser
+import json;
+import numpy as np;
+
+from medinfo.common.Util import ProgressDots;
+from medinfo.common.StatsUtil import ContingencyStatsArray;
+
+from .ItemRecommender import SparseItemAssociationRecommender, RecommenderQuery;
+from .Util import log;
+
+# Default number of top associated items to store per source item
+DEFAULT_TOP_K = 100;
+
+# Default sort fields to build lists for
+DEFAULT_SORT_FIELDS = ("PPV","lift","P-YatesChi2-NegLog");
+
+# Default count column time windows to build lists for (seconds).  None for the unlimited count_any column
+DEFAULT_TIME_DELTAS = (None, 3600, 86400);
+
+# Delimiter for the list names and array component names stored in the index file
+NAME_DELIM = "|";
+
+class TopKNeighborIndex:
+    """Per (countField, sortField) list, stores compact parallel arrays sorted by source item:
+        sourceIds:  Sorted source clinical_item_ids that have any associations
+        rowPtr:     Start of each source item's entries in the arrays below (CSR style)
+        targetIds:  Target clinical_item_ids, in descending score order within each source item (top k only)
+        scores:     Score of each target (NaN scores stored as +inf, so never mistaken for low scores)
+        rowLengths: Total number of scorable associations per source item, to tell if the top k list is complete
+
+    Scores are for the individual (source, target) association, calculated the same way as
+    the recommender would for a single query item.  The index is a snapshot of the association model,
+    so should be rebuilt after the model is updated (totalPatients is stored to detect mismatches).
+    """
+    def __init__(self, k=DEFAULT_TOP_K):
+        self.k = k;
+        self.arraysByList = dict(); # (countField, sortField) -> dictionary of the named arrays
+        self.totalPatientsByField = dict(); # countField -> totalPatients used for the scores
+
+    def listNames(self):
+        return list(self.arraysByList.keys());
+
+    def hasList(self, countField, sortField):
+        return (countField, sortField) in self.arraysByList;
+
+    def totalPatients(self, countField):
+        return self.totalPatientsByField.get(countField);
+
+    def neighbors(self, countField, sortField, sourceId):
+        """Return (targetIds, scores, isComplete) for the top associated items of the source item,
+        in descending score order.  isComplete is False if other associations beyond the top k exist.
+        """
+        arrays = self.arraysByList[(countField, sortField)];
+        sourceIds = arrays["sourceIds"];
+        index = np.searchsorted(sourceIds, sourceId);
+        if index >= len(sourceIds) or sourceIds[index] != sourceId:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0), True);
+        (start, end) = (arrays["rowPtr"][index], arrays["rowPtr"][index+1]);
+        isComplete = (end-start >= arrays["rowLengths"][index]);
+        return (arrays["targetIds"][start:end], arrays["scores"][start:end], isComplete);
+
+    def addLists(self, matrix, baseCounts, totalPatients, countField, sortFields):
+        """Build the top k lists for the count column of the AssociationMatrix, for each of the sort fields.
+        baseCounts are the baseline item counts aligned to the matrix item indexes (for the same count prefix).
+        """
+        valid = (matrix.sourceIndex != matrix.targetIndex);   # Query items are never recommended back to themselves
+        sourceIndex = matrix.sourceIndex[valid].astype(np.int64);
+        targetIndex = matrix.targetIndex[valid].astype(np.int64);
+        nAB = matrix.countsByField[countField][valid];
+        nA = baseCounts[sourceIndex];
+        nB = baseCounts[targetIndex];
+
+        # Items without baseline counts available cannot be scaled, so will never be recommended
+        hasBaseCounts = ~(np.isnan(nA) | np.isnan(nB));
+        (sourceIndex, targetIndex, nAB, nA, nB) = (sourceIndex[hasBaseCounts], targetIndex[hasBaseCounts], nAB[hasBaseCounts], nA[hasBaseCounts], nB[hasBaseCounts]);
+
+        # Same stat calculation as the recommender does per aggregate item
+        contStats = ContingencyStatsArray(nAB, nA, nB, float(totalPatients));
+        contStats.normalize(truncateNegativeValues=False);
+
+        (sourceIndexes, rowLengths) = np.unique(sourceIndex, return_counts=True);
+        rowStarts = np.concatenate(([0], np.cumsum(rowLengths)[:-1])).astype(np.int64);
+        for sortField in sortFields:
+            scores = contStats[sortField];
+            scores = np.where(np.isnan(scores), np.inf, scores);
+
+            # Descending score order within each source item, breaking ties by target item
+            order = np.lexsort((targetIndex, -scores, sourceIndex));
+            rank = np.arange(len(order)) - np.repeat(rowStarts, rowLengths);
+            order = order[rank < self.k];
+
+            arrays = dict();
+            arrays["sourceIds"] = matrix.itemIds[sourceIndexes];
+            arrays["rowPtr"] = np.concatenate(([0], np.cumsum(np.minimum(rowLengths, self.k)))).astype(np.int64);
+            arrays["rowLengths"] = rowLengths.astype(np.int64);
+            arrays["targetIds"] = matrix.itemIds[targetIndex[order]];
+            arrays["scores"] = scores[order];
+            self.arraysByList[(countField, sortField)] = arrays;
+
+        self.totalPatientsByField[countField] = float(totalPatients);
+
+    def buildFromDatabase(self, countFields, sortFields, recommender=None, maxRecommendedId=None, conn=None):
+        """Load the association matrix and baseline counts (same as the recommender would)
+        and build the top k lists for each of the count fields and sort fields.
+        """
+        if recommender is None:
+            recommender = SparseItemAssociationRecommender();
+
+        extConn = True;
+        if conn is None:
+            conn = recommender.connFactory.connection();
+            extConn = False;
+        try:
+            progress = ProgressDots(name="count fields");
+            for countField in countFields:
+                # Template query to reuse recommender data loading
+                query = RecommenderQuery();
+                query.countPrefix = countPrefixFromField(countField);
+                query.maxRecommendedId = maxRecommendedId;
+
+                matrix = recommender.loadAssociationMatrix(query, countField, conn=conn);
+                baseCounts = recommender.loadBaseCounts(matrix, query, conn=conn);
+                totalPatients = recommender.totalPatientCount(query, conn);
+
+                self.addLists(matrix, baseCounts, totalPatients, countField, sortFields);
+                progress.update();
+            progress.printStatus();
+        finally:
+            if not extConn:
+                conn.close();
+
+    def save(self, filename):
+        """Store the index arrays into a single (uncompressed) numpy archive file"""
+        header = {"k": self.k, "totalPatientsByField": self.totalPatientsByField, "lists": [list(listName) for listName in self.arraysByList.keys()] };
+        arraysByName = {"header": np.array(json.dumps(header))};
+        for (countField, sortField), arrays in self.arraysByList.items():
+            for arrayName, array in arrays.items():
+                arraysByName[NAME_DELIM.join((countField, sortField, arrayName))] = array;
+        with open(filename, "wb") as outputFile:
+            np.savez(outputFile, **arraysByName);
+
+    def load(filename):
+        """Load a previously saved index file"""
+        with np.load(filename) as data:
+            header = json.loads(str(data["header"]));
+            index = TopKNeighborIndex(header["k"]);
+            index.totalPatientsByField = header["totalPatientsByField"];
+            for (countField, sortField) in header["lists"]:
+                arrays = dict();
+                for arrayName in ("sourceIds","rowPtr","rowLengths","targetIds","scores"):
+                    arrays[arrayName] = data[NAME_DELIM.join((countField, sortField, arrayName))];
+                index.arraysByList[(countField, sortField)] = arrays;
+        return index;
+    load = staticmethod(load);
+
+    def main(self, argv):
+        """Main method, callable from command line"""
+        usageStr =  "usage: %prog [options] <outputFile>\n"+\
+                    "   <outputFile>    Index file to store the top associated items of each clinical item\n"
+        parser = OptionParser(usage=usageStr)
+        parser.add_option("-k", "--topK", dest="topK", type="int", default=DEFAULT_TOP_K, help="Number of top associated items to store per clinical item.  Default %s" % DEFAULT_TOP_K);
+        parser.add_option("-p", "--countPrefixes", dest="countPrefixes", default="", help="Comma separated list of count prefixes (e.g., ',patient_,encounter_') to build lists for.  Default is just the plain item counts");
+        parser.add_option("-t", "--timeDeltas", dest="timeDeltas", help="Comma separated list of time windows (seconds) to build lists for.  Use 'any' for the unlimited count_any column.  Default %s" % str.join(",", [timeDeltaName(timeDelta) for timeDelta in DEFAULT_TIME_DELTAS]));
+        parser.add_option("-s", "--sortFields", dest="sortFields", default=str.join(",", DEFAULT_SORT_FIELDS), help="Comma separated list of sort fields to build lists for.  Default %s" % str.join(",", DEFAULT_SORT_FIELDS));
+        (options, args) = parser.parse_args(argv[1:])
+
+        log.info("Starting: "+str.join(" ", argv))
+        timer = time.time();
+        if len(args) > 0:
+            self.k = options.topK;
+
+            timeDeltas = DEFAULT_TIME_DELTAS;
+            if options.timeDeltas is not None:
+                timeDeltas = [None if timeDeltaStr == "any" else int(timeDeltaStr) for timeDeltaStr in options.timeDeltas.split(",")];
+            countFields = list();
+            for countPrefix in options.countPrefixes.split(","):
+                for timeDelta in timeDeltas:
+                    countFields.append(countPrefix+"count_"+timeDeltaName(timeDelta));
+            sortFields = options.sortFields.split(",");
+
+            self.buildFromDatabase(countFields, sortFields);
+            self.save(args[0]);
+        else:
+            parser.print_help()
+            sys.exit(-1)
+
+        timer = time.time() - timer;
+        log.info("%.3f seconds to complete",timer);
+
+def timeDeltaName(timeDelta):
+    """Count column suffix for a time window in seconds (None for unlimited)"""
+    if timeDelta is None:
+        return "any";
+    return "%d" % timeDelta;
+
+def countPrefixFromField(countField):
+    """Inverse of ItemAssociationRecommender.countFieldByQuery, extracting the count prefix (e.g., "patient_") from the count column name"""
+    return countField[:countField.rindex("count_")];
+
+if __name__ == "__main__":
+    instance = TopKNeighborIndex();
+    instance.main(sys.argv);
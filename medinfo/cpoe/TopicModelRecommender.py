@@ -6,11 +6,12 @@ then this module will return with a ranked and scored list of associated items /
 """
 import sys, os
 import time;
-from operator import itemgetter
 from optparse import OptionParser;
 import json;
 import urllib.parse;
 import math;
+import numpy as np;
+from scipy.sparse import csr_matrix;
 from datetime import datetime, timedelta;
 from medinfo.common.Const import FALSE_STRINGS, COMMENT_TAG;
 from medinfo.common.Util import stdOpen, ProgressDots;
@@ -21,12 +22,15 @@ from medinfo.db.Model import RowItemFieldComparator;
 from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.db.ResultsFormatter import TextResultsFormatter;
 from medinfo.cpoe.ItemRecommender import BaseItemRecommender;
+from medinfo.cpoe.OrderSetRecommender import topScoreIndexes, NULL_CATEGORY_ID;
 from medinfo.cpoe.TopicModel import TopicModel;
-from .Util import log;
 
 class TopicModelRecommender(BaseItemRecommender):
     """Implementation class for item (e.g., order) recommendation based on topic models 
     (LDA Latent Dirichlet Allocation or HDP Hierarchical Dirichlet Process).
+
+    The topic model item weights are stored as a sparse (item x topic) matrix once loaded,
+    so scoring all candidate items for a query is a single sparse matrix-vector product.
     """
     def __init__(self, model, docCountByWordId=None):
         """Initialize module with prior generated model and word document counts from TopicModel module.
@@ -46,6 +50,14 @@ class TopicModelRecommender(BaseItemRecommender):
         self.categoryIdByItemId = None;
         self.candidateItemIds = None;
         self.weightByItemIdByTopicId = None;
+
+        # Array versions of the lookups, aligned to the sorted itemIds (items with document counts) and topicIds
+        self.itemIds = None;
+        self.itemCategoryIds = None;
+        self.isCandidateItem = None;
+        self.itemDocCounts = None;
+        self.topicIndexById = None;
+        self.itemWeightMatrix = None;   # (item x topic) weight of each item in each topic
     
     def initItemLookups(self, query):
         self.itemsById = DBUtil.loadTableAsDict("clinical_item");
@@ -57,6 +69,29 @@ class TopicModelRecommender(BaseItemRecommender):
         for itemId in list(self.docCountByWordId.keys()):
             if self.isItemRecommendable(itemId, emptyQuerySet, query, self.categoryIdByItemId):
                 self.candidateItemIds.add(itemId);
+
+        self.itemIds = np.array(sorted([itemId for itemId in self.docCountByWordId.keys() if itemId is not None]), dtype=np.int64);
+        categoryIds = [self.categoryIdByItemId.get(itemId) for itemId in self.itemIds.tolist()];
+        self.itemCategoryIds = np.array([NULL_CATEGORY_ID if categoryId is None else categoryId for categoryId in categoryIds], dtype=np.int64);
+        self.isCandidateItem = np.isin(self.itemIds, list(self.candidateItemIds));
+
+        self.itemDocCounts = np.array([self.docCountByWordId[itemId] for itemId in self.itemIds.tolist()], dtype=np.float64);
+
+    def initWeightMatrix(self):
+        """Build the sparse (item x topic) weight matrix from the weightByItemIdByTopicId lookups"""
+        itemIndexById = dict(zip(self.itemIds.tolist(), range(len(self.itemIds))));
+        self.topicIndexById = dict();
+        rows = list();
+        cols = list();
+        weights = list();
+        for topicId, weightByItemId in self.weightByItemIdByTopicId.items():
+            self.topicIndexById[topicId] = len(self.topicIndexById);
+            for itemId, weight in weightByItemId.items():
+                if itemId in itemIndexById: # Only items with document counts could be recommended anyway
+                    rows.append(itemIndexById[itemId]);
+                    cols.append(self.topicIndexById[topicId]);
+                    weights.append(weight);
+        self.itemWeightMatrix = csr_matrix((weights, (rows, cols)), shape=(len(self.itemIds), len(self.topicIndexById)));
     
     def __call__(self, query):
         # Given query items, use model to find related topics with relationship scores
@@ -68,6 +103,7 @@ class TopicModelRecommender(BaseItemRecommender):
         # Load model weight parameters once to save time on serial queries
         if self.weightByItemIdByTopicId is None:
             self.weightByItemIdByTopicId = self.modeler.generateWeightByItemIdByTopicId(self.model, query.itemsPerCluster);
+            self.initWeightMatrix();
 
         # Adapt query into bag-of-words format
         queryItemCountById = query.queryItemIds;
@@ -86,25 +122,29 @@ class TopicModelRecommender(BaseItemRecommender):
             weightByTopicId[topicId] = topicWeight;
 
         # Composite scores for (recommendable) items by taking weighted average across the top items for each topic
-        recScoreByItemId = dict();
-        for itemId in self.candidateItemIds:
-            if self.isItemRecommendable(itemId, queryItemCountById, query, self.categoryIdByItemId):
-                recScoreByItemId[itemId] = 0.0;
+        topicWeightVector = np.zeros(len(self.topicIndexById));
         for topicId, topicWeight in weightByTopicId.items():
             if topicWeight > query.minClusterWeight:    # Ignore topics with tiny contribution
-                weightByItemId = self.weightByItemIdByTopicId[topicId];
-                for itemId in list(recScoreByItemId.keys()):
-                    itemWeight = 0.0;
-                    if itemId in weightByItemId:
-                        itemWeight = weightByItemId[itemId];
-                    recScoreByItemId[itemId] += topicWeight*itemWeight;
+                topicWeightVector[self.topicIndexById[topicId]] = topicWeight;
+        totalItemWeights = self.itemWeightMatrix.dot(topicWeightVector);
+        tfidfs = np.zeros(len(self.itemIds));
+        hasDocCount = (self.itemDocCounts > 0);
+        tfidfs[hasDocCount] = totalItemWeights[hasDocCount] * self.docCountByWordId[None] / self.itemDocCounts[hasDocCount];    # Scale TF*IDF score based on baseline document counts to prioritize disproportionately common items
+
+        candidates = self.isCandidateItem & ~np.isin(self.itemIds, list(queryItemCountById));
+        if query.excludeItemIds:
+            candidates &= ~np.isin(self.itemIds, list(query.excludeItemIds));
+        if query.excludeCategoryIds:
+            candidates &= ~np.isin(self.itemCategoryIds, list(query.excludeCategoryIds));
+        # Only the top (query.limit) results, in descending score order, with ties broken by descending item ID
+        selected = topScoreIndexes(np.flatnonzero(candidates), {"tf": totalItemWeights, "tfidf": tfidfs}, self.itemIds, query);
 
         # Build 2-pls with lists to sort by score
         recommendedData = list();
-        for itemId, totalItemWeight in recScoreByItemId.items():
-            tfidf = 0.0;
-            if itemId in self.docCountByWordId and self.docCountByWordId[itemId] > 0.0:
-                tfidf = totalItemWeight * self.docCountByWordId[None] / self.docCountByWordId[itemId];    # Scale TF*IDF score based on baseline document counts to prioritize disproportionately common items
+        for itemIndex in selected:
+            itemId = int(self.itemIds[itemIndex]);
+            totalItemWeight = float(totalItemWeights[itemIndex]);
+            tfidf = float(tfidfs[itemIndex]);
             itemModel = \
                 {   "totalItemWeight": totalItemWeight, "tf": totalItemWeight, "PPV": totalItemWeight, "P(item|query)": totalItemWeight, "P(B|A)": totalItemWeight,
                     "tfidf": tfidf, "lift": tfidf, "interest": tfidf, "P(item|query)/P(item)": tfidf, "P(B|A)/P(B)": tfidf,
@@ -113,9 +153,12 @@ class TopicModelRecommender(BaseItemRecommender):
                 };
             itemModel["score"] = itemModel[query.sortField];
             recommendedData.append(itemModel);
-        recommendedData.sort(key=itemgetter("score"), reverse=True);
         return recommendedData;
 
+    def recommendBatch(self, queries, conn=None):
+        """Lookups are loaded once in memory, so just run each query in turn (no database connection needed)"""
+        return [self(query) for query in queries];
+
     def main(self, argv):
         """Main method, callable from command line"""
         usageStr =  "usage: %prog [options] <queryStr> [<outputFile>]\n"+\
@@ -156,8 +199,7 @@ class TopicModelRecommender(BaseItemRecommender):
                 # Denormalize results with links to clinical item descriptions
                 self.formatRecommenderResults(recommendedData);
                 # Ensure derived fields are populated if selected for display
-                for resultModel in recommendedData:
-                    self.populateDerivedStats(resultModel, displayFields);
+                self.populateDerivedStatsList(recommendedData, displayFields);
 
             colNames = ["rank","clinical_item_id","name","description","category_description"];
             colNames.extend(displayFields);
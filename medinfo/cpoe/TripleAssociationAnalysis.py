@@ -4,18 +4,29 @@ import time;
 import math;
 from datetime import datetime;
 from optparse import OptionParser
+import numpy as np;
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, generatePlaceholders;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.Model import RowItemModel;
 
-from .AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
-from .DataManager import DataManager;
+from .AssociationAnalysis import AssociationAnalysis, AnalysisOptions, SHARDS_PER_PROCESS, ONE_MICROSECOND, MICROSECONDS_PER_SECOND;
+from .AssociationAnalysis import iterPairBlocks, markFirstOccurrences;
+from .DataManager import DataManager, LINK_INDEX_CACHE_KEY;
+from .AssociationCountBuffer import AssociationCountBuffer;
 
+from medinfo.db.Const import KEEP_ALIVE_SECONDS;
 from .Const import DELTA_NAME_BY_SECONDS;
 
 from .Util import log;
 
+class TripleAnalysisOptions(AnalysisOptions):
+    """AnalysisOptions plus the triple sequence to look for, so can be passed along to parallel worker processes"""
+    def __init__(self, itemIdSequence=None, virtualItemId=None):
+        AnalysisOptions.__init__(self);
+        self.itemIdSequence = itemIdSequence;
+        self.virtualItemId = virtualItemId;
+
 class TripleAssociationAnalysis(AssociationAnalysis):
     """Pre-Computation module to sort through data on patient clinical items
     (orders, lab results, problem list entries, etc.) and aggregate
@@ -45,6 +56,9 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         as would collide with AssociationAnalysis primary timestamping, thus it is the
         caller's responsibility to be careful not to repeat this analysis redundantly
         and generating duplicated statistics.
+
+        If processes is more than 1, split the patients into shards to analyze in parallel worker processes
+        and merge the results for a single commit, the same as AssociationAnalysis.analyzePatientItemsParallel.
         """
         progress = ProgressDots();
         conn = self.connFactory.connection();
@@ -53,23 +67,42 @@ class TripleAssociationAnalysis(AssociationAnalysis):
             linkedItemIdsByBaseId = self.dataManager.loadLinkedItemIdsByBaseId(conn=conn);
             self.verifyVirtualItemLinked(itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=conn);
 
-            # Keep an in memory buffer of the updates to be done so can stall and submit them
-            #   to the database in batch to minimize inefficient DB hits
-            updateBuffer = dict();
-            log.info("Main patient item query...")
-            analysisOptions = AnalysisOptions();
+            analysisOptions = TripleAnalysisOptions(itemIdSequence, virtualItemId);
             analysisOptions.patientIds = patientIds;
-            for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
-                log.debug("Calculate associations for Patient %d's %d patient items" % (iPatient, len(patientItemList)) );
-                self.updateItemAssociationsBuffer(itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
-                # Periodically send a quick arbitrary query to DB, otherwise connection may get recycled because DB thinks timeout with no interaction
-                DBUtil.execute("select 1+1", conn=conn);
+
+            log.info("Main patient item query...")
+            if self.processes is not None and self.processes > 1:
+                patientIds = list(patientIds);
+                shardOptionsList = self.shardAnalysisOptions(analysisOptions, patientIds, self.processes*SHARDS_PER_PROCESS);
+                log.info("Analyze %d patients in %d shards across %d processes" % (len(patientIds), len(shardOptionsList), self.processes) );
+                updateBuffer = self.countPatientShardsParallel(shardOptionsList);
+            else:
+                # Keep an in memory buffer of the updates to be done so can stall and submit them
+                #   to the database in batch to minimize inefficient DB hits
+                updateBuffer = self.makeUpdateBuffer();
+                lastQueryTime = time.time();
+                for iPatient, patientItemList in enumerate(self.queryPatientItemsPerPatient(analysisOptions, progress=progress, conn=conn)):
+                    log.debug("Calculate associations for Patient %d's %d patient items" % (iPatient, len(patientItemList)) );
+                    self.updateItemAssociationsBuffer(itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId, progress=progress);
+                    if time.time() - lastQueryTime > KEEP_ALIVE_SECONDS:
+                        # Periodically check in with the DB, otherwise connection may get recycled because DB thinks timeout with no interaction
+                        DBUtil.pingConnection(conn);
+                        lastQueryTime = time.time();
             log.info("Final commit");
             self.commitUpdateBuffer(updateBuffer, linkedItemIdsByBaseId, conn=conn);  # Final update buffer commit
         finally:
             conn.close();
         # progress.PrintStatus();
 
+    def countPatientShard(self, analysisOptions, linkedItemIdsByBaseId, conn=None):
+        """Count triple sequence associations for the patients of the (TripleAnalysisOptions) analysisOptions
+        into a new update buffer and return it, for parallel worker processes.
+        """
+        updateBuffer = self.makeUpdateBuffer();
+        for patientItemList in self.queryPatientItemsPerPatient(analysisOptions, conn=conn):
+            self.updateItemAssociationsBuffer(analysisOptions.itemIdSequence, analysisOptions.virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId);
+        return updateBuffer;
+
     def updateItemAssociationsBuffer(self, itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId=None, progress=None):
         """Given a list of data on patient clinical items,
         ordered by item event date, increment information in the
@@ -79,69 +112,99 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         Looking for specific triple sequences only though with items followed by those specified
         in the itemIdSequence.  If a triple sequence is found, then mark the end point as
         a virtualItem instance for counting associations.
+
+        Produces the same counts as checking every (item1, item2) pair in turn in a nested loop,
+        but with sorted arrays of the mid-sequence (B1) and end-sequence (B2) item times.  For each item Ai, bisection finds
+        the first B1 at or after Ai, and any B2 at or after that B1 completes an Ai->B1->B2 sequence,
+        so the matching B2 items are a contiguous range that can be enumerated and aggregated in numpy array blocks.
         """
-        # Keep track of which items to mark as newly analyzed
-        newlyAnalyzedPatientItemIdSet = set();
-
-        # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
-        subsequentItemIds = set();
-        # Keep track of all item pairs encountered to avoid counting patient level duplicates
-        encounterIdPairsByItemIdPair = dict();
-
-        # Track where the mid-sequence items occur for easy comparison later
-        midSequenceItemDates = set();
-        for patientItem in patientItemList:
-            if patientItem["clinical_item_id"] == itemIdSequence[0]:
-                midSequenceItemDates.add(patientItem["item_date"]);
-        endSequenceItemsByPatientItemId = dict();
-
-        # Main nested loop to look for associations
-        for iItem1, patientItem1 in enumerate(patientItemList):
-            subsequentItemIds.clear();
-
-            for iItem2, patientItem2 in enumerate(patientItemList):
-                itemIdPair = (patientItem1["clinical_item_id"], virtualItemId);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
-
-                # Verify is not a previously linked item pair, in which case no meaningful asssociation stats to calculate
-                #   and that the item dates are in non-negative direction
-                isPairToAnalyze = self.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId);
-                if isPairToAnalyze and self.isTripleSequence(patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
-                    # Record the stat update
-                    isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
-                    isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
-                    isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
-
-                    self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
-
-                    subsequentItemIds.add(virtualItemId);
-                    endSequenceItemsByPatientItemId[patientItem2["patient_item_id"]] = patientItem2;
-
-                    if itemIdPair not in encounterIdPairsByItemIdPair:
-                        encounterIdPairsByItemIdPair[itemIdPair] = set();
-                    encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+        if linkedItemIdsByBaseId is None:
+            linkedItemIdsByBaseId = dict();
+        if "associationCounts" not in updateBuffer:
+            updateBuffer["associationCounts"] = AssociationCountBuffer();
+        associationCounts = updateBuffer["associationCounts"];
+
+        nItems = len(patientItemList);
+        if nItems < 1:
+            return;
+        deltaSecondsOptions = np.array(sorted(DELTA_NAME_BY_SECONDS.keys()), dtype=np.int64);
+
+        # Sort the timeline once (stable, so is unchanged if already ordered by item_date) and convert into parallel numeric arrays
+        patientItemList = sorted(patientItemList, key=lambda patientItem: patientItem["item_date"]);
+        baseDate = patientItemList[0]["item_date"];
+        microseconds = np.array([(patientItem["item_date"]-baseDate) // ONE_MICROSECOND for patientItem in patientItemList], dtype=np.int64);
+        clinicalItemIds = np.array([patientItem["clinical_item_id"] for patientItem in patientItemList], dtype=np.int64);
+        (itemIds, itemIndexes) = np.unique(clinicalItemIds, return_inverse=True);
+        encounterIndexByEncounterId = dict();
+        encounterIndexes = np.array([encounterIndexByEncounterId.setdefault(patientItem["encounter_id"], len(encounterIndexByEncounterId)) for patientItem in patientItemList], dtype=np.int64);
+        nEncounters = len(encounterIndexByEncounterId);
+
+        # Item index codes, with an extra last index for the virtual item
+        codeItemIds = np.append(itemIds, virtualItemId);
+        nCodes = len(codeItemIds);
+        virtualIndex = nCodes-1;
+
+        # Sorted times of the mid-sequence items, and timeline positions of the end-sequence items
+        midTimes = microseconds[clinicalItemIds == itemIdSequence[0]];
+        endPositions = np.flatnonzero(clinicalItemIds == itemIdSequence[-1]);
+        endTimes = microseconds[endPositions];
+
+        # Each item1 pairs with the end items at or after its next mid-sequence item
+        nextMidIndexes = np.searchsorted(midTimes, microseconds, side="left");
+        hasNextMid = (nextMidIndexes < len(midTimes));
+        pairStarts = np.full(nItems, len(endTimes), dtype=np.int64);
+        pairStarts[hasNextMid] = np.searchsorted(endTimes, midTimes[nextMidIndexes[hasNextMid]], side="left");
+        pairLengths = len(endTimes) - pairStarts;
+
+        # Items linked to the end item have no meaningful association stats
+        endItemId = int(itemIdSequence[-1]);
+        isLinkedItemId = np.array([not self.acceptableClinicalItemIdPair(itemId, endItemId, linkedItemIdsByBaseId) for itemId in itemIds.tolist()], dtype=bool);
+        pairLengths[isLinkedItemId[itemIndexes]] = 0;
+
+        seenPairCodes = np.zeros(0, dtype=np.int64);
+        seenEncounterPairCodes = np.zeros(0, dtype=np.int64);
+        matchedEndPositions = np.zeros(0, dtype=np.int64);
+        for (iStart, iEnd, item1, endIndexes) in iterPairBlocks(pairStarts, pairLengths):
+            item2 = endPositions[endIndexes];
+            pairCodes = itemIndexes[item1]*nCodes + virtualIndex;
+            matchedEndPositions = np.union1d(matchedEndPositions, item2);
+            (seenPairCodes, seenEncounterPairCodes) = self.addSequencePairCounts(associationCounts, codeItemIds, nCodes, deltaSecondsOptions, microseconds, encounterIndexes, nEncounters, item1, item2, pairCodes, seenPairCodes, seenEncounterPairCodes);
 
             # Update progress meter if available
             if progress is not None:
-                progress.Update();
+                progress.Update(iEnd-iStart);
 
         # Separate pass to get virtual item baseline counts.  Cannot be done directly, since the virtual items do not actually exist in the raw data
-        subsequentItemIds.clear();
-        for iItem1, patientItem1 in enumerate(endSequenceItemsByPatientItemId.values()):
-            for iItem2, patientItem2 in enumerate(endSequenceItemsByPatientItemId.values()):
-                itemIdPair = (virtualItemId, virtualItemId);
-                encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+        matchedEndTimes = microseconds[matchedEndPositions];
+        pairStarts = np.searchsorted(matchedEndTimes, matchedEndTimes, side="left");
+        pairLengths = len(matchedEndTimes) - pairStarts;
+        for (iStart, iEnd, endIndexes1, endIndexes2) in iterPairBlocks(pairStarts, pairLengths):
+            (item1, item2) = (matchedEndPositions[endIndexes1], matchedEndPositions[endIndexes2]);
+            pairCodes = np.full(len(item1), virtualIndex*nCodes + virtualIndex, dtype=np.int64);
+            (seenPairCodes, seenEncounterPairCodes) = self.addSequencePairCounts(associationCounts, codeItemIds, nCodes, deltaSecondsOptions, microseconds, encounterIndexes, nEncounters, item1, item2, pairCodes, seenPairCodes, seenEncounterPairCodes);
+
+        updateBuffer["nAssociations"] = len(associationCounts);
+
+    def addSequencePairCounts(self, associationCounts, codeItemIds, nCodes, deltaSecondsOptions, microseconds, encounterIndexes, nEncounters, item1, item2, pairCodes, seenPairCodes, seenEncounterPairCodes):
+        """Add the counts for a block of (item1, item2) timeline position pairs, recorded against the given pair codes,
+        to the buffer.  Returns the updated arrays of pair codes (and encounter specific pair codes) seen so far.
+        """
+        if len(pairCodes) < 1:
+            return (seenPairCodes, seenEncounterPairCodes);
 
-                isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
-                isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
-                isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);
+        # First occurrences of each item pair for the patient, and within an encounter
+        (isNewPair, seenPairCodes) = markFirstOccurrences(pairCodes, seenPairCodes);
 
-                self.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
+        isNewPairWithinEncounter = np.zeros(len(pairCodes), dtype=bool);
+        sameEncounterIndexes = np.flatnonzero(encounterIndexes[item1] == encounterIndexes[item2]);
+        encounterPairCodes = pairCodes[sameEncounterIndexes]*nEncounters + encounterIndexes[item1[sameEncounterIndexes]];
+        (isNewEncounterPair, seenEncounterPairCodes) = markFirstOccurrences(encounterPairCodes, seenEncounterPairCodes);
+        isNewPairWithinEncounter[sameEncounterIndexes[isNewEncounterPair]] = True;
 
-                subsequentItemIds.add(virtualItemId);
-                if itemIdPair not in encounterIdPairsByItemIdPair:
-                    encounterIdPairsByItemIdPair[itemIdPair] = set();
-                encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+        secondsDelta = (microseconds[item2] - microseconds[item1]) // MICROSECONDS_PER_SECOND;
+        windowIndexes = np.searchsorted(deltaSecondsOptions, secondsDelta, side="left");  # Smallest time window that includes the pair
+        self.addPairCountsToBuffer(associationCounts, codeItemIds, nCodes, deltaSecondsOptions, pairCodes, secondsDelta, windowIndexes, isNewPair, isNewPairWithinEncounter);
+        return (seenPairCodes, seenEncounterPairCodes);
 
     def verifyVirtualItemLinked(self, itemIdSequence, virtualItemId, linkedItemIdsByBaseId, conn=None):
         """Verify links exist from the virtualItemId to those in the itemIdSequence.
@@ -165,6 +228,7 @@ class TripleAssociationAnalysis(AssociationAnalysis):
                     DBUtil.execute( insertQuery, insertParams, conn=conn);
 
                     linkedItemIdsByBaseId[virtualItemId].add(componentId);
+                    self.dataManager.invalidateDataCache(LINK_INDEX_CACHE_KEY);    # In memory copy modified, so no longer a clean cached index
         finally:
             if not extConn:
                 conn.close();
@@ -198,6 +262,8 @@ class TripleAssociationAnalysis(AssociationAnalysis):
         parser = OptionParser(usage=usageStr)
         parser.add_option("-s", "--itemIdSequence", dest="itemIdSequence", help="Comma-separated sequence of item IDs to look for as representing the end of a triple of interest.")
         parser.add_option("-v", "--virtualItemId", dest="virtualItemId", help="ID of virtual clinical item to record against if find a specified triple.")
+        parser.add_option("-n", "--processes", dest="processes", help="If provided, split the patients into shards to analyze in parallel with this many worker processes, then merge the results to commit once.")
+        parser.add_option("-k", "--bulkCommit", dest="bulkCommit", action="store_true", help="If set, commit analysis results to the database by streaming them into temporary staging tables and applying set-based update queries, instead of one update query per item pair.")
         (options, args) = parser.parse_args(argv[1:])
 
         log.info("Starting: "+str.join(" ", argv))
@@ -215,6 +281,10 @@ class TripleAssociationAnalysis(AssociationAnalysis):
 
         itemIdSequence = [int(idStr) for idStr in options.itemIdSequence.split(",")];
         virtualItemId = int(options.virtualItemId);
+        if options.processes is not None:
+            self.processes = int(options.processes);
+        if options.bulkCommit:
+            self.bulkCommit = True;
 
         self.analyzePatientItems(patientIds, itemIdSequence, virtualItemId);
 
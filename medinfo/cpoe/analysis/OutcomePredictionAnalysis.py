@@ -14,6 +14,8 @@ Rough approach
 
 import sys, os
 import time;
+import copy;
+from itertools import islice;
 import json;
 from optparse import OptionParser
 from io import StringIO;
@@ -25,7 +27,7 @@ from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.cpoe.Const import AGGREGATOR_OPTIONS, COUNT_PREFIX_OPTIONS;
-from medinfo.cpoe.ItemRecommender import RecommenderQuery;
+from medinfo.cpoe.ItemRecommender import RecommenderQuery, RECOMMEND_BATCH_SIZE;
 from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, BaselineFrequencyRecommender, RandomItemRecommender;
 from .Util import log;
 
@@ -47,6 +49,12 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
         BaseCPOEAnalysis.__init__(self);
 
     def __call__(self, analysisQuery, conn=None):
+        return list(self.iterResultStats(analysisQuery, conn=conn));
+
+    def iterResultStats(self, analysisQuery, conn=None):
+        """Generator version of the primary call function, yielding the result stats for each patient in turn,
+        so callers can stream them to output rather than accumulating the whole cohort's results in memory.
+        """
         extConn = True;
         if conn is None:
             conn = self.connFactory.connection();
@@ -59,49 +67,109 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             # Start building basic recommendation query to use for testing
             recQuery = analysisQuery.baseRecQuery;
 
-            # Start building results data
-            resultsStatDataList = list();
+            # Scorer for just the outcome items, if the recommender supports it (see TargetItemScorer)
+            scorer = None;
             # progress = ProgressDots(50,1,"Patients");
 
-            # Query for all of the order / item data for the test patients.  Load one patient's data at a time
+            # Query for all of the order / item data for the test patients.  Load one patient's data at a time,
+            #   but run the recommendation queries for a batch of patients at a time
             preparer = PreparePatientItems();
-            for patientItemData in preparer.loadPatientItemData(analysisQuery, conn=conn):
-                patientId = patientItemData["patient_id"];
-                (queryItemCountById, scoreByOutcomeId, existsByOutcomeId) = \
-                    self.analyzePatientItems \
-                    (   analysisQuery,
-                        recQuery,
-                        patientId,
-                        patientItemData,
-                        recommender,
-                        conn=conn
-                    );
-
-                if existsByOutcomeId is not None:
-                    # Verify that at least one of the labels is not trivial with the outcome occuring during the query period
-                    nonTrivialOutcomeExists = False;
-                    for outcomeResult in existsByOutcomeId.values():
-                        if outcomeResult != OUTCOME_IN_QUERY:
-                            nonTrivialOutcomeExists = True;
-                    if not analysisQuery.skipIfOutcomeInQuery or nonTrivialOutcomeExists:
-                        # Start aggregating and calculating result stats
-                        resultsStatData = self.prepareResultStats( patientId, queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
-                        resultsStatDataList.append(resultsStatData);
-
-                # progress.Update();
+            patientItemDataIter = iter(preparer.loadPatientItemData(analysisQuery, conn=conn));
+            patientItemDataList = list(islice(patientItemDataIter, RECOMMEND_BATCH_SIZE));
+            while patientItemDataList:
+                # Outcome items may only be known after parsing the first patient data (e.g., from a prepared file)
+                if scorer is None or set(scorer.targetItemIds.tolist()) != set(recQuery.targetItemIds):
+                    scorer = recommender.targetScorer(recQuery, conn=conn);
+
+                if scorer is not None:
+                    recommendedDataList = [None]*len(patientItemDataList);
+                    scoreByOutcomeIdList = self.scorePatientItemBatch(patientItemDataList, scorer);
+                else:
+                    recommendedDataList = self.recommendPatientItemBatch(patientItemDataList, recQuery, recommender, conn=conn);
+                    scoreByOutcomeIdList = [None]*len(patientItemDataList);
+
+                for patientItemData, recommendedData, scoreByOutcomeId in zip(patientItemDataList, recommendedDataList, scoreByOutcomeIdList):
+                    patientId = patientItemData["patient_id"];
+                    (queryItemCountById, scoreByOutcomeId, existsByOutcomeId) = \
+                        self.analyzePatientItems \
+                        (   analysisQuery,
+                            recQuery,
+                            patientId,
+                            patientItemData,
+                            recommender,
+                            conn=conn,
+                            recommendedData=recommendedData,
+                            scoreByOutcomeId=scoreByOutcomeId
+                        );
+
+                    if existsByOutcomeId is not None:
+                        # Verify that at least one of the labels is not trivial with the outcome occuring during the query period
+                        nonTrivialOutcomeExists = False;
+                        for outcomeResult in existsByOutcomeId.values():
+                            if outcomeResult != OUTCOME_IN_QUERY:
+                                nonTrivialOutcomeExists = True;
+                        if not analysisQuery.skipIfOutcomeInQuery or nonTrivialOutcomeExists:
+                            # Start aggregating and calculating result stats
+                            resultsStatData = self.prepareResultStats( patientId, queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
+                            yield resultsStatData;
+
+                    # progress.Update();
+                patientItemDataList = list(islice(patientItemDataIter, RECOMMEND_BATCH_SIZE));
 
             # progress.PrintStatus();
 
-            return resultsStatDataList;
-
         finally:
             if not extConn:
                 conn.close();
 
-    def analyzePatientItems(self, analysisQuery, recQuery, patientId, patientItemData, recommender, conn):
+    def recommendPatientItemBatch(self, patientItemDataList, recQuery, recommender, conn):
+        """Run the recommendation queries for a batch of test patients in one call to the recommender.
+        Returns list of recommendedData parallel to the patientItemDataList
+        (None for patients without outcome data to work with).
+        """
+        patientQueries = list();
+        patientIndexes = list();
+        for iPatient, patientItemData in enumerate(patientItemDataList):
+            if "existsByOutcomeId" in patientItemData:
+                patientQuery = copy.copy(recQuery);
+                patientQuery.queryItemIds = list(patientItemData["queryItemCountById"].keys());
+                patientQueries.append(patientQuery);
+                patientIndexes.append(iPatient);
+
+        recommendedDataList = [None]*len(patientItemDataList);
+        for iPatient, recommendedData in zip(patientIndexes, recommender.recommendBatch(patientQueries, conn=conn)):
+            recommendedDataList[iPatient] = recommendedData;
+        return recommendedDataList;
+
+    def scorePatientItemBatch(self, patientItemDataList, scorer):
+        """Score the outcome items for a batch of test patients in one call to the TargetItemScorer.
+        Returns list of scoreByOutcomeId dictionaries parallel to the patientItemDataList
+        (None for patients without outcome data to work with).
+        """
+        patientIndexes = list();
+        queryItemIdsList = list();
+        for iPatient, patientItemData in enumerate(patientItemDataList):
+            if "existsByOutcomeId" in patientItemData:
+                queryItemIdsList.append(list(patientItemData["queryItemCountById"].keys()));
+                patientIndexes.append(iPatient);
+
+        scoreByOutcomeIdList = [None]*len(patientItemDataList);
+        if queryItemIdsList:
+            (scores, isScored) = scorer.scoreBatch(queryItemIdsList);
+            outcomeIds = scorer.targetItemIds.tolist();
+            for iPatient, patientScores, patientIsScored in zip(patientIndexes, scores.tolist(), isScored.tolist()):
+                scoreByOutcomeId = dict();
+                for outcomeId, score, scored in zip(outcomeIds, patientScores, patientIsScored):
+                    scoreByOutcomeId[outcomeId] = score if scored else DEFAULT_SCORE;
+                scoreByOutcomeIdList[iPatient] = scoreByOutcomeId;
+        return scoreByOutcomeIdList;
+
+    def analyzePatientItems(self, analysisQuery, recQuery, patientId, patientItemData, recommender, conn, recommendedData=None, scoreByOutcomeId=None):
         """Given the primary query data and clinical item list for a given test patient,
         Parse through the item list and run a query to get the top recommended IDs
-        to produce the relevant verify and recommendation item ID sets for comparison
+        to produce the relevant verify and recommendation item ID sets for comparison.
+        If recommendedData already available (e.g., from recommendPatientItemBatch), then will not requery the recommender.
+        If scoreByOutcomeId already available (e.g., from scorePatientItemBatch), then just use those outcome scores.
         """
         if "existsByOutcomeId" not in patientItemData:
             # Apparently not able to extract patient item data.  Return sentinel values
@@ -112,8 +180,12 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
         recQuery.queryItemIds = list(queryItemCountById.keys());
         #recQuery.targetItemIds = queryStartTime.targetItemIds;     # Already established in base construction
 
+        if scoreByOutcomeId is not None:
+            return (queryItemCountById, scoreByOutcomeId, existsByOutcomeId);
+
         # Query for recommended orders / items
-        recommendedData = recommender( recQuery, conn=conn );
+        if recommendedData is None:
+            recommendedData = recommender( recQuery, conn=conn );
 
         """
         # Print component scores to help with debugging degenerate cases
@@ -260,9 +332,6 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             if options.skipIfOutcomeInQuery is not None:
                 query.skipIfOutcomeInQuery = options.skipIfOutcomeInQuery;
 
-            # Run the actual analysis
-            analysisResults = self(query);
-
             # Format the results for output
             outputFilename = None;
             if len(args) > 1:
@@ -272,11 +341,17 @@ class OutcomePredictionAnalysis(BaseCPOEAnalysis):
             # Print comment line with analysis arguments to allow for deconstruction later
             print(COMMENT_TAG, json.dumps({"argv":argv}), file=outputFile);
 
-            colNames = self.analysisHeaders(query);
-            analysisResults.insert(0, RowItemModel(colNames,colNames) );    # Insert a mock record to get a header / label row
-
+            # Run the actual analysis, streaming each patient's results to the output as they are ready
             formatter = TextResultsFormatter( outputFile );
-            formatter.formatResultDicts( analysisResults, colNames );
+            colNames = None;
+            for resultsStatData in self.iterResultStats(query):
+                if colNames is None:
+                    # Outcome items may not be known until the first patient data is parsed (e.g., from a prepared file)
+                    colNames = self.analysisHeaders(query);
+                    formatter.formatTuple(colNames);    # Header / label row
+                formatter.formatResultDict( resultsStatData, colNames );
+            if colNames is None:
+                formatter.formatTuple(self.analysisHeaders(query));
 
         else:
             parser.print_help()
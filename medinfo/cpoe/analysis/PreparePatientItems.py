@@ -20,8 +20,8 @@ from medinfo.common.IteratorFactory import FileFactory;
 from medinfo.db.ResultsFormatter import TextResultsFormatter, TabDictReader;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
-from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.cpoe.ItemRecommender import RecommenderQuery, ItemAssociationRecommender;
+from medinfo.cpoe.PatientTimelineReader import PatientTimelineReader;
 from medinfo.cpoe.TopicModel import TopicModel;
 from medinfo.cpoe.Const import AD_HOC_SECTION;
 from .Util import log;
@@ -182,38 +182,12 @@ class PreparePatientItems(BaseCPOEAnalysis):
         sqlQuery.addOrderBy("pi.patient_id");
         sqlQuery.addOrderBy("pi.item_date");
 
-        # Execute the actual query for patient order / item data
-        cursor = conn.cursor();
-        cursor.execute( str(sqlQuery), tuple(sqlQuery.params) );
-
-        currentPatientId = None;
-        patientItemList = list();
-
-        row = cursor.fetchone();
-        while row is not None:
-            patientItem = RowItemModel( row, rowHeaders );
-            patientId = patientItem["patient_id"];
-
-            if currentPatientId is None:
-                currentPatientId = patientId;
-
-            if patientId != currentPatientId:
-                # Changed patient, yield the existing data for the previous patient after linking any order set data
-                orderSetLinkRow = self.linkOrderSetData(orderSetCursor, orderSetHeaders, orderSetLinkRow, currentPatientId, patientItemList);
-                yield (currentPatientId, patientItemList);
-                # Update our data tracking for the current patient
-                currentPatientId = patientId;
-                patientItemList = list();
-
-            patientItemList.append(patientItem);
-
-            row = cursor.fetchone();
-
-        # Yield / return the last patient data
-        orderSetLinkRow = self.linkOrderSetData(orderSetCursor, orderSetHeaders, orderSetLinkRow, currentPatientId, patientItemList);
-        yield (currentPatientId, patientItemList);
-
-        cursor.close();
+        # Stream the actual query for patient order / item data, one patient at a time
+        reader = PatientTimelineReader(sqlQuery, conn, rowHeaders, connFactory=self.connFactory);
+        for (patientId, patientItemList) in reader:
+            # Link any order set data before yielding the patient's data
+            orderSetLinkRow = self.linkOrderSetData(orderSetCursor, orderSetHeaders, orderSetLinkRow, patientId, patientItemList);
+            yield (patientId, patientItemList);
 
         if orderSetCursor is not None:
             orderSetCursor.close();
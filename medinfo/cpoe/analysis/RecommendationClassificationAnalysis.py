@@ -11,6 +11,8 @@ Rough approach
 
 import sys, os
 import time;
+import copy;
+from itertools import islice;
 from optparse import OptionParser;
 import json;
 from io import StringIO;
@@ -21,9 +23,8 @@ from medinfo.common.Util import stdOpen, ProgressDots, loadJSONDict;
 from medinfo.db.ResultsFormatter import TextResultsFormatter, TabDictReader;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery, RowItemModel;
-from medinfo.db.Model import modelListFromTable, modelDictFromList;
 from medinfo.analysis.ROCPlot import ROCPlot;
-from medinfo.cpoe.ItemRecommender import RecommenderQuery;
+from medinfo.cpoe.ItemRecommender import RecommenderQuery, RECOMMEND_BATCH_SIZE;
 from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, BaselineFrequencyRecommender, RandomItemRecommender;
 from medinfo.cpoe.OrderSetRecommender import OrderSetRecommender;
 from .Util import log;
@@ -63,31 +64,39 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
             resultsStatDataList = list();
             progress = ProgressDots(50,1,"Patients");
 
-            # Query for all of the order / item data for the test patients.  Load one patient's data at a time
+            # Query for all of the order / item data for the test patients.  Load one patient's data at a time,
+            #   but run the recommendation queries for a batch of patients at a time
             preparer = PreparePatientItems();
-            for patientItemData in preparer.loadPatientItemData(analysisQuery, conn=conn):
-                patientId = patientItemData["patient_id"];
-
-                analysisResults = \
-                    self.analyzePatientItems \
-                    (   patientItemData,
-                        analysisQuery,
-                        recQuery,
-                        patientId,
-                        recommender,
-                        preparer,
-                        conn=conn
-                    );
-
-                if analysisResults is not None:
-                    (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData) = analysisResults;  # Unpack results
-                    # Start aggregating and calculating result stats
-                    resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
-                    if "baseItemId" in patientItemData:
-                        analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
-                    resultsStatDataList.append(resultsStatData);
-
-                progress.Update();
+            patientItemDataIter = iter(preparer.loadPatientItemData(analysisQuery, conn=conn));
+            patientItemDataList = list(islice(patientItemDataIter, RECOMMEND_BATCH_SIZE));
+            while patientItemDataList:
+                recommendedDataList = self.recommendPatientItemBatch(patientItemDataList, recQuery, recommender, conn=conn);
+
+                for patientItemData, recommendedData in zip(patientItemDataList, recommendedDataList):
+                    patientId = patientItemData["patient_id"];
+
+                    analysisResults = \
+                        self.analyzePatientItems \
+                        (   patientItemData,
+                            analysisQuery,
+                            recQuery,
+                            patientId,
+                            recommender,
+                            preparer,
+                            conn=conn,
+                            recommendedData=recommendedData
+                        );
+
+                    if analysisResults is not None:
+                        (queryItemCountById, verifyItemCountById, recommendedItemIds, recommendedData) = analysisResults;  # Unpack results
+                        # Start aggregating and calculating result stats
+                        resultsStatData = self.calculateResultStats( patientItemData, queryItemCountById, verifyItemCountById, recommendedItemIds, baseCountByItemId, recQuery, recommendedData );
+                        if "baseItemId" in patientItemData:
+                            analysisQuery.baseItemId = patientItemData["baseItemId"]; # Record something here, so know to report back in result headers
+                        resultsStatDataList.append(resultsStatData);
+
+                    progress.Update();
+                patientItemDataList = list(islice(patientItemDataIter, RECOMMEND_BATCH_SIZE));
             # progress.PrintStatus();
 
             return resultsStatDataList;
@@ -97,10 +106,31 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
                 conn.close();
 
 
-    def analyzePatientItems(self, patientItemData, analysisQuery, recQuery, patientId, recommender, preparer, conn):
+    def recommendPatientItemBatch(self, patientItemDataList, recQuery, recommender, conn):
+        """Run the recommendation queries for a batch of test patients in one call to the recommender.
+        Returns list of recommendedData parallel to the patientItemDataList
+        (None for patients without query data to work with).
+        """
+        patientQueries = list();
+        patientIndexes = list();
+        for iPatient, patientItemData in enumerate(patientItemDataList):
+            if "queryItemCountById" in patientItemData:
+                patientQuery = copy.copy(recQuery);
+                patientQuery.queryItemIds = list(patientItemData["queryItemCountById"].keys());
+                patientQuery.targetItemIds = set(); # Ensure not restricted to some specified outcome target
+                patientQueries.append(patientQuery);
+                patientIndexes.append(iPatient);
+
+        recommendedDataList = [None]*len(patientItemDataList);
+        for iPatient, recommendedData in zip(patientIndexes, recommender.recommendBatch(patientQueries, conn=conn)):
+            recommendedDataList[iPatient] = recommendedData;
+        return recommendedDataList;
+
+    def analyzePatientItems(self, patientItemData, analysisQuery, recQuery, patientId, recommender, preparer, conn, recommendedData=None):
         """Given the primary query data and clinical item list for a given test patient,
         Parse through the item list and run a query to get the top recommended IDs
-        to produce the relevant verify and recommendation item ID sets for comparison
+        to produce the relevant verify and recommendation item ID sets for comparison.
+        If recommendedData already available (e.g., from recommendPatientItemBatch), then will not requery the recommender.
         """
 
         if "queryItemCountById" not in patientItemData:
@@ -113,7 +143,8 @@ class RecommendationClassificationAnalysis(BaseCPOEAnalysis):
         recQuery.targetItemIds = set(); # Ensure not restricted to some specified outcome target
 
         # Query for recommended orders / items
-        recommendedData = recommender( recQuery, conn=conn );
+        if recommendedData is None:
+            recommendedData = recommender( recQuery, conn=conn );
 
         # Customize number of recommendations if comparing against specific order set usage
         self.customizeNumRecommendations(patientItemData, analysisQuery, recQuery, preparer);
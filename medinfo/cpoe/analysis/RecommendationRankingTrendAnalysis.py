@@ -17,6 +17,7 @@ to find the orders that will actually be used.
 
 import sys, os
 import time;
+import copy;
 from optparse import OptionParser
 from io import StringIO;
 from datetime import timedelta;
@@ -31,9 +32,13 @@ from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, BaselineFre
 from .Util import log;
 
 from .BaseCPOEAnalysis import BaseCPOEAnalysis;
-from .BaseCPOEAnalysis import RECOMMENDER_CLASS_LIST, RECOMMENDER_CLASS_BY_NAME, AnalysisQuery;
+from .BaseCPOEAnalysis import RECOMMENDER_CLASS_LIST, RECOMMENDER_CLASS_BY_NAME;
 from .BaseCPOEAnalysis import AGGREGATOR_OPTIONS;
 
+# Number of serial recommendation queries to run through recommendBatch at a time, when the recommender does not support incremental sessions.
+#   Each result list covers every recommendable item (no limit), so keep small to bound the results held in memory at once
+RANK_BATCH_SIZE = 16;
+
 class AnalysisQuery:
     """Simple struct to pass query parameters
     """
@@ -185,6 +190,10 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
         clinical items and perform recommendation queries using the accumulated keyset
         to determine the relative rank and score for each successive item.
         Account for / skip redundant and otherwise excluded items.
+        If the recommender supports incremental sessions, goes through the items in one streaming pass,
+        adding each item to the session's query items after checking its rank.
+        Otherwise, queries for the successive items are run through the recommender in small batches (RANK_BATCH_SIZE),
+        each result list discarded once the item's rank is found in it.
         """
         clinicalItemIdSet = set(clinicalItemIdList);
         numPatientItems = len(clinicalItemIdSet);
@@ -192,30 +201,44 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
         numQueryItems = 0;
         queryItemIds = set();
 
+        session = recommender.session(recQuery, conn=conn);
+        if session is not None:
+            iRecItem = 0;
+            for (iItem, clinicalItemId) in enumerate(clinicalItemIdList):
+                if self.isItemRecommendable(clinicalItemId, queryItemIds, recQuery, categoryIdByItemId):
+                    # Rank based on accumulated key data thus far,
+                    #   to see how well able to predict / rank / score this next clinical item
+                    (recRank, recScore) = session.rank(clinicalItemId);
+
+                    yield (clinicalItemId, iItem, iRecItem, recRank, recScore);
+
+                    iRecItem += 1;  # Track that we recorded information on one more recommended item
+                    progress.Update();
+
+                queryItemIds.add(clinicalItemId);   # Accumulate initial query set as progress
+                session.addItem(clinicalItemId);
+
+                if analysisQuery.queryItemMax is not None and iRecItem >= analysisQuery.queryItemMax:
+                    break;
+            return;
+
+        itemQueries = list();   # (clinicalItemId, iItem, iRecItem, itemQuery) for each item to find in the recommendations, until the batch is full
         iRecItem = 0;   # Separately track number of items that can actually be recommended (skip repeats and other exclusions)
         for (iItem, clinicalItemId) in enumerate(clinicalItemIdList):
             if self.isItemRecommendable(clinicalItemId, queryItemIds, recQuery, categoryIdByItemId):
                 # Query based on accumulated key data thus far,
                 #   to see how well able to predict / rank / score this next clinical item
-                recQuery.queryItemIds = queryItemIds;
-                recQuery.limit = None;  # No limitation because trying to find the next item whereever it may be in the list
-
-                recommendedData = recommender( recQuery, conn=conn );
-
-                # Find the next clinical item in the recommended list
-                recRank = 0;
-                recScore = None;
-                for iRec, recommendationModel in enumerate(recommendedData):
-                    recRank = iRec+1;   # Start rankings at 1, not 0
-                    if recommendationModel["clinical_item_id"] == clinicalItemId:
-                        # Found the match, note the respective recommendation statistics
-                        recScore = recommendationModel["score"];
-                        break;  # Don't need to look anymore
-
-                yield (clinicalItemId, iItem, iRecItem, recRank, recScore);
+                itemQuery = copy.copy(recQuery);
+                itemQuery.queryItemIds = set(queryItemIds);
+                itemQuery.limit = None;  # No limitation because trying to find the next item whereever it may be in the list
+                itemQueries.append( (clinicalItemId, iItem, iRecItem, itemQuery) );
 
                 iRecItem += 1;  # Track that we recorded information on one more recommended item
-                progress.Update();
+
+                if len(itemQueries) >= RANK_BATCH_SIZE:
+                    for rankData in self.rankItemQueries(itemQueries, recommender, progress, conn):
+                        yield rankData;
+                    itemQueries = list();
 
             queryItemIds.add(clinicalItemId);   # Accumulate initial query set as progress
 
@@ -224,6 +247,35 @@ class RecommendationRankingTrendAnalysis(BaseCPOEAnalysis):
                 #   or even potentially damaging to execution memory
                 break;
 
+        for rankData in self.rankItemQueries(itemQueries, recommender, progress, conn):
+            yield rankData;
+
+    def rankItemQueries(self, itemQueries, recommender, progress, conn):
+        """Run a batch of (clinicalItemId, iItem, iRecItem, itemQuery) serial recommendation queries
+        and yield the (clinicalItemId, iItem, iRecItem, recRank, recScore) rank of each clinical item in its recommendations.
+        """
+        if not itemQueries:
+            return;
+        recommendedDataList = recommender.recommendBatch( [itemQuery for (clinicalItemId, iItem, iRecItem, itemQuery) in itemQueries], conn=conn );
+
+        for iQuery, (clinicalItemId, iItem, iRecItem, itemQuery) in enumerate(itemQueries):
+            recommendedData = recommendedDataList[iQuery];
+            recommendedDataList[iQuery] = None; # Done with these results once found the item's rank
+
+            # Find the next clinical item in the recommended list
+            recRank = 0;
+            recScore = None;
+            for iRec, recommendationModel in enumerate(recommendedData):
+                recRank = iRec+1;   # Start rankings at 1, not 0
+                if recommendationModel["clinical_item_id"] == clinicalItemId:
+                    # Found the match, note the respective recommendation statistics
+                    recScore = recommendationModel["score"];
+                    break;  # Don't need to look anymore
+
+            yield (clinicalItemId, iItem, iRecItem, recRank, recScore);
+
+            progress.Update();
+
     def isItemRecommendable(self, clinicalItemId, queryItemIds, recQuery, categoryIdByItemId):
         """Decide if the next clinical item could even possibly appear
         in the recommendation list.  (Because if not, no point in trying to
@@ -306,6 +306,32 @@ class TestOutcomePredictionAnalysis(DBTestCase):
         textOutput = StringIO(sys.stdout.getvalue());
         self.assertEqualStatResultsTextOutput(expectedResults, textOutput, colNames);
 
+    def test_targetScorer(self):
+        # Batch scoring of just the outcome items should give the same scores as complete recommender queries
+        recommender = ItemAssociationRecommender();
+        recQuery = RecommenderQuery();
+        recQuery.targetItemIds = set([-33,-32,-31,-30]);
+        recQuery.maxRecommendedId = 0; # Restrict to test data
+
+        scorer = recommender.targetScorer(recQuery);
+        self.assertNotEqual(None, scorer);
+
+        queryItemIdsList = [[-1],[-2,-4],[-1,-5,-9],[-999]];  # Last one has no associations, so should get default scores
+        (scores, isScored) = scorer.scoreBatch(queryItemIdsList);
+        for queryItemIds, queryScores, queryIsScored in zip(queryItemIdsList, scores, isScored):
+            recQuery.queryItemIds = set(queryItemIds);
+            expectedScoreById = dict();
+            for recommendationModel in recommender(recQuery):
+                expectedScoreById[recommendationModel["clinical_item_id"]] = recommendationModel[recQuery.sortField];
+            for itemId, score, scored in zip(scorer.targetItemIds, queryScores, queryIsScored):
+                self.assertEqual(itemId in expectedScoreById, scored);
+                if scored:
+                    self.assertAlmostEqual(expectedScoreById[itemId], score, 5);
+
+        # Limited results may exclude some of the targets, so cannot score them independently
+        recQuery.limit = 2;
+        self.assertEqual(None, recommender.targetScorer(recQuery));
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
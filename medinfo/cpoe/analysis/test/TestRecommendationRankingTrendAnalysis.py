@@ -16,7 +16,8 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
 from medinfo.cpoe.ItemRecommender import RecommenderQuery;
-from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, BaselineFrequencyRecommender;
+from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, SparseItemAssociationRecommender, BaselineFrequencyRecommender;
+from medinfo.cpoe.analysis import RecommendationRankingTrendAnalysis as RankingTrendModule;
 from medinfo.cpoe.analysis.RecommendationRankingTrendAnalysis import RecommendationRankingTrendAnalysis, AnalysisQuery;
 from medinfo.cpoe.DataManager import DataManager;
 
@@ -176,6 +177,33 @@ class TestRecommendationRankingTrendAnalysis(DBTestCase):
         analysisResults = self.analyzer(analysisQuery);
         self.assertEqualTable(expectedResults, analysisResults, 3);
 
+        # Same results when the serial recommendation queries are split across several batches
+        origBatchSize = RankingTrendModule.RANK_BATCH_SIZE;
+        RankingTrendModule.RANK_BATCH_SIZE = 3;
+        try:
+            analysisResults = self.analyzer(analysisQuery);
+        finally:
+            RankingTrendModule.RANK_BATCH_SIZE = origBatchSize;
+        self.assertEqualTable(expectedResults, analysisResults, 3);
+
+        # Same results from the incremental session of the sparse recommender
+        analysisQuery.recommender = SparseItemAssociationRecommender();
+        analysisResults = self.analyzer(analysisQuery);
+        self.assertEqualTable(expectedResults, analysisResults, 3);
+
+        # Session ranks identical to the batch query ranks, including the order of tied scores
+        for (sortField, sortReverse) in [("P-YatesChi2-NegLog",True), ("P-YatesChi2-NegLog",False), ("PPV",True)]:
+            analysisQuery.baseRecQuery.sortField = sortField;
+            analysisQuery.baseRecQuery.sortReverse = sortReverse;
+            analysisQuery.recommender = SparseItemAssociationRecommender();
+            sessionResults = self.analyzer(analysisQuery);
+            analysisQuery.recommender.session = lambda query, conn=None: None;    # Not supported, so use the batch queries
+            batchResults = self.analyzer(analysisQuery);
+            self.assertEqualTable(batchResults, sessionResults);
+        analysisQuery.baseRecQuery.sortField = RecommenderQuery().sortField;
+        analysisQuery.baseRecQuery.sortReverse = RecommenderQuery().sortReverse;
+        analysisQuery.recommender = ItemAssociationRecommender();
+
         # Repeat, but put a limit on maximum number of query items and recommendations we want analyzed
         analysisQuery.queryItemMax = 2;
         expectedResults = \
@@ -3,7 +3,8 @@
 
 import sys, os
 from io import StringIO
-from datetime import datetime;
+import random;
+from datetime import datetime, timedelta;
 import unittest
 
 from .Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
@@ -12,9 +13,56 @@ from .Util import log;
 from medinfo.db.test.Util import DBTestCase;
 
 from medinfo.db import DBUtil
+from medinfo.db.ConnectionPool import ConnectionPool;
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
 from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
+from medinfo.cpoe.AssociationCountBuffer import AssociationCountBuffer;
+
+def updateItemAssociationsBufferPairwise(analyzer, patientItemList, updateBuffer, analysisOptions, linkedItemIdsByBaseId=None):
+    """Reference implementation of AssociationAnalysis.updateItemAssociationsBuffer,
+    checking every (item1, item2) pair of the patient timeline in a nested loop (the original implementation).
+    """
+    # Keep track of which items to mark as newly analyzed
+    newlyAnalyzedPatientItemIdSet = set();
+
+    # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
+    subsequentItemIds = set();
+    # Keep track of all item pairs encountered to avoid counting patient level duplicates
+    encounterIdPairsByItemIdPair = dict();
+
+    for patientItem1 in patientItemList:
+        subsequentItemIds.clear();
+        for patientItem2 in patientItemList:
+            itemIdPair = (patientItem1["clinical_item_id"], patientItem2["clinical_item_id"]);
+            encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+
+            # Verify is not a previously composite linked item pair, in which case no meaningful asssociation stats to calculate
+            #   and that the item dates are in non-negative direction
+            isPairToAnalyze = analyzer.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId );
+            if isPairToAnalyze:
+                if (patientItem1["analyze_date"] is None or patientItem2["analyze_date"] is None):
+                    # Record the stat update if this pair has not already been analyzed/recorded before
+                    isNewSubsequentItem = patientItem2["clinical_item_id"] not in subsequentItemIds;   # Track repeats
+                    isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
+                    isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
+
+                    analyzer.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, analysisOptions );
+
+                    if patientItem1["analyze_date"] is None:
+                        newlyAnalyzedPatientItemIdSet.add(patientItem1["patient_item_id"]);
+                    if patientItem2["analyze_date"] is None:
+                        newlyAnalyzedPatientItemIdSet.add(patientItem2["patient_item_id"]);
+                subsequentItemIds.add(patientItem2["clinical_item_id"]);
+
+                if itemIdPair not in encounterIdPairsByItemIdPair:
+                    encounterIdPairsByItemIdPair[itemIdPair] = set();
+                encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+
+    # Record this analysis date to any unmarked records
+    if "analyzedPatientItemIds" not in updateBuffer:
+        updateBuffer["analyzedPatientItemIds"] = set();
+    updateBuffer["analyzedPatientItemIds"].update(newlyAnalyzedPatientItemIdSet);
 
 class TestAssociationAnalysis(DBTestCase):
     def setUp(self):
@@ -94,6 +142,7 @@ class TestAssociationAnalysis(DBTestCase):
         self.bufferFilename = "updateBufferTemp.txt"
 
         self.analyzer = AssociationAnalysis();  # Instance to test on
+        self.connPool = None;   # Close any pooled connections before the test database is dropped
 
     def tearDown(self):
         """Restore state from any setUp or test steps"""
@@ -112,6 +161,8 @@ class TestAssociationAnalysis(DBTestCase):
             if filename.startswith(self.bufferFilename):
                 os.remove(os.path.join(dirname,filename));
 
+        if self.connPool is not None:
+            self.connPool.close();
         DBTestCase.tearDown(self);
 
     def test_analyzePatientItems_commandLine_bufferFile(self):
@@ -236,6 +287,230 @@ class TestAssociationAnalysis(DBTestCase):
         associationStats = DBUtil.execute(associationQuery);
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
+    def test_analyzePatientItems_parallel(self):
+        # Run the association analysis split across multiple processes and verify same results as a serial run
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any,
+                patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.processes = 2;
+
+        # Pooled connection source (with thread locks that cannot be pickled) should not need to be sent to the worker processes
+        self.connPool = ConnectionPool(DBUtil.openConnection);
+        self.analyzer.connFactory = DBUtil.ConnectionFactory(pool=self.connPool);
+
+        log.debug("Use incremental update, including date filters to start.");
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222, -33333];
+        analysisOptions.startDate = datetime(2000,1,9);
+        analysisOptions.endDate = datetime(2000,2,11);
+        self.analyzer.analyzePatientItems( analysisOptions );
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        log.debug("Use incremental update, only doing the update based on a part of the data.");
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+                [-11, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7,-11,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+                [ -7, -7,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7, -6,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+
+                [ -6,-11,   1, 1, 1, 2, 2, 2, 2, 2, 172800.0, 29859840000.0],
+                [ -6, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_analyzePatientItems_bulkCommit(self):
+        # Run the association analysis committing results through staging tables and set-based updates and verify same results as per item pair updates
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any,
+                patient_time_diff_sum, patient_time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.bulkCommit = True;
+
+        log.debug("Use incremental update, including date filters to start.");
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222, -33333];
+        analysisOptions.startDate = datetime(2000,1,9);
+        analysisOptions.endDate = datetime(2000,2,11);
+        self.analyzer.analyzePatientItems( analysisOptions );
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6,-11,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        log.debug("Use incremental update, only doing the update based on a part of the data.");
+        analysisOptions = AnalysisOptions();
+        analysisOptions.patientIds = [-22222, -33333];
+        self.analyzer.analyzePatientItems( analysisOptions );
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+                [-11, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [-11, -6,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7,-11,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+                [ -7, -7,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [ -7, -6,   0, 0, 0, 1, 1, 1, 1, 1,  345600.0, 119439360000.0],
+
+                [ -6,-11,   1, 1, 1, 2, 2, 2, 2, 2, 172800.0, 29859840000.0],
+                [ -6, -7,   0, 0, 0, 0, 0, 0, 0, 0,  0.0, 0.0],
+                [ -6, -6,   2, 2, 2, 2, 2, 2, 2, 2,  0.0, 0.0],
+            ];
+
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_updateBuffer_mergeDecay(self):
+        # Verify the compact association count buffer operations against equivalent legacy dictionary buffer contents
+        bufferOne = self.analyzer.makeUpdateBuffer();
+        bufferOne["associationCounts"].increment((-11,-6), "count_any", 2);
+        bufferOne["associationCounts"].increment((-11,-6), "time_diff_sum", 3600);
+        bufferOne["associationCounts"].increment((-6,-11), "count_any");
+        bufferOne["nAssociations"] = len(bufferOne["associationCounts"]);
+
+        bufferTwo = \
+            {   "analyzedPatientItemIds": set([-1,-2]),
+                "nAssociations": 2,
+                "incrementDataByItemIdPair":    # Legacy format, as may be loaded from older JSON buffer files
+                    {   "(-11, -6)": {"count_any": 1, "patient_count_any": 1},
+                        "(-7, -6)": {"count_3600": 4},
+                    },
+            };
+
+        mergedBuffer = self.analyzer.mergeBuffers(bufferOne, bufferTwo);
+        self.assertEqual(3, mergedBuffer["nAssociations"]);
+        self.assertEqual(set([-1,-2]), mergedBuffer["analyzedPatientItemIds"]);
+
+        associationCounts = mergedBuffer["associationCounts"];
+        self.assertEqual({"count_any": 3, "time_diff_sum": 3600, "patient_count_any": 1}, associationCounts.incrementData((-11,-6)) );
+        self.assertEqual({"count_any": 1}, associationCounts.incrementData((-6,-11)) );
+        self.assertEqual({"count_3600": 4}, associationCounts.incrementData((-7,-6)) );
+
+        self.analyzer.bufferDecay(mergedBuffer, 0.5);
+        self.assertEqual({"count_any": 1.5, "time_diff_sum": 1800, "patient_count_any": 0.5}, associationCounts.incrementData((-11,-6)) );
+        self.assertEqual({"count_3600": 2}, associationCounts.incrementData((-7,-6)) );
+
+        # Round trip through the legacy str(tuple) keyed format
+        legacyData = associationCounts.toIncrementData();
+        self.assertEqual({"count_3600": 2}, legacyData["(-7, -6)"]);
+        self.assertEqual(legacyData, AssociationCountBuffer.fromIncrementData(legacyData).toIncrementData() );
+
+    def test_bufferFile_merge(self):
+        # Save update buffers to files in the binary and legacy JSON formats, then reload and merge them by filename prefix
+        bufferOne = self.analyzer.makeUpdateBuffer();
+        bufferOne["associationCounts"].increment((-11,-6), "count_any", 2);
+        bufferOne["associationCounts"].increment((-6,-11), "count_3600", 1);
+        bufferOne["analyzedPatientItemIds"].update([-1,-2]);
+        self.analyzer.saveBufferToFile("%s.1.counts.bin" % self.bufferFilename, bufferOne);
+
+        bufferTwo = self.analyzer.makeUpdateBuffer();
+        bufferTwo["associationCounts"].increment((-11,-6), "count_any", 3);
+        bufferTwo["associationCounts"].increment((-11,-6), "time_diff_sum", 60);
+        bufferTwo["analyzedPatientItemIds"].update([-3]);
+        self.analyzer.saveBufferToFile("%s.2.counts.bin" % self.bufferFilename, bufferTwo);
+
+        bufferThree = self.analyzer.makeUpdateBuffer();
+        bufferThree["associationCounts"].increment((-7,-6), "count_any", 1);
+        bufferThree["analyzedPatientItemIds"].update([-4]);
+        self.analyzer.saveBufferToFile("%s.3.json.gz" % self.bufferFilename, bufferThree);
+
+        updateBuffer = self.analyzer.loadUpdateBufferFromFile(self.bufferFilename);
+        self.assertEqual(3, updateBuffer["nAssociations"]);
+        self.assertEqual(set([-1,-2,-3,-4]), updateBuffer["analyzedPatientItemIds"]);
+        associationCounts = updateBuffer["associationCounts"];
+        self.assertEqual({"count_any": 5, "time_diff_sum": 60}, associationCounts.incrementData((-11,-6)) );
+        self.assertEqual({"count_3600": 1}, associationCounts.incrementData((-6,-11)) );
+        self.assertEqual({"count_any": 1}, associationCounts.incrementData((-7,-6)) );
+
+        # Streaming merge of just the binary files into a single file
+        mergeFilename = "%s.merged.counts.bin" % self.bufferFilename;
+        self.analyzer.main(["AssociationAnalysis.py","-b",self.bufferFilename,"-m",mergeFilename]);
+        updateBuffer = self.analyzer.loadUpdateBufferFromFile(mergeFilename);
+        self.assertEqual(2, updateBuffer["nAssociations"]);
+        self.assertEqual(set([-1,-2,-3]), updateBuffer["analyzedPatientItemIds"]);
+        self.assertEqual({"count_any": 5, "time_diff_sum": 60}, updateBuffer["associationCounts"].incrementData((-11,-6)) );
+
+    def test_updateItemAssociationsBuffer_longTimeline(self):
+        # Verify the sorted sweep counting of item pairs yields the same results as checking every pair
+        #   on a long (e.g., ICU stay) patient timeline
+        randomGen = random.Random(1234);
+        patientItemList = list();
+        for iItem in range(800):
+            patientItem = \
+                {   "patient_item_id": -iItem-1,
+                    "patient_id": -11111,
+                    "encounter_id": randomGen.choice([-111,-112,-113]),
+                    "clinical_item_id": randomGen.randint(-200,-1),
+                    "item_date": datetime(2000,1,1) + timedelta(seconds=randomGen.choice([0,3600,86400])*randomGen.randint(0,100)),
+                    "analyze_date": randomGen.choice([None,None,datetime(2000,6,1)]),
+                };
+            patientItemList.append(patientItem);
+        patientItemList.sort(key=lambda patientItem: patientItem["item_date"]);
+        linkedItemIdsByBaseId = {-6: set([-4,-2]), -4: set([-2])};
+
+        sweepBuffer = self.analyzer.makeUpdateBuffer();
+        self.analyzer.updateItemAssociationsBuffer(patientItemList, sweepBuffer, AnalysisOptions(), linkedItemIdsByBaseId);
+
+        pairwiseBuffer = self.analyzer.makeUpdateBuffer();
+        updateItemAssociationsBufferPairwise(self.analyzer, patientItemList, pairwiseBuffer, AnalysisOptions(), linkedItemIdsByBaseId);
+
+        self.assertEqual(pairwiseBuffer["nAssociations"], sweepBuffer["nAssociations"]);
+        self.assertEqual(pairwiseBuffer["analyzedPatientItemIds"], sweepBuffer["analyzedPatientItemIds"]);
+        pairwiseData = pairwiseBuffer["associationCounts"].toIncrementData();
+        sweepData = sweepBuffer["associationCounts"].toIncrementData();
+        self.assertEqual(pairwiseData, sweepData);
+
     def test_analyzePatientItems(self):
         # Run the association analysis against the mock test data above and verify
         #   expected stats afterwards.
@@ -14,7 +14,8 @@ from medinfo.db.test.Util import DBTestCase;
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
-from medinfo.cpoe.DataManager import DataManager;
+from medinfo.common.DataCache import DataCache;
+from medinfo.cpoe.DataManager import DataManager, MODEL_CACHE_KEYS;
 
 class TestDataManager(DBTestCase):
     def setUp(self):
@@ -685,6 +686,50 @@ class TestDataManager(DBTestCase):
         self.assertEqual(0, cacheCount2);
         self.assertEqual(0, itemCountSummary2);
 
+    def test_linkIndex(self):
+        linkPairs = [(-16,-15), (-15,-14), (-15,-13), (-12,-13)];
+        for (clinicalItemId, linkedItemId) in linkPairs:
+            DBUtil.findOrInsertItem("clinical_item_link", {"clinical_item_id": clinicalItemId, "linked_item_id": linkedItemId});
+
+        # Multi-level links flattened to direct links for any parent items
+        linkIndex = self.analyzer.loadLinkedItemIdsByBaseId(maxItemId=0);
+        expectedLinks = {-16: set([-15,-14,-13]), -15: set([-14,-13]), -12: set([-13])};
+        self.assertEqual(expectedLinks, linkIndex);
+        self.assertTrue(linkIndex.isLinked(-16,-13));
+        self.assertFalse(linkIndex.isLinked(-13,-16));
+        self.assertTrue(linkIndex.isLinkedPair(-13,-16));
+        self.assertFalse(linkIndex.isLinkedPair(-12,-14));
+
+        # Unchanged links reuse the cached index, but any link changes are picked up
+        self.assertTrue(linkIndex is self.analyzer.loadLinkedItemIdsByBaseId(maxItemId=0));
+        DBUtil.findOrInsertItem("clinical_item_link", {"clinical_item_id": -14, "linked_item_id": -10});
+        linkIndex = self.analyzer.loadLinkedItemIdsByBaseId(maxItemId=0);
+        self.assertEqual(set([-15,-14,-13,-10]), linkIndex[-16]);
+        self.assertEqual(set([-10]), linkIndex[-14]);
+
+        # Cyclic links cannot be resolved
+        DBUtil.findOrInsertItem("clinical_item_link", {"clinical_item_id": -10, "linked_item_id": -16});
+        self.assertRaises(ValueError, self.analyzer.loadLinkedItemIdsByBaseId, 0);
+
+    def test_dataCacheInvalidation(self):
+        dataManager = DataManager();
+        dataManager.dataCache = DataCache(defaultTags=MODEL_CACHE_KEYS);
+        dataManager.dataCache["modelQueryResults"] = [[1,2,3]];
+        dataManager.dataCache.set("otherResults", [[4,5,6]], tags=["otherTag"]);
+
+        # Writing (re)calculated data_cache values does not invalidate the in memory entries that depend on them
+        dataManager.setCacheData("clinicalItemCountsUpdated", "True");
+        dataManager.setCacheData("analyzedPatientCount", "3");
+        self.assertEqual("3", dataManager.getCacheData("analyzedPatientCount"));
+        self.assertEqual([[1,2,3]], dataManager.dataCache.get("modelQueryResults"));
+        self.assertEqual(0, dataManager.dataCache.invalidations);
+
+        # Clearing a value signals the model changed, so only the entries tagged with that key are discarded
+        dataManager.clearCacheData("analyzedPatientCount");
+        self.assertEqual(None, dataManager.getCacheData("analyzedPatientCount"));
+        self.assertEqual(None, dataManager.dataCache.get("modelQueryResults"));
+        self.assertEqual([[4,5,6]], dataManager.dataCache.get("otherResults"));
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
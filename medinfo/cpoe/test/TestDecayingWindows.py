@@ -17,7 +17,7 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.cpoe.DecayingWindows import DecayingWindows, DecayAnalysisOptions;
 #from medinfo.cpoe.ResetModel import ResetModel;
-from medinfo.cpoe.DataManager import DataManager;
+from medinfo.cpoe.DataManager import DataManager, DECAY_SCALE_CACHE_KEY;
 
 from medinfo.cpoe.AssociationAnalysis import AssociationAnalysis, AnalysisOptions;
 
@@ -112,6 +112,7 @@ class TestDecayingWindows(DBTestCase):
         DBUtil.execute("delete from patient_item where patient_item_id < 0");
         DBUtil.execute("delete from clinical_item where clinical_item_id < 0");
         DBUtil.execute("delete from clinical_item_category where clinical_item_category_id in (%s)" % str.join(",", self.clinicalItemCategoryIdStrList) );
+        self.dataManager.clearCacheData(DECAY_SCALE_CACHE_KEY);
 
         # Purge temporary buffer files. May not match exact name if modified for other purpose
         for filename in os.listdir("."):
@@ -371,6 +372,70 @@ class TestDecayingWindows(DBTestCase):
         self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
 
 
+    def test_lazyDecay(self):
+        # Same as test_decayingWindows, but decay by just tracking a global scale factor, rather than rewriting stored counts
+        associationQuery = \
+            """
+            select
+                clinical_item_id, subsequent_item_id,
+                patient_count_0, patient_count_3600, patient_count_86400, patient_count_604800,
+                patient_count_2592000, patient_count_7776000, patient_count_31536000,
+                patient_count_any
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        decayAnalysisOptions = DecayAnalysisOptions()
+        decayAnalysisOptions.startD = datetime(2000,1,9)
+        decayAnalysisOptions.endD = datetime(2000,2,11)
+        decayAnalysisOptions.windowLength = 10
+        decayAnalysisOptions.decay = 0.9
+        decayAnalysisOptions.delta = timedelta(weeks=4)
+        decayAnalysisOptions.patientIds = [-22222, -33333]
+        decayAnalysisOptions.lazyDecay = True;
+
+        self.decayAnalyzer.decayAnalyzePatientItems (decayAnalysisOptions)
+
+        # Two deltas, so two decays recorded in the scale factor
+        decayScale = self.dataManager.loadAssociationDecayScale();
+        self.assertAlmostEqual(0.81, decayScale);
+
+        expectedAssociationStats = \
+            [
+                [-11,-11,   1.9, 1.9, 1.9, 1.9, 1.9, 0, 0, 1.9],
+                [-11, -9,   0.0, 0.0, 0.9, 0.9, 0.9, 0, 0, 0.9],
+                [-11, -8,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [-11, -6,   0.9, 0.9, 0.9, 0.9, 0.9, 0, 0, 0.9],
+                [ -9,-11,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -9, -9,   0.9, 0.9, 0.9, 0.9, 0.9, 0, 0, 0.9],
+                [ -9, -8,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -9, -6,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -8,-11,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -8, -9,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -8, -8,   0.9, 0.9, 0.9, 0.9, 0.9, 0, 0, 0.9],
+                [ -8, -6,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -6,-11,   0.9, 0.9, 0.9, 1.9, 1.9, 0, 0, 1.9],
+                [ -6, -9,   0.0, 0.0, 0.9, 0.9, 0.9, 0, 0, 0.9],
+                [ -6, -8,   0.0, 0.0, 0.0, 0.0, 0.0, 0, 0, 0.0],
+                [ -6, -6,   1.9, 1.9, 1.9, 1.9, 1.9, 0, 0, 1.9],
+            ];
+
+        # Stored counts are pre-scaled, so apply the current scale factor to get the actual decayed values
+        associationStats = DBUtil.execute(associationQuery)
+        for row in associationStats:
+            for iCol in range(2, len(row)):
+                row[iCol] *= decayScale;
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+        # Denormalized item counts should reflect the decayed values as well
+        self.dataManager.updateClinicalItemCounts();
+        itemCount = DBUtil.execute("select patient_count from clinical_item where clinical_item_id = -6")[0][0];
+        self.assertAlmostEqual(1.9, itemCount, 3);
+
     def test_resetModel(self):
         associationQuery = \
             """
@@ -2,6 +2,7 @@
 """Test case for respective module in application package"""
 
 import sys, os
+import json;
 from io import StringIO
 from datetime import datetime, timedelta;
 import unittest
@@ -17,9 +18,11 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.ResultsFormatter import TabDictReader;
 
-from medinfo.cpoe.DataManager import DataManager;
-from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, RecommenderQuery;
+from medinfo.cpoe.DataManager import DataManager, ASSOCIATION_MATRIX_CACHE_KEY;
+from medinfo.cpoe.ItemRecommender import ItemAssociationRecommender, SparseItemAssociationRecommender, RecommenderQuery;
 from medinfo.cpoe.ItemRecommender import SIMULATED_PATIENT_COUNT;
+from medinfo.cpoe.TopKNeighborIndex import TopKNeighborIndex;
+from medinfo.cpoe.RecommenderMetrics import RecommenderMetrics;
 
 DELTA_HOUR = timedelta(0,60*60);
 
@@ -306,6 +309,30 @@ class TestItemRecommender(DBTestCase):
         recommendedData = self.recommender( query );
         self.assertEqualRecommendedData( expectedData, recommendedData, query );
 
+    def test_aggregateCounts_baselineAdjustment(self):
+        # Bayes aggregation of component counts, including fractional (decayed) baseline counts that should be used as is,
+        #   and zero baseline counts (associations but no baseline count of the target item) that should be adjusted rather than divide by zero
+        query = RecommenderQuery();
+        for (nB, expectedProduct) in [(0.25, 32.0), (0.0, 8.0)]:
+            componentResultsById = \
+                {   -1: {"nAB": 2.0, "nA": 4.0, "nB": nB, "N": 10.0},
+                    -2: {"nAB": 1.0, "nA": 5.0, "nB": nB, "N": 10.0},
+                };
+
+            query.aggregationMethod = "NaiveBayes";
+            aggregateResult = {"componentResultsById": componentResultsById};
+            ItemAssociationRecommender.populateAggregateCounts(aggregateResult, query);
+            self.assertAlmostEqual( expectedProduct, aggregateResult["product(nAB/nB)"], 5 );
+            self.assertAlmostEqual( expectedProduct*nB, aggregateResult["nAB"], 5 );
+            self.assertAlmostEqual( 2.0, aggregateResult["nA"], 5 );
+
+            query.aggregationMethod = "SerialBayes";
+            aggregateResult = {"componentResultsById": componentResultsById};
+            ItemAssociationRecommender.populateAggregateCounts(aggregateResult, query);
+            self.assertAlmostEqual( expectedProduct, aggregateResult["Product(nAB/nB)"], 5 );
+            self.assertAlmostEqual( expectedProduct*nB, aggregateResult["nAB"], 5 );
+            self.assertAlmostEqual( (2.0/(10.0-nB))*(4.0/(10.0-nB)), aggregateResult["Product((nA-nAB)/(N-nB))"], 5 );
+
     def assertEqualRecommendedData(self, expectedData, recommendedData, query):
         """Run assertEqualGeneral on the key components of the contents of the recommendation data.
         Don't necessarily care about the specific numbers that come out of the recommendations,
@@ -406,6 +433,21 @@ class TestItemRecommender(DBTestCase):
         textOutput = StringIO(sys.stdout.getvalue());
         self.assertEqualRecommendedDataStatsTextOutput( expectedData, textOutput, headers );
 
+        log.debug("Same query, also writing out the call metrics to a file.");
+        metricsFilename = "TestItemRecommender.metrics.json";
+        sys.stdout = StringIO();    # Redirect stdout output to collect test results
+        argv = ["ItemRecommender.py","-M",metricsFilename,"maxRecommendedId=0&queryItemIds=-6&countPrefix=&resultCount=3&sortField=oddsRatio","-"];
+        try:
+            self.recommender.main(argv);
+            with open(metricsFilename) as metricsFile:
+                metricsData = json.load(metricsFile);
+        finally:
+            if os.path.exists(metricsFilename):
+                os.remove(metricsFilename);
+        self.assertEqual( 1, metricsData["calls"] );
+        textOutput = StringIO(sys.stdout.getvalue());
+        self.assertEqualRecommendedDataStatsTextOutput( expectedData, textOutput, headers );
+
     def assertEqualRecommendedDataStatsTextOutput(self, expectedData, textOutput, headers):
         """Run assertEqualGeneral on the key components of the contents of the recommendation data.
         In this case, we do want to verify actual score / stat values match
@@ -490,6 +532,249 @@ class TestItemRecommender(DBTestCase):
         self.assertEqualRecommendedData( baselineData, newData, query );
         self.assertEqual( baselineQueryCount, newQueryCount );  # Expect no queries for subsets
 
+    def test_sparseRecommender(self):
+        # Verify the in memory sparse matrix recommender yields the same results as the standard database query version
+        sparseRecommender = SparseItemAssociationRecommender();
+        sparseRecommender.dataManager.dataCache = dict();
+
+        query = RecommenderQuery();
+        query.countPrefix = "patient_";
+        query.limit = 3;
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+        for queryItemIds in [set([-2,-5]), set([-2]), set([-5,-6]), set([-1,-2,-3,-4,-5,-6])]:
+            query.queryItemIds = queryItemIds;
+            for aggregationMethod in ["weighted","unweighted","SerialBayes","NaiveBayes"]:
+                query.aggregationMethod = aggregationMethod;
+                for invertQuery in [False, True]:
+                    query.invertQuery = invertQuery;
+                    baselineData = self.recommender( query );
+                    sparseData = sparseRecommender( query );
+                    self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in sparseData] );
+                    for baselineItem, sparseItem in zip(baselineData, sparseData):
+                        self.assertAlmostEqual( baselineItem["score"], sparseItem["score"], 5 );
+                        self.assertEqual( set(baselineItem["componentResultsById"].keys()), set(sparseItem["componentResultsById"].keys()) );
+
+        # Repeat queries should be served from the cached matrix without further database queries
+        queryCount = sparseRecommender.dataManager.queryCount;
+        query.queryItemIds = set([-2,-5]);
+        query.invertQuery = False;
+        sparseRecommender( query );
+        self.assertEqual( queryCount, sparseRecommender.dataManager.queryCount );
+
+    def test_lazyDecayScale(self):
+        # Verify the standard database query version applies a lazy decay scale to the association counts,
+        #   consistent with the (scaled) baseline item counts and the sparse matrix recommender
+        self.dataManager.setAssociationDecayScale(0.5);
+        try:
+            sparseRecommender = SparseItemAssociationRecommender();
+            sparseRecommender.dataManager.dataCache = dict();
+            self.recommender.dataManager.dataCache = dict();
+
+            query = RecommenderQuery();
+            query.countPrefix = "patient_";
+            query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+            query.queryItemIds = set([-2,-4]);
+            baselineData = self.recommender( query );
+            sparseData = sparseRecommender( query );
+            self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in sparseData] );
+            for baselineItem, sparseItem in zip(baselineData, sparseData):
+                self.assertAlmostEqual( baselineItem["score"], sparseItem["score"], 5 );
+                self.assertAlmostEqual( baselineItem["nAB"], sparseItem["nAB"], 5 );
+
+            # Association -4 -> -6 (patient_count_any = 63) scaled to the current value
+            componentResult = [item for item in baselineData if item["clinical_item_id"] == -6][0]["componentResultsById"][-4];
+            self.assertAlmostEqual( 31.5, componentResult["nAB"], 5 );
+        finally:
+            self.dataManager.setAssociationDecayScale(1.0);
+
+    def test_neighborIndex(self):
+        # Verify the top-k neighbor index fast path yields the same results as the full sparse matrix calculation
+        sparseRecommender = SparseItemAssociationRecommender();
+        sparseRecommender.dataManager.dataCache = dict();
+
+        index = TopKNeighborIndex(k=4);
+        index.buildFromDatabase(["patient_count_any","patient_count_3600"], ["PPV","lift","P-YatesChi2-NegLog"], recommender=sparseRecommender, maxRecommendedId=0);
+        (targetIds, scores, isComplete) = index.neighbors("patient_count_any", "PPV", -2);
+        self.assertTrue(len(targetIds) <= 4);
+        self.assertEqual(sorted(scores, reverse=True), list(scores));
+        self.assertTrue(-2 not in targetIds);
+
+        # Round trip through the index file
+        indexFilename = "TopKNeighborIndexTemp.npz";
+        index.save(indexFilename);
+        index = TopKNeighborIndex.load(indexFilename);
+        os.remove(indexFilename);
+        self.assertEqual(6, len(index.listNames()));
+
+        query = RecommenderQuery();
+        query.countPrefix = "patient_";
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+        for queryItemIds in [set([-2,-5]), set([-2]), set([-5,-6]), set([-1,-2,-3,-4,-5,-6])]:
+            query.queryItemIds = queryItemIds;
+            for sortField in ["PPV","lift","P-YatesChi2-NegLog"]:
+                query.sortField = sortField;
+                for limit in [1,3]:
+                    query.limit = limit;
+                    for timeDeltaMax in [None, DELTA_HOUR]:
+                        query.timeDeltaMax = timeDeltaMax;
+                        sparseRecommender.neighborIndex = None;
+                        baselineData = sparseRecommender( query );
+                        sparseRecommender.neighborIndex = index;
+                        indexData = sparseRecommender( query );
+                        self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in indexData] );
+                        for baselineItem, indexItem in zip(baselineData, indexData):
+                            self.assertAlmostEqual( baselineItem["score"], indexItem["score"], 5 );
+                            self.assertEqual( set(baselineItem["componentResultsById"].keys()), set(indexItem["componentResultsById"].keys()) );
+
+    def test_recommendBatch(self):
+        # Verify a batch of queries yields the same results as running each query separately
+        queries = list();
+        for queryItemIds in [set(), set([-2,-5]), set([-2]), set([-5,-6]), set([-1,-2,-3,-4,-5,-6])]:
+            for (sortField, sortReverse) in [("PPV",True), ("lift",True), ("P-YatesChi2-NegLog",False)]:
+                for aggregationMethod in ["weighted","unweighted","NaiveBayes","SerialBayes"]:
+                    for limit in [1,3,None]:
+                        for invertQuery in [False, True]:
+                            query = RecommenderQuery();
+                            query.countPrefix = "patient_";
+                            query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+                            query.queryItemIds = queryItemIds;
+                            query.sortField = sortField;
+                            query.sortReverse = sortReverse;
+                            query.aggregationMethod = aggregationMethod;
+                            query.limit = limit;
+                            query.invertQuery = invertQuery;
+                            queries.append(query);
+        queries[-1].excludeItemIds = set([-3]);
+        queries[-2].timeDeltaMax = DELTA_HOUR;
+
+        for recommender in [ItemAssociationRecommender(), SparseItemAssociationRecommender()]:
+            recommender.dataManager.dataCache = dict();
+            batchDataList = recommender.recommendBatch(queries);
+            self.assertEqual(len(queries), len(batchDataList));
+            for query, batchData in zip(queries, batchDataList):
+                baselineData = recommender( query );
+                self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in batchData] );
+                for baselineItem, batchItem in zip(baselineData, batchData):
+                    self.assertAlmostEqual( baselineItem["score"], batchItem["score"], 5 );
+
+    def test_incrementalSession(self):
+        # Verify ranks from an incremental session, adding one query item at a time,
+        #   match the positions in the full recommendation lists for the accumulated query items
+        recommender = SparseItemAssociationRecommender();
+        recommender.dataManager.dataCache = dict();
+        self.assertEqual(None, ItemAssociationRecommender().session(RecommenderQuery()));   # Not supported, so just use full queries
+
+        itemIds = [-1,-2,-3,-4,-5,-6];
+        for aggregationMethod in ["weighted","unweighted","NaiveBayes","SerialBayes"]:
+            for (sortField, sortReverse) in [("P-YatesChi2-NegLog",True), ("P-YatesChi2-NegLog",False), ("PPV",True)]:
+                for itemOrder in [itemIds, itemIds[::-1]]:
+                    query = RecommenderQuery();
+                    query.countPrefix = "patient_";
+                    query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+                    query.sortField = sortField;
+                    query.sortReverse = sortReverse;
+                    query.aggregationMethod = aggregationMethod;
+
+                    session = recommender.session(query);
+                    for iItem, itemId in enumerate(itemOrder):
+                        query.queryItemIds = set(itemOrder[:iItem]);
+                        recommendedData = recommender.recommendBatch([query])[0];
+                        (rank, score) = session.rank(itemId);
+
+                        # Rank is the position in the list, including the order of any tied scores
+                        recommendedIds = [item["clinical_item_id"] for item in recommendedData];
+                        if itemId not in recommendedIds:
+                            self.assertEqual( (len(recommendedData), None), (rank, score) );
+                        else:
+                            self.assertEqual( recommendedIds.index(itemId)+1, rank );
+                            self.assertAlmostEqual( recommendedData[rank-1]["score"], score, 5 );
+                        for otherId in recommendedIds:
+                            self.assertEqual( recommendedIds.index(otherId)+1, session.rank(otherId)[0] );
+                        session.addItem(itemId);
+
+    def test_modelSnapshot(self):
+        # Verify a recommender started from a model snapshot file yields the same results as one loading from the database,
+        #   without having to query for the association model itself
+        snapshotFilename = "ModelSnapshotTemp.bin";
+        DataManager().exportModelSnapshot(snapshotFilename);
+
+        sparseRecommender = SparseItemAssociationRecommender();
+        sparseRecommender.dataManager.dataCache = dict();
+        snapshotRecommender = SparseItemAssociationRecommender();
+        snapshotRecommender.dataManager.dataCache = dict();
+        self.assertNotEqual(None, snapshotRecommender.dataManager.importModelSnapshot(snapshotFilename));
+
+        query = RecommenderQuery();
+        query.countPrefix = "patient_";
+        query.limit = 3;
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+
+        for queryItemIds in [set([-2,-5]), set([-2]), set([-5,-6]), set([-1,-2,-3,-4,-5,-6])]:
+            query.queryItemIds = queryItemIds;
+            for timeDeltaMax in [None, DELTA_HOUR]:
+                query.timeDeltaMax = timeDeltaMax;
+                baselineData = sparseRecommender( query );
+                snapshotData = snapshotRecommender( query );
+                self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in snapshotData] );
+                for baselineItem, snapshotItem in zip(baselineData, snapshotData):
+                    self.assertAlmostEqual( baselineItem["score"], snapshotItem["score"], 5 );
+        self.assertEqual( 0, snapshotRecommender.dataManager.queryCount );
+
+        # Imported snapshot kept in a bounded cache even when the model cache keys are invalidated,
+        #   such as on the first query of a process before the analyzed patient count is recorded
+        snapshotRecommender = SparseItemAssociationRecommender();
+        snapshotRecommender.dataManager.importModelSnapshot(snapshotFilename);
+        snapshotRecommender.dataManager.invalidateDataCache("analyzedPatientCount");
+        self.assertNotEqual(None, snapshotRecommender.dataManager.dataCache.get(ASSOCIATION_MATRIX_CACHE_KEY));
+
+        # Command line startup from the snapshot yields the same results
+        argv = ["ItemRecommender.py","maxRecommendedId=0&queryItemIds=-6&countPrefix=patient_&resultCount=3&sortField=P-Fisher","-"];
+        sys.stdout = StringIO();
+        self.recommender.main(argv);
+        baselineOutput = sys.stdout.getvalue();
+        sys.stdout = StringIO();
+        self.recommender.main(argv[:1]+["-s",snapshotFilename]+argv[1:]);
+        snapshotOutput = sys.stdout.getvalue();
+        sys.stdout = sys.__stdout__;
+        self.assertEqual( baselineOutput.splitlines()[1:], snapshotOutput.splitlines()[1:] );   # Other than the argv comment line
+
+        # Snapshot no longer usable once the model has been updated
+        DataManager().setCacheData("analyzedPatientCount", "12345");
+        self.assertEqual(None, SparseItemAssociationRecommender().dataManager.importModelSnapshot(snapshotFilename));
+        os.remove(snapshotFilename);
+
+    def test_recommendWithContext(self):
+        # Verify instrumented calls yield the same results, along with per stage timings, counts and cache lookups
+        query = RecommenderQuery();
+        query.countPrefix = "patient_";
+        query.limit = 3;
+        query.maxRecommendedId = 0; # Artificial constraint to focus only on test data
+        query.queryItemIds = set([-2,-5]);
+
+        for recommender in [ItemAssociationRecommender(), SparseItemAssociationRecommender()]:
+            recommender.dataManager.dataCache = dict();
+            recommender.metrics = RecommenderMetrics();
+            for iCall in range(2):
+                baselineData = recommender( query );
+                (recommendedData, context) = recommender.recommendWithContext( query, formatResults=True );
+                self.assertEqual( [item["clinical_item_id"] for item in baselineData], [item["clinical_item_id"] for item in recommendedData] );
+                self.assertEqual( 1, recommendedData[0]["rank"] );
+
+                for stage in ["total","loadAssociations","populateResultCounts","aggregateStats","filterSort","formatResults"]:
+                    self.assertTrue( context.stageTimes[stage] >= 0.0 );
+                self.assertEqual( len(recommendedData), context.counts["resultItems"] );
+                self.assertTrue( context.counts["candidateItems"] >= len(recommendedData) );
+                self.assertEqual( 1.0, context.cacheHitRatio() );   # Association data already cached by the baseline call
+                self.assertEqual( 1, context.counts["dbQueries"] );  # Just the item description lookup to format results
+            self.assertEqual( None, recommender.context );
+
+            metricsData = recommender.metrics.toDict();
+            self.assertEqual( 2, metricsData["calls"] );
+            self.assertEqual( 2, metricsData["stageSeconds"]["total"]["count"] );
+            self.assertTrue( 'stage="filterSort",quantile="0.99"' in recommender.metrics.toPrometheusText() );
+
 def suite():
     """Returns the suite of tests to run for this test class / module.
     Use unittest.makeSuite methods which simply extracts all of the
@@ -504,6 +789,7 @@ def suite():
     #suite.addTest(TestItemRecommender('test_recommender_stats'));
     #suite.addTest(TestItemRecommender('test_recommender_stats_commandline'));
     #suite.addTest(TestItemRecommender('test_dataCache'));
+    #suite.addTest(TestItemRecommender('test_sparseRecommender'));
     suite.addTest(unittest.makeSuite(TestItemRecommender));
 
     return suite;
@@ -335,6 +335,11 @@ class TestOrderSetRecommender(DBTestCase):
         recommendedData = self.recommender( query );
         self.assertEqualRecommendedData( expectedData, recommendedData, query );
 
+        log.debug("Same query, but only the top few results.");
+        query.limit = 4;
+        recommendedData = self.recommender( query );
+        self.assertEqualRecommendedData( expectedData[:4], recommendedData, query );
+
     def assertEqualRecommendedData(self, expectedData, recommendedData, query):
         """Run assertEqualGeneral on the key components of the contents of the recommendation data.
         Don't necessarily care about the specific numbers that come out of the recommendations,
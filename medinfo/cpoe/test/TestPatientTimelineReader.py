@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+import threading;
+from datetime import datetime, timedelta;
+import unittest
+
+from .Const import LOGGER_LEVEL, RUNNER_VERBOSITY;
+from .Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import SQLQuery;
+
+from medinfo.cpoe.PatientTimelineReader import PatientTimelineReader;
+
+TEST_TABLE = "test_patient_timeline";
+
+class TestPatientTimelineReader(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        DBUtil.execute("create table %s (patient_item_id bigint, patient_id bigint, item_date timestamp)" % TEST_TABLE);
+
+        # Patients with varying numbers of items, so groups cross the fetch chunk boundaries
+        self.itemIdsByPatientId = dict();
+        patientItemId = 0;
+        conn = DBUtil.connection();
+        try:
+            for patientId, nItems in [(-1,1), (-2,4), (-3,2), (-4,7), (-5,3)]:
+                self.itemIdsByPatientId[patientId] = list();
+                for iItem in range(nItems):
+                    patientItemId -= 1;
+                    DBUtil.insertRow(TEST_TABLE, {"patient_item_id": patientItemId, "patient_id": patientId, "item_date": datetime(2000,1,1)+timedelta(hours=iItem)}, conn=conn);
+                    self.itemIdsByPatientId[patientId].append(patientItemId);
+            conn.commit();
+        finally:
+            conn.close();
+
+        self.headers = ["patient_item_id","patient_id","item_date"];
+        self.query = SQLQuery();
+        for header in self.headers:
+            self.query.addSelect(header);
+        self.query.addFrom(TEST_TABLE);
+        self.query.addOrderBy("patient_id", dir="desc");
+        self.query.addOrderBy("item_date");
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+        DBUtil.execute("drop table %s" % TEST_TABLE);
+        DBTestCase.tearDown(self);
+
+    def test_readTimelines(self):
+        # Verify the rows are grouped one patient at a time in every row format, with or without the prefetch thread
+        expectedPatientIds = [-1,-2,-3,-4,-5];
+        conn = DBUtil.connection();
+        try:
+            for prefetch in [False, True]:
+                for rowFormat in ["tuple","dict","records"]:
+                    reader = PatientTimelineReader(self.query, conn, self.headers, rowFormat=rowFormat, fetchSize=3, prefetch=prefetch);
+                    patientIds = list();
+                    for (patientId, rows) in reader:
+                        patientIds.append(patientId);
+                        if rowFormat == "tuple":
+                            itemIds = [row[0] for row in rows];
+                        elif rowFormat == "dict":
+                            itemIds = [row["patient_item_id"] for row in rows];
+                            self.assertEqual(set(self.headers), set(rows[0].keys()));
+                        else:
+                            itemIds = rows["patient_item_id"].tolist();
+                        self.assertEqual(self.itemIdsByPatientId[patientId], itemIds);
+
+                        # Caller queries and commits on its own connection while iterating
+                        DBUtil.execute("select count(*) from %s" % TEST_TABLE, conn=conn);
+                        conn.commit();
+                    self.assertEqual(expectedPatientIds, patientIds);
+
+            # Only a planner estimate for PostgreSQL, but enough for progress tracking
+            self.assertTrue(PatientTimelineReader(self.query, conn, self.headers).estimateRowCount() > 0);
+        finally:
+            conn.close();
+
+    def test_abandonIteration(self):
+        # Verify stopping early does not leave the prefetch thread (and its connection) behind
+        conn = DBUtil.connection();
+        try:
+            reader = PatientTimelineReader(self.query, conn, self.headers, fetchSize=2);
+            timelines = iter(reader);
+            (patientId, rows) = next(timelines);
+            self.assertEqual(-1, patientId);
+            timelines.close();
+            self.assertEqual([], [thread for thread in threading.enumerate() if thread.name == "PatientTimelineReader"]);
+
+            # Can still read all over again
+            self.assertEqual(5, len(list(reader)));
+        finally:
+            conn.close();
+
+    def test_errorPropagation(self):
+        # Verify database errors are raised to the caller, including those from the prefetch thread
+        query = SQLQuery();
+        query.addSelect("patient_id");
+        query.addFrom("nonexistent_table");
+        conn = DBUtil.connection();
+        try:
+            for prefetch in [False, True]:
+                reader = PatientTimelineReader(query, conn, ["patient_id"], prefetch=prefetch);
+                self.assertRaises(Exception, list, reader);
+                conn.rollback();
+            self.assertEqual([], [thread for thread in threading.enumerate() if thread.name == "PatientTimelineReader"]);
+        finally:
+            conn.close();
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestPatientTimelineReader));
+    return suite;
+
+if __name__=="__main__":
+    log.setLevel(LOGGER_LEVEL)
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
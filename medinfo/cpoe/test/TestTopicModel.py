@@ -16,11 +16,20 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.ResultsFormatter import TabDictReader;
 
+from medinfo.cpoe.ItemRecommender import RecommenderQuery;
 from medinfo.cpoe.TopicModel import TopicModel;
+from medinfo.cpoe.TopicModelRecommender import TopicModelRecommender;
 
 TEST_FILE_PREFIX = "TestTopicModel.model";
 ITEMS_PER_TOPIC = 5;
 
+class FixedTopicModel:
+    """Stands in for a trained model, assigning the same topic weights to any query bag-of-words"""
+    def __init__(self, topicWeights):
+        self.topicWeights = topicWeights;
+    def __getitem__(self, queryBag):
+        return self.topicWeights;
+
 class TestTopicModel(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
@@ -120,6 +129,44 @@ class TestTopicModel(DBTestCase):
                 {1:3, 2:3, 3:3, 4:4, 5:3, None:5, 9:3, 10:3, 11:2, 12:4, 13:4, 14:1, 15:2, 16:4, 8:3}
         self.assertExpectedTopItems( expectedDocCountByWordId, model, topTopicFile );
 
+    def test_topicModelRecommender(self):
+        # Verify the recommender scores and ranks items by the topic weights, with fixed model parameters
+        model = FixedTopicModel([(0, 0.5), (1, 0.5)]);
+        docCountByWordId = {1:3, 3:3, 4:4, 5:3, 9:3, 12:4, None:5};
+        recommender = TopicModelRecommender(model, docCountByWordId);
+
+        query = RecommenderQuery();
+        query.queryItemIds = set([4]);
+        recommender.initItemLookups(query);
+        recommender.weightByItemIdByTopicId = \
+            {   0: {1:0.5, 3:0.25, 5:0.25},
+                1: {3:0.5, 9:0.25, 12:0.25},
+            };
+        recommender.initWeightMatrix();
+
+        # Descending score, with ties broken by descending item ID
+        query.sortField = "tf";
+        expectedData = [(3, 0.375), (1, 0.25), (12, 0.125), (9, 0.125), (5, 0.125)];
+        recommendedData = recommender(query);
+        self.assertEqual(expectedData, [(item["clinical_item_id"], item["score"]) for item in recommendedData]);
+
+        # TF*IDF scaled by the document counts
+        query.sortField = "tfidf";
+        expectedData = [(3, 0.625), (1, 0.25*5/3), (9, 0.125*5/3), (5, 0.125*5/3), (12, 0.125*5/4)];
+        recommendedData = recommender(query);
+        self.assertEqual([itemId for (itemId, score) in expectedData], [item["clinical_item_id"] for item in recommendedData]);
+        for (itemId, score), item in zip(expectedData, recommendedData):
+            self.assertAlmostEqual(score, item["score"], places=5);
+
+        # Only the top results, and excluding a category (Meds)
+        query.sortField = "tf";
+        query.limit = 3;
+        recommendedData = recommender(query);
+        self.assertEqual([3, 1, 12], [item["clinical_item_id"] for item in recommendedData]);
+        query.excludeCategoryIds = set([-3]);
+        recommendedData = recommender(query);
+        self.assertEqual([3, 1, 5], [item["clinical_item_id"] for item in recommendedData]);
+
     def assertExpectedTopItems(self, expectedDocCountByWordId, model, topTopicFile):
         # With randomized optimization algorithm, cannot depend on stable
         # Test results with each run.  Instead make sure internally consistent,
@@ -2,8 +2,9 @@
 """Test case for respective module in application package"""
 
 import sys, os
+import random;
 from io import StringIO
-from datetime import datetime;
+from datetime import datetime, timedelta;
 import unittest
 
 from .Const import RUNNER_VERBOSITY;
@@ -16,6 +17,66 @@ from medinfo.db.Model import SQLQuery, RowItemModel;
 
 from medinfo.cpoe.TripleAssociationAnalysis import TripleAssociationAnalysis;
 
+def updateItemAssociationsBufferPairwise(analyzer, itemIdSequence, virtualItemId, patientItemList, updateBuffer, linkedItemIdsByBaseId=None):
+    """Reference implementation of TripleAssociationAnalysis.updateItemAssociationsBuffer,
+    checking every (item1, item2) pair of the patient timeline in a nested loop (the original implementation).
+    """
+    # Keep track of which subsequent items have been analyzed, so we don't count further duplicates (just the first ones found)
+    subsequentItemIds = set();
+    # Keep track of all item pairs encountered to avoid counting patient level duplicates
+    encounterIdPairsByItemIdPair = dict();
+
+    # Track where the mid-sequence items occur for easy comparison later
+    midSequenceItemDates = set();
+    for patientItem in patientItemList:
+        if patientItem["clinical_item_id"] == itemIdSequence[0]:
+            midSequenceItemDates.add(patientItem["item_date"]);
+    endSequenceItemsByPatientItemId = dict();
+
+    # Main nested loop to look for associations
+    for patientItem1 in patientItemList:
+        subsequentItemIds.clear();
+
+        for patientItem2 in patientItemList:
+            itemIdPair = (patientItem1["clinical_item_id"], virtualItemId);
+            encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+
+            # Verify is not a previously linked item pair, in which case no meaningful asssociation stats to calculate
+            #   and that the item dates are in non-negative direction
+            isPairToAnalyze = analyzer.acceptableClinicalItemPair(patientItem1, patientItem2, linkedItemIdsByBaseId);
+            if isPairToAnalyze and analyzer.isTripleSequence(patientItem1, patientItem2, midSequenceItemDates, itemIdSequence):
+                # Record the stat update
+                isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
+                isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
+                isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);    # Pair ever seen for a common encounter combination
+
+                analyzer.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
+
+                subsequentItemIds.add(virtualItemId);
+                endSequenceItemsByPatientItemId[patientItem2["patient_item_id"]] = patientItem2;
+
+                if itemIdPair not in encounterIdPairsByItemIdPair:
+                    encounterIdPairsByItemIdPair[itemIdPair] = set();
+                encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+
+    # Separate pass to get virtual item baseline counts.  Cannot be done directly, since the virtual items do not actually exist in the raw data
+    subsequentItemIds.clear();
+    for patientItem1 in endSequenceItemsByPatientItemId.values():
+        for patientItem2 in endSequenceItemsByPatientItemId.values():
+            itemIdPair = (virtualItemId, virtualItemId);
+            encounterIdPair = (patientItem1["encounter_id"], patientItem2["encounter_id"]);
+
+            isNewSubsequentItem = virtualItemId not in subsequentItemIds;   # Track repeats
+            isNewPair = itemIdPair not in encounterIdPairsByItemIdPair; # Pair ever seen for this patient
+            isNewPairWithinEncounter = (encounterIdPair[0]==encounterIdPair[-1]) and (isNewPair or encounterIdPair not in encounterIdPairsByItemIdPair[itemIdPair]);
+
+            analyzer.updateClinicalItemAssociationBuffer( patientItem1, patientItem2, isNewSubsequentItem, isNewPair, isNewPairWithinEncounter, updateBuffer, itemIdPair=itemIdPair );
+
+            subsequentItemIds.add(virtualItemId);
+            if itemIdPair not in encounterIdPairsByItemIdPair:
+                encounterIdPairsByItemIdPair[itemIdPair] = set();
+            encounterIdPairsByItemIdPair[itemIdPair].add(encounterIdPair);
+
 class TestTripleAssociationAnalysis(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
@@ -153,6 +214,68 @@ class TestTripleAssociationAnalysis(DBTestCase):
         itemLinks = DBUtil.execute(itemLinkQuery);
         self.assertEqualTable( expectedItemLinks, itemLinks );
 
+    def test_analyzePatientItems_parallel(self):
+        # Run the triple association analysis split across multiple processes with bulk commit, and verify same results as a serial run
+        associationQuery = \
+            """
+            select 
+                clinical_item_id, subsequent_item_id, 
+                count_0, count_3600, count_86400, count_604800, 
+                count_2592000, count_7776000, count_31536000,
+                count_any, 
+                time_diff_sum, time_diff_sum_squares
+            from
+                clinical_item_association
+            where
+                clinical_item_id < 0 and
+                count_any > 0
+            order by
+                clinical_item_id, subsequent_item_id
+            """;
+
+        self.analyzer.processes = 2;
+        self.analyzer.bulkCommit = True;
+        self.analyzer.analyzePatientItems( [-11111], (-15,-14), -16 );
+
+        expectedAssociationStats = \
+            [
+                [-16,-16,   1, 1, 1, 1, 1, 1, 1, 1,  0.0, 0.0],
+                [-12,-16,   0, 0, 0, 0, 1, 1, 1, 1,  2509200.0, 2509200.0**2],
+                [-11,-16,   0, 0, 0, 0, 1, 1, 1, 1,  2422800.0, 2422800.0**2],
+                [-10,-16,   0, 0, 0, 0, 0, 2, 2, 2,  5101200.0+5187600.0, 5101200.0**2+5187600.0**2],
+                [ -8,-16,   0, 0, 0, 0, 0, 1, 1, 1,  5180400.0, 5180400.0**2],
+            ];
+        associationStats = DBUtil.execute(associationQuery);
+        self.assertEqualTable( expectedAssociationStats, associationStats, precision=3 );
+
+    def test_updateItemAssociationsBuffer_longTimeline(self):
+        # Verify the bisection search for triple sequences yields the same results as checking every pair
+        #   on a long patient timeline with multiple admissions
+        randomGen = random.Random(1234);
+        patientItemList = list();
+        for iItem in range(600):
+            patientItem = \
+                {   "patient_item_id": -iItem-1,
+                    "patient_id": -11111,
+                    "encounter_id": randomGen.choice([-111,-112,-113]),
+                    "clinical_item_id": randomGen.choice([-15,-14,-13,-12,-11,-10,-9,-8]),
+                    "item_date": datetime(2000,1,1) + timedelta(seconds=randomGen.choice([0,3600,86400])*randomGen.randint(0,100)),
+                    "analyze_date": None,
+                };
+            patientItemList.append(patientItem);
+        patientItemList.sort(key=lambda patientItem: patientItem["item_date"]);
+        linkedItemIdsByBaseId = {-16: set([-15,-14]), -9: set([-14])};
+
+        bisectBuffer = self.analyzer.makeUpdateBuffer();
+        self.analyzer.updateItemAssociationsBuffer((-15,-14), -16, patientItemList, bisectBuffer, linkedItemIdsByBaseId);
+
+        pairwiseBuffer = self.analyzer.makeUpdateBuffer();
+        updateItemAssociationsBufferPairwise(self.analyzer, (-15,-14), -16, patientItemList, pairwiseBuffer, linkedItemIdsByBaseId);
+
+        pairwiseData = pairwiseBuffer["associationCounts"].toIncrementData();
+        bisectData = bisectBuffer["associationCounts"].toIncrementData();
+        self.assertEqual(pairwiseData, bisectData);
+        self.assertFalse((-9,-16) in bisectData);   # Linked to the end sequence item, so not counted
 
 def suite():
     """Returns the suite of tests to run for this test class / module.
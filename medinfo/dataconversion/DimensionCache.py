@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+In memory (write-through) cache of dimension tables like clinical_item_category and clinical_item,
+so that data conversion processes can resolve the records for each source row
+without several database round trips per row.
+"""
+
+import sys, os
+import zlib;
+
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from .Util import log;
+
+# Number of primary key values to reserve from a (PostgreSQL) table sequence at a time for new records
+ID_RESERVE_SIZE = 100;
+
+# Process-wide DimensionCache instances by table name, so conversion processes run together share one preloaded index per table
+SHARED_CACHE_BY_TABLE = dict();
+
+class DimensionCache:
+    """Drop-in replacement for DBUtil.findOrInsertItem calls against a dimension table (with an auto-generated ID column).
+
+    The first lookup by a given set of search columns preloads the whole table into an index of those columns'
+    values (the natural key) to the record IDs, so subsequent lookups are resolved in memory,
+    including any records created by previous conversion runs or other processes.
+
+    New records are written through to the database right away, rather than batched, as dependent records
+    (e.g., patient_item rows with foreign keys to clinical_item) need them to exist before they can be inserted.
+    For PostgreSQL, ID values are reserved from the table sequence in blocks of idReserveSize, so each new record
+    does not need to search again after the insert to find its ID.
+
+    Before inserting, check the database again for a matching record (in case another process added it since the preload).
+    For PostgreSQL, that check and insert is serialized with other writers by an advisory lock on the table
+    (held until the transaction commits), so concurrent conversion processes discovering the same new item
+    will all resolve to the same record.
+    """
+    def __init__(self, tableName, idCol=None, idReserveSize=ID_RESERVE_SIZE):
+        self.tableName = tableName;
+        self.idCol = idCol;
+        if idCol is None:
+            self.idCol = DBUtil.defaultIDColumn(tableName);
+        self.idReserveSize = idReserveSize;
+
+        self.idByKeyByCols = dict();    # Tuple of search column names -> (Tuple of search column values -> record ID)
+        self.reservedIds = list();      # Reserved ID values not yet used, in reverse order so can pop off the next one
+
+        # Usage statistics
+        self.nHits = 0;
+        self.nMisses = 0;
+        self.nInserts = 0;
+
+    def findOrInsertItem(self, searchDict, insertDict=None, autoCommit=True, conn=None):
+        """Look for the record ID matching the searchDict values, inserting a new record with the insertDict values
+        (or else the searchDict) if there is none yet.  Same semantics as DBUtil.findOrInsertItem.
+        Returns a (recordId, isNew) 2-ple.
+        """
+        cols = tuple(sorted(searchDict.keys()));
+        if cols not in self.idByKeyByCols:
+            self.idByKeyByCols[cols] = self.loadIndex(cols, conn=conn);
+        idByKey = self.idByKeyByCols[cols];
+
+        key = normalizeKey([searchDict[col] for col in cols]);
+        if key in idByKey:
+            self.nHits += 1;
+            return (idByKey[key], False);
+        self.nMisses += 1;
+
+        if insertDict is None:
+            insertDict = searchDict;
+        (recordId, isNew) = self.insertItem(searchDict, insertDict, autoCommit=autoCommit, conn=conn);
+
+        # Track in any other loaded indexes that the inserted values fully determine
+        for otherCols, otherIdByKey in self.idByKeyByCols.items():
+            if otherCols == cols:
+                otherIdByKey[key] = recordId;
+            elif isNew and all([col in insertDict for col in otherCols]):
+                otherIdByKey.setdefault(normalizeKey([insertDict[col] for col in otherCols]), recordId);
+        return (recordId, isNew);
+
+    def loadIndex(self, cols, conn=None):
+        """Preload the dictionary of search column values -> record ID for the whole table.
+        If there are duplicate records by the search columns, use the first (smallest ID) one.
+        """
+        query = SQLQuery();
+        query.addSelect(self.idCol);
+        for col in cols:
+            query.addSelect(col);
+        query.addFrom(self.tableName);
+        query.addOrderBy(self.idCol, "desc");   # Load in reverse order, so the smallest ID for any duplicate key overwrites the others
+        idByKey = dict();
+        for row in DBUtil.execute(query, conn=conn, autoCommit=False):
+            idByKey[normalizeKey(row[1:])] = row[0];
+        log.debug("Preloaded %d %s records by %s" % (len(idByKey), self.tableName, cols) );
+        return idByKey;
+
+    def insertItem(self, searchDict, insertDict, autoCommit=True, conn=None):
+        """Insert a new record into the database, unless one already exists matching the searchDict
+        (e.g., added by another process since the preload).
+        Returns (recordId, isNew) of the new or existing record.
+        """
+        extConn = conn is not None;
+        if not extConn:
+            conn = DBUtil.connection();
+        try:
+            cursor = conn.cursor();
+            try:
+                if DBUtil.Env.DATABASE_CONNECTOR_NAME == "psycopg2":
+                    # Serialize with other processes checking for and inserting new records in this table.
+                    #   Separate statement first, so the following search sees anything committed while waiting for the lock.
+                    cursor.execute("select pg_advisory_xact_lock(%s)", (self.lockKey(),) );
+
+                searchQuery = SQLQuery();
+                searchQuery.addSelect("min(%s)" % self.idCol);
+                searchQuery.addFrom(self.tableName);
+                for col, value in searchDict.items():
+                    if value is not None:
+                        searchQuery.addWhereEqual(col, value);
+                    else:
+                        searchQuery.addWhereOp(col,"is",value);  # Equals operator doesn't work for null values
+                cursor.execute(str(searchQuery), tuple(searchQuery.getParams()) );
+                recordId = cursor.fetchone()[0];
+                isNew = (recordId is None);
+
+                if isNew:
+                    insertDict = dict(insertDict);
+                    if self.idCol not in insertDict:
+                        reservedId = self.reserveId(cursor);
+                        if reservedId is not None:
+                            insertDict[self.idCol] = reservedId;
+                    DBUtil.insertRow(self.tableName, insertDict, conn=conn, cursor=cursor);
+                    self.nInserts += 1;
+
+                    if self.idCol in insertDict:
+                        recordId = insertDict[self.idCol];
+                    elif DBUtil.Env.DATABASE_CONNECTOR_NAME == "sqlite3":
+                        recordId = cursor.lastrowid;
+                    else:
+                        cursor.execute(str(searchQuery), tuple(searchQuery.getParams()) );
+                        recordId = cursor.fetchone()[0];
+                else:
+                    log.debug("Found %s record %s added since preload for %s" % (self.tableName, recordId, searchDict) );
+            finally:
+                cursor.close();
+
+            # Allow caller to not commit when providing their own connection (though that holds the lock until they do)
+            if not extConn or autoCommit:
+                conn.commit();
+            return (recordId, isNew);
+        finally:
+            if not extConn:
+                conn.close();
+
+    def reserveId(self, cursor):
+        """Next reserved ID value for a new record, reserving another block from the table sequence as needed.
+        None if the database does not support sequences (e.g., SQLite), so new records just use the default auto-generated ID.
+        """
+        if DBUtil.Env.DATABASE_CONNECTOR_NAME != "psycopg2":
+            return None;
+        if not self.reservedIds:
+            cursor.execute("select nextval(%s) from generate_series(1,%s)", (DBUtil.sequenceName(self.tableName), self.idReserveSize) );
+            self.reservedIds = [row[0] for row in cursor.fetchall()];
+            self.reservedIds.sort(reverse=True);
+        return self.reservedIds.pop();
+
+    def lockKey(self):
+        """Advisory lock key for the table, consistent across processes (unlike the builtin hash function)"""
+        return zlib.crc32(self.tableName.encode("utf-8"));
+
+def sharedCache(tableName):
+    """DimensionCache for the named table shared by all conversion processes in this process, created on first use,
+    so the table is only preloaded once rather than once per conversion process
+    """
+    if tableName not in SHARED_CACHE_BY_TABLE:
+        SHARED_CACHE_BY_TABLE[tableName] = DimensionCache(tableName);
+    return SHARED_CACHE_BY_TABLE[tableName];
+
+def clearSharedCaches():
+    """Discard the shared caches, so the next lookups preload from the database again
+    (e.g., after the database is rebuilt or records are deleted other than through the caches)
+    """
+    SHARED_CACHE_BY_TABLE.clear();
+
+def normalizeKey(values):
+    """Tuple of values comparable between database results and conversion source data,
+    which may represent the same value with different types (e.g., integer IDs from the database vs. strings from a text file)
+    """
+    return tuple([str(value) if value is not None else None for value in values]);
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+Batched insertion of patient_item (and dependent patient_item_collection_link) records for data conversion processes,
+so that conversion throughput is not bound by the latency of several database round trips per source row.
+"""
+
+import sys, os
+
+from medinfo.db import DBUtil;
+from medinfo.db.Model import SQLQuery;
+
+from .DimensionCache import normalizeKey;
+from .Util import log;
+
+# Number of patient_item records to accumulate before flushing them to the database in multi-row inserts
+BATCH_SIZE = 1000;
+
+# Natural key of patient_item records (unique constraint), to match inserted or existing records back to their IDs
+PATIENT_ITEM_KEY_COLS = ("patient_id", "clinical_item_id", "item_date");
+
+class PatientItemBuffer:
+    """Accumulate patient_item record models produced by a conversion process, in place of an optimistic insert
+    (and identity query) for each one, and flush them to the database in batches with
+    multi-row "insert ... on conflict do nothing returning ..." statements (DBUtil.insertRowsReturning).
+
+    The returned IDs are joined back to the record models in memory by the natural key columns,
+    so after a flush, each patientItem["patient_item_id"] is populated, whether the record was newly inserted
+    or a duplicate of an existing one (resolved with a batched search for the remaining keys).
+    Dependent patient_item_collection_link records are queued with their (not yet inserted) patient item
+    and inserted after it has its ID.  Links are unique by (patient_item_id, item_collection_item_id),
+    so a repeated link (e.g., for a duplicate patient item) is skipped rather than inserted again,
+    and is not counted in nLinks.
+
+    Callers must flush (e.g., at the end of convertSourceItems) before closing the connection,
+    otherwise the last partial batch is never written.
+    """
+    def __init__(self, batchSize=BATCH_SIZE):
+        self.batchSize = batchSize;
+        self.patientItems = list(); # Patient item record models not yet inserted
+        self.collectionLinks = list();  # (patientItem, collectionItem) pairs for links not yet inserted
+
+        # Usage statistics
+        self.nInserted = 0;
+        self.nSkipped = 0;
+        self.nLinks = 0;
+
+    def addPatientItem(self, patientItem, conn):
+        """Queue the patient_item record model to be inserted, flushing the batch if it is full"""
+        self.patientItems.append(patientItem);
+        if len(self.patientItems) >= self.batchSize:
+            self.flush(conn);
+
+    def addCollectionLink(self, patientItem, collectionItem, conn):
+        """Queue a patient_item_collection_link record for the patient item (whose ID may not be resolved until the next flush)"""
+        self.collectionLinks.append( (patientItem, collectionItem) );
+        if len(self.collectionLinks) >= self.batchSize:
+            self.flush(conn);
+
+    def flush(self, conn):
+        """Insert all of the queued records and commit, populating the patient_item_id of the queued patient item models"""
+        patientItems = self.patientItems;
+        collectionLinks = self.collectionLinks;
+        self.patientItems = list();
+        self.collectionLinks = list();
+
+        if patientItems:
+            self.insertPatientItems(patientItems, conn);
+        if collectionLinks:
+            self.insertCollectionLinks(collectionLinks, conn);
+        conn.commit();
+
+    def insertPatientItems(self, patientItems, conn):
+        # Different conversions (and even records within one) may specify different columns, so batch by column set
+        patientItemsByCols = dict();
+        for patientItem in patientItems:
+            cols = tuple(col for col in patientItem.keys() if col != "patient_item_id");
+            patientItemsByCols.setdefault(cols, list()).append(patientItem);
+
+        for cols, itemsForCols in patientItemsByCols.items():
+            rows = [[patientItem[col] for col in cols] for patientItem in itemsForCols];
+            try:
+                returnedRows = DBUtil.insertRowsReturning("patient_item", cols, rows, ("patient_item_id",)+PATIENT_ITEM_KEY_COLS, ignoreDuplicates=True, conn=conn);
+                conn.commit();  # Before any rollback of a later batch could undo these records after their IDs are assigned
+            except conn.IntegrityError as err:
+                # Some other constraint violated (e.g., null or foreign key values).  Fall back to one record at a time to insert whatever else is possible
+                log.info(err);
+                conn.rollback();
+                self.insertPatientItemsByRow(itemsForCols, conn);
+                continue;
+
+            idByKey = dict();
+            for row in returnedRows:
+                idByKey[normalizeKey(row[1:])] = row[0];
+            self.nInserted += len(returnedRows);
+
+            unresolvedItems = list();
+            for patientItem in itemsForCols:
+                key = normalizeKey([patientItem[col] for col in PATIENT_ITEM_KEY_COLS]);
+                if key in idByKey:
+                    patientItem["patient_item_id"] = idByKey[key];
+                else:
+                    unresolvedItems.append(patientItem);
+            if unresolvedItems:
+                # Duplicates of existing records, pull out the existing IDs
+                self.nSkipped += len(unresolvedItems);
+                log.info("%d duplicate patient_item records skipped" % len(unresolvedItems) );
+                self.resolveExistingIds(unresolvedItems, conn);
+
+    def insertPatientItemsByRow(self, patientItems, conn):
+        """Same as the original one record at a time insertion. Optimistic insert of each new item,
+        and if turns out to be a duplicate or otherwise invalid, look up any existing ID and continue with the rest.
+        """
+        for patientItem in patientItems:
+            insertDict = dict( (col, value) for (col, value) in patientItem.items() if col != "patient_item_id" );
+            try:
+                DBUtil.insertRow("patient_item", insertDict, conn=conn);
+                conn.commit();
+                self.nInserted += 1;
+            except conn.IntegrityError as err:
+                log.info(err);
+                conn.rollback();
+                self.nSkipped += 1;
+            patientItem["patient_item_id"] = self.findExistingId(patientItem, conn);
+
+    def resolveExistingIds(self, patientItems, conn):
+        """Look up the IDs of existing patient_item records by their natural key columns, in batched queries"""
+        for iStart in range(0, len(patientItems), self.batchSize):
+            chunk = patientItems[iStart:iStart+self.batchSize];
+
+            query = SQLQuery();
+            query.addSelect("patient_item_id");
+            for col in PATIENT_ITEM_KEY_COLS:
+                query.addSelect(col);
+            query.addFrom("patient_item");
+            keyConditions = list();
+            for patientItem in chunk:
+                keyConditions.append( "(%s)" % str.join(" and ", ["%s = %s" % (col, DBUtil.SQL_PLACEHOLDER) for col in PATIENT_ITEM_KEY_COLS]) );
+                query.params.extend( [patientItem[col] for col in PATIENT_ITEM_KEY_COLS] );
+            query.addWhere( str.join(" or ", keyConditions) );
+
+            idByKey = dict();
+            for row in DBUtil.execute(query, conn=conn):
+                idByKey.setdefault(normalizeKey(row[1:]), row[0]);
+
+            for patientItem in chunk:
+                key = normalizeKey([patientItem[col] for col in PATIENT_ITEM_KEY_COLS]);
+                if key in idByKey:
+                    patientItem["patient_item_id"] = idByKey[key];
+                else:
+                    # Key values may not match in string form (e.g., different date formats), so fall back to searching for the record directly
+                    patientItem["patient_item_id"] = self.findExistingId(patientItem, conn);
+
+    def findExistingId(self, patientItem, conn):
+        """ID of the existing patient_item record with the same natural key values, or None if there is none
+        (e.g., the record was rejected for null or invalid values)
+        """
+        query = SQLQuery();
+        query.addSelect("patient_item_id");
+        query.addFrom("patient_item");
+        for col in PATIENT_ITEM_KEY_COLS:
+            if patientItem[col] is not None:
+                query.addWhereEqual(col, patientItem[col]);
+            else:
+                query.addWhereOp(col,"is",patientItem[col]);  # Equals operator doesn't work for null values
+        results = DBUtil.execute(query, conn=conn);
+        if not results:
+            log.warning("Could not find or insert patient_item record %s" % patientItem);
+            return None;
+        return results[0][0];
+
+    def insertCollectionLinks(self, collectionLinks, conn):
+        cols = ("patient_item_id", "item_collection_item_id");
+        rows = list();
+        for (patientItem, collectionItem) in collectionLinks:
+            if patientItem.get("patient_item_id") is None:
+                log.warning("No patient_item record for %s, so skipping its item collection link" % patientItem);
+                continue;
+            rows.append( [patientItem["patient_item_id"], collectionItem["item_collection_item_id"]] );
+        try:
+            self.nLinks += len(DBUtil.insertRowsReturning("patient_item_collection_link", cols, rows, ("patient_item_collection_link_id",), ignoreDuplicates=True, conn=conn));
+        except conn.IntegrityError as err:
+            # Fall back to one record at a time, just noting any invalid ones and continuing to insert whatever else is possible
+            log.info(err);
+            conn.rollback();
+            for row in rows:
+                try:
+                    DBUtil.insertRow("patient_item_collection_link", dict(zip(cols, row)), conn=conn);
+                    conn.commit();
+                    self.nLinks += 1;
+                except conn.IntegrityError as err:
+                    log.info(err);
+                    conn.rollback();
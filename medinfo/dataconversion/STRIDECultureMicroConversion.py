@@ -6,9 +6,11 @@ from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator;
+from medinfo.db.Model import RowItemModel;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Env import DATE_FORMAT;
 
 
@@ -26,6 +28,9 @@ class STRIDECultureMicroConversion:
 
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCompositeKey = dict(); # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
 
     def convertSourceItems(self, convOptions):
         """Primary run function to process the contents of the raw source
@@ -43,6 +48,7 @@ class STRIDECultureMicroConversion:
             for sourceItem in self.querySourceItems(convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.patientItemBuffer.flush(conn);
 
         finally:
             conn.close();
@@ -131,6 +137,8 @@ class STRIDECultureMicroConversion:
             category = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
             patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
 
         finally:
             if not extConn:
@@ -151,7 +159,7 @@ class STRIDECultureMicroConversion:
                         "description":  categoryDescription,
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -178,7 +186,7 @@ class STRIDECultureMicroConversion:
                         "description": description
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCompositeKey[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCompositeKey[clinicalItemKey];
@@ -194,21 +202,7 @@ class STRIDECultureMicroConversion:
                     "item_date":  sourceItem["shifted_result_time"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existing ID and continue to insert whatever else is possible
-            # log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
         return patientItem;
 
     def main(self, argv):
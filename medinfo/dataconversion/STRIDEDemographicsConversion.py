@@ -6,9 +6,11 @@ from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.Model import RowItemModel;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Env import DATE_FORMAT;
 
 SOURCE_TABLE = "stride_patient";
@@ -79,6 +81,9 @@ class STRIDEDemographicsConversion:
 
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
 
     def convertSourceItems(self, patientIds=None):
         """Primary run function to process the contents of the stride_patient
@@ -93,6 +98,7 @@ class STRIDEDemographicsConversion:
         try:
             for sourceItem in self.querySourceItems(patientIds, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
+            self.patientItemBuffer.flush(conn);
         finally:
             conn.close();
         # progress.PrintStatus();
@@ -202,6 +208,8 @@ class STRIDEDemographicsConversion:
             categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItemModel = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
             patientItemModel = self.patientItemModelFromSourceItem(sourceItem, clinicalItemModel, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
 
         finally:
             if not extConn:
@@ -218,7 +226,7 @@ class STRIDEDemographicsConversion:
                         "description":  "Demographics",
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -236,7 +244,7 @@ class STRIDEDemographicsConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
@@ -252,14 +260,7 @@ class STRIDEDemographicsConversion:
                     "item_date":  sourceItem["itemDate"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
 
 
 
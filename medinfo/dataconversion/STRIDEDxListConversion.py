@@ -6,9 +6,11 @@ from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.Model import RowItemModel;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Env import DATE_FORMAT;
 
 SOURCE_TABLE = "stride_dx_list";
@@ -38,6 +40,9 @@ class STRIDEDxListConversion:
 
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
         self.icd9_str_by_code = None
         self.icd10_str_by_code = None
 
@@ -55,6 +60,7 @@ class STRIDEDxListConversion:
         try:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
+            self.patientItemBuffer.flush(conn);
         finally:
             conn.close();
         progress.PrintStatus();
@@ -200,6 +206,8 @@ class STRIDEDxListConversion:
             categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItem = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
             patientItem = self.patientItemModelFromSourceItem(sourceItem, clinicalItem, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
 
         finally:
             if not extConn:
@@ -217,7 +225,7 @@ class STRIDEDxListConversion:
                         "description":  "Diagnosis (%s)" % sourceItem["data_source"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -236,7 +244,7 @@ class STRIDEDxListConversion:
                         "description": "%(icd_str)s" % sourceItem,
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey]
@@ -252,15 +260,7 @@ class STRIDEDxListConversion:
                     "item_date":  sourceItem["noted_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
-            pass;
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
 
     def prepare_icd9_lookup(self, conn):
         """
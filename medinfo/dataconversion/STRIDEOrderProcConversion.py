@@ -6,9 +6,11 @@ from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
+from medinfo.db.Model import RowItemModel;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Env import DATE_FORMAT;
 from .Const import COLLECTION_TYPE_ORDERSET;
 
@@ -44,6 +46,10 @@ class STRIDEOrderProcConversion:
 
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdExtId = dict(); # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.collectionItemCache = sharedCache("item_collection_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
         self.itemCollectionByKeyStr = dict();   # Local cache to track item collections
         self.itemCollectionItemByCollectionIdItemId = dict();   # Local cache to track item collection items
 
@@ -62,6 +68,7 @@ class STRIDEOrderProcConversion:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.patientItemBuffer.flush(conn);
         finally:
             conn.close();
         progress.PrintStatus();
@@ -135,6 +142,8 @@ class STRIDEOrderProcConversion:
                 itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn);
                 itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn);
                 patientItemCollectionLink = self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
         finally:
             if not extConn:
                 conn.close();
@@ -151,7 +160,7 @@ class STRIDEOrderProcConversion:
                         "description":  sourceItem["order_type"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -177,7 +186,7 @@ class STRIDEOrderProcConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
@@ -193,21 +202,7 @@ class STRIDEOrderProcConversion:
                     "item_date":  sourceItem["order_time"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existint ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
         return patientItem;
 
 
@@ -247,27 +242,14 @@ class STRIDEOrderProcConversion:
                         "collection_type_id": COLLECTION_TYPE_ORDERSET,
                     }
                 );
-            (collectionItemId, isNew) = DBUtil.findOrInsertItem("item_collection_item", collectionItem, conn=conn);
+            (collectionItemId, isNew) = self.collectionItemCache.findOrInsertItem(collectionItem, conn=conn);
             collectionItem["item_collection_item_id"] = collectionItemId;
             self.itemCollectionItemByCollectionIdItemId[itemKey] = collectionItem;
         return self.itemCollectionItemByCollectionIdItemId[itemKey];
 
     def patientItemCollectionLinkFromSourceItem(self, sourceItem, collectionItem, patientItem, conn):
-        # Produce a patient_item_collection_link record model for the given sourceItem
-        patientItemCollectionLink = \
-            RowItemModel \
-            (   {   "patient_item_id": patientItem["patient_item_id"],
-                    "item_collection_item_id":  collectionItem["item_collection_item_id"],
-                }
-            );
-        insertQuery = DBUtil.buildInsertQuery("patient_item_collection_link", list(patientItemCollectionLink.keys()) );
-        insertParams= list(patientItemCollectionLink.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        # Queue a patient_item_collection_link record for the given sourceItem, inserted once the patient item has its ID
+        self.patientItemBuffer.addCollectionLink(patientItem, collectionItem, conn=conn);
 
 
     def main(self, argv):
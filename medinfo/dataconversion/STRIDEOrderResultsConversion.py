@@ -10,6 +10,8 @@ from medinfo.db.Model import SQLQuery;
 from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Env import DATE_FORMAT;
 
 from .Const import SENTINEL_RESULT_VALUE, Z_SCORE_LIMIT;
@@ -38,6 +40,9 @@ class STRIDEOrderResultsConversion:
 
         self.categoryBySourceDescr = dict();
         self.clinicalItemByCategoryIdExtId = dict();
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
         self.resultStatsByBaseName = None;
 
     def convertSourceItems(self, startDate=None, endDate=None):
@@ -55,6 +60,7 @@ class STRIDEOrderResultsConversion:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.patientItemBuffer.flush(conn);
         finally:
             conn.close();
         progress.PrintStatus();
@@ -227,6 +233,8 @@ class STRIDEOrderResultsConversion:
             categoryModel = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItemModel = self.clinicalItemFromSourceItem(sourceItem, categoryModel, conn=conn);
             patientItemModel = self.patientItemModelFromSourceItem(sourceItem, clinicalItemModel, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
 
         finally:
             if not extConn:
@@ -244,7 +252,7 @@ class STRIDEOrderResultsConversion:
                         "description":  "%s Result" % sourceItem["order_type"],
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -264,7 +272,7 @@ class STRIDEOrderResultsConversion:
                         "description": "%(common_name)s (%(result_flag)s)" % sourceItem,
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey];
@@ -281,14 +289,7 @@ class STRIDEOrderResultsConversion:
                     "num_value": sourceItem["ord_num_value"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err);
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
 
 
     def main(self, argv):
@@ -6,9 +6,11 @@ from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots;
 from medinfo.db import DBUtil;
 from medinfo.db.Model import SQLQuery;
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator;
+from medinfo.db.Model import RowItemModel;
 
 from .Util import log;
+from .DimensionCache import sharedCache;
+from .PatientItemBuffer import PatientItemBuffer;
 from .Const import TEMPLATE_MEDICATION_ID, TEMPLATE_MEDICATION_PREFIX;
 from .Const import COLLECTION_TYPE_ORDERSET;
 from .Env import DATE_FORMAT;
@@ -37,6 +39,9 @@ class STRIDETreatmentTeamConversion:
 
         self.categoryBySourceDescr = dict();    # Local cache to track the clinical item category table contents
         self.clinicalItemByCompositeKey = dict(); # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category");
+        self.clinicalItemCache = sharedCache("clinical_item");
+        self.patientItemBuffer = PatientItemBuffer();   # Batched patient_item inserts, so must flush before the connection is closed
 
     def convertSourceItems(self, convOptions):
         """Primary run function to process the contents of the raw source
@@ -54,6 +59,7 @@ class STRIDETreatmentTeamConversion:
             for sourceItem in self.querySourceItems(convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn);
                 progress.Update();
+            self.patientItemBuffer.flush(conn);
 
         finally:
             conn.close();
@@ -206,6 +212,8 @@ class STRIDETreatmentTeamConversion:
             category = self.categoryFromSourceItem(sourceItem, conn=conn);
             clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn);
             patientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn);
+            if not extConn:
+                self.patientItemBuffer.flush(conn);
 
         finally:
             if not extConn:
@@ -226,7 +234,7 @@ class STRIDETreatmentTeamConversion:
                         "description":  categoryDescription,
                     }
                 );
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn);
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn);
             category["clinical_item_category_id"] = categoryId;
             self.categoryBySourceDescr[categoryKey] = category;
         return self.categoryBySourceDescr[categoryKey];
@@ -244,7 +252,7 @@ class STRIDETreatmentTeamConversion:
                         "description": sourceItem["description"],
                     }
                 );
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn);
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn);
             clinicalItem["clinical_item_id"] = clinicalItemId;
             self.clinicalItemByCompositeKey[clinicalItemKey] = clinicalItem;
         return self.clinicalItemByCompositeKey[clinicalItemKey];
@@ -260,21 +268,7 @@ class STRIDETreatmentTeamConversion:
                     "item_date":  sourceItem["trtmnt_tm_begin_date"],
                 }
             );
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()) );
-        insertParams= list(patientItem.values());
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute( insertQuery, insertParams, conn=conn );
-            patientItem["patient_item_id"] = DBUtil.execute( DBUtil.identityQuery("patient_item"), conn=conn )[0][0];
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existing ID and continue to insert whatever else is possible
-            log.info(err);   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = \
-                {   "patient_id":       patientItem["patient_id"],
-                    "clinical_item_id": patientItem["clinical_item_id"],
-                    "item_date":        patientItem["item_date"],
-                }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn);
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn);
         return patientItem;
 
     def main(self, argv):
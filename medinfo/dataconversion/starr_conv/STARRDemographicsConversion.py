@@ -9,11 +9,12 @@ from datetime import datetime
 from optparse import OptionParser
 from medinfo.common.Util import ProgressDots
 from medinfo.db import DBUtil
-from medinfo.db.Model import SQLQuery
 from medinfo.db.Model import RowItemModel
 from medinfo.dataconversion.starr_conv import STARRUtil
 
 from medinfo.dataconversion.Util import log
+from medinfo.dataconversion.DimensionCache import sharedCache
+from medinfo.dataconversion.PatientItemBuffer import PatientItemBuffer
 from medinfo.db.bigquery import bigQueryUtil
 
 from google.cloud import bigquery
@@ -93,6 +94,9 @@ class STARRDemographicsConversion:
 
         self.categoryBySourceDescr = dict()
         self.clinicalItemByCategoryIdExtId = dict()
+        self.categoryCache = sharedCache("clinical_item_category")
+        self.clinicalItemCache = sharedCache("clinical_item")
+        self.patientItemBuffer = PatientItemBuffer()   # Batched patient_item inserts, so must flush before the connection is closed
 
     def convertItemsByBatch(self, patientIdsFile, batchSize=250000, tempDir=tempfile.gettempdir(), removeCsvs=True,
                             targetDatasetId='clinical_item2018', skipFirstLine=True, startBatch=0):
@@ -162,6 +166,7 @@ class STARRDemographicsConversion:
             category_model = self.categoryFromSourceItem(conn)   # only 1 category - no need to have it in the loop
             for sourceItem in self.querySourceItems(patientIds, progress):
                 self.convertSourceItem(category_model, sourceItem, conn)
+            self.patientItemBuffer.flush(conn)
 
     def convertSourceItem(self, categoryModel, sourceItem, conn=None):
         """Given an individual sourceItem record, produce / convert it into an equivalent
@@ -287,7 +292,7 @@ class STARRDemographicsConversion:
                 }
             )
 
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn)
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn)
             category["clinical_item_category_id"] = categoryId
             self.categoryBySourceDescr[category_key] = category
         return self.categoryBySourceDescr[category_key]
@@ -305,7 +310,7 @@ class STARRDemographicsConversion:
                     "description": sourceItem["description"],
                 }
             )
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn)
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn)
             clinicalItem["clinical_item_id"] = clinicalItemId
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey]
@@ -322,14 +327,7 @@ class STARRDemographicsConversion:
                 "item_date_utc": None,                          # it's a date - so, no need to have a duplicate here
             }
         )
-        insert_query = DBUtil.buildInsertQuery("patient_item", list(patient_item.keys()))
-        insert_params = list(patient_item.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insert_query, insert_params, conn=conn)
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.warn(err)
+        self.patientItemBuffer.addPatientItem(patient_item, conn=conn)
 
     def main(self, argv):
         """Main method, callable from command line"""
@@ -10,10 +10,11 @@ from datetime import datetime
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots
 from medinfo.db import DBUtil
-from medinfo.db.Model import SQLQuery
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator
+from medinfo.db.Model import RowItemModel
 
 from medinfo.dataconversion.Util import log
+from medinfo.dataconversion.DimensionCache import sharedCache
+from medinfo.dataconversion.PatientItemBuffer import PatientItemBuffer
 from medinfo.dataconversion.Const import TEMPLATE_MEDICATION_ID, TEMPLATE_MEDICATION_PREFIX
 from medinfo.dataconversion.Const import COLLECTION_TYPE_ORDERSET
 from medinfo.dataconversion.Env import DATE_FORMAT
@@ -51,6 +52,10 @@ class STARROrderMedConversion:
 
         self.categoryBySourceDescr = dict()     # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdCode = dict()  # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category")
+        self.clinicalItemCache = sharedCache("clinical_item")
+        self.collectionItemCache = sharedCache("item_collection_item")
+        self.patientItemBuffer = PatientItemBuffer()   # Batched patient_item inserts, so must flush before the connection is closed
         self.itemCollectionByKeyStr = dict()    # Local cache to track item collections
         self.itemCollectionItemByCollectionIdItemId = dict()    # Local cache to track item collection items
 
@@ -109,6 +114,7 @@ class STARROrderMedConversion:
             for sourceItem in self.querySourceItems(rxcuiDataByMedId, convOptions, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn)
                 progress.Update()
+            self.patientItemBuffer.flush(conn)
 
         finally:
             conn.close()
@@ -295,6 +301,8 @@ class STARROrderMedConversion:
                 itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn)
                 itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn)
                 patientItemCollectionLink = self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn)
+            if not extConn:
+                self.patientItemBuffer.flush(conn)
 
         finally:
             if not extConn:
@@ -313,7 +321,7 @@ class STARROrderMedConversion:
                     "description":  categoryDescription,
                 }
             )
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn)
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn)
             category["clinical_item_category_id"] = categoryId
             self.categoryBySourceDescr[categoryKey] = category
         return self.categoryBySourceDescr[categoryKey]
@@ -331,7 +339,7 @@ class STARROrderMedConversion:
                     "description": sourceItem["med_description"],
                 }
             )
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn)
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn)
             clinicalItem["clinical_item_id"] = clinicalItemId
             self.clinicalItemByCategoryIdCode[clinicalItemKey] = clinicalItem
         else:
@@ -358,21 +366,7 @@ class STARROrderMedConversion:
                 "item_date_utc": str(sourceItem["order_time_jittered_utc"]),    # without str(), the time is being converted in postgres
             }
         )
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()))
-        insertParams = list(patientItem.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insertQuery, insertParams, conn=conn)
-            patientItem["patient_item_id"] = DBUtil.execute(DBUtil.identityQuery("patient_item"), conn=conn)[0][0]
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existint ID and continue to insert whatever else is possible
-            log.info(err)    # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = {
-                "patient_id":       patientItem["patient_id"],
-                "clinical_item_id": patientItem["clinical_item_id"],
-                "item_date":        patientItem["item_date"],
-            }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn)
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn)
         return patientItem
 
     def itemCollectionFromSourceItem(self, sourceItem, conn):
@@ -415,27 +409,14 @@ class STARROrderMedConversion:
                     "collection_type_id": COLLECTION_TYPE_ORDERSET,
                 }
             )
-            (collectionItemId, isNew) = DBUtil.findOrInsertItem("item_collection_item", collectionItem, conn=conn)
+            (collectionItemId, isNew) = self.collectionItemCache.findOrInsertItem(collectionItem, conn=conn)
             collectionItem["item_collection_item_id"] = collectionItemId
             self.itemCollectionItemByCollectionIdItemId[itemKey] = collectionItem
         return self.itemCollectionItemByCollectionIdItemId[itemKey]
 
     def patientItemCollectionLinkFromSourceItem(self, sourceItem, collectionItem, patientItem, conn):
-        # Produce a patient_item_collection_link record model for the given sourceItem
-        patientItemCollectionLink = RowItemModel(
-            {
-                "patient_item_id": patientItem["patient_item_id"],
-                "item_collection_item_id": collectionItem["item_collection_item_id"],
-            }
-        )
-        insertQuery = DBUtil.buildInsertQuery("patient_item_collection_link", list(patientItemCollectionLink.keys()))
-        insertParams = list(patientItemCollectionLink.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insertQuery, insertParams, conn=conn)
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.info(err)
+        # Queue a patient_item_collection_link record for the given sourceItem, inserted once the patient item has its ID
+        self.patientItemBuffer.addCollectionLink(patientItem, collectionItem, conn=conn)
 
     def main(self, argv):
         """Main method, callable from command line"""
@@ -11,10 +11,11 @@ from datetime import timedelta
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots
 from medinfo.db import DBUtil
-from medinfo.db.Model import SQLQuery
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList
+from medinfo.db.Model import RowItemModel
 
 from medinfo.dataconversion.Util import log
+from medinfo.dataconversion.DimensionCache import sharedCache
+from medinfo.dataconversion.PatientItemBuffer import PatientItemBuffer
 from medinfo.dataconversion.Const import COLLECTION_TYPE_ORDERSET
 from medinfo.dataconversion.Env import DATE_FORMAT
 
@@ -60,6 +61,10 @@ class STARROrderProcConversion:
 
         self.categoryBySourceDescr = dict()                     # Local cache to track the clinical item category table contents
         self.clinicalItemByCategoryIdExtId = dict()             # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category")
+        self.clinicalItemCache = sharedCache("clinical_item")
+        self.collectionItemCache = sharedCache("item_collection_item")
+        self.patientItemBuffer = PatientItemBuffer()   # Batched patient_item inserts, so must flush before the connection is closed
 
         self.itemCollectionByKeyStr = dict()                    # Local cache to track item collections
         self.itemCollectionItemByCollectionIdItemId = dict()    # Local cache to track item collection items
@@ -117,6 +122,7 @@ class STARROrderProcConversion:
             for sourceItem in self.querySourceItems(startDate, endDate, progress=progress, conn=conn):
                 self.convertSourceItem(sourceItem, conn=conn)
                 progress.Update()
+            self.patientItemBuffer.flush(conn)
         finally:
             conn.close()
         progress.PrintStatus()
@@ -222,6 +228,8 @@ class STARROrderProcConversion:
                 itemCollection = self.itemCollectionFromSourceItem(sourceItem, conn=conn)
                 itemCollectionItem = self.itemCollectionItemFromSourceItem(sourceItem, itemCollection, clinicalItem, conn=conn)
                 patientItemCollectionLink = self.patientItemCollectionLinkFromSourceItem(sourceItem, itemCollectionItem, patientItem, conn=conn)
+            if not extConn:
+                self.patientItemBuffer.flush(conn)
         finally:
             if not extConn:
                 conn.close()
@@ -237,7 +245,7 @@ class STARROrderProcConversion:
                     "description": "{} ({})".format(sourceItem["order_type"], sourceItem["ordering_mode"])
                 }
             )
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn)
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn)
             category["clinical_item_category_id"] = categoryId
             self.categoryBySourceDescr[categoryKey] = category
         return self.categoryBySourceDescr[categoryKey]
@@ -263,7 +271,7 @@ class STARROrderProcConversion:
                     "description":               sourceItem["description"],
                 }
             )
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn)
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn)
             clinicalItem["clinical_item_id"] = clinicalItemId
             self.clinicalItemByCategoryIdExtId[clinicalItemKey] = clinicalItem
         return self.clinicalItemByCategoryIdExtId[clinicalItemKey]
@@ -286,23 +294,8 @@ class STARROrderProcConversion:
         if key_hash in self.patient_items:
             return self.patient_items[key_hash]
 
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()))
-        insertParams = list(patientItem.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insertQuery, insertParams, conn=conn)
-            patientItem["patient_item_id"] = DBUtil.execute(DBUtil.identityQuery("patient_item"), conn=conn)[0][0]
-            self.patient_items[key_hash] = patientItem
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existint ID and continue to insert whatever else is possible
-            log.warn(err)   # Lookup just by the composite key components to avoid attempting duplicate insertion again
-            searchPatientItem = {
-                "patient_id":       patientItem["patient_id"],
-                "clinical_item_id": patientItem["clinical_item_id"],
-                "item_date":        patientItem["item_date"],
-            }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem, conn=conn)
-            self.patient_items[key_hash] = patientItem
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn)
+        self.patient_items[key_hash] = patientItem
 
         return patientItem
 
@@ -338,33 +331,21 @@ class STARROrderProcConversion:
                     "collection_type_id": COLLECTION_TYPE_ORDERSET,
                 }
             )
-            (collectionItemId, isNew) = DBUtil.findOrInsertItem("item_collection_item", collectionItem, conn=conn)
+            (collectionItemId, isNew) = self.collectionItemCache.findOrInsertItem(collectionItem, conn=conn)
             collectionItem["item_collection_item_id"] = collectionItemId
             self.itemCollectionItemByCollectionIdItemId[itemKey] = collectionItem
         return self.itemCollectionItemByCollectionIdItemId[itemKey]
 
     def patientItemCollectionLinkFromSourceItem(self, sourceItem, collectionItem, patientItem, conn):
-        hash_key = hash('{}{}'.format(patientItem["patient_item_id"], collectionItem["item_collection_item_id"]))
+        # Track by the patient item composite key, as its patient_item_id may not be resolved until the next batch flush
+        hash_key = hash('{}{}{}{}'.format(patientItem["patient_id"], patientItem["clinical_item_id"], patientItem["item_date"],
+                                          collectionItem["item_collection_item_id"]))
         if hash_key in self.patient_item_collection_links:
             return
 
-        # Produce a patient_item_collection_link record model for the given sourceItem
-        patientItemCollectionLink = RowItemModel(
-            {
-                "patient_item_id": patientItem["patient_item_id"],
-                "item_collection_item_id":  collectionItem["item_collection_item_id"],
-            }
-        )
-        insertQuery = DBUtil.buildInsertQuery("patient_item_collection_link", list(patientItemCollectionLink.keys()))
-        insertParams = list(patientItemCollectionLink.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insertQuery, insertParams, conn=conn)
-            self.patient_item_collection_links.add(hash_key)
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, just note it and continue to insert whatever else is possible
-            log.warn(err)
-            self.patient_item_collection_links.add(hash_key)
+        # Queue a patient_item_collection_link record for the given sourceItem
+        self.patientItemBuffer.addCollectionLink(patientItem, collectionItem, conn=conn)
+        self.patient_item_collection_links.add(hash_key)
 
     def main(self, argv):
         """Main method, callable from command line"""
@@ -8,10 +8,11 @@ from datetime import datetime
 from optparse import OptionParser
 from medinfo.common.Util import stdOpen, ProgressDots
 from medinfo.db import DBUtil
-from medinfo.db.Model import SQLQuery
-from medinfo.db.Model import RowItemModel, modelListFromTable, modelDictFromList, RowItemFieldComparator
+from medinfo.db.Model import RowItemModel
 
 from medinfo.dataconversion.Util import log
+from medinfo.dataconversion.DimensionCache import sharedCache
+from medinfo.dataconversion.PatientItemBuffer import PatientItemBuffer
 from medinfo.dataconversion.Env import DATE_FORMAT
 
 from medinfo.db.bigquery import bigQueryUtil
@@ -53,6 +54,9 @@ class STARRTreatmentTeamConversion:
 
         self.categoryBySourceDescr = dict()  # Local cache to track the clinical item category table contents
         self.clinicalItemByCompositeKey = dict()  # Local cache to track clinical item table contents
+        self.categoryCache = sharedCache("clinical_item_category")
+        self.clinicalItemCache = sharedCache("clinical_item")
+        self.patientItemBuffer = PatientItemBuffer()   # Batched patient_item inserts, so must flush before the connection is closed
 
     def convertAndUpload(self, convOptions, tempDir=tempfile.gettempdir(), removeCsvs=True, targetDatasetId='clinical_item2018'):
         """
@@ -100,6 +104,7 @@ class STARRTreatmentTeamConversion:
                 log.debug('sourceItem: {}'.format(sourceItem))
                 self.convertSourceItem(category, sourceItem, conn=conn)
                 progress.Update()
+            self.patientItemBuffer.flush(conn)
 
         finally:
             conn.close()
@@ -247,6 +252,8 @@ class STARRTreatmentTeamConversion:
             #   in a first pass, with subsequent calls just yielding back in memory cached copies
             clinicalItem = self.clinicalItemFromSourceItem(sourceItem, category, conn=conn)
             ignoredPatientItem = self.patientItemFromSourceItem(sourceItem, clinicalItem, conn=conn)
+            if not extConn:
+                self.patientItemBuffer.flush(conn)
 
         finally:
             if not extConn:
@@ -265,7 +272,7 @@ class STARRTreatmentTeamConversion:
                     "description": categoryDescription,
                 }
             )
-            (categoryId, isNew) = DBUtil.findOrInsertItem("clinical_item_category", category, conn=conn)
+            (categoryId, isNew) = self.categoryCache.findOrInsertItem(category, conn=conn)
             category["clinical_item_category_id"] = categoryId
             self.categoryBySourceDescr[categoryKey] = category
         return self.categoryBySourceDescr[categoryKey]
@@ -283,7 +290,7 @@ class STARRTreatmentTeamConversion:
                     "description": sourceItem["description"],
                 }
             )
-            (clinicalItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", clinicalItem, conn=conn)
+            (clinicalItemId, isNew) = self.clinicalItemCache.findOrInsertItem(clinicalItem, conn=conn)
             clinicalItem["clinical_item_id"] = clinicalItemId
             self.clinicalItemByCompositeKey[clinicalItemKey] = clinicalItem
         return self.clinicalItemByCompositeKey[clinicalItemKey]
@@ -308,24 +315,7 @@ class STARRTreatmentTeamConversion:
             }
         )
 
-        insertQuery = DBUtil.buildInsertQuery("patient_item", list(patientItem.keys()))
-        insertParams = list(patientItem.values())
-        try:
-            # Optimistic insert of a new unique item
-            DBUtil.execute(insertQuery, insertParams, conn=conn)
-            # Retrieve id of just inserted row
-            patientItem["patient_item_id"] = DBUtil.execute(DBUtil.identityQuery("patient_item"), conn=conn)[0][0]
-        except conn.IntegrityError as err:
-            # If turns out to be a duplicate, okay, pull out existing ID and continue to insert whatever else is possible
-            log.info(err)  # Lookup just by the composite key components to avoid attempting duplicate insertion again
-
-            searchPatientItem = {
-                "patient_id": patientItem["patient_id"],
-                "clinical_item_id": patientItem["clinical_item_id"],
-                "item_date": patientItem["item_date"],
-            }
-            (patientItem["patient_item_id"], isNew) = DBUtil.findOrInsertItem("patient_item", searchPatientItem,
-                                                                              conn=conn)
+        self.patientItemBuffer.addPatientItem(patientItem, conn=conn)
         return patientItem
 
     def main(self, argv):
@@ -19,6 +19,7 @@ from datetime import time
 import unittest
 
 from medinfo.dataconversion.starr_conv import STARRDemographicsConversion
+from medinfo.dataconversion.DimensionCache import clearSharedCaches
 from medinfo.dataconversion.starr_conv.STARRUtil import StarrCommonUtils
 from medinfo.dataconversion.test.Const import RUNNER_VERBOSITY
 from medinfo.dataconversion.Util import log
@@ -69,6 +70,7 @@ class TestSTARRDemographicsConversion(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
         DBTestCase.setUp(self)
+        clearSharedCaches()   # Test database is rebuilt for each test, so don't reuse record IDs preloaded for a previous one
         ClinicalItemDataLoader.build_clinical_item_psql_schemata()
 
         # point the converter to dummy source table
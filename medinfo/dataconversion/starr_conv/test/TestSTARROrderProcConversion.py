@@ -25,6 +25,7 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel
 
 from medinfo.dataconversion.starr_conv import STARROrderProcConversion
+from medinfo.dataconversion.DimensionCache import clearSharedCaches
 from medinfo.dataconversion.starr_conv import STARRUtil
 
 TEST_SOURCE_TABLE = 'test_dataset.starr_order_proc'
@@ -1366,6 +1367,7 @@ class TestSTARROrderProcConversion(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
         DBTestCase.setUp(self)
+        clearSharedCaches()   # Test database is rebuilt for each test, so don't reuse record IDs preloaded for a previous one
 
         log.info("Sourcing from BigQuery DB")
         ClinicalItemDataLoader.build_clinical_item_psql_schemata()
@@ -23,6 +23,7 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel
 
 from medinfo.dataconversion.starr_conv import STARRTreatmentTeamConversion
+from medinfo.dataconversion.DimensionCache import clearSharedCaches
 from medinfo.dataconversion.starr_conv import STARRUtil
 
 TEST_SOURCE_TABLE = 'test_dataset.starr_treatment_team'
@@ -547,6 +548,7 @@ class TestSTARRTreatmentTeamConversion(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
         DBTestCase.setUp(self)
+        clearSharedCaches()   # Test database is rebuilt for each test, so don't reuse record IDs preloaded for a previous one
 
         log.info("Sourcing from BigQuery DB")
         ClinicalItemDataLoader.build_clinical_item_psql_schemata()
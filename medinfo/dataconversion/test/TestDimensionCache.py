@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+import unittest
+
+from .Const import RUNNER_VERBOSITY;
+from .Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import RowItemModel;
+
+from medinfo.dataconversion.DimensionCache import DimensionCache, sharedCache, clearSharedCaches;
+
+TEST_SOURCE_TABLE = "test_dimension_cache";
+
+class TestDimensionCache(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        ClinicalItemDataLoader.build_clinical_item_psql_schemata();
+
+        self.categoryId = DBUtil.findOrInsertItem("clinical_item_category", {"source_table": TEST_SOURCE_TABLE, "description": "Category"})[0];
+        self.existingItemId = DBUtil.findOrInsertItem("clinical_item", self.clinicalItemModel(-100, "A"))[0];
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+        DBUtil.execute("delete from clinical_item where clinical_item_category_id = %s" % self.categoryId);
+        DBUtil.execute("delete from clinical_item_category where source_table = '%s';" % TEST_SOURCE_TABLE);
+        DBTestCase.tearDown(self);
+
+    def clinicalItemModel(self, externalId, name):
+        return RowItemModel \
+            (   {   "clinical_item_category_id": self.categoryId,
+                    "external_id": externalId,
+                    "name": name,
+                    "description": "Item %s" % name,
+                }
+            );
+
+    def test_findOrInsertItem(self):
+        cache = DimensionCache("clinical_item");
+
+        # Existing records found from the preload, even if source values are different types (string vs. integer IDs)
+        self.assertEqual( (self.existingItemId, False), cache.findOrInsertItem(self.clinicalItemModel("-100", "A")) );
+
+        # New records inserted, then resolved in memory on repeat lookups
+        (newItemId, isNew) = cache.findOrInsertItem(self.clinicalItemModel(-200, "B"));
+        self.assertTrue( isNew );
+        self.assertEqual( (newItemId, False), cache.findOrInsertItem(self.clinicalItemModel(-200, "B")) );
+        self.assertEqual( (newItemId, False), DBUtil.findOrInsertItem("clinical_item", self.clinicalItemModel(-200, "B")) );
+        self.assertEqual( (2, 1, 1), (cache.nHits, cache.nMisses, cache.nInserts) );
+
+        # Record added by another process since the preload should be found rather than duplicated
+        (otherItemId, isNew) = DBUtil.findOrInsertItem("clinical_item", self.clinicalItemModel(-300, "C"));
+        self.assertEqual( (otherItemId, False), cache.findOrInsertItem(self.clinicalItemModel(-300, "C")) );
+        self.assertEqual( 1, cache.nInserts );
+
+        itemCount = DBUtil.execute("select count(*) from clinical_item where clinical_item_category_id = %s" % self.categoryId)[0][0];
+        self.assertEqual( 3, itemCount );
+
+        # Separate cache (e.g., another conversion process) sharing the same records
+        otherCache = DimensionCache("clinical_item");
+        self.assertEqual( (newItemId, False), otherCache.findOrInsertItem(self.clinicalItemModel(-200, "B")) );
+        (nextItemId, isNew) = otherCache.findOrInsertItem(self.clinicalItemModel(-400, "D"));
+        self.assertTrue( isNew );
+        self.assertNotEqual( newItemId, nextItemId );
+
+    def test_sharedCache(self):
+        clearSharedCaches();
+
+        # Same instance for every conversion process, so the table is only preloaded once
+        cache = sharedCache("clinical_item");
+        self.assertTrue( cache is sharedCache("clinical_item") );
+        self.assertFalse( cache is sharedCache("clinical_item_category") );
+        self.assertEqual( (self.existingItemId, False), sharedCache("clinical_item").findOrInsertItem(self.clinicalItemModel(-100, "A")) );
+        self.assertEqual( 1, len(cache.idByKeyByCols) );
+
+        # Fresh instance after clearing, loading from the database again
+        clearSharedCaches();
+        self.assertFalse( cache is sharedCache("clinical_item") );
+        self.assertEqual( 0, len(sharedCache("clinical_item").idByKeyByCols) );
+        clearSharedCaches();
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestDimensionCache));
+    return suite;
+
+if __name__=="__main__":
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Test case for respective module in application package"""
+
+import sys, os
+from datetime import datetime;
+import unittest
+
+from .Const import RUNNER_VERBOSITY;
+from .Util import log;
+
+from medinfo.db.test.Util import DBTestCase;
+from stride.clinical_item.ClinicalItemDataLoader import ClinicalItemDataLoader;
+
+from medinfo.db import DBUtil
+from medinfo.db.Model import RowItemModel;
+
+from medinfo.dataconversion.Const import COLLECTION_TYPE_ORDERSET;
+from medinfo.dataconversion.PatientItemBuffer import PatientItemBuffer;
+
+TEST_SOURCE_TABLE = "test_patient_item_buffer";
+
+class TestPatientItemBuffer(DBTestCase):
+    def setUp(self):
+        """Prepare state for test cases"""
+        DBTestCase.setUp(self);
+
+        log.info("Populate the database with test data")
+        ClinicalItemDataLoader.build_clinical_item_psql_schemata();
+
+        self.categoryId = DBUtil.findOrInsertItem("clinical_item_category", {"source_table": TEST_SOURCE_TABLE, "description": "Category"})[0];
+        self.clinicalItemId = DBUtil.findOrInsertItem("clinical_item", {"clinical_item_category_id": self.categoryId, "name": "A", "description": "Item A"})[0];
+        self.collectionId = DBUtil.findOrInsertItem("item_collection", {"external_id": -100, "name": "Collection"})[0];
+        self.collectionItem = {"item_collection_id": self.collectionId, "clinical_item_id": self.clinicalItemId, "collection_type_id": COLLECTION_TYPE_ORDERSET};
+        self.collectionItem["item_collection_item_id"] = DBUtil.findOrInsertItem("item_collection_item", dict(self.collectionItem))[0];
+
+        # Existing record from a previous conversion run
+        self.existingItemId = DBUtil.findOrInsertItem("patient_item", self.patientItemModel(-1, datetime(2011,1,1)))[0];
+
+    def tearDown(self):
+        """Restore state from any setUp or test steps"""
+        log.info("Purge test records from the database")
+        DBUtil.execute("delete from patient_item_collection_link where item_collection_item_id = %s" % self.collectionItem["item_collection_item_id"]);
+        DBUtil.execute("delete from patient_item where clinical_item_id = %s" % self.clinicalItemId);
+        DBUtil.execute("delete from item_collection_item where item_collection_id = %s" % self.collectionId);
+        DBUtil.execute("delete from item_collection where item_collection_id = %s" % self.collectionId);
+        DBUtil.execute("delete from clinical_item where clinical_item_category_id = %s" % self.categoryId);
+        DBUtil.execute("delete from clinical_item_category where source_table = '%s';" % TEST_SOURCE_TABLE);
+        DBTestCase.tearDown(self);
+
+    def patientItemModel(self, patientId, itemDate):
+        return RowItemModel \
+            (   {   "patient_id": patientId,
+                    "clinical_item_id": self.clinicalItemId,
+                    "item_date": itemDate,
+                }
+            );
+
+    def test_flush(self):
+        conn = DBUtil.connection();
+        try:
+            buffer = PatientItemBuffer(batchSize=3);
+            patientItems = \
+                [   self.patientItemModel(-1, datetime(2011,1,1)),   # Duplicate of existing record
+                    self.patientItemModel(-2, datetime(2011,1,2)),
+                    self.patientItemModel(-2, datetime(2011,1,2)),   # Repeated within the batch
+                    self.patientItemModel(-3, datetime(2011,1,3)),   # Next batch
+                ];
+            for patientItem in patientItems:
+                buffer.addPatientItem(patientItem, conn);
+                buffer.addCollectionLink(patientItem, self.collectionItem, conn);
+
+            # First batch flushed when full, the rest not until explicitly flushed
+            self.assertEqual(self.existingItemId, patientItems[0]["patient_item_id"]);
+            self.assertEqual(patientItems[1]["patient_item_id"], patientItems[2]["patient_item_id"]);
+            self.assertTrue("patient_item_id" not in patientItems[3]);
+            buffer.flush(conn);
+        finally:
+            conn.close();
+
+        itemIdByPatientId = dict( DBUtil.execute("select patient_id, patient_item_id from patient_item where clinical_item_id = %s" % self.clinicalItemId) );
+        self.assertEqual( 3, len(itemIdByPatientId) );
+        self.assertEqual( [itemIdByPatientId[patientItem["patient_id"]] for patientItem in patientItems], [patientItem["patient_item_id"] for patientItem in patientItems] );
+        # Repeated patient item within the batch resolves to the same patient_item_id, so its duplicate link is skipped by the unique constraint
+        self.assertEqual( (2, 1, 3), (buffer.nInserted, buffer.nSkipped, buffer.nLinks) );
+
+        linkCount = DBUtil.execute("select count(*) from patient_item_collection_link where item_collection_item_id = %s" % self.collectionItem["item_collection_item_id"])[0][0];
+        self.assertEqual( 3, linkCount );
+
+def suite():
+    """Returns the suite of tests to run for this test class / module.
+    Use unittest.makeSuite methods which simply extracts all of the
+    methods for the given class whose name starts with "test"
+    """
+    suite = unittest.TestSuite();
+    suite.addTest(unittest.makeSuite(TestPatientItemBuffer));
+    return suite;
+
+if __name__=="__main__":
+    unittest.TextTestRunner(verbosity=RUNNER_VERBOSITY).run(suite())
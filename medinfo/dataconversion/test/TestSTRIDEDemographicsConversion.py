@@ -19,6 +19,7 @@ from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery, RowItemModel;
 
 from medinfo.dataconversion.STRIDEDemographicsConversion import STRIDEDemographicsConversion;
+from medinfo.dataconversion.DimensionCache import clearSharedCaches;
 
 TEST_SOURCE_TABLE = "stride_patient";
 
@@ -26,6 +27,7 @@ class TestSTRIDEDemographicsConversion(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
         DBTestCase.setUp(self);
+        clearSharedCaches();   # Test database is rebuilt for each test, so don't reuse record IDs preloaded for a previous one
         
         log.info("Populate the database with test data")
         StrideLoader.build_stride_psql_schemata()
@@ -18,6 +18,7 @@ from medinfo.db.Model import SQLQuery, RowItemModel;
 from medinfo.db.ResultsFormatter import TabDictReader;
 
 from medinfo.dataconversion.STRIDETreatmentTeamConversion import STRIDETreatmentTeamConversion, ConversionOptions;
+from medinfo.dataconversion.DimensionCache import clearSharedCaches;
 
 TEST_START_DATE = datetime(2100,1,1);   # Date in far future to start checking for test records to avoid including existing data in database
 
@@ -25,6 +26,7 @@ class TestSTRIDETreatmentTeamConversion(DBTestCase):
     def setUp(self):
         """Prepare state for test cases"""
         DBTestCase.setUp(self);
+        clearSharedCaches();   # Test database is rebuilt for each test, so don't reuse record IDs preloaded for a previous one
         
         log.info("Populate the database with test data")
         StrideLoader.build_stride_psql_schemata()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Pool of reusable database connections, so that short operations (e.g., single queries
+from web requests or conversion scripts) do not each pay the cost of opening a new connection.
+"""
+
+import sys, os
+import time;
+import threading;
+from collections import deque;
+from contextlib import contextmanager;
+
+from .Util import log;
+
+# Default minimum number of idle connections the pool keeps open, rather than closing after MAX_IDLE_SECONDS
+MIN_SIZE = 1;
+
+# Default maximum number of connections the pool will have open (idle or checked out) at once
+MAX_SIZE = 10;
+
+# Seconds a connection can sit idle in the pool before being health checked again on checkout
+HEALTH_CHECK_SECONDS = 30;
+
+# Seconds a connection can sit idle in the pool (beyond the minimum size) before being closed
+MAX_IDLE_SECONDS = 600;
+
+# Lightweight query to check that a connection is still usable
+HEALTH_CHECK_QUERY = "select 1";
+
+class PoolExhaustedError(Exception):
+    """Raised when no pooled connection becomes available within the checkout timeout"""
+    pass;
+
+class ConnectionPool:
+    """Thread safe pool of database connections, produced by the given connect function (e.g., DBUtil.openConnection).
+
+    connection() checks out a PooledConnection, which behaves as the underlying connection,
+    except that close() returns it to the pool (rolling back anything not committed, as closing would) rather than closing it.
+    So existing code that opens a connection, uses it, and closes it when done can reuse pooled connections without modification.
+    Alternatively, use the checkout() context manager.
+
+    Connections are opened as needed (up to maxSize), and kept open when returned, though idle connections
+    beyond minSize are closed after maxIdleSeconds.
+    Connections that sat idle for more than healthCheckSeconds are checked with a quick query before reuse,
+    and any found broken are discarded and replaced.
+    If maxSize connections are already checked out, callers wait up to timeout seconds (None to wait indefinitely)
+    for one to be returned, before raising PoolExhaustedError.
+
+    Connections are not shared across processes.  If used from a forked child process, the pool starts over with new connections,
+    and connections checked out before the fork are left untouched (not rolled back or closed) when closed in the child.
+    Beware SQLite connections by default cannot be used from threads other than the one that opened them.
+    """
+    def __init__(self, connect, minSize=MIN_SIZE, maxSize=MAX_SIZE, healthCheckSeconds=HEALTH_CHECK_SECONDS, maxIdleSeconds=MAX_IDLE_SECONDS, timeout=None):
+        self.connect = connect;
+        self.minSize = minSize;
+        self.maxSize = maxSize;
+        self.healthCheckSeconds = healthCheckSeconds;
+        self.maxIdleSeconds = maxIdleSeconds;
+        self.timeout = timeout;
+
+        self.condition = threading.Condition();
+        self.idle = deque();    # (connection, generation, time returned) of idle connections, most recently returned last
+        self.nOpen = 0;     # Number of open connections, idle or checked out
+        self.generation = 0;    # Incremented by reset, so connections opened before then are not reused
+        self.pid = os.getpid();
+        self.inheritedConnections = list(); # Connections inherited from a parent process, just kept referenced so they are not closed out from under the parent
+
+        # Usage statistics
+        self.nCreated = 0;
+        self.nReused = 0;
+        self.nDiscarded = 0;
+
+    def connection(self):
+        """Check out a PooledConnection, reusing an idle connection if available.
+        Health checks and opening new connections can block on the network,
+        so are done without holding the lock, after taking the connection (or an open slot) out of the pool.
+        """
+        deadline = None;
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout;
+        while True:
+            (conn, generation, returnTime) = self.reserveConnection(deadline);
+            if conn is None:
+                # Reserved a slot for a new connection
+                try:
+                    conn = self.openConnection();
+                except Exception:
+                    with self.condition:
+                        self.nOpen -= 1;
+                        self.condition.notify();
+                    raise;
+                return PooledConnection(self, conn, generation);
+
+            if time.time() - returnTime > self.healthCheckSeconds and not self.isHealthy(conn):
+                with self.condition:
+                    self.discard(conn);
+                    self.condition.notify();
+                continue;
+            with self.condition:
+                self.nReused += 1;
+            return PooledConnection(self, conn, generation);
+
+    def reserveConnection(self, deadline):
+        """Take the most recently returned idle (connection, generation, return time) out of the pool.
+        If there are none, but fewer than maxSize connections open, then reserve a slot for a new connection instead,
+        returning (None, generation, None).  Otherwise, wait until the deadline for a connection to be returned.
+        """
+        with self.condition:
+            self.checkProcess();
+            while True:
+                if self.idle:
+                    return self.idle.pop();
+                if self.nOpen < self.maxSize:
+                    self.nOpen += 1;
+                    return (None, self.generation, None);
+
+                # Pool exhausted, wait for a connection to be returned
+                waitSeconds = None;
+                if deadline is not None:
+                    waitSeconds = deadline - time.time();
+                    if waitSeconds <= 0:
+                        raise PoolExhaustedError("No database connection available after %s seconds (%d connections checked out)" % (self.timeout, self.nOpen) );
+                self.condition.wait(waitSeconds);
+
+    @contextmanager
+    def checkout(self):
+        """Context manager to check out a connection and return it to the pool when done"""
+        conn = self.connection();
+        try:
+            yield conn;
+        finally:
+            conn.close();
+
+    def release(self, conn, generation, pid):
+        """Return a checked out connection to the pool.  Called by PooledConnection.close"""
+        if pid != os.getpid():
+            # Checked out in a parent process, so not part of this process's pool.
+            #   Leave the connection untouched (no rollback or close), as it is still the parent's socket
+            with self.condition:
+                self.inheritedConnections.append(conn);
+            return;
+        with self.condition:
+            try:
+                conn.rollback();    # Discard any uncommitted work, same as closing the connection would have done
+                if getattr(conn, "autocommit", False) is True:
+                    conn.autocommit = False;    # Restore default transaction behavior for the next user
+            except Exception as err:
+                log.warning("Discarding broken pooled connection: %s" % err);
+                self.discard(conn);
+            else:
+                if generation != self.generation:
+                    self.discard(conn);
+                else:
+                    self.idle.append( (conn, generation, time.time()) );
+                    self.pruneIdle();
+            self.condition.notify();
+
+    def isHealthy(self, conn):
+        """Check if the connection is still usable by running a quick query"""
+        if getattr(conn, "closed", 0):    # psycopg2 reports nonzero if closed
+            return False;
+        try:
+            cursor = conn.cursor();
+            try:
+                cursor.execute(HEALTH_CHECK_QUERY);
+                cursor.fetchall();
+            finally:
+                cursor.close();
+            conn.rollback();
+            return True;
+        except Exception as err:
+            log.warning("Pooled connection failed health check: %s" % err);
+            return False;
+
+    def openConnection(self):
+        conn = self.connect();
+        with self.condition:
+            self.nCreated += 1;
+        return conn;
+
+    def discard(self, conn):
+        """Close and forget about a connection (caller should hold the condition lock)"""
+        self.nOpen -= 1;
+        self.nDiscarded += 1;
+        try:
+            conn.close();
+        except Exception:
+            pass;   # Already broken anyway
+
+    def pruneIdle(self):
+        """Close connections idle for longer than maxIdleSeconds, down to the minimum pool size.
+        Idle list is in order of return time, so the oldest are at the front.
+        """
+        now = time.time();
+        while len(self.idle) > self.minSize and now - self.idle[0][2] > self.maxIdleSeconds:
+            (conn, generation, returnTime) = self.idle.popleft();
+            self.discard(conn);
+
+    def checkProcess(self):
+        """If now running in a forked child process, start over rather than sharing the parent's connections"""
+        if os.getpid() != self.pid:
+            self.inheritedConnections.extend([conn for (conn, generation, returnTime) in self.idle]);
+            self.idle.clear();
+            self.nOpen = 0;
+            self.generation += 1;
+            self.pid = os.getpid();
+
+    def reset(self):
+        """Close all of the idle connections, and have any currently checked out closed when returned,
+        rather than reused (e.g., because the connection parameters changed or the database is to be dropped).
+        """
+        with self.condition:
+            self.checkProcess();
+            self.generation += 1;
+            while self.idle:
+                (conn, generation, returnTime) = self.idle.pop();
+                self.discard(conn);
+            self.condition.notify_all();
+
+    def close(self):
+        """Close all of the idle connections.  Any still checked out will be closed when returned"""
+        self.reset();
+
+    def stats(self):
+        with self.condition:
+            return \
+                {   "open": self.nOpen,
+                    "idle": len(self.idle),
+                    "checkedOut": self.nOpen - len(self.idle),
+                    "created": self.nCreated,
+                    "reused": self.nReused,
+                    "discarded": self.nDiscarded,
+                };
+
+class PooledConnection:
+    """Wrapper around a pooled database connection, that passes through all attributes
+    to the underlying connection, except close returns the connection to the pool.
+    """
+    def __init__(self, pool, conn, generation):
+        self.__dict__["pool"] = pool;
+        self.__dict__["conn"] = conn;
+        self.__dict__["generation"] = generation;
+        self.__dict__["pid"] = os.getpid();   # Process that checked out the connection
+
+    def __getattr__(self, name):
+        conn = self.__dict__["conn"];
+        if conn is None:
+            raise AttributeError("Pooled connection already closed (returned to the pool)");
+        return getattr(conn, name);
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__["conn"], name, value);
+
+    def close(self):
+        conn = self.__dict__["conn"];
+        if conn is not None:
+            self.__dict__["conn"] = None;
+            self.pool.release(conn, self.generation, self.pid);
+
+    def __del__(self):
+        # Return the connection to the pool even if the caller forgot to close it
+        try:
+            self.close();
+        except Exception:
+            pass;
@@ -14,6 +14,16 @@ DEFAULT_ID_COL_SUFFIX = "_id";
 """Wildcard string used in SQL queries"""
 SQL_WILDCARD = "%";
 
+"""Number of rows to send to the database at a time for bulk inserts (COPY / executemany batches)"""
+BULK_INSERT_SIZE = 10000;
+
+"""Number of rows to fetch from the database at a time when streaming through query results (DBUtil.iterExecute)"""
+ITER_SIZE = 10000;
+
+"""Seconds a long running process can go without any database interaction before checking in with a quick query,
+to keep its (otherwise idle) connection from being dropped as timed out"""
+KEEP_ALIVE_SECONDS = 60;
+
 """Default level for application logging.  Modify these for different scenarios.  See Python logging package documentation for more information"""
 LOGGER_LEVEL = Env.LOGGER_LEVEL
 
@@ -19,10 +19,13 @@ be edited in the following places...
 
 import sys, os
 import subprocess
+import itertools;
 import time;
 from datetime import datetime;
 import json;
 import csv;
+from io import StringIO;
+from contextlib import contextmanager;
 from getpass import getpass;
 from optparse import OptionParser
 from medinfo.common.Const import EST_INPUT, COMMENT_TAG, TOKEN_END, NULL_STRING;
@@ -30,9 +33,10 @@ from medinfo.common.Util import stdOpen, isStdFile, fileLineCount, ProgressDots;
 from medinfo.common.Util import parseDateValue, asciiSafeStr;
 from .Model import SQLQuery, RowItemModel;
 from .Model import modelListFromTable, modelDictFromList;
-from .Const import DEFAULT_ID_COL_SUFFIX, SQL_DELIM;
+from .Const import DEFAULT_ID_COL_SUFFIX, SQL_DELIM, BULK_INSERT_SIZE, ITER_SIZE;
 from .Env import DB_PARAM;   # Default connection parameters
 from .ResultsFormatter import TextResultsFormatter, TabDictReader;
+from .ConnectionPool import ConnectionPool, MIN_SIZE, MAX_SIZE, HEALTH_CHECK_QUERY;
 from .Util import log;
 from medinfo.db import Util;
 
@@ -45,8 +49,69 @@ DOUBLE_TOKEN_END = TOKEN_END+TOKEN_END;
 from . import Env;
 SQL_PLACEHOLDER = Env.SQL_PLACEHOLDER;
 
+# Formats that iterExecute can yield results in
+#   None:   One row (list) at a time, like the rows of an execute result
+#   rows:   Chunks of up to iterSize rows at a time, as lists of the raw row tuples
+#   numpy:  Chunks as numpy record arrays with fields named by the result columns
+#   pandas: Chunks as pandas DataFrames with the result column names
+CHUNK_FORMATS = (None, "rows", "numpy", "pandas");
+
+# Source of unique names for server side cursors
+serverCursorIds = itertools.count();
+
+# Shared pool for the default database connections, if enabled (see enableConnectionPool)
+defaultPool = None;
+
+# Copy of the default connection parameters the defaultPool connections were opened with, to detect if they change
+defaultPoolParams = None;
+
 def connection( connParams=None ):
     """Return a connection to the application database.
+    If connParams are not specified and the default connection pool is enabled,
+    borrow a pooled connection, which will return to the pool when closed.
+    Otherwise, open a new connection (see openConnection).
+    """
+    global defaultPoolParams;
+    if connParams is None and defaultPool is not None:
+        if defaultPoolParams != DB_PARAM:
+            # Default parameters changed (e.g., switched to test database), so existing connections no longer apply
+            defaultPool.reset();
+            defaultPoolParams = dict(DB_PARAM);
+        return defaultPool.connection();
+    return openConnection( connParams );
+
+def enableConnectionPool( minSize=MIN_SIZE, maxSize=MAX_SIZE, **poolOptions ):
+    """Have default connection() calls borrow from a shared ConnectionPool,
+    rather than opening a new connection each time.  See ConnectionPool for other options.
+    Returns the pool.
+    """
+    global defaultPool, defaultPoolParams;
+    disableConnectionPool();
+    defaultPoolParams = dict(DB_PARAM);
+    defaultPool = ConnectionPool(openConnection, minSize=minSize, maxSize=maxSize, **poolOptions);
+    return defaultPool;
+
+def disableConnectionPool():
+    """Close any default connection pool, going back to opening a new connection for each connection() call"""
+    global defaultPool;
+    if defaultPool is not None:
+        defaultPool.close();
+    defaultPool = None;
+
+def pingConnection( conn ):
+    """Send a quick health check query on the connection (without committing or rolling back anything),
+    e.g., to keep a connection held by a long running process from being dropped as idle.
+    Raises any error if the connection is no longer usable.
+    """
+    cursor = conn.cursor();
+    try:
+        cursor.execute(HEALTH_CHECK_QUERY);
+        cursor.fetchall();
+    finally:
+        cursor.close();
+
+def openConnection( connParams=None ):
+    """Open a new connection to the application database.
     Implementation of this method should change depending upon what
     database is being interfaced to.
     """
@@ -103,6 +168,8 @@ def connection( connParams=None ):
         import google.cloud.bigquery.dbapi;
         return google.cloud.bigquery.dbapi.connect();   # Depends on environment variables to identify right connection
 
+if Env.DB_POOL_PARAM is not None:
+    enableConnectionPool(**Env.DB_POOL_PARAM);
 
 
 def identityQuery( tableName , pgSeqName=None):
@@ -135,6 +202,40 @@ def sequenceName( tableName ):
     pgSeqName = tableName[:29] + "_" + idCol[:29] + "_seq"
     return pgSeqName; #PostgreSQL auto generated object name for sequence
 
+def buildInsertSelectQuery( tableName, colNames, selectQuery, ignoreDuplicates=False ):
+    """Given a table, a list of column names under that table, and a SQL select query string
+    yielding parallel columns, construct a set-based "insert into ... select ..." query.
+    If ignoreDuplicates, rows that would violate a unique constraint are skipped instead of raising an IntegrityError
+    (rather than the slow alternative of inserting rows one at a time and catching each error).
+
+    For PostgreSQL (9.5+) and SQLite (3.24+), this uses "on conflict do nothing".
+    Note SQLite requires the select query to include a where clause (if only "where true")
+    to avoid parsing ambiguity with the trailing on conflict clause.
+    """
+    query = "insert into %s (%s) %s" % (tableName, str.join(",", colNames), selectQuery);
+    if ignoreDuplicates:
+        if Env.DATABASE_CONNECTOR_NAME in ("mysql.connector", "MySQLdb"):
+            query = "insert ignore"+query[len("insert"):];
+        else:
+            query += " on conflict do nothing";
+    return query;
+
+def buildUpdateFromQuery( tableName, colNames, sourceQuery, keyColNames ):
+    """Given a table, a list of column names to update under that table, and a SQL select query string
+    yielding the key columns and the same named update columns, construct a set-based update query
+    that sets the table columns to the values of the source query rows with matching key values.
+    Equivalent to calling updateRow for every source query row, but in a single statement.
+
+    For PostgreSQL and SQLite (3.33+), uses "update ... from".  For MySQL, "update ... join".
+    """
+    keyConditions = str.join(" and ", ["%s.%s = src.%s" % (tableName, keyCol, keyCol) for keyCol in keyColNames] );
+    if Env.DATABASE_CONNECTOR_NAME in ("mysql.connector", "MySQLdb"):
+        assignments = str.join(", ", ["%s.%s = src.%s" % (tableName, col, col) for col in colNames] );
+        return "update %s inner join (%s) as src on %s set %s" % (tableName, sourceQuery, keyConditions, assignments);
+
+    assignments = str.join(", ", ["%s = src.%s" % (col, col) for col in colNames] );
+    return "update %s set %s from (%s) as src where %s" % (tableName, assignments, sourceQuery, keyConditions);
+
 def createDatabase( dbParams ):
     """Create a database based on the DSN name specified in the dbParams.
     Will likely require logging in first as the user-password specified in the dbParams.
@@ -161,6 +262,8 @@ def dropDatabase( dbParams ):
     """Drop the database specified by the DSN name specified in the dbParams.
     Will likely require logging in first as the user-password specified.
     """
+    if defaultPool is not None:
+        defaultPool.reset();    # Pooled connections to the database would otherwise block dropping it
     if Env.DATABASE_CONNECTOR_NAME == "psycopg2":
     # For PostgreSQL, cannot drop database while connected to it, so connect to default "postgres" database to start.
         defaultParams = dict(dbParams);
@@ -191,12 +294,27 @@ class ConnectionFactory:
     committing and closing, etc.
     """
     
-    def __init__(self, connParam=None):
+    def __init__(self, connParam=None, pool=None):
+        """If a ConnectionPool is specified, borrow connections from there.
+        Otherwise, default connections (no connParam) will come from the default pool, if enabled.
+        """
         self.connParam = connParam;
+        self.pool = pool;
     
     def connection(self):
+        if self.pool is not None:
+            return self.pool.connection();
         return connection( self.connParam );
 
+    @contextmanager
+    def checkout(self):
+        """Context manager for a connection that is closed (or returned to the pool) when done"""
+        conn = self.connection();
+        try:
+            yield conn;
+        finally:
+            conn.close();
+
 
 def execute( query, parameters=None, includeColumnNames=False, incTypeCodes=False, formatter=None, 
             conn=None, connFactory=None, autoCommit=True):
@@ -314,6 +432,85 @@ def execute( query, parameters=None, includeColumnNames=False, incTypeCodes=Fals
     
     return returnValue
 
+def iterExecute( query, parameters=None, includeColumnNames=False, chunkFormat=None, iterSize=ITER_SIZE, withHold=False, conn=None, connFactory=None ):
+    """Generator version of execute for queries producing (large) result sets,
+    yielding the results lazily, so memory use is bounded by the iterSize regardless of the total result size.
+
+    For PostgreSQL, uses a named (server side) cursor, so the database only sends iterSize rows at a time,
+    rather than the client library pulling the entire result set into memory up front.
+    SQLite cursors already step through results lazily, so just fetch iterSize at a time from a regular cursor.
+
+    See CHUNK_FORMATS for the options to yield results one row at a time or in chunks of rows (e.g., numpy or pandas).
+    If includeColumnNames is true and yielding one row at a time, the first row yielded will be the list of column names
+    (chunk formats already carry the column names for numpy and pandas).
+
+    If an external connection is supplied, the caller must not commit while iterating,
+    as that closes server side cursors, unless withHold is set (at the expense of the database
+    materializing the remaining results on commit).  Otherwise, the connection is closed when iteration
+    completes or the generator is closed / garbage collected.
+    """
+    if chunkFormat not in CHUNK_FORMATS:
+        raise ValueError("Unrecognized chunk format: %s" % chunkFormat);
+
+    extConn = conn is not None
+    if conn is None:
+        if connFactory is not None:
+            conn = connFactory.connection()
+        else:
+            conn = connection()
+
+    if isinstance(query, SQLQuery):
+        if parameters is None:
+            parameters = tuple(query.getParams())
+        else:
+            parameters = tuple(parameters)
+        query = str(query)
+    elif parameters is None:
+        parameters = ()
+
+    try:
+        if Env.DATABASE_CONNECTOR_NAME == "psycopg2":
+            cur = conn.cursor("dbutil_iter_%d_%d" % (os.getpid(), next(serverCursorIds)), withhold=withHold);
+            cur.itersize = iterSize;
+        else:
+            cur = conn.cursor();
+        try:
+            timer = time.time();
+            try:
+                cur.execute( query, parameters );
+                rows = cur.fetchmany(iterSize);   # Named cursors do not have a description until the first fetch
+            except Exception as err:
+                log.error(err);
+                if not extConn:
+                    conn.rollback();
+                raise;
+            log.debug("Query Time to First Rows: (%1.3f sec)" % (time.time() - timer) );
+
+            colNames = columnNamesFromCursor(cur);
+            if includeColumnNames and chunkFormat is None:
+                yield colNames;
+            while rows:
+                if chunkFormat is None:
+                    for row in rows:
+                        yield list(row);
+                else:
+                    yield formatRowChunk(rows, colNames, chunkFormat);
+                rows = cur.fetchmany(iterSize);
+        finally:
+            cur.close();
+    finally:
+        if not extConn:
+            conn.close();
+
+def formatRowChunk( rows, colNames, chunkFormat ):
+    """Convert a list of result row tuples into the chunkFormat (see CHUNK_FORMATS)"""
+    if chunkFormat == "numpy":
+        import numpy as np;
+        return np.rec.fromrecords(rows, names=colNames);
+    elif chunkFormat == "pandas":
+        import pandas as pd;
+        return pd.DataFrame.from_records(rows, columns=colNames);
+    return rows;
 
 def columnNamesFromCursor(cursor):
     """Given a cursor that was just used to execute a query, return the list
@@ -386,7 +583,7 @@ def normalizeColName( col ):
         normCol = normCol[1:-1];
     return normCol;
 
-def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None, skipErrors=False, dateColFormats=None, escapeStrings=False, estInput=None, connFactory=None ):
+def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None, skipErrors=False, dateColFormats=None, escapeStrings=False, estInput=None, connFactory=None, bulk=False, chunkSize=BULK_INSERT_SIZE ):
     """Insert the contents of a whitespace-delimited text file into the database.
     
     For PostgreSQL specifically, consider alternative direct COPY command that can run 10x:
@@ -410,6 +607,12 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
     Python date format string to parse them by.  
     If a format string is not provided, a series of standard date format strings will be attempted 
     (but this is inefficient for repeated date text parsing and error handling).
+
+    If bulk is set, rather than one insert query per row, send the parsed rows in chunks of chunkSize
+    via bulkInsertRows (COPY for PostgreSQL, executemany otherwise), committing only at the end.
+    If skipErrors, commit after each chunk instead, and retry any chunk that fails one row at a time
+    to isolate (and skip) the bad rows.  Generated IDs cannot be retrieved from bulk inserts,
+    so if an idFile is requested without an explicit ID column, falls back to one row at a time.
     
     Returns the total number of rows successfully inserted.
     """
@@ -425,6 +628,10 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
         if colName == idCol:
             iIdCol = iCol;
 
+    if bulk and idFile is not None and iIdCol is None:
+        log.warning("Inserting one row at a time rather than in bulk, to retrieve generated %s values" % idCol );
+        bulk = False;
+
     if dateColFormats is not None:
         # Ensure column keys are normalized
         dateCols = list(dateColFormats.keys());
@@ -467,6 +674,19 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
         nCols = len(columnNames)
         params = list();
         progress = ProgressDots(total=estInput);
+        if bulk:
+            chunk = list();
+            for iLine, rowModel in enumerate(reader):
+                chunk.append( [parseValue(rowModel[colName], colName, dateColFormats, escapeStrings) for colName in columnNames] );
+                if len(chunk) >= chunkSize:
+                    nInserts += insertFileChunk(chunk, tableName, columnNames, sql, conn, idFile, iIdCol, skipErrors);
+                    chunk = list();
+                progress.Update();
+            if chunk:
+                nInserts += insertFileChunk(chunk, tableName, columnNames, sql, conn, idFile, iIdCol, skipErrors);
+            conn.commit();
+            return nInserts;
+
         for iLine, rowModel in enumerate(reader):
             # Parse out data values from strings
             for iCol, colName in enumerate(columnNames):
@@ -515,8 +735,46 @@ def insertFile( sourceFile, tableName, columnNames=None, delim=None, idFile=None
 
     return 0    
 
+def insertFileChunk( chunk, tableName, columnNames, sql, conn, idFile=None, iIdCol=None, skipErrors=False ):
+    """Bulk insert a chunk of parsed row value lists for insertFile.  Returns the number of rows inserted.
+    If the bulk insert fails and skipErrors is set, retry the rows one at a time with the single row insert sql,
+    skipping (and reporting) just the ones that fail.
+    """
+    try:
+        bulkInsertRows(tableName, columnNames, chunk, conn=conn, chunkSize=len(chunk));
+        if skipErrors:
+            conn.commit();  # Otherwise a later skipped error would roll back this chunk as well
+        insertedRows = chunk;
+    except Exception as err:
+        conn.rollback();    # Reset any changes since the last commit
+        if not skipErrors:
+            log.info(sql);
+            log.info("Error bulk inserting %d rows, starting with %s" % (len(chunk), chunk[0]) );
+            raise;
+        log.warning("Error bulk inserting %d rows into %s, retrying one row at a time: %s" % (len(chunk), tableName, err) );
+        insertedRows = list();
+        cur = conn.cursor();
+        try:
+            for params in chunk:
+                try:
+                    cur.execute(sql, tuple(params));
+                    conn.commit();
+                    insertedRows.append(params);
+                except Exception as err:
+                    conn.rollback();
+                    log.info(tuple(params));
+                    log.warning("Error Executing in Script: "+ sql );
+                    log.warning(err);
+        finally:
+            cur.close();
+
+    if idFile is not None:
+        for params in insertedRows:
+            print(params[iIdCol], file=idFile);
+    return len(insertedRows);
 
-def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=None, skipErrors=False, connFactory=None  ):
+
+def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=None, skipErrors=False, connFactory=None, bulk=False ):
     """Update the database with the contents of a whitespace-delimited text file.
     
     Updates the contents of the <tableName> with the data from the <sourceFile>.  
@@ -535,7 +793,14 @@ def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=No
     values must not be None / null.  The query looks for rows where columnname = value,
     and the = operator always returns false when the value is null.
 
-    Returns the total number of rows successfully updated.
+    If the same key values appear on more than one line, the last of those lines wins, as when applying each line in order.
+
+    If bulk is set, rather than one update query per line, stream the file contents into a temporary staging table
+    (via bulkInsertRows) and apply all of the updates with a single set-based query (see buildUpdateFromQuery).
+    In that case, any error rolls back the whole update (skipErrors then only reports the error rather than raising it).
+
+    Returns the total number of table rows successfully updated, counting each row once
+    even if repeated key lines updated it more than once.  Lines that match no rows count for nothing.
     """
     if columnNames is None or len(columnNames) < 1:
         headerLine = sourceFile.readline();
@@ -578,8 +843,12 @@ def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=No
 
         log.debug(sql)
 
+        if bulk:
+            return updateFromFileBulk( sourceFile, tableName, columnNames, nIdCols, delim, skipErrors, conn );
+
         # Loop through file and execute update statement for every line
         progress = ProgressDots()
+        nRowsByIdParams = dict();   # Rows updated by the (last) line for each key, so rows updated by repeated keys are only counted once
         for iLine, line in enumerate(sourceFile):
             if not line.startswith(COMMENT_TAG):
                 try:
@@ -599,6 +868,7 @@ def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=No
                     paramTuple = tuple(paramTuple);
                     
                     cur.execute(sql, paramTuple);
+                    nRowsByIdParams[tuple(idParams)] = cur.rowcount;
 
                     # Need to "auto-commit" after each command, 
                     #   otherwise a skipped error will rollback 
@@ -620,13 +890,58 @@ def updateFromFile( sourceFile, tableName, columnNames=None, nIdCols=1, delim=No
 
         conn.commit()
 
-        return progress.GetCounts();
+        return sum(nRowsByIdParams.values());
 
     finally:
         conn.close()
 
     return 0    
 
+def updateFromFileBulk( sourceFile, tableName, columnNames, nIdCols, delim, skipErrors, conn ):
+    """Bulk mode of updateFromFile, via a temporary staging table with the same column types as the target table.
+    The staging table also records the line number of each row, so that only the last line for any repeated key is applied
+    (a set-based update would otherwise apply an arbitrary one of them).
+    """
+    stagingTable = "temp_update_%s" % tableName.replace(".","_");
+    colList = str.join(",", columnNames);
+    keyList = str.join(",", columnNames[:nIdCols]);
+    progress = ProgressDots();
+
+    def iterParams():
+        for iLine, line in enumerate(sourceFile):
+            if not line.startswith(COMMENT_TAG):
+                line = line[:-1];    # Strip the newline character
+                params = line.split(delim);
+                # Special handling for null / None string
+                for iParam in range(len(params)):
+                    if params[iParam] == "" or params[iParam] == NULL_STRING:   # Treat blank strings as NULL
+                        params[iParam] = None;
+                params.append(iLine);
+                progress.Update();
+                yield params;
+
+    lastLineQuery = \
+        "select %s from (select %s, row_number() over (partition by %s order by staging_line desc) as line_rank from %s) as ranked where line_rank = 1" % \
+        (colList, colList, keyList, stagingTable);
+    updateQuery = buildUpdateFromQuery( tableName, columnNames[nIdCols:], lastLineQuery, columnNames[:nIdCols] );
+    try:
+        execute("create temporary table %s as select %s, 0 as staging_line from %s where 1=0" % (stagingTable, colList, tableName), conn=conn, autoCommit=False);
+        bulkInsertRows(stagingTable, columnNames+["staging_line"], iterParams(), conn=conn);
+        log.debug(updateQuery);
+        nRows = execute(updateQuery, conn=conn, autoCommit=False);  # Rows actually updated, not lines staged (e.g., unmatched or repeated IDs)
+        conn.commit();
+    except Exception as err:
+        conn.rollback();    # Reset changes and connection state
+        log.critical(updateQuery);
+        log.warning("Error bulk updating %s after %d lines" % (tableName, progress.GetCounts()) );
+        if not skipErrors:
+            raise;
+        log.warning(err);
+        nRows = 0;
+    finally:
+        execute("drop table if exists %s" % stagingTable, conn=conn);
+    return nRows;
+
 
 def dumpTableToCsv(table_name, file_name, conn_params=None):
     if conn_params is None:
@@ -756,6 +1071,90 @@ def insertRow(tableName, insertDict, conn=None, cursor=None):
         if not extConn:
             conn.close();
 
+def bulkInsertRows(tableName, colNames, rows, conn=None, chunkSize=BULK_INSERT_SIZE):
+    """Insert many records into the named table, given an iterable of row value lists parallel to colNames.
+    For PostgreSQL, streams the rows in chunks through a COPY command.
+    Otherwise (e.g., SQLite), sends the rows in chunked executemany batches of a single insert query.
+    Returns the number of rows inserted.
+    """
+    extConn = ( conn is not None );
+    if not extConn: conn = connection();
+    cursor = conn.cursor();
+    try:
+        if Env.DATABASE_CONNECTOR_NAME == "psycopg2":
+            copyQuery = "COPY %s (%s) FROM STDIN" % (tableName, str.join(",", colNames) );
+            writeChunk = lambda chunk: cursor.copy_expert(copyQuery, StringIO(str.join("", chunk)) );
+            formatRow = copyFormatRow;
+        else:
+            insertQuery = buildInsertQuery(tableName, colNames);
+            writeChunk = lambda chunk: cursor.executemany(insertQuery, chunk);
+            formatRow = tuple;
+
+        nRows = 0;
+        chunk = list();
+        for row in rows:
+            chunk.append(formatRow(row));
+            if len(chunk) >= chunkSize:
+                writeChunk(chunk);
+                nRows += len(chunk);
+                chunk = list();
+        if chunk:
+            writeChunk(chunk);
+            nRows += len(chunk);
+        log.debug("Bulk inserted %d rows into %s" % (nRows, tableName) );
+        return nRows;
+    finally:
+        cursor.close();
+        if not extConn:
+            conn.commit();
+            conn.close();
+
+def copyFormatRow(row):
+    """Format a row of values as a line of PostgreSQL COPY text format (tab delimited, \\N for nulls)"""
+    values = list();
+    for value in row:
+        if value is None:
+            values.append("\\N");
+        else:
+            value = str(value);
+            value = value.replace("\\","\\\\").replace("\t","\\t").replace("\n","\\n").replace("\r","\\r");
+            values.append(value);
+    return str.join("\t", values)+"\n";
+
+def insertRowsReturning(tableName, colNames, rows, returnColNames, ignoreDuplicates=False, conn=None, chunkSize=BULK_INSERT_SIZE):
+    """Insert many records into the named table, given a list of row value lists parallel to colNames,
+    with multi-row "insert ... values (...), (...) returning ..." statements (chunkSize rows per statement).
+    Returns the list of returnColNames values (e.g., the generated ID and key columns) for the inserted rows,
+    so callers can join new IDs back to their records without separate identity queries for each row.
+    If ignoreDuplicates, rows that would violate a unique constraint are skipped ("on conflict do nothing")
+    and so do not appear in the results.
+
+    Returned rows are not guaranteed to be in the same order as the input rows (e.g., for SQLite),
+    so include key columns in returnColNames to match them back up.
+    Requires PostgreSQL (9.5+) or SQLite (3.35+).
+    """
+    extConn = ( conn is not None );
+    if not extConn: conn = connection();
+    cursor = conn.cursor();
+    try:
+        rowPlaceholders = "(%s)" % str.join(",", [Env.SQL_PLACEHOLDER]*len(colNames) );
+        results = list();
+        for iStart in range(0, len(rows), chunkSize):
+            chunk = rows[iStart:iStart+chunkSize];
+            insertQuery = "insert into %s (%s) values %s" % (tableName, str.join(",", colNames), str.join(",", [rowPlaceholders]*len(chunk)) );
+            if ignoreDuplicates:
+                insertQuery += " on conflict do nothing";
+            insertQuery += " returning %s" % str.join(",", returnColNames);
+            cursor.execute( insertQuery, list(itertools.chain.from_iterable(chunk)) );
+            results.extend( cursor.fetchall() );
+        log.debug("Inserted %d of %d rows into %s" % (len(results), len(rows), tableName) );
+        return results;
+    finally:
+        cursor.close();
+        if not extConn:
+            conn.commit();
+            conn.close();
+
 def updateRow(tableName, rowDict, idValue, idCol=None, conn=None):
     """Adapted from Jocelyne's function.  Given a dictionary object (RowItemModel)
     representing a row of a database table, and identified by the key value(s),
@@ -1032,6 +1431,7 @@ def main(argv):
     parser.add_option("-o", "--output",     dest="output",      metavar="<outputFile>", help="If inserting a file with the -i option and want to get generated ID numbers from the inserted rows, specify this file to send them to.")
     parser.add_option("-e", "--skipErrors", dest="skipErrors",  action="store_true",    help="If inserting or updating a file or running a script with the -s option, keep running the remainder of the inserts or script commands even if one causes an exception.")
     parser.add_option("-f", "--dateColFormats", dest="dateColFormats",  metavar="<dateColFormats>",    help="If inserting a file, can specify columns that should be interpreted as date strings to be parsed into datetime objects.  Provide comma-separated list, and optional | separated Python date parsing format (e.g., 'MyDateTime1|%m/%d/%Y %H:%M:%S,MyDateTime2').  http://docs.python.org/library/datetime.html#strftime-strptime-behavior.")
+    parser.add_option("-b", "--bulk",       dest="bulk",        action="store_true",    help="If inserting or updating a file, send the rows to the database in bulk (COPY for PostgreSQL, executemany batches otherwise, and a staging table for updates), rather than one query per row.")
     parser.add_option("-x", "--escapeStrings", dest="escapeStrings",  action="store_true",    help="If inserting a file, can set whether to run all input strings through escape filter to avoid special characters compromising inserts.")
     (options, args) = parser.parse_args(argv[1:])
 
@@ -1066,12 +1466,12 @@ def main(argv):
             lineCountFile = stdOpen(options.input);
             estInput = fileLineCount(lineCountFile);
 
-        nInserts = insertFile( inputFile, options.table, args, options.delim, outputFile, options.skipErrors, dateColFormats=dateColFormats, escapeStrings=options.escapeStrings, estInput=estInput );
+        nInserts = insertFile( inputFile, options.table, args, options.delim, outputFile, options.skipErrors, dateColFormats=dateColFormats, escapeStrings=options.escapeStrings, estInput=estInput, bulk=options.bulk );
         log.info("%d rows successfully inserted",nInserts)
     elif options.update is not None and options.table is not None:
         sourceFile  = stdOpen(options.update,"r",sys.stdin);
         nIdCols = int(options.nIdCols);
-        nUpdates = updateFromFile( sourceFile, options.table, args, nIdCols, options.delim, options.skipErrors );
+        nUpdates = updateFromFile( sourceFile, options.table, args, nIdCols, options.delim, options.skipErrors, bulk=options.bulk );
         log.info("%d row updates completed",nUpdates);
     elif len(args) > 0:
         outFile = "-"   # Default to stdout if no outputFile specified
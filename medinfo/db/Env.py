@@ -66,6 +66,12 @@ TEST_DB_PARAM = LocalEnv.LOCAL_TEST_DB_PARAM
 #TEST_DB_PARAM["DSN"] = "/Users/angelicaperez/Documents/JonChen/sqlite_db/dave_chan2.sqlite"
 
 
+"""Connection pool settings (e.g., {"minSize": 1, "maxSize": 10}) for the default database connections.
+If set, DBUtil.connection() calls without explicit parameters borrow from a shared pool (see DBUtil.enableConnectionPool)
+rather than opening a new connection each time.  None to just open new connections.
+"""
+DB_POOL_PARAM = getattr(LocalEnv, "LOCAL_DB_POOL_PARAM", None);
+
 """Parameters on whether to do additional pre-processing when parsing text / CSV files.
 Seems necessary for STRIDE 2008-2014-2017 Order Proc dumps?
 """
@@ -2,6 +2,7 @@
 """Test case for respective module in medinfo.Common package"""
 
 import sys, os
+import threading;
 from io import StringIO
 import unittest
 
@@ -16,6 +17,7 @@ from medinfo.common.test.Util import MedInfoTestCase;
 
 from medinfo.db import DBUtil
 from medinfo.db.Model import SQLQuery;
+from medinfo.db.ConnectionPool import ConnectionPool, PoolExhaustedError;
 
 # String representations for boolean values
 TRUE_STR = "1";
@@ -172,6 +174,36 @@ class TestDBUtil(DBTestCase):
         sys.stdin = origStdin
 
 
+    def test_iterExecute(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False );
+
+        query = SQLQuery();
+        query.addSelect("MyInteger");
+        query.addSelect("MyText");
+        query.addFrom("TestTypes");
+        query.addOrderBy("MyInteger");
+
+        # Streamed rows should match the fully fetched results, regardless of fetch size
+        expectedResults = DBUtil.execute(query, includeColumnNames=True);
+        for iterSize in (1, 2, 100):
+            actualResults = list(DBUtil.iterExecute(query, includeColumnNames=True, iterSize=iterSize));
+            self.assertEqual( expectedResults, actualResults );
+
+        # Chunked results as numpy record arrays
+        chunks = list(DBUtil.iterExecute(query, chunkFormat="numpy", iterSize=2));
+        self.assertEqual( [2,1], [len(chunk) for chunk in chunks] );
+        self.assertEqual( [123,234,345], [int(value) for chunk in chunks for value in chunk[chunk.dtype.names[0]]] );
+
+        # Abandoning iteration early should still clean up, leaving the connection usable
+        conn = DBUtil.connection();
+        try:
+            rowIter = DBUtil.iterExecute(query, iterSize=1, conn=conn);
+            self.assertEqual( [123,"Sample Text"], next(rowIter) );
+            rowIter.close();
+            self.assertEqual( 3, DBUtil.execute("select count(*) from TestTypes", conn=conn)[0][0] );
+        finally:
+            conn.close();
+
     def test_execute_commandline(self):
         # Run basic executes for both an update and a select query, but
         #   using the higher-level command-line "main" method interface
@@ -230,6 +262,29 @@ class TestDBUtil(DBTestCase):
         results = DBUtil.execute( self.DATA_QUERY );
         self.assertEqual( self.MULTI_LINE_DATA_ROWS, results );
 
+    def test_insertFile_bulk(self):
+        # Same results as inserting one row at a time, but sent in chunks
+        DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
+
+        tableName = "TestTypes"
+
+        nInserts = DBUtil.insertFile( self.MULTI_LINE_DATA_FILE, tableName, None, "\t", bulk=True, chunkSize=2 );
+
+        self.assertEqual( len(self.MULTI_LINE_DATA_ROWS), nInserts );
+        results = DBUtil.execute( self.DATA_QUERY );
+        self.assertEqual( self.MULTI_LINE_DATA_ROWS, results );
+
+        # Bulk chunk with a bad row should be retried one row at a time, only skipping the bad one
+        self.DATA_FILE = StringIO();
+        self.DATA_FILE.write('400\t400.4\tNone\tDTest\n');
+        self.DATA_FILE.write('NotAnInteger\t500.5\tNone\tETest\n');
+        self.DATA_FILE.write('600\t600.6\tNone\tFTest\n');
+        self.DATA_FILE = StringIO(self.DATA_FILE.getvalue());
+        nInserts = DBUtil.insertFile( self.DATA_FILE, tableName, self.COL_NAMES, "\t", skipErrors=True, bulk=True );
+        self.assertEqual( 2, nInserts );
+        results = DBUtil.execute("select MyText from TestTypes where MyInteger >= 400 order by MyInteger");
+        self.assertEqual( [["DTest"],["FTest"]], results );
+
     def test_insertFile_commandline(self):
         # Similar to test_insertFile, but from higher-level command-line interface
         DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
@@ -488,6 +543,19 @@ class TestDBUtil(DBTestCase):
         self.assertEqual("newText",data)
         self.assertEqual(False,isNew)
 
+    def test_insertRowsReturning(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False )
+
+        log.debug("Insert multiple rows in chunks, skipping one that duplicates an existing primary key")
+        rows = [[-1, 400, "DTest"], [1, 500, "ETest"], [-2, 600, "FTest"]];
+        results = DBUtil.insertRowsReturning("TestTypes", ["TestTypes_id","MyInteger","MyText"], rows, ["TestTypes_id","MyInteger"], ignoreDuplicates=True, chunkSize=2);
+        self.assertEqual([[-2,600],[-1,400]], sorted([list(row) for row in results]));
+        self.assertEqual([[123]], DBUtil.execute("select MyInteger from TestTypes where TestTypes_id = 1"));
+
+        log.debug("Without ignoring duplicates, should raise an error")
+        self.assertRaises(Exception, DBUtil.insertRowsReturning, "TestTypes", ["TestTypes_id","MyInteger"], [[-3, 700], [-1, 800]], ["TestTypes_id"]);
+        self.assertEqual([[0]], DBUtil.execute("select count(*) from TestTypes where TestTypes_id = -3"));
+
 
     def test_updateFromFile(self):
         # Create a test data file to insert, and verify no errors
@@ -502,11 +570,56 @@ class TestDBUtil(DBTestCase):
         self.assertNotEqual( self.DATA_ROWS, results );
 
         # Now do the actual update from the file
-        DBUtil.updateFromFile( self.DATA_FILE, self.DATA_TABLE, self.COL_NAMES, delim="\t" );
+        nUpdates = DBUtil.updateFromFile( self.DATA_FILE, self.DATA_TABLE, self.COL_NAMES, delim="\t" );
+        self.assertEqual( 3, nUpdates );    # Data file includes a (redundant) line for the same ID, but that row is only counted once
+
+        results = DBUtil.execute( self.DATA_QUERY );
+        self.assertEqual( self.DATA_ROWS, results );
+
+        # Repeated keys with different values, so the last line wins
+        self.assertUpdateLastLineWins( bulk=False );
+
+    def test_updateFromFile_bulk(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False ) # Assume this works based on test_runDBScript method
+
+        # Insert some blank data first to update
+        for idValue in self.ID_DATA:
+            DBUtil.execute("insert into TestTypes ("+self.ID_COL+") values (%s)",(idValue,));
+
+        # Update through a staging table in one query, rather than one update per line
+        nUpdates = DBUtil.updateFromFile( self.DATA_FILE, self.DATA_TABLE, self.COL_NAMES, delim="\t", bulk=True );
+        self.assertEqual( 3, nUpdates );    # Data file includes a (redundant) line for the same ID, but that row is only updated once
 
         results = DBUtil.execute( self.DATA_QUERY );
         self.assertEqual( self.DATA_ROWS, results );
 
+        # Same handling of repeated keys as the line by line updates
+        self.assertUpdateLastLineWins( bulk=True );
+
+    def assertUpdateLastLineWins(self, bulk):
+        """Update the (already loaded) DATA_ROWS with repeated keys of different values, and check the last line for each key is applied"""
+        dataFile = StringIO();
+        dataFile.write('100\t101.1\tNone\tFirst\n');
+        dataFile.write('300\t303.3\t'+TRUE_STR+'\tOnly\n');
+        dataFile.write('100\t102.2\tNone\tLast\n');
+        dataFile.write('999\t999.9\tNone\tNoMatch\n');
+        dataFile = StringIO(dataFile.getvalue());
+
+        nUpdates = DBUtil.updateFromFile( dataFile, self.DATA_TABLE, self.COL_NAMES, delim="\t", bulk=bulk );
+        self.assertEqual( 2, nUpdates );
+
+        expectedRows = \
+            [   [100, 102.2, None, "Last"],
+                self.DATA_ROWS[1],
+                [300, 303.3, True, "Only"],
+            ];
+        results = DBUtil.execute( self.DATA_QUERY );
+        self.assertEqual( len(expectedRows), len(results) );
+        for expectedRow, resultRow in zip(expectedRows, results):
+            self.assertEqual( expectedRow[0], resultRow[0] );
+            self.assertAlmostEqual( expectedRow[1], resultRow[1], 3 );
+            self.assertEqual( expectedRow[2:], list(resultRow[2:]) );
+
 
     def test_updateFromFile_commandline(self):
         # Similar to test_updateFromFile, but from higher-level command-line interface
@@ -593,6 +706,91 @@ class TestDBUtil(DBTestCase):
         DBUtil.deleteRows("TestTypes", nonDefaultIds, "MyInteger");
         afterCount = DBUtil.execute( query )[0][0];
 
+    def test_connectionPool(self):
+        DBUtil.runDBScript( self.SCRIPT_FILE, False );
+        query = "select count(*) from TestTypes;";
+        initialCount = DBUtil.execute( query )[0][0];
+
+        pool = DBUtil.enableConnectionPool(maxSize=2, timeout=0.1);
+        try:
+            # Default connections now borrowed from the pool and returned when closed, rather than opening new ones
+            conn = DBUtil.connection();
+            rawConn = conn.conn;
+            conn.close();
+            conn = DBUtil.connection();
+            self.assertTrue( conn.conn is rawConn );
+
+            # Anything not committed is rolled back when returned to the pool, same as closing the connection
+            DBUtil.execute("insert into TestTypes (MyText) values ('Uncommitted')", conn=conn, autoCommit=False );
+            conn.close();
+            self.assertEqual( initialCount, DBUtil.execute( query )[0][0] );
+
+            # Pool size limit, with context manager checkout
+            connFactory = DBUtil.ConnectionFactory();
+            with connFactory.checkout() as conn1, connFactory.checkout() as conn2:
+                self.assertFalse( conn1.conn is conn2.conn );
+                self.assertEqual( 2, pool.stats()["checkedOut"] );
+                self.assertRaises( PoolExhaustedError, DBUtil.connection );
+            self.assertEqual( 0, pool.stats()["checkedOut"] );
+
+            # Broken connections caught by health check and replaced
+            pool.healthCheckSeconds = -1;
+            rawConn.close();
+            conn = DBUtil.connection();
+            self.assertFalse( conn.conn is rawConn );
+            DBUtil.pingConnection(conn);
+            conn.close();
+            self.assertEqual( initialCount, DBUtil.execute( query )[0][0] );
+
+            # Connection checked out before a fork is left alone when closed in the child process,
+            #   rather than rolling back the parent's transaction on the shared socket
+            if hasattr(os, "fork"):
+                conn = DBUtil.connection();
+                DBUtil.execute("insert into TestTypes (MyText) values ('Parent')", conn=conn, autoCommit=False );
+                pid = os.fork();
+                if pid == 0:
+                    try:
+                        DBUtil.connection().close();    # Child process starts its own pool
+                        conn.close();
+                    finally:
+                        os._exit(0);
+                os.waitpid(pid, 0);
+                conn.commit();
+                conn.close();
+                self.assertEqual( initialCount+1, DBUtil.execute( query )[0][0] );
+        finally:
+            DBUtil.disableConnectionPool();
+
+    def test_connectionPool_healthCheckUnlocked(self):
+        # A slow health check of one connection does not hold up other threads using the pool
+        healthCheckStarted = threading.Event();
+        finishHealthCheck = threading.Event();
+        class SlowCheckPool(ConnectionPool):
+            def isHealthy(self, conn):
+                healthCheckStarted.set();
+                finishHealthCheck.wait(10);
+                return ConnectionPool.isHealthy(self, conn);
+
+        pool = SlowCheckPool(DBUtil.openConnection, maxSize=2, healthCheckSeconds=-1);
+        try:
+            pool.connection().close();  # One idle connection, to be health checked on the next checkout
+            checkedOut = list();
+            checkThread = threading.Thread(target=lambda: checkedOut.append(pool.connection()));
+            checkThread.start();
+            self.assertTrue( healthCheckStarted.wait(10) );
+
+            # Meanwhile, can still check out a new connection and look at the pool
+            conn = pool.connection();
+            self.assertEqual( 2, pool.stats()["checkedOut"] );
+            finishHealthCheck.set();
+            checkThread.join(10);
+            self.assertEqual( 1, len(checkedOut) );
+            checkedOut[0].close();
+            conn.close();
+            self.assertEqual( 0, pool.stats()["checkedOut"] );
+        finally:
+            finishHealthCheck.set();
+            pool.close();
 
 def suite():
     """Returns the suite of tests to run for this test class / module.
@@ -42,6 +42,13 @@ TRACKING_SCRIPT_TEMPLATE = "";
 # Otherwise turn this off to not waste I/O to stdout if using WSGI or mod_python
 CGI_TEXT_RESPONSE = False;
 
-# Whether to use a local memory data cache to reduce DB hits for web queries.  If left unchecked, this will result
-#   in excessive memory use / leak by the webserver
+# Whether to use a local memory data cache to reduce DB hits for web queries.  Bounded by the memory budget
+#   below (least recently used results evicted first), otherwise would result in excessive memory use / leak by the webserver
 USE_DATA_CACHE = True;
+
+# Memory budget (bytes) for the web data cache
+DATA_CACHE_MAX_BYTES = 2*1024*1024*1024;
+
+# Seconds before a web data cache entry expires and is reloaded from the database,
+#   so web server processes pick up association model updates made by other processes.  None for no expiration
+DATA_CACHE_TTL = 24*60*60;
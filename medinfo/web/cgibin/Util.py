@@ -5,6 +5,8 @@ from . import Env;
 from . import Const
 import sys, os
 import logging
+from medinfo.common.DataCache import DataCache;
+from medinfo.cpoe.DataManager import MODEL_CACHE_KEYS;
 
 log = logging.getLogger("CDSS")
 log.setLevel(Const.LOGGER_LEVEL)
@@ -18,4 +20,4 @@ log.addHandler(handler)
 """Persistent cache object to store query results in local memory for reuse later"""
 webDataCache = None;
 if Env.USE_DATA_CACHE:
-    webDataCache = dict();
+    webDataCache = DataCache(Env.DATA_CACHE_MAX_BYTES, Env.DATA_CACHE_TTL, MODEL_CACHE_KEYS);